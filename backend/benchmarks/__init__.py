@@ -0,0 +1 @@
+"""Benchmarks for the BA AI GOST backend (run against a live or fake Ollama)."""
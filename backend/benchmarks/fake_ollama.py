@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+"""
+Фиктивный сервер Ollama для нагрузочных тестов backend без GPU.
+
+Реализует `/api/generate`, `/api/chat` (в том числе потоковые), `/api/embed`, `/api/tags`, `/api/ps`
+и `/api/show`. Вместо модели — паузы, рассчитанные по настраиваемым скоростям:
+- загрузка модели (`--load-seconds`) при первом запросе, смене `num_ctx` или после выгрузки по `keep_alive`;
+- обработка промпта (`--prompt-eval-rate` токенов/с); общий префикс с предыдущим промптом
+  модели и переданный `context` считаются уже вычисленными, как KV-кэш настоящей Ollama;
+- генерация (`--eval-rate` токенов/с): рассуждения (`thinking` или `<think>` в тексте) и ответ;
+- эмбеддинги (`--embedding-dim`): хэши слов текста, поэтому тексты с общими словами близки по косинусу;
+- параллельные слоты (`--num-parallel`), остальные запросы ждут в очереди;
+- ошибки: доля запросов с ошибкой HTTP (`--error-rate`) и обрывов посреди потока (`--stream-error-rate`).
+
+Метрики в ответах (`load_duration`, `prompt_eval_count`, `eval_duration` …) заполняются
+так же, как у Ollama, поэтому работают кэш, планировщик, резидентность и бюджет контекста.
+Счётчики сервера (в том числе прерванные генерации): `GET /fake/stats`.
+
+Запуск из каталога backend:
+    python -m benchmarks.fake_ollama --port 11435 --eval-rate 40
+    OLLAMA_BASE_URLS=http://localhost:11435 uvicorn src.main:app
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+_NS_IN_S = 1_000_000_000
+_CHARS_PER_TOKEN = 4
+
+_THINKING_WORDS = (
+    "Рассматриваю", "данные", "документа,", "сопоставляю", "позиции", "с", "вопросом", "и", "проверяю", "итог.",
+)
+_EMBED_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_ANSWER_WORDS = (
+    "Фиктивный", "ответ", "сервера", "нагрузочного", "тестирования:", "значения", "взяты", "из", "документа.",
+)
+
+
+def _env_list(name: str, default: str) -> List[str]:
+    return [item.strip() for item in os.getenv(name, default).split(",") if item.strip()]
+
+
+def _normalize(model: str) -> str:
+    model = (model or "").strip()
+    return model if ":" in model else f"{model}:latest"
+
+
+@dataclass
+class FakeOllamaConfig:
+    models: List[str] = field(default_factory=lambda: _env_list("FAKE_OLLAMA_MODELS", "deepseek-r1,llava,bge-m3"))
+    # Модели, которые рассуждают (`think`), — как deepseek-r1
+    thinking_models: List[str] = field(default_factory=lambda: _env_list("FAKE_OLLAMA_THINKING_MODELS", "deepseek-r1"))
+    context_length: int = int(os.getenv("FAKE_OLLAMA_CONTEXT_LENGTH", "131072"))
+    prompt_eval_rate: float = float(os.getenv("FAKE_OLLAMA_PROMPT_EVAL_RATE", "2000"))
+    eval_rate: float = float(os.getenv("FAKE_OLLAMA_EVAL_RATE", "40"))
+    load_seconds: float = float(os.getenv("FAKE_OLLAMA_LOAD_SECONDS", "3"))
+    keep_alive_seconds: float = float(os.getenv("FAKE_OLLAMA_KEEP_ALIVE_SECONDS", "300"))
+    num_parallel: int = int(os.getenv("FAKE_OLLAMA_NUM_PARALLEL", "1"))
+    max_loaded_models: int = int(os.getenv("FAKE_OLLAMA_MAX_LOADED_MODELS", "1"))
+    thinking_tokens: int = int(os.getenv("FAKE_OLLAMA_THINKING_TOKENS", "200"))
+    answer_tokens: int = int(os.getenv("FAKE_OLLAMA_ANSWER_TOKENS", "60"))
+    image_tokens: int = int(os.getenv("FAKE_OLLAMA_IMAGE_TOKENS", "576"))
+    embedding_dim: int = int(os.getenv("FAKE_OLLAMA_EMBEDDING_DIM", "256"))
+    error_rate: float = float(os.getenv("FAKE_OLLAMA_ERROR_RATE", "0"))
+    error_status: int = int(os.getenv("FAKE_OLLAMA_ERROR_STATUS", "500"))
+    stream_error_rate: float = float(os.getenv("FAKE_OLLAMA_STREAM_ERROR_RATE", "0"))
+    model_size_bytes: int = int(os.getenv("FAKE_OLLAMA_MODEL_SIZE_BYTES", str(5 * 1024 ** 3)))
+
+
+@dataclass
+class _LoadedModel:
+    num_ctx: int
+    expires_at: float
+    last_prompt: str = ""
+
+
+@dataclass
+class FakeOllamaStats:
+    requests: int = 0
+    completed: int = 0
+    cancelled: int = 0
+    injected_errors: int = 0
+    loads: int = 0
+    queued_now: int = 0
+    running_now: int = 0
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    generated_tokens: int = 0
+    embedded_inputs: int = 0
+
+
+def _count_tokens(text: str) -> int:
+    return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN if text else 0
+
+
+def _common_prefix_length(left: str, right: str) -> int:
+    limit = min(len(left), len(right))
+    index = 0
+    while index < limit and left[index] == right[index]:
+        index += 1
+    return index
+
+
+def _parse_keep_alive(value, default: float) -> float:
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    for suffix in ("ms", "s", "m", "h"):
+        if text.endswith(suffix):
+            return float(text[:-len(suffix)]) * units[suffix]
+    return float(text)
+
+
+def _timestamp(moment: Optional[float] = None) -> str:
+    return datetime.fromtimestamp(moment or time.time(), tz=timezone.utc).isoformat()
+
+
+class _RequestError(Exception):
+    def __init__(self, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class FakeOllama:
+    """Состояние сервера: загруженные модели, очередь слотов и счётчики."""
+
+    def __init__(self, config: FakeOllamaConfig) -> None:
+        self.config = config
+        self.stats = FakeOllamaStats()
+        self._loaded: Dict[str, _LoadedModel] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._load_lock: Optional[asyncio.Lock] = None
+
+    def _known(self, model: str) -> bool:
+        return _normalize(model) in {_normalize(name) for name in self.config.models}
+
+    def _thinks(self, model: str) -> bool:
+        return _normalize(model) in {_normalize(name) for name in self.config.thinking_models}
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for name in [name for name, loaded in self._loaded.items() if loaded.expires_at <= now]:
+            del self._loaded[name]
+
+    async def _ensure_loaded(self, model: str, num_ctx: int, keep_alive: float) -> float:
+        """Загружает модель при необходимости; возвращает время загрузки в секундах."""
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            self._expire()
+            name = _normalize(model)
+            loaded = self._loaded.get(name)
+            load_seconds = 0.0
+            if loaded is None or loaded.num_ctx != num_ctx:
+                # Как и настоящая Ollama, другой num_ctx требует перезагрузки модели
+                while len(self._loaded) >= self.config.max_loaded_models and name not in self._loaded:
+                    oldest = min(self._loaded, key=lambda key: self._loaded[key].expires_at)
+                    del self._loaded[oldest]
+                await asyncio.sleep(self.config.load_seconds)
+                load_seconds = self.config.load_seconds
+                self.stats.loads += 1
+                loaded = self._loaded[name] = _LoadedModel(num_ctx=num_ctx, expires_at=0.0)
+            loaded.expires_at = time.monotonic() + keep_alive
+            if keep_alive <= 0:
+                del self._loaded[name]
+            return load_seconds
+
+    def _prompt_eval_tokens(self, model: str, prompt: str, context_tokens: int, images: int) -> tuple:
+        """(всего токенов промпта, из них вычисленных заново) с учётом общего префикса."""
+        loaded = self._loaded.get(_normalize(model))
+        cached_chars = _common_prefix_length(loaded.last_prompt, prompt) if loaded else 0
+        if loaded is not None:
+            loaded.last_prompt = prompt
+        total = context_tokens + _count_tokens(prompt) + images * self.config.image_tokens
+        evaluated = total - context_tokens - _count_tokens(prompt[:cached_chars])
+        return total, max(1, evaluated)
+
+    def _plan_tokens(self, model: str, think, num_predict: Optional[int]) -> tuple:
+        """Токены ответа в порядке генерации: список пар (вид, текст) и `done_reason`."""
+        if think and not self._thinks(model):
+            raise _RequestError(400, f'"{model}" does not support thinking')
+        tokens: List[tuple] = []
+        if self._thinks(model) and think is not False:
+            # think: true — отдельное поле `thinking`; без параметра — теги `<think>` в тексте ответа
+            kind = "thinking" if think else "response"
+            thinking = [_THINKING_WORDS[i % len(_THINKING_WORDS)] + " " for i in range(self.config.thinking_tokens)]
+            if kind == "response":
+                thinking = ["<think>\n", *thinking, "\n</think>\n\n"]
+            tokens.extend((kind, text) for text in thinking)
+        tokens.extend(
+            ("response", _ANSWER_WORDS[i % len(_ANSWER_WORDS)] + ("" if i == self.config.answer_tokens - 1 else " "))
+            for i in range(self.config.answer_tokens)
+        )
+        if num_predict is not None and 0 < num_predict < len(tokens):
+            return tokens[:num_predict], "length"
+        return tokens, "stop"
+
+    async def run(self, endpoint: str, payload: dict) -> AsyncIterator[dict]:
+        """Генерирует чанки ответа; последний — с `done: true` и метриками."""
+        self.stats.requests += 1
+        model = payload.get("model") or ""
+        if not self._known(model):
+            raise _RequestError(404, f"model '{model}' not found, try pulling it first")
+        if random.random() < self.config.error_rate:
+            self.stats.injected_errors += 1
+            raise _RequestError(self.config.error_status, "injected failure")
+
+        options = payload.get("options") or {}
+        tokens, done_reason = self._plan_tokens(model, payload.get("think"), options.get("num_predict"))
+        num_ctx = int(options.get("num_ctx") or 2048)
+        keep_alive = _parse_keep_alive(payload.get("keep_alive"), self.config.keep_alive_seconds)
+        if endpoint == "/api/chat":
+            messages = payload.get("messages") or []
+            prompt = "\n".join(str(message.get("content") or "") for message in messages)
+            images = sum(len(message.get("images") or []) for message in messages)
+        else:
+            prompt = str(payload.get("prompt") or "")
+            images = len(payload.get("images") or [])
+        context = payload.get("context") or []
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(1, self.config.num_parallel))
+        started = time.monotonic()
+        self.stats.queued_now += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.stats.queued_now -= 1
+        self.stats.running_now += 1
+        done = False
+        try:
+            load_seconds = await self._ensure_loaded(model, num_ctx, keep_alive)
+            if not prompt and not images:
+                # Пустой запрос — только загрузка модели (предзагрузка backend)
+                done = True
+                yield self._final_chunk(endpoint, model, "load", started, load_seconds, 0, 0, 0, 0.0, 0.0, context)
+                return
+
+            prompt_tokens, evaluated = self._prompt_eval_tokens(model, prompt, len(context), images)
+            if prompt_tokens > num_ctx:
+                # Ollama молча обрезает промпт по окну; имитируем так же
+                evaluated = min(evaluated, num_ctx)
+            prompt_seconds = evaluated / self.config.prompt_eval_rate
+            await asyncio.sleep(prompt_seconds)
+            self.stats.prompt_tokens += prompt_tokens
+            self.stats.cached_prompt_tokens += prompt_tokens - evaluated
+
+            eval_started = time.monotonic()
+            for index, (kind, text) in enumerate(tokens):
+                await asyncio.sleep(1 / self.config.eval_rate)
+                self.stats.generated_tokens += 1
+                if index and random.random() < self.config.stream_error_rate / max(1, len(tokens)):
+                    self.stats.injected_errors += 1
+                    yield {"error": "injected stream failure"}
+                    done = True
+                    return
+                yield self._token_chunk(endpoint, model, kind, text)
+            done = True
+            yield self._final_chunk(
+                endpoint, model, done_reason, started, load_seconds, prompt_tokens, evaluated,
+                len(tokens), prompt_seconds, time.monotonic() - eval_started, context,
+            )
+        finally:
+            self.stats.running_now -= 1
+            self._slots.release()
+            if done:
+                self.stats.completed += 1
+            else:
+                # Клиент закрыл соединение: генерация прервана, слот освобождён
+                self.stats.cancelled += 1
+
+    def _embedding(self, text: str) -> List[float]:
+        # Мешок слов, разложенный хэшем по измерениям, — детерминированно и без модели
+        vector = [0.0] * max(1, self.config.embedding_dim)
+        for word in _EMBED_WORD_RE.findall(text.lower()):
+            vector[zlib.crc32(word[:6].encode("utf-8")) % len(vector)] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [round(value / norm, 6) for value in vector]
+
+    async def embed(self, payload: dict) -> dict:
+        """Ответ `/api/embed`: по вектору на каждый вход; время — как обработка промпта той же длины."""
+        self.stats.requests += 1
+        model = payload.get("model") or ""
+        if not self._known(model):
+            raise _RequestError(404, f"model '{model}' not found, try pulling it first")
+        if random.random() < self.config.error_rate:
+            self.stats.injected_errors += 1
+            raise _RequestError(self.config.error_status, "injected failure")
+        inputs = payload.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        options = payload.get("options") or {}
+        keep_alive = _parse_keep_alive(payload.get("keep_alive"), self.config.keep_alive_seconds)
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(1, self.config.num_parallel))
+        started = time.monotonic()
+        async with self._slots:
+            load_seconds = await self._ensure_loaded(model, int(options.get("num_ctx") or 2048), keep_alive)
+            prompt_tokens = sum(_count_tokens(str(text)) for text in inputs)
+            await asyncio.sleep(prompt_tokens / self.config.prompt_eval_rate)
+        self.stats.completed += 1
+        self.stats.embedded_inputs += len(inputs)
+        self.stats.prompt_tokens += prompt_tokens
+        return {
+            "model": model,
+            "embeddings": [self._embedding(str(text)) for text in inputs],
+            "total_duration": int((time.monotonic() - started) * _NS_IN_S),
+            "load_duration": int(load_seconds * _NS_IN_S),
+            "prompt_eval_count": prompt_tokens,
+        }
+
+    @staticmethod
+    def _token_chunk(endpoint: str, model: str, kind: str, text: str) -> dict:
+        field_name = "thinking" if kind == "thinking" else "content"
+        if endpoint == "/api/chat":
+            return {"model": model, "created_at": _timestamp(), "message": {"role": "assistant", field_name: text},
+                    "done": False}
+        if kind == "thinking":
+            return {"model": model, "created_at": _timestamp(), "response": "", "thinking": text, "done": False}
+        return {"model": model, "created_at": _timestamp(), "response": text, "done": False}
+
+    @staticmethod
+    def _final_chunk(
+        endpoint: str,
+        model: str,
+        done_reason: str,
+        started: float,
+        load_seconds: float,
+        prompt_tokens: int,
+        evaluated: int,
+        eval_count: int,
+        prompt_seconds: float,
+        eval_seconds: float,
+        context: list,
+    ) -> dict:
+        chunk = {
+            "model": model,
+            "created_at": _timestamp(),
+            "done": True,
+            "done_reason": done_reason,
+            "total_duration": int((time.monotonic() - started) * _NS_IN_S),
+            "load_duration": int(load_seconds * _NS_IN_S),
+            "prompt_eval_count": evaluated if prompt_tokens else 0,
+            "prompt_eval_duration": int(prompt_seconds * _NS_IN_S),
+            "eval_count": eval_count,
+            "eval_duration": int(eval_seconds * _NS_IN_S),
+        }
+        if endpoint == "/api/chat":
+            chunk["message"] = {"role": "assistant", "content": ""}
+        else:
+            chunk["response"] = ""
+            # Токены контекста — только их количество имеет значение для backend
+            chunk["context"] = list(range(prompt_tokens + eval_count)) if prompt_tokens else []
+        return chunk
+
+    def tags(self) -> dict:
+        return {
+            "models": [
+                {
+                    "name": _normalize(name),
+                    "model": _normalize(name),
+                    "modified_at": _timestamp(),
+                    "size": self.config.model_size_bytes,
+                    "details": {"family": "fake", "parameter_size": "7B", "quantization_level": "Q4_K_M"},
+                }
+                for name in self.config.models
+            ]
+        }
+
+    def ps(self) -> dict:
+        self._expire()
+        now_monotonic, now = time.monotonic(), time.time()
+        return {
+            "models": [
+                {
+                    "name": name,
+                    "model": name,
+                    "size": self.config.model_size_bytes,
+                    "size_vram": self.config.model_size_bytes,
+                    "context_length": loaded.num_ctx,
+                    "expires_at": (
+                        datetime.fromtimestamp(now, tz=timezone.utc)
+                        + timedelta(seconds=loaded.expires_at - now_monotonic)
+                    ).isoformat(),
+                }
+                for name, loaded in self._loaded.items()
+            ]
+        }
+
+    def show(self, model: str) -> dict:
+        if not self._known(model):
+            raise _RequestError(404, f"model '{model}' not found")
+        capabilities = ["completion"] + (["thinking"] if self._thinks(model) else [])
+        return {
+            "details": {"family": "fake", "parameter_size": "7B", "quantization_level": "Q4_K_M"},
+            "capabilities": capabilities,
+            "model_info": {
+                "general.architecture": "fake",
+                "fake.context_length": self.config.context_length,
+            },
+        }
+
+
+def _error_response(exc: _RequestError) -> JSONResponse:
+    return JSONResponse({"error": exc.message}, status_code=exc.status_code)
+
+
+def create_app(config: Optional[FakeOllamaConfig] = None) -> FastAPI:
+    fake = FakeOllama(config or FakeOllamaConfig())
+    app = FastAPI(title="Fake Ollama")
+    app.state.fake = fake
+
+    async def _generate(endpoint: str, request: Request):
+        payload = await request.json()
+        chunks = fake.run(endpoint, payload)
+        try:
+            first = await chunks.__anext__()
+        except _RequestError as exc:
+            return _error_response(exc)
+
+        if payload.get("stream", True):
+            async def body() -> AsyncIterator[bytes]:
+                try:
+                    yield (json.dumps(first, ensure_ascii=False) + "\n").encode("utf-8")
+                    async for chunk in chunks:
+                        yield (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+                finally:
+                    await chunks.aclose()
+
+            return StreamingResponse(body(), media_type="application/x-ndjson")
+
+        # Без потока — собираем ответ целиком, как это делает Ollama
+        parts: Dict[str, List[str]] = {"response": [], "thinking": []}
+        chunk = first
+        try:
+            while True:
+                if chunk.get("error"):
+                    return JSONResponse({"error": chunk["error"]}, status_code=500)
+                if chunk.get("done"):
+                    break
+                if await request.is_disconnected():
+                    # Ollama прекращает генерацию, когда клиент закрывает соединение
+                    return JSONResponse({"error": "client disconnected"}, status_code=499)
+                message = chunk.get("message") or {}
+                parts["response"].append(chunk.get("response") or message.get("content") or "")
+                parts["thinking"].append(chunk.get("thinking") or message.get("thinking") or "")
+                chunk = await chunks.__anext__()
+        finally:
+            await chunks.aclose()
+        result = dict(chunk)
+        thinking = "".join(parts["thinking"])
+        if endpoint == "/api/chat":
+            result["message"] = {"role": "assistant", "content": "".join(parts["response"])}
+            if thinking:
+                result["message"]["thinking"] = thinking
+        else:
+            result["response"] = "".join(parts["response"])
+            if thinking:
+                result["thinking"] = thinking
+        return JSONResponse(result)
+
+    @app.get("/")
+    async def root():
+        return PlainTextResponse("Ollama is running")
+
+    @app.get("/api/version")
+    async def version():
+        return {"version": "0.0.0-fake"}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        return await _generate("/api/generate", request)
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        return await _generate("/api/chat", request)
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        try:
+            return await fake.embed(await request.json())
+        except _RequestError as exc:
+            return _error_response(exc)
+
+    @app.get("/api/tags")
+    async def tags():
+        return fake.tags()
+
+    @app.get("/api/ps")
+    async def ps():
+        return fake.ps()
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        payload = await request.json()
+        try:
+            return fake.show(payload.get("model") or payload.get("name") or "")
+        except _RequestError as exc:
+            return _error_response(exc)
+
+    @app.get("/fake/stats")
+    async def stats():
+        return {"config": asdict(fake.config), "stats": asdict(fake.stats), "loaded": sorted(fake._loaded)}
+
+    return app
+
+
+def main() -> None:
+    defaults = FakeOllamaConfig()
+    parser = argparse.ArgumentParser(description="Фиктивный сервер Ollama для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", default=",".join(defaults.models), help="Модели через запятую")
+    parser.add_argument("--thinking-models", default=",".join(defaults.thinking_models))
+    parser.add_argument("--context-length", type=int, default=defaults.context_length)
+    parser.add_argument("--prompt-eval-rate", type=float, default=defaults.prompt_eval_rate, help="Токенов/с")
+    parser.add_argument("--eval-rate", type=float, default=defaults.eval_rate, help="Токенов/с")
+    parser.add_argument("--load-seconds", type=float, default=defaults.load_seconds)
+    parser.add_argument("--keep-alive-seconds", type=float, default=defaults.keep_alive_seconds)
+    parser.add_argument("--num-parallel", type=int, default=defaults.num_parallel)
+    parser.add_argument("--max-loaded-models", type=int, default=defaults.max_loaded_models)
+    parser.add_argument("--thinking-tokens", type=int, default=defaults.thinking_tokens)
+    parser.add_argument("--answer-tokens", type=int, default=defaults.answer_tokens)
+    parser.add_argument("--embedding-dim", type=int, default=defaults.embedding_dim)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Доля запросов с ошибкой")
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--stream-error-rate", type=float, default=defaults.stream_error_rate,
+                        help="Доля потоков, обрываемых ошибкой")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    config = FakeOllamaConfig(
+        models=[item.strip() for item in args.models.split(",") if item.strip()],
+        thinking_models=[item.strip() for item in args.thinking_models.split(",") if item.strip()],
+        context_length=args.context_length,
+        prompt_eval_rate=args.prompt_eval_rate,
+        eval_rate=args.eval_rate,
+        load_seconds=args.load_seconds,
+        keep_alive_seconds=args.keep_alive_seconds,
+        num_parallel=args.num_parallel,
+        max_loaded_models=args.max_loaded_models,
+        thinking_tokens=args.thinking_tokens,
+        answer_tokens=args.answer_tokens,
+        embedding_dim=args.embedding_dim,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stream_error_rate=args.stream_error_rate,
+    )
+
+    import uvicorn
+
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
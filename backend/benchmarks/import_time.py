@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Время холодного импорта backend: старт процесса uvicorn, воркера очереди и рабочего процесса
+пула конвертеров (тот же набор модулей, что CONVERTER_PROCESS_PRELOAD), а также каждого
+обработчика файлов по отдельности — столько стоит первая загрузка файла этого типа.
+
+Каждая цель импортируется в новом интерпретаторе `python -X importtime` `--repeat` раз;
+в отчёте медиана, минимум и максимум времени импорта и самые медленные модули
+(собственное время без вложенных импортов). Неустановленная зависимость отмечается
+в отчёте ошибкой и не прерывает замер остальных целей.
+С `--output` отчёт сохраняется в JSON для сравнения релизов.
+
+Запуск из каталога backend:
+    python -m benchmarks.import_time --repeat 5 --output import-time.json
+    python -m benchmarks.import_time --target app --target handler:.xlsx
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+
+HANDLER_MODULES = {
+    ".arp": "src.services.file_handlers.arp_upload_service",
+    ".dxf": "src.services.file_handlers.dxf_console_service",
+    ".gsfx": "src.services.file_handlers.gsfx_upload_service",
+    ".pdf": "src.services.file_handlers.pdf_upload_service",
+    ".rtf": "src.services.file_handlers.rtf_upload_service",
+    ".xlsx": "src.services.file_handlers.xlsx_upload_service",
+}
+
+# Прогрев обработчиков отключён: цель app меряет именно то, что импортируется до готовности приложения
+TARGETS: Dict[str, List[str]] = {
+    "app": ["src.main"],
+    "worker": ["src.worker"],
+    "converter": [
+        "pandas", "openpyxl", "ezdxf", "xmltodict",
+        *(HANDLER_MODULES[suffix] for suffix in (".arp", ".dxf", ".gsfx", ".rtf", ".xlsx")),
+    ],
+    **{f"handler:{suffix}": [module] for suffix, module in HANDLER_MODULES.items()},
+}
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S.*)$")
+
+
+def parse_importtime(stderr: str) -> Tuple[int, List[Tuple[str, int]]]:
+    """Суммарное время импорта (мкс) и собственное время каждого модуля из вывода `-X importtime`."""
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), match[3], match[4].strip()
+        modules.append((name, self_us))
+        # Модули верхнего уровня (с одним пробелом отступа) — без двойного счёта вложенных
+        if len(indent) <= 1:
+            total += cumulative_us
+    return total, modules
+
+
+def measure(modules: List[str]) -> dict:
+    code = "".join(f"import {module}\n" for module in modules)
+    env = {**os.environ, "HANDLER_PREWARM": "0"}
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    total_us, modules_us = parse_importtime(completed.stderr)
+    result = {"seconds": total_us / 1e6, "modules": modules_us}
+    if completed.returncode != 0:
+        lines = [line for line in completed.stderr.splitlines() if not line.startswith("import time:")]
+        result["error"] = lines[-1] if lines else f"exit code {completed.returncode}"
+    return result
+
+
+def run_target(name: str, modules: List[str], repeat: int, top: int) -> dict:
+    # Первый запуск не учитывается: он компилирует .pyc и прогревает файловый кэш
+    measure(modules)
+    runs = [measure(modules) for _ in range(repeat)]
+    seconds = [run["seconds"] for run in runs]
+    slowest: Dict[str, List[int]] = {}
+    for run in runs:
+        for module, self_us in run["modules"]:
+            slowest.setdefault(module, []).append(self_us)
+    ranked = sorted(
+        ((module, statistics.median(values)) for module, values in slowest.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )[:top]
+    report = {
+        "target": name,
+        "modules": modules,
+        "median_seconds": round(statistics.median(seconds), 4),
+        "min_seconds": round(min(seconds), 4),
+        "max_seconds": round(max(seconds), 4),
+        "modules_imported": len(runs[-1]["modules"]),
+        "slowest_modules": [{"module": module, "self_ms": round(us / 1000, 2)} for module, us in ranked],
+    }
+    error = runs[-1].get("error")
+    if error:
+        report["error"] = error
+    return report
+
+
+def print_report(reports: List[dict]) -> None:
+    width = max(len(report["target"]) for report in reports)
+    print(f"{'target':<{width}}  {'median':>8}  {'min':>8}  {'max':>8}  modules")
+    for report in reports:
+        print(
+            f"{report['target']:<{width}}  {report['median_seconds']:>7.3f}s  {report['min_seconds']:>7.3f}s  "
+            f"{report['max_seconds']:>7.3f}s  {report['modules_imported']}"
+            + (f"  ERROR: {report['error']}" if "error" in report else "")
+        )
+    for report in reports:
+        if report["slowest_modules"]:
+            print(f"\n{report['target']}: slowest modules (self time)")
+            for item in report["slowest_modules"]:
+                print(f"  {item['self_ms']:>9.2f} ms  {item['module']}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--target",
+        action="append",
+        choices=sorted(TARGETS),
+        help="Что импортировать (можно несколько раз); по умолчанию — все цели",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Замеров на цель")
+    parser.add_argument("--top", type=int, default=10, help="Сколько самых медленных модулей показать")
+    parser.add_argument("--output", type=Path, help="Сохранить отчёт в JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    names = args.target or list(TARGETS)
+    reports = [run_target(name, TARGETS[name], max(1, args.repeat), args.top) for name in names]
+    print_report(reports)
+    if args.output:
+        document = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "repeat": args.repeat,
+            "targets": reports,
+        }
+        args.output.write_text(json.dumps(document, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nReport written to {args.output}")
+    return 0 if all("error" not in report for report in reports) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Генератор нагрузки на `/json-query` и `/vision-query` с отчётом о задержках.
+
+Источник запросов:
+- `--replay traffic.jsonl` — записанный трафик, по объекту на строку:
+  `{"endpoint": "/json-query", "file": "4.arp", "question": "...", "response_language": "ru",
+  "fields": {"priority": "batch"}, "at": 12.5}`. Поле `at` — смещение от начала записи в секундах;
+  вместо `file` можно указать `kind` одного из встроенных образцов. Строки без файла пропускаются;
+- `--mix arp=3,xlsx=2,dxf=1,pdf=1,image=1` — синтетическая смесь по образцам из
+  `documentation/06-assets` (DXF генерируется на лету).
+
+Режим нагрузки:
+- `--concurrency N` — замкнутый цикл: N клиентов шлют запросы друг за другом;
+- `--rate R` — открытый цикл: запросы приходят пуассоновским потоком R запросов/с
+  независимо от того, успевает ли backend;
+- для `--replay` без `--rate` сохраняются интервалы записи (`at`), ускоренные в `--speed` раз.
+
+Отчёт: p50/p95/p99 задержки, время до первого байта и первого токена (`--stream`),
+пропускная способность, доля ошибок по кодам и по видам файлов, а также этапы Ollama
+(загрузка, обработка промпта, генерация) из событий `done` и заголовка `Server-Timing`.
+С `--output` отчёт сохраняется в JSON для сравнения релизов.
+
+Запуск из каталога backend:
+    python -m benchmarks.loadgen --mix arp=1,xlsx=1 --requests 50 --concurrency 4 --output report.json
+    python -m benchmarks.loadgen --replay traffic.jsonl --rate 2 --stream
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import random
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+_REPO_ROOT = Path(__file__).resolve().parents[2]
+DEFAULT_SAMPLES_DIR = _REPO_ROOT / "documentation" / "06-assets"
+
+# Минимальный DXF R12: в репозитории есть только DWG, который backend не принимает
+_SAMPLE_DXF = "\n".join([
+    "0", "SECTION", "2", "ENTITIES",
+    *[
+        line
+        for index in range(20)
+        for line in (
+            "0", "LINE", "8", f"СТЕНЫ-{index % 3}",
+            "10", f"{index * 1000.0:.1f}", "20", "0.0", "30", "0.0",
+            "11", f"{index * 1000.0 + 850.5:.1f}", "21", "3000.0", "31", "0.0",
+        )
+    ],
+    "0", "ENDSEC", "0", "EOF", "",
+])
+
+
+@dataclass(frozen=True)
+class Sample:
+    kind: str
+    endpoint: str
+    filename: str
+    path: Optional[str] = None
+    content: Optional[bytes] = None
+    question: str = "Кратко перечисли основные позиции документа."
+
+    def read(self) -> bytes:
+        return self.content if self.content is not None else Path(self.path).read_bytes()
+
+
+def builtin_samples(samples_dir: Path) -> Dict[str, Sample]:
+    inputs = samples_dir / "input-documents" / "prototype-input-documents"
+    return {
+        "arp": Sample("arp", "/json-query", "4.arp", str(inputs / "4.arp"),
+                      question="Какова итоговая сметная стоимость?"),
+        "xlsx": Sample("xlsx", "/json-query", "8.xlsx", str(inputs / "8.xlsx"),
+                       question="Сколько позиций в спецификации?"),
+        "gsfx": Sample("gsfx", "/json-query", "5.gsfx", str(inputs / "5.gsfx")),
+        "pdf": Sample("pdf", "/json-query", "1.pdf", str(inputs / "1..pdf")),
+        "dxf": Sample("dxf", "/json-query", "sample.dxf", content=_SAMPLE_DXF.encode("utf-8"),
+                      question="Сколько линий на слое СТЕНЫ-0?"),
+        "image": Sample("image", "/vision-query", "sheet.jpg",
+                        str(samples_dir / "images" / "приложение-лист-1.jpg"),
+                        question="Что изображено на листе?"),
+    }
+
+
+@dataclass
+class PlannedRequest:
+    kind: str
+    endpoint: str
+    filename: str
+    data: bytes
+    question: str
+    fields: Dict[str, str] = field(default_factory=dict)
+    at: Optional[float] = None
+
+
+@dataclass
+class RequestResult:
+    kind: str
+    endpoint: str
+    status: int
+    ok: bool
+    latency_ms: float
+    ttfb_ms: Optional[float] = None
+    first_token_ms: Optional[float] = None
+    cached: Optional[bool] = None
+    error: Optional[str] = None
+    stages_ms: Dict[str, float] = field(default_factory=dict)
+
+
+def _load_replay(path: Path, samples: Dict[str, Sample], base_dir: Path) -> List[PlannedRequest]:
+    planned: List[PlannedRequest] = []
+    skipped = 0
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        sample = samples.get(record.get("kind") or "")
+        file_path = record.get("file")
+        if file_path:
+            resolved = Path(file_path) if Path(file_path).is_absolute() else base_dir / file_path
+            data, filename = resolved.read_bytes(), resolved.name
+        elif sample is not None:
+            data, filename = sample.read(), sample.filename
+        else:
+            skipped += 1
+            continue
+        endpoint = record.get("endpoint") or (sample.endpoint if sample else "/json-query")
+        planned.append(PlannedRequest(
+            kind=record.get("kind") or Path(filename).suffix.lstrip(".").lower() or "file",
+            endpoint=endpoint,
+            filename=filename,
+            data=data,
+            question=record.get("question") or (sample.question if sample else Sample.question),
+            fields={
+                "response_language": record.get("response_language", "ru"),
+                **{key: str(value) for key, value in (record.get("fields") or {}).items()},
+            },
+            at=record.get("at"),
+        ))
+    if skipped:
+        print(f"{path}: пропущено строк без файла: {skipped}", file=sys.stderr)
+    return planned
+
+
+def _synthetic_plan(mix: Dict[str, int], samples: Dict[str, Sample], total: int, seed: int) -> List[PlannedRequest]:
+    unknown = set(mix) - set(samples)
+    if unknown:
+        raise SystemExit(f"Неизвестные виды файлов в --mix: {', '.join(sorted(unknown))}")
+    rng = random.Random(seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=total)
+    contents = {kind: samples[kind].read() for kind in mix}
+    return [
+        PlannedRequest(
+            kind=kind,
+            endpoint=samples[kind].endpoint,
+            filename=samples[kind].filename,
+            data=contents[kind],
+            question=samples[kind].question,
+            fields={"response_language": "ru"},
+        )
+        for kind in kinds
+    ]
+
+
+def _parse_mix(value: str) -> Dict[str, int]:
+    mix: Dict[str, int] = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        kind, _, weight = item.partition("=")
+        mix[kind.strip().lower()] = int(weight or 1)
+    return mix
+
+
+def _parse_server_timing(header: str) -> Dict[str, float]:
+    stages: Dict[str, float] = {}
+    for metric in header.split(","):
+        name, *params = [part.strip() for part in metric.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur" and name:
+                try:
+                    stages[f"server.{name}"] = float(value)
+                except ValueError:
+                    pass
+    return stages
+
+
+def _model_stages(timings: Optional[dict]) -> Dict[str, float]:
+    if not isinstance(timings, dict):
+        return {}
+    return {
+        f"ollama.{key[:-3]}": float(value)
+        for key, value in timings.items()
+        if key.endswith("_ms") and isinstance(value, (int, float))
+    }
+
+
+async def _send(
+    client: httpx.AsyncClient,
+    base_url: str,
+    planned: PlannedRequest,
+    *,
+    stream: bool,
+) -> RequestResult:
+    file_field = "image_file" if planned.endpoint == "/vision-query" else "json_file"
+    content_type = mimetypes.guess_type(planned.filename)[0] or "application/octet-stream"
+    form = {"question": planned.question, **planned.fields}
+    if stream:
+        form.update({"stream": "true", "stream_format": "ndjson"})
+
+    started = time.perf_counter()
+    result = RequestResult(kind=planned.kind, endpoint=planned.endpoint, status=0, ok=False, latency_ms=0.0)
+    try:
+        async with client.stream(
+            "POST",
+            f"{base_url}{planned.endpoint}",
+            data=form,
+            files={file_field: (planned.filename, planned.data, content_type)},
+        ) as response:
+            result.status = response.status_code
+            result.ttfb_ms = (time.perf_counter() - started) * 1000
+            result.stages_ms.update(_parse_server_timing(response.headers.get("server-timing", "")))
+
+            if stream and response.status_code < 400:
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event.get("type") == "token" and result.first_token_ms is None:
+                        result.first_token_ms = (time.perf_counter() - started) * 1000
+                    elif event.get("type") == "done":
+                        result.cached = event.get("cached")
+                        result.stages_ms.update(_model_stages(event.get("timings")))
+                    elif event.get("type") == "error":
+                        result.status = event.get("status_code") or 500
+                        result.error = str(event.get("detail"))
+            else:
+                body = await response.aread()
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    payload = {}
+                if response.status_code >= 400:
+                    result.error = str(payload.get("detail") or body[:200])
+                else:
+                    result.cached = payload.get("cached")
+                    result.stages_ms.update(_model_stages(payload.get("timings")))
+    except httpx.HTTPError as exc:
+        result.error = f"{type(exc).__name__}: {exc}"
+
+    result.latency_ms = (time.perf_counter() - started) * 1000
+    result.ok = result.error is None and 0 < result.status < 400
+    return result
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return round(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower), 1)
+
+
+def _distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": _percentile(values, 0.50),
+        "p95": _percentile(values, 0.95),
+        "p99": _percentile(values, 0.99),
+        "mean": round(statistics.fmean(values), 1) if values else None,
+        "max": round(max(values), 1) if values else None,
+    }
+
+
+def build_report(results: List[RequestResult], wall_seconds: float, config: dict) -> dict:
+    ok = [result for result in results if result.ok]
+    errors_by_status: Dict[str, int] = {}
+    for result in results:
+        if not result.ok:
+            key = str(result.status or "connection")
+            errors_by_status[key] = errors_by_status.get(key, 0) + 1
+
+    stage_values: Dict[str, List[float]] = {}
+    for result in ok:
+        for stage, value in result.stages_ms.items():
+            stage_values.setdefault(stage, []).append(value)
+
+    by_kind: Dict[str, dict] = {}
+    for kind in sorted({result.kind for result in results}):
+        kind_results = [result for result in results if result.kind == kind]
+        kind_ok = [result.latency_ms for result in kind_results if result.ok]
+        by_kind[kind] = {
+            "requests": len(kind_results),
+            "error_rate": round(1 - len(kind_ok) / len(kind_results), 4),
+            "latency_ms": _distribution(kind_ok),
+        }
+
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "config": config,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors_by_status": errors_by_status,
+        "throughput_rps": round(len(ok) / wall_seconds, 3) if wall_seconds > 0 else None,
+        "cache_hits": sum(1 for result in ok if result.cached),
+        "latency_ms": _distribution([result.latency_ms for result in ok]),
+        "ttfb_ms": _distribution([result.ttfb_ms for result in ok if result.ttfb_ms is not None]),
+        "first_token_ms": _distribution([result.first_token_ms for result in ok if result.first_token_ms is not None]),
+        "stages_ms": {stage: _distribution(values) for stage, values in sorted(stage_values.items())},
+        "by_kind": by_kind,
+    }
+
+
+async def _run_closed_loop(client, base_url, plan, concurrency, stream) -> List[RequestResult]:
+    queue: "asyncio.Queue[PlannedRequest]" = asyncio.Queue()
+    for planned in plan:
+        queue.put_nowait(planned)
+    results: List[RequestResult] = []
+
+    async def worker() -> None:
+        while True:
+            try:
+                planned = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results.append(await _send(client, base_url, planned, stream=stream))
+            _progress(len(results), len(plan))
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return results
+
+
+async def _run_open_loop(client, base_url, plan, offsets, stream) -> List[RequestResult]:
+    """Запросы уходят в моменты `offsets` (секунды от старта), не дожидаясь предыдущих."""
+    results: List[RequestResult] = []
+    started = time.perf_counter()
+
+    async def fire(planned: PlannedRequest, offset: float) -> None:
+        await asyncio.sleep(max(0.0, offset - (time.perf_counter() - started)))
+        results.append(await _send(client, base_url, planned, stream=stream))
+        _progress(len(results), len(plan))
+
+    await asyncio.gather(*(fire(planned, offset) for planned, offset in zip(plan, offsets)))
+    return results
+
+
+def _progress(done: int, total: int) -> None:
+    if done == total or done % max(1, total // 20) == 0:
+        print(f"  {done}/{total}", file=sys.stderr)
+
+
+def _arrival_offsets(plan: List[PlannedRequest], rate: Optional[float], speed: float, seed: int) -> Optional[List[float]]:
+    if rate:
+        rng = random.Random(seed)
+        offsets, moment = [], 0.0
+        for _ in plan:
+            offsets.append(moment)
+            moment += rng.expovariate(rate)
+        return offsets
+    if plan and all(planned.at is not None for planned in plan):
+        first = min(planned.at for planned in plan)
+        return [(planned.at - first) / speed for planned in plan]
+    return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    samples = builtin_samples(args.samples_dir)
+    if args.replay:
+        plan = _load_replay(args.replay, samples, args.replay.parent)
+        if args.requests:
+            plan = plan[:args.requests]
+    else:
+        plan = _synthetic_plan(_parse_mix(args.mix), samples, args.requests or 20, args.seed)
+    if not plan:
+        raise SystemExit("Нет запросов для отправки.")
+
+    offsets = _arrival_offsets(plan, args.rate, args.speed, args.seed)
+    mode = "open_loop" if offsets is not None else "closed_loop"
+    base_url = args.base_url.rstrip("/")
+    print(f"Sending {len(plan)} requests to {base_url} ({mode})", file=sys.stderr)
+
+    limits = httpx.Limits(max_connections=None if offsets is not None else args.concurrency)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        started = time.perf_counter()
+        if offsets is not None:
+            results = await _run_open_loop(client, base_url, plan, offsets, args.stream)
+        else:
+            results = await _run_closed_loop(client, base_url, plan, args.concurrency, args.stream)
+        wall_seconds = time.perf_counter() - started
+
+    config = {
+        "base_url": base_url,
+        "mode": mode,
+        "source": str(args.replay) if args.replay else f"mix:{args.mix}",
+        "concurrency": args.concurrency if offsets is None else None,
+        "rate": args.rate,
+        "speed": args.speed if args.replay and not args.rate else None,
+        "stream": args.stream,
+        "seed": args.seed,
+    }
+    report = build_report(results, wall_seconds, config)
+    if args.include_samples:
+        report["samples"] = [asdict(result) for result in results]
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8080", help="Адрес backend")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--replay", type=Path, help="JSONL с записанными запросами")
+    source.add_argument("--mix", default="arp=3,xlsx=2,dxf=1,pdf=1,image=1", help="Синтетическая смесь вид=вес")
+    parser.add_argument("--requests", type=int, help="Число запросов (для --mix по умолчанию 20)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Параллельных клиентов в замкнутом цикле")
+    parser.add_argument("--rate", type=float, help="Запросов в секунду (открытый цикл)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Ускорение интервалов записи при --replay")
+    parser.add_argument("--stream", action="store_true", help="Потоковые ответы: время до первого токена")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--samples-dir", type=Path, default=DEFAULT_SAMPLES_DIR)
+    parser.add_argument("--include-samples", action="store_true", help="Добавить в отчёт замеры каждого запроса")
+    parser.add_argument("--output", type=Path, help="Сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    summary = {key: report[key] for key in ("requests", "ok", "error_rate", "throughput_rps", "latency_ms")}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк переиспользования префикса промпта в Ollama.
+
+Сравнивает две раскладки промпта для серии вопросов по одному документу:
+- question_first — прежний порядок: инструкции, вопрос, затем файл;
+- document_first — текущий порядок `build_json_prompt`: инструкции и файл, затем вопрос.
+
+Для каждого запроса фиксируются `prompt_eval_count` и `prompt_eval_duration` из ответа Ollama.
+Ollama учитывает в них только реально вычисленные токены, поэтому при document_first
+повторные вопросы должны обрабатывать лишь хвост с вопросом.
+
+Запуск из каталога backend:
+    python -m benchmarks.prompt_prefix_reuse --file converted.json --rounds 2
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+
+from src.services.console_json_ollama import DEFAULT_ROUTER_INSTRUCTION, build_json_prompt
+
+DEFAULT_QUESTIONS = [
+    "Какова итоговая стоимость?",
+    "Перечисли основные разделы документа.",
+    "Какие позиции относятся к бетонным работам?",
+]
+
+
+def _question_first_prompt(question: str, contents: str, filename: str) -> str:
+    """Раскладка промпта до перестановки: вопрос перед содержимым файла."""
+    return (
+        "ВАЖНО: Отвечайте ТОЛЬКО на русском языке. Все ваши ответы должны быть на русском языке.\n\n"
+        f"{DEFAULT_ROUTER_INSTRUCTION}\n\n"
+        f"Вопрос:\n{question}\n\n"
+        f"файл ({filename}):\n{contents}"
+    )
+
+
+def _document_first_prompt(question: str, contents: str, filename: str) -> str:
+    return build_json_prompt(question, contents, "ru", filename=filename)
+
+
+LAYOUTS = {
+    "question_first": _question_first_prompt,
+    "document_first": _document_first_prompt,
+}
+
+
+def _run_layout(
+    client: httpx.Client,
+    base_url: str,
+    model: str,
+    layout: str,
+    contents: str,
+    filename: str,
+    questions: List[str],
+    rounds: int,
+    num_predict: int,
+) -> List[Dict[str, float]]:
+    build_prompt = LAYOUTS[layout]
+    samples: List[Dict[str, float]] = []
+    for round_index in range(rounds):
+        for question in questions:
+            payload = {
+                "model": model,
+                "prompt": build_prompt(question, contents, filename),
+                "stream": False,
+                "keep_alive": "10m",
+                "options": {"num_predict": num_predict, "temperature": 0},
+            }
+            response = client.post(f"{base_url}/api/generate", json=payload)
+            response.raise_for_status()
+            data = response.json()
+            sample = {
+                "round": round_index,
+                "question": question,
+                "prompt_eval_count": data.get("prompt_eval_count", 0),
+                "prompt_eval_ms": data.get("prompt_eval_duration", 0) / 1_000_000,
+                "total_ms": data.get("total_duration", 0) / 1_000_000,
+            }
+            samples.append(sample)
+            print(
+                f"{layout:>15} round={round_index} prompt_eval_count={sample['prompt_eval_count']:>7} "
+                f"prompt_eval_ms={sample['prompt_eval_ms']:>10.1f}  {question[:40]}",
+                file=sys.stderr,
+            )
+    return samples
+
+
+def _summarize(samples: List[Dict[str, float]]) -> Dict[str, float]:
+    # Первый запрос всегда вычисляет документ целиком; интересны последующие вопросы
+    repeated = samples[1:] or samples
+    return {
+        "first_prompt_eval_ms": round(samples[0]["prompt_eval_ms"], 1),
+        "first_prompt_eval_count": samples[0]["prompt_eval_count"],
+        "repeated_median_prompt_eval_ms": round(statistics.median(s["prompt_eval_ms"] for s in repeated), 1),
+        "repeated_median_prompt_eval_count": statistics.median(s["prompt_eval_count"] for s in repeated),
+        "repeated_total_prompt_eval_ms": round(sum(s["prompt_eval_ms"] for s in repeated), 1),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", required=True, type=Path, help="Текстовый/JSON файл с содержимым документа")
+    parser.add_argument("--question", action="append", dest="questions", help="Вопрос (можно несколько)")
+    parser.add_argument("--rounds", type=int, default=2, help="Сколько раз повторить серию вопросов")
+    parser.add_argument("--model", default="deepseek-r1")
+    parser.add_argument("--base-url", default=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"))
+    parser.add_argument("--num-predict", type=int, default=1, help="Длина ответа (минимальная, важен только промпт)")
+    parser.add_argument("--output", type=Path, help="Сохранить сырые замеры и сводку в JSON")
+    args = parser.parse_args()
+
+    contents = args.file.read_text(encoding="utf-8")
+    questions = args.questions or DEFAULT_QUESTIONS
+    base_url = args.base_url.rstrip("/")
+
+    report: Dict[str, Dict] = {}
+    with httpx.Client(timeout=httpx.Timeout(1800.0)) as client:
+        for layout in LAYOUTS:
+            samples = _run_layout(
+                client, base_url, args.model, layout, contents, args.file.name,
+                questions, args.rounds, args.num_predict,
+            )
+            report[layout] = {"summary": _summarize(samples), "samples": samples}
+
+    summary = {layout: data["summary"] for layout, data in report.items()}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,15 +3,61 @@ from __future__ import annotations
 
 import logging
 import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
 import uvicorn
 from fastapi import FastAPI, HTTPException, File, Form, UploadFile, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from .ollama_client import OllamaClient
 from .schemas import GenerateRequest, ChatRequest
+from .services.utils.compat_asyncio import aclosing
 
 
-from .services import process_json_query, process_vision_query
+from .services import (
+    ask_document_session,
+    cancellations,
+    current_trace,
+    close_document_session,
+    context_encoder_stats,
+    conversion_cache,
+    converter_pool,
+    create_document_session,
+    describe_document_session,
+    document_indexes,
+    HANDLER_MAP,
+    HTTP_ERRORS,
+    get_job_result,
+    iter_batch_results,
+    job_queue,
+    map_reducer,
+    metrics,
+    open_document_session_stream,
+    session_store,
+    single_flight_snapshot,
+    event_stream_response,
+    open_json_query_stream,
+    open_vision_query_stream,
+    pool,
+    process_json_query,
+    process_vision_query,
+    prompt_budgeter,
+    resolve_context_encoder,
+    resolve_context_overflow,
+    resolve_reasoning_budget,
+    resolve_job_kind,
+    run_until_disconnected,
+    resolve_priority,
+    residency,
+    resolve_stream_format,
+    response_cache,
+    scheduler,
+    shutdown_ollama_client,
+    startup_ollama_client,
+    submit_upload_jobs,
+    tracer,
+)
 
 # Настройка логирования
 # Используем простой формат для лучшей читаемости
@@ -34,9 +80,58 @@ logger.info("=== LOGGING CONFIGURED ===")
 
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "8080"))
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 
-app = FastAPI(title="BA_AI_GOST Backend", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Общие ресурсы приложения: пул соединений с Ollama живёт всё время работы процесса."""
+    await startup_ollama_client()
+    await pool.start()
+    logger.info("Ollama HTTP pool started: %s", ", ".join(node.url for node in pool.nodes))
+    await residency.start()
+    await converter_pool.start()
+    await HANDLER_MAP.start()
+    try:
+        yield
+    finally:
+        await HANDLER_MAP.stop()
+        await converter_pool.stop()
+        await residency.stop()
+        await pool.stop()
+        await shutdown_ollama_client()
+        logger.info("Ollama HTTP pool closed")
+
+
+app = FastAPI(title="BA_AI_GOST Backend", version="1.0.0", lifespan=lifespan)
+
+def _count_error(request: Request, status_code: int) -> None:
+    # Шаблон маршрута вместо пути: идентификаторы сессий и задач не размножают ряды метрики
+    route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+    HTTP_ERRORS.inc(route=route, status=status_code)
+
+
+async def _finish_trace_after_body(body, trace, request: Request, status_code: int):
+    # Трасса завершается после отдачи тела: для потоковых ответов в неё попадает вся генерация
+    try:
+        async with aclosing(body):
+            async for chunk in body:
+                yield chunk
+    finally:
+        await _finish_trace(trace, request, status_code)
+
+
+async def _finish_trace(trace, request: Request, status_code: int) -> None:
+    route = getattr(request.scope.get("route"), "path", None)
+    await tracer.finish(trace, method=request.method, path=request.url.path, route=route, status=status_code)
+
+
+def _with_trace_timings(result: dict) -> dict:
+    """Этапы запроса в поле `timings.trace` ответа (include_timings)."""
+    trace = current_trace()
+    if trace is None:
+        return result
+    return {**result, "timings": {**(result.get("timings") or {}), "trace": trace.as_dict()}}
+
 
 # Middleware для логирования запросов
 @app.middleware("http")
@@ -45,17 +140,29 @@ async def log_requests(request: Request, call_next):
     path = request.url.path
     method = request.method
     logger.info(">>> MIDDLEWARE START: %s %s", method, path)
+    trace = tracer.start(f"{method} {path}")
     
     try:
         response = await call_next(request)
         logger.info(">>> MIDDLEWARE SUCCESS: %s %s - %s", method, path, response.status_code)
+        if response.status_code >= 400:
+            _count_error(request, response.status_code)
+        if trace is not None:
+            response.headers["Server-Timing"] = trace.server_timing()
+            response.body_iterator = _finish_trace_after_body(
+                response.body_iterator, trace, request, response.status_code
+            )
         return response
     except HTTPException as exc:
         # HTTPException логируем отдельно, но не перехватываем
         logger.error(">>> MIDDLEWARE HTTPException: %s %s - status=%d, detail=%s", 
                     method, path, exc.status_code, exc.detail)
+        _count_error(request, exc.status_code)
+        await _finish_trace(trace, request, exc.status_code)
         raise
     except Exception as exc:
+        _count_error(request, 500)
+        await _finish_trace(trace, request, 500)
         # Логируем все необработанные исключения с полным traceback
         error_type = type(exc).__name__
         error_msg = str(exc)
@@ -94,32 +201,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-ollama = OllamaClient(base_url=OLLAMA_BASE_URL)
+ollama = OllamaClient()
 
 
 @app.post("/vision-query")
 async def vision_query(
+    request: Request,
     image_file: UploadFile = File(..., description="One or more image files"),
     question: str = Form(..., description="Question to ask the vision model"),
     response_language: str = Form("ru", description="Language for the response (ru, en, auto)"),
+    stream: bool = Form(False, description="Stream model tokens as they are generated"),
+    stream_format: str = Form("ndjson", description="Stream format: ndjson or sse"),
+    priority: str = Form("interactive", description="Scheduling priority: interactive or batch"),
+    no_cache: bool = Form(False, description="Bypass the LLM response cache"),
+    include_timings: bool = Form(False, description="Add per-stage server timings to the response"),
 ):
-    return await process_vision_query(image_file, question, response_language)
+    priority_level = resolve_priority(priority)
+    if stream:
+        fmt = resolve_stream_format(stream_format)
+        events = await run_until_disconnected(request, open_vision_query_stream(
+            image_file, question, response_language, priority=priority_level, use_cache=not no_cache
+        ))
+        return event_stream_response(events, fmt)
+    result = await run_until_disconnected(request, process_vision_query(
+        image_file, question, response_language, priority=priority_level, use_cache=not no_cache
+    ))
+    return _with_trace_timings(result) if include_timings else result
 
 
 @app.post("/json-query")
 async def json_query(
+    request: Request,
     json_file: UploadFile = File(..., description="JSON file to provide as context"),
     question: str = Form(..., description="Question to ask the deepseek-r1 model"),
     response_language: str = Form("ru", description="Language for the response (ru, en, auto)"),
+    stream: bool = Form(False, description="Stream model tokens as they are generated"),
+    stream_format: str = Form("ndjson", description="Stream format: ndjson or sse"),
+    priority: str = Form("interactive", description="Scheduling priority: interactive or batch"),
+    no_cache: bool = Form(False, description="Bypass the LLM response cache"),
+    context_overflow: str = Form("", description="Oversized document policy: reject, trim, retrieve or map_reduce"),
+    think: str = Form("", description="Model reasoning: auto, on or off"),
+    max_reasoning_tokens: int = Form(0, description="Reasoning token cap, 0 - server default"),
+    max_answer_tokens: int = Form(0, description="Answer token cap, 0 - server default"),
+    include_reasoning: Optional[bool] = Form(None, description="Return the model reasoning alongside the answer"),
+    context_encoder: str = Form("", description="Document format in the prompt: auto, json, compact, tsv or csv"),
+    include_timings: bool = Form(False, description="Add per-stage server timings to the response"),
 ):
     """Обработка JSON запроса с файлом."""
     filename = json_file.filename if json_file else "unknown"
     logger.info("=== JSON-QUERY START: file=%s, question_len=%d ===", filename, len(question) if question else 0)
     
     try:
-        result = await process_json_query(json_file, question, response_language)
+        priority_level = resolve_priority(priority)
+        overflow_policy = resolve_context_overflow(context_overflow)
+        reasoning = resolve_reasoning_budget(think, max_reasoning_tokens, max_answer_tokens, include_reasoning)
+        encoder = resolve_context_encoder(context_encoder)
+        if stream:
+            fmt = resolve_stream_format(stream_format)
+            events = await run_until_disconnected(request, open_json_query_stream(
+                json_file,
+                question,
+                response_language,
+                priority=priority_level,
+                use_cache=not no_cache,
+                context_overflow=overflow_policy,
+                reasoning=reasoning,
+                context_encoder=encoder,
+            ))
+            logger.info("=== JSON-QUERY STREAM OPENED: file=%s ===", filename)
+            return event_stream_response(events, fmt)
+        result = await run_until_disconnected(request, process_json_query(
+            json_file,
+            question,
+            response_language,
+            priority=priority_level,
+            use_cache=not no_cache,
+            context_overflow=overflow_policy,
+            reasoning=reasoning,
+            context_encoder=encoder,
+        ))
         logger.info("=== JSON-QUERY SUCCESS: file=%s ===", filename)
-        return result
+        return _with_trace_timings(result) if include_timings else result
     except HTTPException as exc:
         # Логируем HTTPException для отладки
         logger.warning("=== JSON-QUERY HTTPException: file=%s, status=%d, detail=%s ===", 
@@ -137,6 +299,157 @@ async def json_query(
         ) from exc
 
 
+@app.post("/sessions")
+async def create_session(
+    json_file: UploadFile = File(..., description="Document to convert once and query many times"),
+    context_encoder: str = Form("", description="Document format in the prompt: auto, json, compact, tsv or csv"),
+):
+    """Загрузка документа: файл конвертируется один раз, возвращается session_id."""
+    return await create_document_session(json_file, resolve_context_encoder(context_encoder))
+
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    return describe_document_session(session_id)
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    close_document_session(session_id)
+    return {"session_id": session_id, "status": "closed"}
+
+
+@app.post("/sessions/{session_id}/query")
+async def session_query(
+    request: Request,
+    session_id: str,
+    question: str = Form(..., description="Question about the session document"),
+    response_language: str = Form("ru", description="Language for the response (ru, en, auto)"),
+    stream: bool = Form(False, description="Stream model tokens as they are generated"),
+    stream_format: str = Form("ndjson", description="Stream format: ndjson or sse"),
+    priority: str = Form("interactive", description="Scheduling priority: interactive or batch"),
+    no_cache: bool = Form(False, description="Bypass the LLM response cache"),
+    context_overflow: str = Form("", description="Oversized document policy: reject, trim, retrieve or map_reduce"),
+    think: str = Form("", description="Model reasoning: auto, on or off"),
+    max_reasoning_tokens: int = Form(0, description="Reasoning token cap, 0 - server default"),
+    max_answer_tokens: int = Form(0, description="Answer token cap, 0 - server default"),
+    include_reasoning: Optional[bool] = Form(None, description="Return the model reasoning alongside the answer"),
+    context_encoder: str = Form(
+        "", description="Document format in the prompt: auto, json, compact, tsv or csv; empty - keep the session format"
+    ),
+):
+    """Вопрос к ранее загруженному документу без повторной загрузки и конвертации."""
+    priority_level = resolve_priority(priority)
+    overflow_policy = resolve_context_overflow(context_overflow)
+    reasoning = resolve_reasoning_budget(think, max_reasoning_tokens, max_answer_tokens, include_reasoning)
+    encoder = resolve_context_encoder(context_encoder) if context_encoder else None
+    if stream:
+        fmt = resolve_stream_format(stream_format)
+        events = await run_until_disconnected(request, open_document_session_stream(
+            session_id,
+            question,
+            response_language,
+            priority=priority_level,
+            use_cache=not no_cache,
+            context_overflow=overflow_policy,
+            reasoning=reasoning,
+            context_encoder=encoder,
+        ))
+        return event_stream_response(events, fmt)
+    return await run_until_disconnected(request, ask_document_session(
+        session_id,
+        question,
+        response_language,
+        priority=priority_level,
+        use_cache=not no_cache,
+        context_overflow=overflow_policy,
+        reasoning=reasoning,
+        context_encoder=encoder,
+    ))
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(..., description="Document or image to process in the background"),
+    question: str = Form(..., description="Question about the file"),
+    response_language: str = Form("ru", description="Language for the response (ru, en, auto)"),
+    kind: str = Form("json", description="Pipeline: json (/json-query) or vision (/vision-query)"),
+    priority: str = Form("batch", description="Scheduling priority: interactive or batch"),
+    no_cache: bool = Form(False, description="Bypass the LLM response cache"),
+    context_overflow: str = Form("", description="Oversized document policy: reject, trim, retrieve or map_reduce"),
+    context_encoder: str = Form("", description="Document format in the prompt: auto, json, compact, tsv or csv"),
+):
+    """Фоновая задача: файл сохраняется в очереди, обработку выполняет воркер (`python -m src.worker`)."""
+    submitted = await submit_upload_jobs(
+        [file],
+        question,
+        response_language,
+        kind=resolve_job_kind(kind),
+        priority=resolve_priority(priority),
+        use_cache=not no_cache,
+        context_overflow=resolve_context_overflow(context_overflow),
+        context_encoder=resolve_context_encoder(context_encoder),
+    )
+    return submitted[0]
+
+
+@app.post("/jobs/batch")
+async def create_job_batch(
+    files: List[UploadFile] = File(..., description="Documents or images to process in the background"),
+    question: str = Form(..., description="Question asked about every file"),
+    response_language: str = Form("ru", description="Language for the response (ru, en, auto)"),
+    kind: str = Form("json", description="Pipeline: json (/json-query) or vision (/vision-query)"),
+    priority: str = Form("batch", description="Scheduling priority: interactive or batch"),
+    no_cache: bool = Form(False, description="Bypass the LLM response cache"),
+    context_overflow: str = Form("", description="Oversized document policy: reject, trim, retrieve or map_reduce"),
+    context_encoder: str = Form("", description="Document format in the prompt: auto, json, compact, tsv or csv"),
+    stream_format: str = Form("ndjson", description="Stream format: ndjson or sse"),
+):
+    """Пакет задач: результаты отдаются потоком по мере завершения, задачи продолжаются и без клиента."""
+    fmt = resolve_stream_format(stream_format)
+    submitted = await submit_upload_jobs(
+        files,
+        question,
+        response_language,
+        kind=resolve_job_kind(kind),
+        priority=resolve_priority(priority),
+        use_cache=not no_cache,
+        context_overflow=resolve_context_overflow(context_overflow),
+        context_encoder=resolve_context_encoder(context_encoder),
+        batch=True,
+    )
+    return event_stream_response(iter_batch_results(submitted), fmt, deadline=0)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return await job_queue.get(job_id)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result_endpoint(job_id: str):
+    result = await get_job_result(job_id)
+    if result is None:
+        job = await job_queue.get(job_id)
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "status": job["status"]},
+            headers={"Retry-After": "5"},
+        )
+    return result
+
+
+@app.get("/stats/jobs")
+async def jobs_stats():
+    """Background job queue: jobs per status."""
+    return await job_queue.snapshot()
+
+
+@app.get("/stats/sessions")
+async def sessions_stats():
+    return session_store.snapshot()
+
+
 @app.get("/")
 async def root():
     """Root endpoint with available routes."""
@@ -152,12 +465,112 @@ async def health():
 
 @app.get("/health/ollama")
 async def health_ollama():
-    """Check Ollama connectivity."""
-    try:
-        data = await ollama.list_models()
-        return {"status": "ok", "ollama_url": OLLAMA_BASE_URL, "models_available": len(data.get("models", []))}
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"Ollama unavailable: {str(e)}")
+    """Check Ollama connectivity of every configured node."""
+    await pool.check_all()
+    snapshot = pool.snapshot()
+    if not snapshot["healthy_nodes"]:
+        errors = "; ".join(f"{node['url']}: {node['last_error']}" for node in snapshot["nodes"])
+        raise HTTPException(status_code=503, detail=f"Ollama unavailable: {errors}")
+    models = set()
+    for node in snapshot["nodes"]:
+        if node["healthy"]:
+            models.update(node["models"])
+    return {
+        "status": "ok" if snapshot["healthy_nodes"] == len(snapshot["nodes"]) else "degraded",
+        "ollama_url": pool.primary_url,
+        "models_available": len(models),
+        "nodes": snapshot["nodes"],
+    }
+
+
+@app.get("/stats/scheduler")
+async def scheduler_stats():
+    """Ollama admission queue: active slots, queue depth and wait times per model."""
+    return scheduler.snapshot()
+
+
+@app.get("/stats/ollama-nodes")
+async def ollama_nodes_stats():
+    """Ollama node pool: health, outstanding requests and loaded models per node."""
+    return pool.snapshot()
+
+
+@app.get("/stats/models")
+async def models_stats():
+    """Model residency: resident models per node from /api/ps, keep_alive policy, cold-load counts and times."""
+    return residency.snapshot()
+
+
+@app.get("/stats/prompt-budget")
+async def prompt_budget_stats():
+    """Context budgeting: chosen num_ctx buckets, rejected/trimmed documents and token estimate accuracy."""
+    return prompt_budgeter.snapshot()
+
+
+@app.get("/stats/retrieval")
+async def retrieval_stats():
+    """Question-based retrieval: indexes built, chunks and tokens sent instead of whole documents."""
+    return document_indexes.snapshot()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Prometheus metrics: per-stage latency histograms, Ollama timings, errors by status and cache lookups."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/stats/tracing")
+async def tracing_stats():
+    """Request tracing: traces finished and slow traces written to the JSONL log."""
+    return tracer.snapshot()
+
+
+@app.get("/stats/handlers")
+async def handler_stats():
+    """File handlers: which modules are imported, how long each import took and which are unavailable."""
+    return HANDLER_MAP.snapshot()
+
+
+@app.get("/stats/map-reduce")
+async def map_reduce_stats():
+    """Map-reduce answering: documents split into parts, cached partial answers and extra reduce rounds."""
+    return map_reducer.snapshot()
+
+
+@app.get("/stats/llm-cache")
+async def llm_cache_stats():
+    """LLM response cache: hit/miss counters and tier sizes."""
+    return response_cache.snapshot()
+
+
+@app.get("/stats/conversion-cache")
+async def conversion_cache_stats():
+    """Conversion cache: hit rate, bytes and handler time saved, disk usage."""
+    return conversion_cache.snapshot()
+
+
+@app.get("/stats/context-encoders")
+async def context_encoders_stats():
+    """Prompt encoding of documents: estimated tokens per encoder and file type versus indented JSON."""
+    return context_encoder_stats.snapshot()
+
+
+@app.get("/stats/converters")
+async def converters_stats():
+    """File converters: thread/process task counts, average time, shared memory transfers, pool restarts."""
+    return converter_pool.snapshot()
+
+
+@app.get("/stats/cancellations")
+async def cancellations_stats():
+    """Cancelled requests (client disconnect, deadline) and Ollama time spent on abandoned generations."""
+    return cancellations.snapshot()
+
+
+@app.get("/stats/single-flight")
+async def single_flight_stats():
+    """Request coalescing: conversions and generations shared between identical concurrent requests."""
+    return single_flight_snapshot()
 
 
 @app.get("/models")
@@ -176,6 +589,8 @@ async def generate(req: GenerateRequest):
     try:
         data = await ollama.generate(model=req.model, prompt=req.prompt, options=req.options or {})
         return data
+    except HTTPException:
+        raise
     except ConnectionError as e:
         raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
@@ -188,6 +603,8 @@ async def chat(req: ChatRequest):
     try:
         data = await ollama.chat(model=req.model, messages=req.messages, options=req.options or {})
         return data
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,37 +1,59 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 import httpx
 
+from .services.model_residency import residency
+from .services.ollama_pool import pool
+from .services.ollama_scheduler import scheduler
+from .services.ollama_service import get_ollama_http_client
+
 
 class OllamaClient:
-    def __init__(self, base_url: str = "http://localhost:11434") -> None:
-        self.base_url = base_url.rstrip('/')
-        self.client = httpx.AsyncClient(timeout=60)
+    def __init__(self, base_url: Optional[str] = None) -> None:
+        # Без base_url запросы распределяются по узлам пула (OLLAMA_BASE_URLS)
+        self.base_url = base_url.rstrip('/') if base_url else None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Общий keep-alive пул, которым управляет lifespan приложения
+        return get_ollama_http_client()
+
+    async def _post(self, endpoint: str, model: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        node = pool.choose(model, pinned_url=self.base_url)
+        url = f"{node.url}{endpoint}"
+        async with scheduler.slot(model):
+            try:
+                async with pool.lease(node):
+                    resp = await self.client.post(url, json=payload, timeout=60.0)
+            except httpx.ConnectError as e:
+                pool.mark_failure(node, e)
+                raise
+            pool.mark_success(node)
+        resp.raise_for_status()
+        data = resp.json()
+        residency.observe_response(model, data, node.url)
+        return data
 
     async def list_models(self) -> Dict[str, Any]:
-        url = f"{self.base_url}/api/tags"
-        resp = await self.client.get(url)
+        url = f"{self.base_url or pool.choose().url}/api/tags"
+        resp = await self.client.get(url, timeout=60.0)
         resp.raise_for_status()
         return resp.json()
 
     async def generate(self, model: str, prompt: str, options: Dict[str, Any]) -> Dict[str, Any]:
-        url = f"{self.base_url}/api/generate"
-        payload = {"model": model, "prompt": prompt, "stream": False, "options": options or {}}
+        payload = residency.prepare_payload(
+            {"model": model, "prompt": prompt, "stream": False, "options": options or {}}
+        )
         try:
-            resp = await self.client.post(url, json=payload, timeout=60.0)
-            resp.raise_for_status()
-            return resp.json()
+            return await self._post("/api/generate", model, payload)
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
-                raise ConnectionError(f"Ollama endpoint not found: {url}. Check if Ollama is running and model '{model}' exists.")
+                raise ConnectionError(f"Ollama endpoint not found: {e.request.url}. Check if Ollama is running and model '{model}' exists.")
             raise
         except httpx.ConnectError as e:
-            raise ConnectionError(f"Cannot connect to Ollama at {self.base_url}. Check if Ollama is running.")
+            raise ConnectionError(f"Cannot connect to Ollama at {e.request.url.host}. Check if Ollama is running.")
 
     async def chat(self, model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> Dict[str, Any]:
-        url = f"{self.base_url}/api/chat"
-        payload = {"model": model, "messages": messages, "stream": False, "options": options}
-        resp = await self.client.post(url, json=payload)
-        resp.raise_for_status()
-        return resp.json()
-
-
+        payload = residency.prepare_payload(
+            {"model": model, "messages": messages, "stream": False, "options": options}
+        )
+        return await self._post("/api/chat", model, payload)
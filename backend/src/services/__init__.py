@@ -1,24 +1,105 @@
+from importlib import import_module
+
+from .cancellation import cancellations, run_until_disconnected
 from .console_json_ollama import run_console_json_ollama
-from .json_service import process_json_query
-from .file_handlers.arp_upload_service import convert_arp_upload_to_json
-from .file_handlers.dxf_console_service import convert_dxf_upload_to_json
-from .file_handlers.gsfx_upload_service import convert_gsfx_upload_to_json
-from .file_handlers.pdf_upload_service import convert_pdf_upload_to_base64_images
-from .file_handlers.rtf_upload_service import convert_rtf_upload_to_json
+from .context_encoders import context_encoder_stats, resolve_context_encoder
+from .conversion_cache import conversion_cache
+from .converter_pool import converter_pool
+from .document_sessions import (
+    ask_document_session,
+    close_document_session,
+    create_document_session,
+    describe_document_session,
+    open_document_session_stream,
+    session_store,
+)
+from .job_queue import get_job_result, iter_batch_results, job_queue, resolve_job_kind, submit_upload_jobs
+from .json_service import open_json_query_stream, process_json_query
+from .handler_registry import HANDLER_MAP
 from .json_file_router import load_raw_json_data
-from .vision import process_vision_query
+from .map_reduce import map_reducer
+from .metrics import HTTP_ERRORS, metrics
+from .model_residency import residency
+from .ollama_pool import pool
+from .ollama_scheduler import resolve_priority, scheduler
+from .ollama_service import shutdown_ollama_client, startup_ollama_client
+from .prompt_budget import prompt_budgeter, resolve_context_overflow
+from .reasoning import resolve_reasoning_budget
+from .response_cache import response_cache
+from .retrieval import document_indexes
+from .single_flight import single_flight_snapshot
+from .streaming import event_stream_response, resolve_stream_format
+from .tracing import current_trace, tracer
+from .vision import open_vision_query_stream, process_vision_query
 from .file_handlers.image_upload_service import convert_upload_image_to_base64
 
 __all__ = [
     "run_console_json_ollama",
+    "cancellations",
+    "run_until_disconnected",
+    "context_encoder_stats",
+    "resolve_context_encoder",
+    "conversion_cache",
+    "converter_pool",
     "convert_arp_upload_to_json",
     "convert_dxf_upload_to_json",
     "convert_gsfx_upload_to_json",
     "convert_pdf_upload_to_base64_images",
     "convert_rtf_upload_to_json",
+    "HANDLER_MAP",
     "load_raw_json_data",
+    "get_job_result",
+    "iter_batch_results",
+    "job_queue",
+    "resolve_job_kind",
+    "submit_upload_jobs",
     "process_json_query",
     "process_vision_query",
+    "open_json_query_stream",
+    "open_vision_query_stream",
+    "event_stream_response",
+    "resolve_stream_format",
+    "current_trace",
+    "tracer",
+    "resolve_priority",
+    "scheduler",
+    "pool",
+    "response_cache",
+    "document_indexes",
+    "map_reducer",
+    "HTTP_ERRORS",
+    "metrics",
+    "prompt_budgeter",
+    "resolve_context_overflow",
+    "resolve_reasoning_budget",
+    "single_flight_snapshot",
+    "residency",
+    "ask_document_session",
+    "close_document_session",
+    "create_document_session",
+    "describe_document_session",
+    "open_document_session_stream",
+    "session_store",
     "convert_upload_image_to_base64",
+    "startup_ollama_client",
+    "shutdown_ollama_client",
 ]
 
+
+# Обработчики файлов тянут pandas, openpyxl, ezdxf и pypdfium2: импортируются при первом обращении
+_LAZY_EXPORTS = {
+    "convert_arp_upload_to_json": ".file_handlers.arp_upload_service",
+    "convert_dxf_upload_to_json": ".file_handlers.dxf_console_service",
+    "convert_gsfx_upload_to_json": ".file_handlers.gsfx_upload_service",
+    "convert_pdf_upload_to_base64_images": ".file_handlers.pdf_upload_service",
+    "convert_rtf_upload_to_json": ".file_handlers.rtf_upload_service",
+}
+
+
+def __getattr__(name: str):
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Dict, Optional, TypeVar
+
+from fastapi import HTTPException, Request
+
+from .utils.compat_asyncio import aclosing
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# По умолчанию — прежний предел OLLAMA_TIMEOUT_SECONDS: долгие ответы API-клиентов не обрываются.
+# Для клиента Electron, который сам прерывает запрос через 6 минут, можно задать 360
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "1800"))
+DISCONNECT_POLL_INTERVAL_SECONDS = float(os.getenv("DISCONNECT_POLL_INTERVAL_SECONDS", "1"))
+
+# Нестандартный код nginx «клиент закрыл соединение»: ответ всё равно никто не получит
+CLIENT_CLOSED_REQUEST = 499
+
+REASON_DISCONNECT = "disconnect"
+REASON_DEADLINE = "deadline"
+
+
+@dataclass
+class AbandonedGenerationStats:
+    generations: int = 0
+    wasted_seconds: float = 0.0
+    wasted_chunks: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "generations": self.generations,
+            "wasted_ms": round(self.wasted_seconds * 1000, 1),
+            "wasted_chunks": self.wasted_chunks,
+        }
+
+
+class CancellationTracker:
+    """Считает отменённые запросы и время Ollama, потраченное на ответы, которые никто не получил."""
+
+    def __init__(self) -> None:
+        self.reasons: Dict[str, int] = {REASON_DISCONNECT: 0, REASON_DEADLINE: 0}
+        self._models: Dict[str, AbandonedGenerationStats] = {}
+
+    def record_cancellation(self, reason: str) -> None:
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def record_abandoned_generation(self, model: str, seconds: float, chunks: int = 0) -> None:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = AbandonedGenerationStats()
+        stats.generations += 1
+        stats.wasted_seconds += seconds
+        stats.wasted_chunks += chunks
+        logger.info("Cancelled Ollama generation: model=%s, wasted=%.1f s, chunks=%d", model, seconds, chunks)
+
+    def snapshot(self) -> dict:
+        return {
+            "deadline_seconds": REQUEST_DEADLINE_SECONDS,
+            "cancelled_requests": dict(self.reasons),
+            "abandoned_generations": sum(stats.generations for stats in self._models.values()),
+            "wasted_gpu_ms": round(sum(stats.wasted_seconds for stats in self._models.values()) * 1000, 1),
+            "models": {model: stats.as_dict() for model, stats in sorted(self._models.items())},
+        }
+
+
+cancellations = CancellationTracker()
+
+
+async def run_until_disconnected(
+    request: Request,
+    awaitable: Awaitable[T],
+    *,
+    deadline: Optional[float] = None,
+) -> T:
+    """
+    Выполняет обработку запроса, пока клиент подключён и не истёк срок `deadline`.
+    Иначе отменяет её: отмена закрывает соединение с Ollama (генерация прекращается,
+    слот планировщика освобождается) и прерывает ожидающую конвертацию.
+    """
+    deadline = REQUEST_DEADLINE_SECONDS if deadline is None else deadline
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + deadline if deadline > 0 else None
+    task = asyncio.ensure_future(awaitable)
+
+    reason = None
+    try:
+        while reason is None:
+            timeout = DISCONNECT_POLL_INTERVAL_SECONDS
+            if expires_at is not None:
+                timeout = max(0.0, min(timeout, expires_at - loop.time()))
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if done:
+                return task.result()
+            if expires_at is not None and loop.time() >= expires_at:
+                reason = REASON_DEADLINE
+            elif await request.is_disconnected():
+                reason = REASON_DISCONNECT
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    cancellations.record_cancellation(reason)
+    logger.warning("Request %s %s cancelled: %s", request.method, request.url.path, reason)
+    if reason == REASON_DEADLINE:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Запрос не уложился в {deadline:g} с и был отменён."
+        )
+    raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Клиент закрыл соединение, обработка отменена.")
+
+
+def _uncancel(task: asyncio.Task) -> None:
+    # Python 3.11+: снятая своими силами отмена не должна считаться отменой задачи
+    uncancel = getattr(task, "uncancel", None)
+    if uncancel is not None:
+        uncancel()
+
+
+async def stream_with_deadline(
+    events: AsyncIterator[dict],
+    deadline: Optional[float] = None,
+) -> AsyncIterator[dict]:
+    """
+    Ограничивает потоковый ответ сроком `deadline`. Отключение клиента здесь не отслеживается:
+    при разрыве соединения Starlette сам отменяет отдачу потока.
+    Следующее событие ожидается в задаче запроса, а не в отдельной задаче `wait_for`:
+    поток Ollama закрывается и слот планировщика освобождается в той же задаче, где были получены.
+    """
+    deadline = REQUEST_DEADLINE_SECONDS if deadline is None else deadline
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    expires_at = loop.time() + deadline if deadline > 0 else None
+    expired = False
+
+    def expire() -> None:
+        nonlocal expired
+        expired = True
+        task.cancel()
+
+    async with aclosing(events):
+        while True:
+            timer = loop.call_at(expires_at, expire) if expires_at is not None else None
+            try:
+                event = await events.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                # Отмена по сроку становится ответом 504, любая другая (отключение клиента) — пробрасывается
+                if not expired:
+                    raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+            if expired:
+                _uncancel(task)
+                cancellations.record_cancellation(REASON_DEADLINE)
+                raise HTTPException(
+                    status_code=504,
+                    detail=f"Запрос не уложился в {deadline:g} с и был отменён."
+                )
+            yield event
+
+
+__all__ = [
+    "CLIENT_CLOSED_REQUEST",
+    "REASON_DEADLINE",
+    "REASON_DISCONNECT",
+    "REQUEST_DEADLINE_SECONDS",
+    "cancellations",
+    "run_until_disconnected",
+    "stream_with_deadline",
+]
@@ -1,63 +1,221 @@
 from __future__ import annotations
 
-from pathlib import Path
+import hashlib
+from dataclasses import replace
+from typing import AsyncGenerator, Callable
 
 from fastapi import HTTPException
 
-from .ollama_service import call_ollama
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .ollama_service import extract_ollama_timings
+from .map_reduce import MAP_INSTRUCTION, REDUCE_INSTRUCTION, map_reducer
+from .prompt_budget import (
+    OVERFLOW_MAP_REDUCE,
+    OVERFLOW_RETRIEVE,
+    PROMPT_RESPONSE_RESERVE_TOKENS,
+    PromptBudget,
+    estimate_tokens,
+    prompt_budgeter,
+    resolve_context_overflow,
+)
+from .reasoning import ReasoningBudget, generate_with_budget, resolve_reasoning_budget, stream_with_budget
+from .retrieval import DocumentIndex, select_context
+from .tracing import traced
+from .utils.compat_asyncio import aclosing
 
 DEFAULT_ROUTER_INSTRUCTION = (
     "Вам предоставлены данные из файла. Используйте их, чтобы ответить на вопрос пользователя ясно и кратко."
 )
 
 
-async def run_console_json_ollama(
-    question: str,
-    file_path: str,
-    response_language: str = "ru",
-    *,
-    instruction: str | None = None,
-    original_filename: str | None = None,
-) -> dict:
-    """Run the deepseek-r1 model via the Ollama HTTP API using JSON/file context."""
+JSON_QUERY_MODEL = "deepseek-r1"
 
-    path = Path(file_path).expanduser().resolve()
-    if not path.is_file():
-        raise FileNotFoundError(f"File not found: {path}")
-
-    try:
-        file_contents = path.read_text(encoding="utf-8")
-    except UnicodeDecodeError as exc:
-        raise UnicodeDecodeError(exc.encoding, exc.object, exc.start, exc.end, "Unable to decode file as UTF-8")
 
+def _build_language_instruction(response_language: str) -> str:
     # Определяем инструкцию по языку ответа (ВАЖНО: в начале промпта)
     if response_language == "ru":
-        language_instruction = "ВАЖНО: Отвечайте ТОЛЬКО на русском языке. Все ваши ответы должны быть на русском языке."
+        return "ВАЖНО: Отвечайте ТОЛЬКО на русском языке. Все ваши ответы должны быть на русском языке."
     elif response_language == "en":
-        language_instruction = "IMPORTANT: Respond ONLY in English. All your responses must be in English."
+        return "IMPORTANT: Respond ONLY in English. All your responses must be in English."
     elif response_language == "auto":
-        language_instruction = "Respond in the same language as the question or context."
+        return "Respond in the same language as the question or context."
     else:
-        language_instruction = "ВАЖНО: Отвечайте ТОЛЬКО на русском языке. Все ваши ответы должны быть на русском языке."  # По умолчанию русский
+        return "ВАЖНО: Отвечайте ТОЛЬКО на русском языке. Все ваши ответы должны быть на русском языке."  # По умолчанию русский
+
 
+def build_document_prefix(
+    file_contents: str,
+    response_language: str = "ru",
+    *,
+    instruction: str | None = None,
+    filename: str = "uploaded.json",
+) -> str:
+    """
+    Неизменяемая часть промпта: инструкция по языку, инструкция обработчика и содержимое файла.
+    Для всех вопросов по одному документу она совпадает побайтно, поэтому Ollama
+    переиспользует уже вычисленный KV-кэш этого префикса и обрабатывает заново только вопрос.
+    """
+    language_instruction = _build_language_instruction(response_language)
     instruction_block = (instruction or DEFAULT_ROUTER_INSTRUCTION).strip()
-    filename_for_prompt = original_filename or path.name
 
-    prompt = (
+    return (
         f"{language_instruction}\n\n"
         f"{instruction_block}\n\n"
-        f"Вопрос:\n{question}\n\n"
-        f"файл ({filename_for_prompt}):\n{file_contents}"
+        f"файл ({filename}):\n{file_contents}\n\n"
     )
 
+
+def build_question_suffix(question: str) -> str:
+    return f"Вопрос:\n{question}"
+
+
+def build_json_prompt(
+    question: str,
+    file_contents: str,
+    response_language: str = "ru",
+    *,
+    instruction: str | None = None,
+    filename: str = "uploaded.json",
+) -> str:
+    # Сначала документ, затем вопрос: переменная часть всегда в конце промпта
+    document_prefix = build_document_prefix(
+        file_contents,
+        response_language,
+        instruction=instruction,
+        filename=filename,
+    )
+    return f"{document_prefix}{build_question_suffix(question)}"
+
+
+def build_follow_up_prompt(question: str, response_language: str = "ru") -> str:
+    """Промпт уточняющего вопроса в сессии: документ уже есть в `context` предыдущего ответа."""
+    language_instruction = _build_language_instruction(response_language)
+    return f"{language_instruction}\n\n{build_question_suffix(question)}"
+
+
+def document_affinity_key(file_contents: str) -> str:
+    """Вопросы по одному документу идут на один узел Ollama, где префикс промпта уже в KV-кэше."""
+    return hashlib.sha256(file_contents.encode("utf-8")).hexdigest()
+
+
+async def build_budgeted_payload(
+    question: str,
+    file_contents: str,
+    response_language: str = "ru",
+    *,
+    instruction: str | None = None,
+    filename: str = "uploaded.json",
+    context_overflow: str | None = None,
+    index: DocumentIndex | None = None,
+    reasoning: ReasoningBudget | None = None,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+) -> tuple[dict, PromptBudget]:
+    """
+    Промпт deepseek-r1 с `num_ctx`, подобранным под размер документа (см. prompt_budget).
+    При политике `retrieve` крупный документ с индексом заменяется фрагментами, найденными по вопросу;
+    при `map_reduce` не помещающийся в окно документ обрабатывается по частям (см. map_reduce),
+    и промпт строится из выписок частей.
+    """
+    instruction_block = (instruction or DEFAULT_ROUTER_INSTRUCTION).strip()
+
+    def build_prompt_with(block: str) -> Callable[[str], str]:
+        def build_prompt(contents: str) -> str:
+            return build_json_prompt(
+                question,
+                contents,
+                response_language,
+                instruction=block,
+                filename=filename,
+            )
+
+        return build_prompt
+
+    build_prompt = build_prompt_with(instruction_block)
+    policy = resolve_context_overflow(context_overflow)
+    retrieval = None
+    map_reduce = None
+    if index is not None and policy == OVERFLOW_RETRIEVE:
+        context_length = await prompt_budgeter.context_length(JSON_QUERY_MODEL)
+        token_limit = context_length - PROMPT_RESPONSE_RESERVE_TOKENS - estimate_tokens(build_prompt(""))
+        selected = await select_context(index, question, token_limit)
+        if selected is not None:
+            file_contents, retrieval = selected
+    elif index is not None and policy == OVERFLOW_MAP_REDUCE:
+        context_length = await prompt_budgeter.context_length(JSON_QUERY_MODEL)
+        if estimate_tokens(build_prompt(file_contents)) + PROMPT_RESPONSE_RESERVE_TOKENS > context_length:
+            build_prompt = build_prompt_with(f"{instruction_block} {REDUCE_INSTRUCTION}")
+            file_contents, map_reduce = await map_reducer.map_document(
+                JSON_QUERY_MODEL,
+                index.header,
+                index.chunks,
+                build_prompt_with(f"{instruction_block} {MAP_INSTRUCTION}"),
+                build_prompt,
+                context_length=context_length,
+                reserve_tokens=PROMPT_RESPONSE_RESERVE_TOKENS,
+                reasoning=reasoning or resolve_reasoning_budget(),
+                priority=priority,
+                use_cache=use_cache,
+            )
+
+    prompt, budget = await prompt_budgeter.fit_document(
+        JSON_QUERY_MODEL,
+        file_contents,
+        build_prompt,
+        overflow=context_overflow,
+    )
+    if retrieval is not None or map_reduce is not None:
+        budget = replace(budget, retrieval=retrieval, map_reduce=map_reduce)
     payload = {
-        "model": "deepseek-r1",
+        "model": JSON_QUERY_MODEL,
         "prompt": prompt,
-        "stream": False,
+        "options": {"num_ctx": budget.num_ctx},
     }
+    return payload, budget
+
+
+@traced("llm")
+async def run_console_json_ollama(
+    question: str,
+    file_contents: str,
+    response_language: str = "ru",
+    *,
+    instruction: str | None = None,
+    filename: str = "uploaded.json",
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    index: DocumentIndex | None = None,
+) -> dict:
+    """
+    Run the deepseek-r1 model via the Ollama HTTP API using the serialized file contents as context.
+    Рассуждения `<think>` вырезаются из ответа (см. reasoning.ReasoningBudget).
+    `index` — индекс фрагментов документа для политик `retrieve` и `map_reduce` (см. retrieval, map_reduce).
+    """
+
+    reasoning = reasoning or resolve_reasoning_budget()
+    payload, budget = await build_budgeted_payload(
+        question,
+        file_contents,
+        response_language,
+        instruction=instruction,
+        filename=filename,
+        context_overflow=context_overflow,
+        index=index,
+        reasoning=reasoning,
+        priority=priority,
+        use_cache=use_cache,
+    )
 
     try:
-        ollama_response = await call_ollama("/api/generate", payload)
+        result = await generate_with_budget(
+            payload,
+            reasoning,
+            priority=priority,
+            use_cache=use_cache,
+            affinity_key=document_affinity_key(file_contents),
+        )
     except HTTPException as exc:
         # Пробрасываем HTTPException как есть, чтобы сохранить статус код
         raise
@@ -71,7 +229,7 @@ async def run_console_json_ollama(
         elif "model" in error_msg.lower() and "not found" in error_msg.lower():
             raise HTTPException(
                 status_code=404,
-                detail=f"Модель 'deepseek-r1' не найдена в Ollama. Установите модель через docker-compose run --rm ollama-init"
+                detail=f"Модель '{JSON_QUERY_MODEL}' не найдена в Ollama. Установите модель через docker-compose run --rm ollama-init"
             ) from exc
         else:
             raise HTTPException(
@@ -79,12 +237,84 @@ async def run_console_json_ollama(
                 detail=f"Ошибка при обращении к Ollama: {error_msg}"
             ) from exc
 
-    response_text = ollama_response.get("response", "").strip()
+    if not result.reasoning_truncated:
+        prompt_budgeter.observe_response(budget, result.final_chunk)
 
     return {
-        "model": "deepseek-r1",
-        "prompt": prompt,
-        "response": response_text,
+        "model": JSON_QUERY_MODEL,
+        "prompt": payload["prompt"],
+        "response": result.answer,
+        "cached": bool(result.final_chunk.get("cached")),
+        "context_budget": budget.as_dict(),
+        "reasoning": result.stats(reasoning.include_reasoning),
+        "timings": extract_ollama_timings(result.final_chunk),
     }
 
 
+async def stream_console_json_ollama(
+    question: str,
+    file_contents: str,
+    response_language: str = "ru",
+    *,
+    instruction: str | None = None,
+    filename: str = "uploaded.json",
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    index: DocumentIndex | None = None,
+) -> AsyncGenerator[dict, None]:
+    """
+    Потоковый вариант `run_console_json_ollama`.
+    Отдаёт события `{"type": "token", "content": ...}` только с текстом ответа
+    (рассуждения — событиями `reasoning`, если они запрошены)
+    и финальное `{"type": "done", ...}` с метриками модели и числом токенов рассуждений и ответа.
+    """
+
+    reasoning = reasoning or resolve_reasoning_budget()
+    payload, budget = await build_budgeted_payload(
+        question,
+        file_contents,
+        response_language,
+        instruction=instruction,
+        filename=filename,
+        context_overflow=context_overflow,
+        index=index,
+        reasoning=reasoning,
+        priority=priority,
+        use_cache=use_cache,
+    )
+
+    answer_started = False
+
+    events = stream_with_budget(
+        payload,
+        reasoning,
+        priority=priority,
+        use_cache=use_cache,
+        affinity_key=document_affinity_key(file_contents),
+    )
+    async with aclosing(events):
+        async for kind, text, result in events:
+            if kind == "answer":
+                # После `</think>` модель ставит пустые строки — начало ответа отдаём без них
+                if not answer_started:
+                    text = text.lstrip()
+                    answer_started = bool(text)
+                if text:
+                    yield {"type": "token", "content": text}
+            elif kind == "thinking":
+                if reasoning.include_reasoning:
+                    yield {"type": "reasoning", "content": text}
+            else:
+                if not result.reasoning_truncated:
+                    prompt_budgeter.observe_response(budget, result.final_chunk)
+                yield {
+                    "type": "done",
+                    "model": JSON_QUERY_MODEL,
+                    "done_reason": "length" if result.answer_truncated else result.final_chunk.get("done_reason"),
+                    "cached": bool(result.final_chunk.get("cached")),
+                    "context_budget": budget.as_dict(),
+                    "reasoning": result.stats(include_reasoning=False),
+                    "timings": extract_ollama_timings(result.final_chunk),
+                }
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import math
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .prompt_budget import estimate_tokens
+
+ENCODER_AUTO = "auto"
+ENCODER_JSON = "json"
+ENCODER_COMPACT = "compact"
+ENCODER_TSV = "tsv"
+ENCODER_CSV = "csv"
+CONTEXT_ENCODERS = (ENCODER_AUTO, ENCODER_JSON, ENCODER_COMPACT, ENCODER_TSV, ENCODER_CSV)
+
+# auto — кодировщик по умолчанию для типа файла (см. HANDLER_MAP); json — прежний формат с отступами
+CONTEXT_ENCODER = os.getenv("CONTEXT_ENCODER", ENCODER_AUTO).strip().lower()
+
+# Версия текстового представления: входит в ключи кэша кодирования и индексов фрагментов
+CONTEXT_ENCODING_VERSION = "2"
+
+# Таблицы документа: (остаток данных без таблиц, [(имя таблицы, записи)])
+TableExtractor = Callable[[Any], Tuple[Any, List[Tuple[str, List[Dict[str, Any]]]]]]
+
+
+def resolve_context_encoder(encoder: str | None) -> str:
+    if encoder is None or encoder == "":
+        return CONTEXT_ENCODER
+    normalized = encoder.strip().lower()
+    if normalized not in CONTEXT_ENCODERS:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Неизвестный формат контекста '{encoder}'. "
+                f"Допустимые значения: {', '.join(CONTEXT_ENCODERS)}."
+            )
+        )
+    return normalized
+
+
+@dataclass(frozen=True)
+class ContextEncoding:
+    """Как результат обработчика превращается в текст промпта."""
+
+    encoder: str = ENCODER_COMPACT
+    # Число знаков после запятой для дробных чисел (координаты DXF); None — без округления
+    float_precision: Optional[int] = None
+    tables: Optional[TableExtractor] = None
+
+    def as_key(self) -> dict:
+        return {
+            "version": CONTEXT_ENCODING_VERSION,
+            "encoder": self.encoder,
+            "float_precision": self.float_precision,
+        }
+
+
+def round_floats(value: Any, precision: int) -> Any:
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return value
+        rounded = round(value, precision)
+        return int(rounded) if rounded.is_integer() else rounded
+    if isinstance(value, dict):
+        return {key: round_floats(item, precision) for key, item in value.items()}
+    if isinstance(value, list):
+        return [round_floats(item, precision) for item in value]
+    return value
+
+
+def _compact_json(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _flatten_record(record: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    # Вложенные словари разворачиваются в столбцы «родитель.поле», списки остаются компактным JSON
+    flat: Dict[str, Any] = {}
+    for key, value in record.items():
+        column = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten_record(value, f"{column}."))
+        else:
+            flat[column] = value
+    return flat
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        return str(int(value)) if value.is_integer() else repr(value)
+    if isinstance(value, (list, dict)):
+        return _compact_json(value)
+    return str(value)
+
+
+def _write_table(out: io.StringIO, name: str, records: List[Dict[str, Any]], delimiter: str) -> None:
+    rows = [_flatten_record(record) if isinstance(record, dict) else {"value": record} for record in records]
+    columns: Dict[str, None] = {}
+    for row in rows:
+        columns.update(dict.fromkeys(row))
+    out.write(f"# {name} (строк: {len(rows)})\n")
+    if delimiter == "\t":
+        # В TSV нет экранирования: табуляции и переводы строк внутри ячеек заменяются пробелами
+        def clean(text: str) -> str:
+            return text.replace("\t", " ").replace("\r", " ").replace("\n", " ")
+
+        out.write("\t".join(clean(column) for column in columns) + "\n")
+        for row in rows:
+            out.write("\t".join(clean(_cell(row.get(column))) for column in columns) + "\n")
+    else:
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(list(columns))
+        for row in rows:
+            writer.writerow([_cell(row.get(column)) for column in columns])
+
+
+def _encode(payload: Any, encoder: str, encoding: ContextEncoding) -> Tuple[str, bool]:
+    # Текст и признак того, что в нём есть таблицы (для пояснения формата в инструкции)
+    if encoding.float_precision is not None:
+        payload = round_floats(payload, encoding.float_precision)
+
+    if encoder == ENCODER_JSON:
+        return json.dumps(payload, indent=2, ensure_ascii=False, default=str), False
+    if encoder not in (ENCODER_TSV, ENCODER_CSV) or encoding.tables is None:
+        return _compact_json(payload), False
+
+    remainder, tables = encoding.tables(payload)
+    if not tables:
+        return _compact_json(payload), False
+    out = io.StringIO()
+    if remainder:
+        out.write(_compact_json(remainder) + "\n")
+    for name, records in tables:
+        _write_table(out, name, records, "\t" if encoder == ENCODER_TSV else ",")
+    return out.getvalue(), True
+
+
+def encode_context(payload: Any, encoder: str, encoding: ContextEncoding) -> str:
+    """
+    Текст документа для промпта:
+    - json — JSON с отступами (прежний формат);
+    - compact — JSON без пробелов;
+    - tsv/csv — таблицы с одной строкой заголовков вместо повторения ключей в каждой записи;
+      остальные данные документа — компактным JSON перед таблицами.
+    Если у обработчика нет таблиц или в документе они не нашлись, tsv/csv равносильны compact.
+    """
+    return _encode(payload, encoder, encoding)[0]
+
+
+_FORMAT_NOTES = {
+    ENCODER_TSV: (
+        "Данные переданы таблицами в формате TSV: строка «# имя (строк: N)», затем заголовки столбцов "
+        "и строки значений через табуляцию; вложенные поля — столбцы вида «родитель.поле»."
+    ),
+    ENCODER_CSV: (
+        "Данные переданы таблицами в формате CSV: строка «# имя (строк: N)», затем заголовки столбцов "
+        "и строки значений через запятую; вложенные поля — столбцы вида «родитель.поле»."
+    ),
+}
+
+
+@dataclass(frozen=True)
+class EncodedContext:
+    content: str
+    encoder: str
+    tokens: int
+    # Оценка для прежнего формата (JSON с отступами) — для подсчёта экономии
+    baseline_tokens: int
+    # В тексте есть таблицы TSV/CSV; иначе он записан JSON, даже если запрошен tsv/csv
+    tabular: bool = False
+
+    def as_dict(self) -> dict:
+        return {
+            "encoder": self.encoder,
+            "tokens": self.tokens,
+            "baseline_tokens": self.baseline_tokens,
+            "tokens_saved": self.baseline_tokens - self.tokens,
+            "tabular": self.tabular,
+        }
+
+
+def build_encoded_context(payload: Any, encoder: str, encoding: ContextEncoding) -> EncodedContext:
+    """Кодирует документ и оценивает токены его и прежнего формата. Синхронно — вызывать через to_thread."""
+    content, tabular = _encode(payload, encoder, encoding)
+    tokens = estimate_tokens(content)
+    if encoder == ENCODER_JSON and encoding.float_precision is None:
+        baseline_tokens = tokens
+    else:
+        baseline_tokens = estimate_tokens(json.dumps(payload, indent=2, ensure_ascii=False, default=str))
+    return EncodedContext(
+        content=content, encoder=encoder, tokens=tokens, baseline_tokens=baseline_tokens, tabular=tabular
+    )
+
+
+def context_format_note(encoded: EncodedContext) -> str:
+    """Пояснение к формату для инструкции модели — только если документ действительно записан таблицами."""
+    if not encoded.tabular:
+        return ""
+    return _FORMAT_NOTES.get(encoded.encoder, "")
+
+
+@dataclass
+class _EncoderStats:
+    documents: int = 0
+    tokens: int = 0
+    baseline_tokens: int = 0
+
+    def as_dict(self) -> dict:
+        saved = self.baseline_tokens - self.tokens
+        return {
+            "documents": self.documents,
+            "tokens": self.tokens,
+            "baseline_tokens": self.baseline_tokens,
+            "tokens_saved": saved,
+            "saved_ratio": round(saved / self.baseline_tokens, 4) if self.baseline_tokens else 0.0,
+        }
+
+
+class ContextEncoderStats:
+    """Экономия токенов промпта по кодировщикам и типам файлов."""
+
+    def __init__(self) -> None:
+        self._by_encoder: Dict[str, _EncoderStats] = {}
+        self._by_handler: Dict[str, _EncoderStats] = {}
+
+    def observe(self, handler: str, encoded: EncodedContext) -> None:
+        for stats in (
+            self._by_encoder.setdefault(encoded.encoder, _EncoderStats()),
+            self._by_handler.setdefault(handler, _EncoderStats()),
+        ):
+            stats.documents += 1
+            stats.tokens += encoded.tokens
+            stats.baseline_tokens += encoded.baseline_tokens
+
+    def snapshot(self) -> dict:
+        return {
+            "default_encoder": CONTEXT_ENCODER,
+            "by_encoder": {name: stats.as_dict() for name, stats in sorted(self._by_encoder.items())},
+            "by_handler": {name: stats.as_dict() for name, stats in sorted(self._by_handler.items())},
+        }
+
+
+context_encoder_stats = ContextEncoderStats()
+
+
+__all__ = [
+    "CONTEXT_ENCODERS",
+    "ContextEncoding",
+    "EncodedContext",
+    "build_encoded_context",
+    "context_encoder_stats",
+    "context_format_note",
+    "encode_context",
+    "resolve_context_encoder",
+    "round_floats",
+]
@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from .metrics import record_cache_lookup
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+CONVERSION_CACHE_ENABLED = os.getenv("CONVERSION_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+CONVERSION_CACHE_DIR = os.getenv(
+    "CONVERSION_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "ba_ai_gost", "conversion_cache"),
+)
+CONVERSION_CACHE_MAX_BYTES = int(os.getenv("CONVERSION_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CONVERSION_CACHE_COMPRESSION_LEVEL = int(os.getenv("CONVERSION_CACHE_COMPRESSION_LEVEL", "6"))
+
+# После вытеснения по размеру диск заполняется не более чем на эту долю лимита
+_DISK_EVICTION_TARGET = 0.9
+
+
+def conversion_cache_key(
+    file_digest: str,
+    handler: str,
+    version: str,
+    options: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Ключ результата конвертации: SHA-256 загруженного файла, имя и версия обработчика, параметры.
+    При изменении формата вывода обработчика достаточно поднять его версию — старые записи не совпадут.
+    """
+    material = {"file_sha256": file_digest, "handler": handler, "version": version, "options": options or {}}
+    serialized = json.dumps(material, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ConversionCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    errors: int = 0
+    # Объём результатов конвертации, отданных из кэша, и сэкономленное время обработчиков
+    bytes_saved: int = 0
+    seconds_saved: float = 0.0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        data = asdict(self)
+        data["seconds_saved"] = round(self.seconds_saved, 3)
+        data["hit_ratio"] = round(self.hits / lookups, 4) if lookups else 0.0
+        return data
+
+
+class ConversionCache:
+    """
+    Кэш результатов конвертации загруженных файлов на диске (JSON, сжатый zlib).
+    Записи адресуются содержимым, поэтому не устаревают; при превышении лимита размера
+    вытесняются самые давно использованные (по mtime). Запись через временный файл
+    и атомарное переименование: каталог разделяют все воркеры uvicorn и воркер очереди,
+    и он переживает перезапуск.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path = CONVERSION_CACHE_DIR,
+        *,
+        max_bytes: int = CONVERSION_CACHE_MAX_BYTES,
+        compression_level: int = CONVERSION_CACHE_COMPRESSION_LEVEL,
+        enabled: bool = CONVERSION_CACHE_ENABLED,
+    ) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max(0, max_bytes)
+        self.compression_level = compression_level
+        self.enabled = enabled
+        self.stats = ConversionCacheStats()
+        self._disk_bytes: Optional[int] = None
+        self._stored_raw_bytes = 0
+        self._stored_compressed_bytes = 0
+
+    def _path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json.z"
+
+    def _read(self, key: str) -> Optional[Tuple[Any, int, float]]:
+        path = self._path_for(key)
+        try:
+            raw = zlib.decompress(path.read_bytes())
+            record = json.loads(raw)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error) as exc:
+            logger.warning("Corrupted conversion cache entry %s: %s", path, exc)
+            path.unlink(missing_ok=True)
+            return None
+        # mtime служит отметкой последнего использования для LRU-вытеснения
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return record.get("value"), len(raw), float(record.get("seconds", 0.0))
+
+    def _write(self, key: str, value: Any, seconds: float) -> Tuple[int, int]:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        raw = json.dumps(
+            {"stored_at": time.time(), "seconds": seconds, "value": value}, ensure_ascii=False
+        ).encode("utf-8")
+        data = zlib.compress(raw, self.compression_level)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False, suffix=".tmp") as tmp_file:
+            tmp_file.write(data)
+            tmp_path = Path(tmp_file.name)
+        os.replace(tmp_path, path)
+
+        if self._disk_bytes is None:
+            self._disk_bytes = self._scan_disk_bytes()
+        else:
+            self._disk_bytes += len(data)
+        if self.max_bytes and self._disk_bytes > self.max_bytes:
+            self._evict()
+        return len(raw), len(data)
+
+    def _scan_entries(self) -> list[Tuple[float, int, Path]]:
+        entries = []
+        for path in self.directory.glob("*/*.json.z"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(size for _, size, _ in self._scan_entries())
+
+    def _evict(self) -> None:
+        entries = sorted(self._scan_entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * _DISK_EVICTION_TARGET)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.stats.evictions += 1
+        self._disk_bytes = total
+
+    async def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        record = await to_thread(self._read, key)
+        record_cache_lookup("conversion", record is not None)
+        if record is None:
+            self.stats.misses += 1
+            return None
+        value, raw_bytes, seconds = record
+        self.stats.hits += 1
+        self.stats.bytes_saved += raw_bytes
+        self.stats.seconds_saved += seconds
+        return value
+
+    async def put(self, key: str, value: Any, *, seconds: float = 0.0) -> None:
+        if not self.enabled:
+            return
+        try:
+            raw_bytes, compressed_bytes = await to_thread(self._write, key, value, seconds)
+        except (OSError, TypeError, ValueError) as exc:
+            self.stats.errors += 1
+            logger.warning("Failed to write conversion cache entry %s: %s", key, exc)
+            return
+        self.stats.stores += 1
+        self._stored_raw_bytes += raw_bytes
+        self._stored_compressed_bytes += compressed_bytes
+
+    async def get_or_convert(self, key: str, convert: Callable[[], Awaitable[Any]]) -> Any:
+        """Результат из кэша или `convert()` с сохранением результата; ошибки конвертации не кэшируются."""
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+        started = time.perf_counter()
+        value = await convert()
+        await self.put(key, value, seconds=time.perf_counter() - started)
+        return value
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "directory": str(self.directory),
+            "disk_bytes": self._disk_bytes,
+            "max_bytes": self.max_bytes,
+            "compression_ratio": (
+                round(self._stored_raw_bytes / self._stored_compressed_bytes, 2)
+                if self._stored_compressed_bytes else None
+            ),
+            **self.stats.as_dict(),
+        }
+
+
+conversion_cache = ConversionCache()
+
+
+__all__ = ["ConversionCache", "conversion_cache", "conversion_cache_key"]
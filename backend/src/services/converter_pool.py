@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+THREAD = "thread"
+PROCESS = "process"
+_MODES = (THREAD, PROCESS)
+
+# 0 — пул процессов отключён, обработчики с режимом process выполняются в потоках
+CONVERTER_PROCESS_WORKERS = int(os.getenv("CONVERTER_PROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# spawn безопасен для процесса с циклом событий и потоками; fork быстрее стартует, но наследует их состояние
+CONVERTER_PROCESS_START_METHOD = os.getenv("CONVERTER_PROCESS_START_METHOD", "spawn")
+# Входные данные крупнее порога передаются через разделяемую память, а не pickle по каналу
+CONVERTER_SHARED_MEMORY_THRESHOLD_BYTES = int(
+    os.getenv("CONVERTER_SHARED_MEMORY_THRESHOLD_BYTES", str(1024 * 1024))
+)
+# Модули, импортируемые в рабочих процессах при старте; имена с точкой в начале — относительно services
+CONVERTER_PROCESS_PRELOAD = [
+    name.strip()
+    for name in os.getenv(
+        "CONVERTER_PROCESS_PRELOAD",
+        "pandas,openpyxl,ezdxf,xmltodict,"
+        ".file_handlers.arp_upload_service,.file_handlers.dxf_console_service,"
+        ".file_handlers.gsfx_upload_service,.file_handlers.rtf_upload_service,"
+        ".file_handlers.xlsx_upload_service",
+    ).split(",")
+    if name.strip()
+]
+
+_SERVICES_PACKAGE = __package__
+
+
+@dataclass(frozen=True)
+class ConverterExecution:
+    """Где выполняется синхронная часть обработчика: в пуле потоков или в пуле процессов."""
+
+    name: str
+    mode: str
+
+
+def converter_execution(name: str, default: str = THREAD) -> ConverterExecution:
+    """
+    Режим выполнения обработчика `name`: значение по умолчанию задаёт сам обработчик,
+    переопределяется переменной `CONVERTER_EXECUTION_<NAME>` (thread/process).
+    """
+    mode = os.getenv(f"CONVERTER_EXECUTION_{name.upper()}", default).strip().lower()
+    if mode not in _MODES:
+        logger.warning("Unknown execution mode %r for converter %s, using %s", mode, name, default)
+        mode = default
+    return ConverterExecution(name=name, mode=mode)
+
+
+@dataclass(frozen=True)
+class _SharedPayload:
+    """Ссылка на входные данные в разделяемой памяти вместо самих байтов."""
+
+    name: str
+    size: int
+    text: bool
+
+
+def _init_worker(modules: List[str]) -> None:
+    for module in modules:
+        try:
+            importlib.import_module(module, package=_SERVICES_PACKAGE if module.startswith(".") else None)
+        except ImportError as exc:
+            # Необязательные зависимости: обработчик сам сообщит об их отсутствии
+            logger.debug("Converter worker preload skipped %s: %s", module, exc)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _shared_memory_free_bytes() -> float:
+    # Запись сверх свободного места в tmpfs /dev/shm завершает процесс по SIGBUS — проверяем заранее
+    try:
+        stat = os.statvfs("/dev/shm")
+    except (AttributeError, OSError):
+        return float("inf")
+    return stat.f_bavail * stat.f_frsize
+
+
+def _run_in_worker(func: Callable[..., T], payload: Any, args: tuple) -> T:
+    if isinstance(payload, _SharedPayload):
+        # Подключение к сегменту родителя; удаляет сегмент родитель после завершения задачи
+        segment = shared_memory.SharedMemory(name=payload.name)
+        # Подключение регистрирует сегмент в resource_tracker, как будто им владеет рабочий процесс
+        resource_tracker.unregister(segment._name, "shared_memory")
+        try:
+            data = bytes(segment.buf[: payload.size])
+        finally:
+            segment.close()
+        payload = data.decode("utf-8") if payload.text else data
+    return func(payload, *args)
+
+
+def _release_segment(segment: shared_memory.SharedMemory, _future: Any = None) -> None:
+    segment.close()
+    # Рабочий процесс снял сегмент с учёта в общем resource_tracker: без повторной регистрации
+    # unlink() завершится ошибкой KeyError в процессе resource_tracker
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+@dataclass
+class _ConverterStats:
+    thread_tasks: int = 0
+    process_tasks: int = 0
+    failures: int = 0
+    seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        tasks = self.thread_tasks + self.process_tasks
+        return {
+            "thread_tasks": self.thread_tasks,
+            "process_tasks": self.process_tasks,
+            "failures": self.failures,
+            "avg_seconds": round(self.seconds / tasks, 4) if tasks else None,
+        }
+
+
+class ConverterPool:
+    """
+    Пул процессов для CPU-ёмких конвертеров (разбор RTF и ARP, xmltodict, pandas, ezdxf).
+    В пуле потоков такие задачи упираются в GIL, и одновременные загрузки обрабатываются
+    на одном ядре. Рабочие процессы запускаются заранее с импортированными тяжёлыми модулями;
+    крупные входные данные передаются через разделяемую память. После аварийного завершения
+    рабочего процесса пул пересоздаётся при следующем обращении.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = CONVERTER_PROCESS_WORKERS,
+        start_method: str = CONVERTER_PROCESS_START_METHOD,
+        shared_memory_threshold: int = CONVERTER_SHARED_MEMORY_THRESHOLD_BYTES,
+        preload: Optional[List[str]] = None,
+    ) -> None:
+        self.workers = max(0, workers)
+        self.start_method = start_method
+        self.shared_memory_threshold = shared_memory_threshold
+        self.preload = list(CONVERTER_PROCESS_PRELOAD if preload is None else preload)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._stats: Dict[str, _ConverterStats] = {}
+        self._restarts = 0
+        self._shared_memory_transfers = 0
+        self._shared_memory_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def _ensure_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_worker,
+                initargs=(self.preload,),
+            )
+        return self._executor
+
+    async def start(self) -> None:
+        """Запускает рабочие процессы заранее, чтобы первая загрузка не ждала spawn и импорты."""
+        if not self.enabled:
+            return
+        executor = self._ensure_executor()
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        pids = await asyncio.gather(*(loop.run_in_executor(executor, _ping) for _ in range(self.workers)))
+        logger.info(
+            "Converter process pool started: workers=%d (%d warm), %.2fs",
+            self.workers, len(set(pids)), time.perf_counter() - started,
+        )
+
+    async def stop(self) -> None:
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            await to_thread(executor.shutdown, True)
+
+    def _share(self, payload: Any) -> Optional[Tuple[shared_memory.SharedMemory, _SharedPayload]]:
+        if isinstance(payload, str):
+            data = payload.encode("utf-8")
+        elif isinstance(payload, (bytes, bytearray, memoryview)):
+            data = payload
+        else:
+            return None
+        if self.shared_memory_threshold < 0 or len(data) <= self.shared_memory_threshold:
+            return None
+        if len(data) > _shared_memory_free_bytes():
+            logger.warning("Not enough shared memory for %d bytes, passing converter input by pickle", len(data))
+            return None
+        segment = shared_memory.SharedMemory(create=True, size=len(data))
+        segment.buf[: len(data)] = data
+        self._shared_memory_transfers += 1
+        self._shared_memory_bytes += len(data)
+        # Размер сегмента округляется до страницы, поэтому передаётся точная длина данных
+        return segment, _SharedPayload(name=segment.name, size=len(data), text=isinstance(payload, str))
+
+    async def _run_in_process(self, func: Callable[..., T], payload: Any, args: tuple) -> T:
+        shared = self._share(payload)
+        if shared is not None:
+            payload = shared[1]
+        executor = self._ensure_executor()
+        future = None
+        try:
+            future = executor.submit(_run_in_worker, func, payload, args)
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # Рабочий процесс упал (например, OOM на огромном чертеже) — следующий вызов получит новый пул
+            if self._executor is executor:
+                self._executor = None
+                self._restarts += 1
+                executor.shutdown(wait=False)
+            raise
+        finally:
+            if shared is not None and future is not None:
+                # При отмене запроса рабочий процесс может ещё читать сегмент: удаляем его, когда задача завершится
+                future.add_done_callback(functools.partial(_release_segment, shared[0]))
+            elif shared is not None:
+                _release_segment(shared[0])
+
+    async def run(self, execution: ConverterExecution, func: Callable[..., T], payload: Any, *args: Any) -> T:
+        """
+        Выполняет `func(payload, *args)` вне цикла событий в режиме `execution`.
+        Для режима process функция и аргументы должны быть доступны для pickle.
+        """
+        stats = self._stats.setdefault(execution.name, _ConverterStats())
+        use_process = execution.mode == PROCESS and self.enabled
+        started = time.perf_counter()
+        try:
+            if use_process:
+                stats.process_tasks += 1
+                return await self._run_in_process(func, payload, args)
+            stats.thread_tasks += 1
+            return await to_thread(func, payload, *args)
+        except Exception:
+            stats.failures += 1
+            raise
+        finally:
+            stats.seconds += time.perf_counter() - started
+
+    def snapshot(self) -> dict:
+        return {
+            "workers": self.workers,
+            "start_method": self.start_method,
+            "running": self._executor is not None,
+            "restarts": self._restarts,
+            "shared_memory_threshold_bytes": self.shared_memory_threshold,
+            "shared_memory_transfers": self._shared_memory_transfers,
+            "shared_memory_bytes": self._shared_memory_bytes,
+            "converters": {name: stats.as_dict() for name, stats in sorted(self._stats.items())},
+        }
+
+
+converter_pool = ConverterPool()
+
+
+async def run_converter(execution: ConverterExecution, func: Callable[..., T], payload: Any, *args: Any) -> T:
+    return await converter_pool.run(execution, func, payload, *args)
+
+
+__all__ = [
+    "PROCESS",
+    "THREAD",
+    "ConverterExecution",
+    "ConverterPool",
+    "converter_execution",
+    "converter_pool",
+    "run_converter",
+]
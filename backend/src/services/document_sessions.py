@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, AsyncIterator, List, Optional
+
+from fastapi import HTTPException, UploadFile
+
+from .console_json_ollama import JSON_QUERY_MODEL, build_follow_up_prompt, build_json_prompt
+from .json_file_router import load_raw_json_data
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .ollama_service import extract_ollama_timings
+from .prompt_budget import estimate_tokens, prompt_budgeter
+from .reasoning import ReasoningBudget, generate_with_budget, resolve_reasoning_budget, stream_with_budget
+from .single_flight import buffer_upload
+from .streaming import prime_event_stream
+from .utils.compat_asyncio import aclosing
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_SESSION_IDLE_TIMEOUT_SECONDS = float(os.getenv("DOCUMENT_SESSION_IDLE_TIMEOUT_SECONDS", "1800"))
+DOCUMENT_SESSION_MAX_SESSIONS = int(os.getenv("DOCUMENT_SESSION_MAX_SESSIONS", "64"))
+# Когда накопленный контекст диалога длиннее, следующий вопрос снова отправляется с полным документом
+DOCUMENT_SESSION_MAX_CONTEXT_TOKENS = int(os.getenv("DOCUMENT_SESSION_MAX_CONTEXT_TOKENS", "32768"))
+
+
+@dataclass
+class DocumentSession:
+    session_id: str
+    filename: str
+    instruction: str
+    content: str
+    created_at: float
+    last_used_at: float
+    context: Optional[List[int]] = None
+    num_ctx: int = 0
+    turns: int = 0
+    context_encoding: Optional[dict] = None
+    # Загруженный файл в памяти и его SHA-256: по ним документ перекодируется в другой формат
+    source: Optional[UploadFile] = field(default=None, repr=False)
+    file_digest: Optional[str] = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+    def describe(self, idle_timeout: float) -> dict:
+        return {
+            "session_id": self.session_id,
+            "filename": self.filename,
+            "content_length": len(self.content),
+            "context_encoding": self.context_encoding,
+            "turns": self.turns,
+            "context_tokens": len(self.context) if self.context else 0,
+            "num_ctx": self.num_ctx,
+            "created_at": self.created_at,
+            "last_used_at": self.last_used_at,
+            "expires_in_seconds": max(0.0, round(self.last_used_at + idle_timeout - time.time(), 1)),
+        }
+
+
+class DocumentSessionStore:
+    """
+    Хранилище сессий «загрузил один раз — спросил много раз».
+    Сессии живут в памяти процесса и удаляются после `idle_timeout` секунд без обращений;
+    при превышении `max_sessions` вытесняется сессия, к которой дольше всего не обращались.
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = DOCUMENT_SESSION_IDLE_TIMEOUT_SECONDS,
+        max_sessions: int = DOCUMENT_SESSION_MAX_SESSIONS,
+    ) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, DocumentSession]" = OrderedDict()
+
+    def purge_expired(self) -> int:
+        deadline = time.time() - self.idle_timeout
+        expired = [sid for sid, session in self._sessions.items() if session.last_used_at < deadline]
+        for session_id in expired:
+            del self._sessions[session_id]
+        if expired:
+            logger.info("Expired %d document session(s)", len(expired))
+        return len(expired)
+
+    def create(
+        self,
+        *,
+        filename: str,
+        instruction: str,
+        content: str,
+        context_encoding: Optional[dict] = None,
+        source: Optional[UploadFile] = None,
+        file_digest: Optional[str] = None,
+    ) -> DocumentSession:
+        self.purge_expired()
+        while len(self._sessions) >= self.max_sessions:
+            evicted_id, _ = self._sessions.popitem(last=False)
+            logger.info("Evicted document session %s (limit %d)", evicted_id, self.max_sessions)
+
+        now = time.time()
+        session = DocumentSession(
+            session_id=uuid.uuid4().hex,
+            filename=filename,
+            instruction=instruction,
+            content=content,
+            context_encoding=context_encoding,
+            source=source,
+            file_digest=file_digest,
+            created_at=now,
+            last_used_at=now,
+        )
+        self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> DocumentSession:
+        self.purge_expired()
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Сессия '{session_id}' не найдена или истекла. Загрузите документ заново."
+            )
+        session.last_used_at = time.time()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id: str) -> None:
+        if self._sessions.pop(session_id, None) is None:
+            raise HTTPException(status_code=404, detail=f"Сессия '{session_id}' не найдена.")
+
+    def snapshot(self) -> dict:
+        self.purge_expired()
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "idle_timeout_seconds": self.idle_timeout,
+        }
+
+
+session_store = DocumentSessionStore()
+
+
+async def create_document_session(json_file: UploadFile, context_encoder: str | None = None) -> dict:
+    """Конвертирует загруженный файл один раз и сохраняет результат в новой сессии."""
+    if json_file is None:
+        raise HTTPException(status_code=400, detail="Файл не предоставлен. Загрузите файл для создания сессии.")
+
+    filename = json_file.filename or "unknown"
+    try:
+        source, file_digest = await buffer_upload(json_file)
+        routed_payload = await load_raw_json_data(source, file_digest, context_encoder)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        error_type = type(exc).__name__
+        logger.error("Error loading file %s for session: %s: %s", filename, error_type, exc, exc_info=True)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ошибка при чтении файла '{filename}' ({error_type}): {exc}"
+        ) from exc
+
+    session = session_store.create(
+        filename=routed_payload.filename,
+        instruction=routed_payload.instruction,
+        content=routed_payload.content,
+        context_encoding=routed_payload.encoding,
+        source=source,
+        file_digest=file_digest,
+    )
+    logger.info("Created document session %s for file %s", session.session_id, session.filename)
+    return session.describe(session_store.idle_timeout)
+
+
+def describe_document_session(session_id: str) -> dict:
+    return session_store.get(session_id).describe(session_store.idle_timeout)
+
+
+async def _apply_context_encoder(session: DocumentSession, context_encoder: str | None) -> None:
+    """
+    Перекодирует документ сессии в формат `context_encoder` (результат конвертации берётся из кэша).
+    Если текст документа изменился, накопленный `context` сбрасывается: следующий вопрос
+    отправляется с документом в новом формате.
+    """
+    if context_encoder is None or session.source is None or session.context_encoding is None:
+        return
+    if context_encoder == session.context_encoding.get("encoder"):
+        return
+    await session.source.seek(0)
+    routed_payload = await load_raw_json_data(session.source, session.file_digest, context_encoder)
+    session.context_encoding = routed_payload.encoding
+    if routed_payload.content != session.content:
+        session.content = routed_payload.content
+        session.instruction = routed_payload.instruction
+        session.context = None
+        logger.info("Session %s document re-encoded as %s", session.session_id, context_encoder)
+
+
+async def _build_session_payload(
+    session: DocumentSession,
+    question: str,
+    response_language: str,
+    context_overflow: str | None = None,
+) -> dict:
+    """
+    Первый вопрос (или вопрос после слишком длинного диалога) отправляется вместе с документом.
+    Следующие — только текстом вопроса с `context` из предыдущего ответа Ollama:
+    токены документа уже вычислены и повторно не обрабатываются.
+    `num_ctx` внутри сессии только растёт: смена окна заставила бы Ollama перезагрузить модель.
+    """
+    context = session.context
+    if context and len(context) <= DOCUMENT_SESSION_MAX_CONTEXT_TOKENS:
+        prompt = build_follow_up_prompt(question, response_language)
+        budget = await prompt_budgeter.budget_for_tokens(
+            JSON_QUERY_MODEL, len(context) + estimate_tokens(prompt), min_num_ctx=session.num_ctx
+        )
+        if budget is not None:
+            session.num_ctx = budget.num_ctx
+            return {
+                "model": JSON_QUERY_MODEL,
+                "prompt": prompt,
+                "context": context,
+                "options": {"num_ctx": budget.num_ctx},
+            }
+
+    prompt, budget = await prompt_budgeter.fit_document(
+        JSON_QUERY_MODEL,
+        session.content,
+        lambda contents: build_json_prompt(
+            question,
+            contents,
+            response_language,
+            instruction=session.instruction,
+            filename=session.filename,
+        ),
+        overflow=context_overflow,
+    )
+    session.num_ctx = max(session.num_ctx, budget.num_ctx)
+    return {
+        "model": JSON_QUERY_MODEL,
+        "prompt": prompt,
+        "options": {"num_ctx": session.num_ctx},
+    }
+
+
+def _remember_turn(session: DocumentSession, ollama_response: dict) -> None:
+    session.turns += 1
+    session.last_used_at = time.time()
+    # Ответ из кэша приходит без `context` — в этом случае сохраняем прежний
+    context = ollama_response.get("context")
+    if isinstance(context, list) and context:
+        session.context = context
+
+
+async def ask_document_session(
+    session_id: str,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    context_encoder: str | None = None,
+) -> dict:
+    """
+    Вопрос к документу сессии. Рассуждения `<think>` вырезаются из ответа и ограничиваются
+    бюджетом `reasoning`, как в `/json-query` (см. reasoning.ReasoningBudget).
+    """
+    reasoning = reasoning or resolve_reasoning_budget()
+    session = session_store.get(session_id)
+    async with session.lock:
+        await _apply_context_encoder(session, context_encoder)
+        payload = await _build_session_payload(session, question, response_language, context_overflow)
+        result = await generate_with_budget(
+            payload,
+            reasoning,
+            priority=priority,
+            use_cache=use_cache,
+            affinity_key=session.session_id,
+        )
+        _remember_turn(session, result.final_chunk)
+
+    if not result.answer:
+        raise HTTPException(
+            status_code=502,
+            detail="Модель вернула пустой ответ. Возможно, модель не установлена или произошла ошибка при генерации."
+        )
+
+    return {
+        "session_id": session.session_id,
+        "model": JSON_QUERY_MODEL,
+        "response": result.answer,
+        "turn": session.turns,
+        "reused_context": "context" in payload,
+        "num_ctx": payload["options"]["num_ctx"],
+        "cached": bool(result.final_chunk.get("cached")),
+        "context_encoding": session.context_encoding,
+        "reasoning": result.stats(reasoning.include_reasoning),
+        "timings": extract_ollama_timings(result.final_chunk),
+    }
+
+
+async def _stream_session_events(
+    session: DocumentSession,
+    question: str,
+    response_language: str,
+    priority: int,
+    use_cache: bool,
+    context_overflow: str | None,
+    reasoning: ReasoningBudget,
+    context_encoder: str | None,
+) -> AsyncGenerator[dict, None]:
+    async with session.lock:
+        await _apply_context_encoder(session, context_encoder)
+        payload = await _build_session_payload(session, question, response_language, context_overflow)
+        answer_started = False
+        events = stream_with_budget(
+            payload, reasoning, priority=priority, use_cache=use_cache, affinity_key=session.session_id
+        )
+        async with aclosing(events):
+            async for kind, text, result in events:
+                if kind == "answer":
+                    # После `</think>` модель ставит пустые строки — начало ответа отдаём без них
+                    if not answer_started:
+                        text = text.lstrip()
+                        answer_started = bool(text)
+                    if text:
+                        yield {"type": "token", "content": text}
+                elif kind == "thinking":
+                    if reasoning.include_reasoning:
+                        yield {"type": "reasoning", "content": text}
+                else:
+                    _remember_turn(session, result.final_chunk)
+                    yield {
+                        "type": "done",
+                        "session_id": session.session_id,
+                        "model": JSON_QUERY_MODEL,
+                        "turn": session.turns,
+                        "reused_context": "context" in payload,
+                        "done_reason": "length" if result.answer_truncated else result.final_chunk.get("done_reason"),
+                        "cached": bool(result.final_chunk.get("cached")),
+                        "context_encoding": session.context_encoding,
+                        "reasoning": result.stats(include_reasoning=False),
+                        "timings": extract_ollama_timings(result.final_chunk),
+                    }
+
+
+async def open_document_session_stream(
+    session_id: str,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    context_encoder: str | None = None,
+) -> AsyncIterator[dict]:
+    session = session_store.get(session_id)
+    return await prime_event_stream(
+        _stream_session_events(
+            session,
+            question,
+            response_language,
+            priority,
+            use_cache,
+            context_overflow,
+            reasoning or resolve_reasoning_budget(),
+            context_encoder,
+        )
+    )
+
+
+def close_document_session(session_id: str) -> None:
+    session_store.delete(session_id)
+
+
+__all__ = [
+    "ask_document_session",
+    "close_document_session",
+    "create_document_session",
+    "describe_document_session",
+    "open_document_session_stream",
+    "session_store",
+]
@@ -0,0 +1,283 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .conversion_cache import CONVERSION_CACHE_DIR
+from .metrics import record_cache_lookup
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .ollama_service import call_ollama
+from .single_flight import SingleFlight
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+# Многоязычная модель: русские формулировки вопроса и позиций сметы оказываются рядом
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "bge-m3")
+# Фрагментов в одном запросе к /api/embed
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX_DIR", os.path.join(CONVERSION_CACHE_DIR, "embeddings"))
+EMBEDDING_INDEX_MAX_BYTES = int(os.getenv("EMBEDDING_INDEX_MAX_BYTES", str(512 * 1024 * 1024)))
+EMBEDDING_MEMORY_INDEXES = int(os.getenv("EMBEDDING_MEMORY_INDEXES", "32"))
+# После ошибки модели эмбеддингов (не скачана, узел недоступен) столько секунд поиск идёт только по BM25
+EMBEDDING_RETRY_SECONDS = float(os.getenv("EMBEDDING_RETRY_SECONDS", "60"))
+
+# Версия формата векторов на диске: входит в ключ
+EMBEDDING_INDEX_VERSION = "1"
+
+_DISK_EVICTION_TARGET = 0.9
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Векторы единичной длины (float32): косинусная близость сводится к скалярному произведению."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class EmbeddingIndex:
+    """Векторы фрагментов документа — матрица n×d в памяти; поиск — одно умножение матрицы на вектор."""
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return int(self.vectors.shape[0])
+
+    def top_k(self, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """До `k` пар (номер фрагмента, косинус) по убыванию близости к нормированному `query`."""
+        if not len(self) or k <= 0:
+            return []
+        scores = self.vectors @ query
+        k = min(k, len(scores))
+        # argpartition — O(n) вместо полной сортировки, сортируются только k лучших
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(number), float(scores[number])) for number in top]
+
+
+async def embed_texts(
+    texts: Sequence[str],
+    *,
+    model: str = EMBEDDING_MODEL,
+    priority: int = PRIORITY_INTERACTIVE,
+) -> np.ndarray:
+    """
+    Нормированные эмбеддинги `texts` (матрица len(texts)×d) пачками по `EMBEDDING_BATCH_SIZE`
+    через `/api/embed`. Ошибки Ollama пробрасываются как HTTPException (см. call_ollama).
+    Запросы не ждут слотов планировщика: вектор вопроса не должен стоять в очереди за генерациями.
+    """
+    batch_size = max(1, EMBEDDING_BATCH_SIZE)
+    batches = []
+    for start in range(0, len(texts), batch_size):
+        batch = list(texts[start:start + batch_size])
+        response = await call_ollama(
+            "/api/embed",
+            # truncate: фрагмент длиннее окна модели обрезается, а не отклоняется
+            {"model": model, "input": batch, "truncate": True},
+            priority=priority,
+            use_cache=False,
+            scheduled=False,
+        )
+        embeddings = response.get("embeddings") or []
+        if len(embeddings) != len(batch):
+            raise ValueError(f"Ollama returned {len(embeddings)} embeddings for {len(batch)} inputs")
+        batches.append(np.asarray(embeddings, dtype=np.float32))
+    if not batches:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize_rows(np.vstack(batches))
+
+
+def embedding_index_key(index_key: str, model: str = EMBEDDING_MODEL) -> str:
+    material = {"index": index_key, "model": model, "version": EMBEDDING_INDEX_VERSION}
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class EmbeddingStats:
+    indexes_built: int = 0
+    memory_hits: int = 0
+    disk_hits: int = 0
+    chunks_embedded: int = 0
+    queries: int = 0
+    failures: int = 0
+    embed_seconds: float = 0.0
+    search_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["embed_seconds"] = round(self.embed_seconds, 3)
+        data["avg_search_ms"] = round(self.search_seconds * 1000 / self.queries, 3) if self.queries else None
+        del data["search_seconds"]
+        return data
+
+
+class EmbeddingStore:
+    """
+    Векторы фрагментов документов: последние — в памяти (LRU), все — на диске в `.npy`
+    (запись через временный файл и атомарное переименование, вытеснение по mtime, как в кэше конвертаций).
+    Векторы документа считаются один раз на индекс фрагментов и модель; одновременные запросы
+    по одному документу ждут одно вычисление.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path = EMBEDDING_INDEX_DIR,
+        *,
+        model: str = EMBEDDING_MODEL,
+        max_bytes: int = EMBEDDING_INDEX_MAX_BYTES,
+        max_items: int = EMBEDDING_MEMORY_INDEXES,
+        retry_seconds: float = EMBEDDING_RETRY_SECONDS,
+    ) -> None:
+        self.directory = Path(directory)
+        self.model = model
+        self.max_bytes = max(0, max_bytes)
+        self.max_items = max(0, max_items)
+        self.retry_seconds = retry_seconds
+        self.stats = EmbeddingStats()
+        self._items: "OrderedDict[str, EmbeddingIndex]" = OrderedDict()
+        self._flights = SingleFlight("embedding")
+        self._unavailable_until = 0.0
+        self._last_error: Optional[str] = None
+
+    @property
+    def available(self) -> bool:
+        return bool(self.model) and time.monotonic() >= self._unavailable_until
+
+    def mark_failure(self, exc: BaseException) -> None:
+        self.stats.failures += 1
+        self._unavailable_until = time.monotonic() + self.retry_seconds
+        self._last_error = str(getattr(exc, "detail", None) or exc)
+        logger.warning(
+            "Embedding model %s failed, using BM25 only for %.0fs: %s", self.model, self.retry_seconds, self._last_error
+        )
+
+    def _path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        path = self._path_for(key)
+        try:
+            vectors = np.load(path, allow_pickle=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError) as exc:
+            logger.warning("Corrupted embedding index %s: %s", path, exc)
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return vectors
+
+    def _save(self, key: str, vectors: np.ndarray) -> None:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False, suffix=".tmp") as tmp_file:
+            np.save(tmp_file, vectors, allow_pickle=False)
+            tmp_path = Path(tmp_file.name)
+        os.replace(tmp_path, path)
+        if self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self.directory.glob("*/*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * _DISK_EVICTION_TARGET)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def _remember(self, key: str, index: EmbeddingIndex) -> None:
+        if not self.max_items:
+            return
+        self._items[key] = index
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    async def get_or_embed(self, index_key: str, texts: Sequence[str]) -> EmbeddingIndex:
+        """Векторы фрагментов индекса `index_key` из памяти, с диска или от модели эмбеддингов."""
+        key = embedding_index_key(index_key, self.model)
+        index = self._items.get(key)
+        if index is not None and len(index) == len(texts):
+            self._items.move_to_end(key)
+            self.stats.memory_hits += 1
+            record_cache_lookup("embedding", True)
+            return index
+        return await self._flights.do(key, lambda: self._load_or_embed(key, texts))
+
+    async def _load_or_embed(self, key: str, texts: Sequence[str]) -> EmbeddingIndex:
+        vectors = await to_thread(self._load, key)
+        cached = vectors is not None and vectors.shape[0] == len(texts)
+        record_cache_lookup("embedding", cached)
+        if cached:
+            self.stats.disk_hits += 1
+        else:
+            started = time.perf_counter()
+            vectors = await embed_texts(texts, model=self.model)
+            self.stats.embed_seconds += time.perf_counter() - started
+            self.stats.indexes_built += 1
+            self.stats.chunks_embedded += len(texts)
+            try:
+                await to_thread(self._save, key, vectors)
+            except OSError as exc:
+                logger.warning("Failed to store embedding index %s: %s", key, exc)
+        index = EmbeddingIndex(vectors)
+        self._remember(key, index)
+        return index
+
+    async def search(self, index_key: str, texts: Sequence[str], question: str, k: int) -> List[Tuple[int, float]]:
+        """Ближайшие к вопросу фрагменты: [(номер фрагмента, косинус)] по убыванию близости."""
+        index = await self.get_or_embed(index_key, texts)
+        query = await embed_texts([question], model=self.model)
+        started = time.perf_counter()
+        matches = index.top_k(query[0], k)
+        self.stats.queries += 1
+        self.stats.search_seconds += time.perf_counter() - started
+        return matches
+
+    def snapshot(self) -> dict:
+        return {
+            "model": self.model,
+            "available": self.available,
+            "last_error": self._last_error,
+            "directory": str(self.directory),
+            "indexes_in_memory": len(self._items),
+            **self.stats.as_dict(),
+        }
+
+
+embedding_store = EmbeddingStore()
+
+
+__all__ = [
+    "EmbeddingIndex",
+    "EmbeddingStore",
+    "embed_texts",
+    "embedding_index_key",
+    "embedding_store",
+    "normalize_rows",
+]
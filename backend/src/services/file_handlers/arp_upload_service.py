@@ -6,13 +6,15 @@
 
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import HTTPException, UploadFile
 
-from ..utils.compat_asyncio import to_thread
+from ..converter_pool import PROCESS, converter_execution, run_converter
 
 _CANDIDATE_ENCODINGS = ("cp866", "cp1251", "utf-8")
+# Посимвольный разбор строк ARP упирается в GIL — по умолчанию в пуле процессов
+ARP_EXECUTION = converter_execution("arp", PROCESS)
 
 
 def _to_number(value: Optional[str]) -> Optional[float]:
@@ -211,6 +213,95 @@ def _parse_arp(text: str) -> Dict[str, Any]:
     return document
 
 
+def _without_type(records: Optional[List[Dict[str, Any]]]) -> Optional[List[Dict[str, Any]]]:
+    # Тип записи в таблице постоянен и только занимает токены
+    if not records:
+        return records
+    return [{key: value for key, value in record.items() if key != "type"} for record in records]
+
+
+def _section_rows(
+    items: List[Dict[str, Any]],
+    path: str,
+    sections: List[Dict[str, Any]],
+    positions: List[Dict[str, Any]],
+) -> None:
+    for item in items:
+        if item.get("type") == 10:
+            section_path = f"{path} / {item['number']}. {item['name']}" if path else f"{item['number']}. {item['name']}"
+            sections.append({
+                "section": section_path,
+                "level": item.get("level"),
+                "coefficients": _without_type(item.get("coefficients")),
+                "comments": item.get("comments"),
+            })
+            _section_rows(item.get("items", []), section_path, sections, positions)
+        elif item.get("type") == 20:
+            position = {key: value for key, value in item.items() if key != "type"}
+            if "coefficients" in position:
+                position["coefficients"] = _without_type(position["coefficients"])
+            positions.append({"section": path, **position})
+
+
+def _document_details(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # Реквизиты: поля результата обработчика и данных сметы, кроме разделов и позиций
+    document = payload.get("data") or {}
+    details = {key: value for key, value in payload.items() if key != "data" and value}
+    details.update(
+        (key, value) for key, value in document.items() if key not in ("sections", "items") and value
+    )
+    return details
+
+
+def arp_context_tables(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Tuple[str, List[Dict[str, Any]]]]]:
+    """
+    Таблицы результата `convert_arp_upload_to_json`: разделы и позиции сметы из `data`
+    (путь раздела в столбце), реквизиты документа — отдельно.
+    """
+    document = payload.get("data") or {}
+    sections: List[Dict[str, Any]] = []
+    positions: List[Dict[str, Any]] = []
+    _section_rows(document.get("sections", []), "", sections, positions)
+    _section_rows(document.get("items", []), "", sections, positions)
+    tables = [(name, rows) for name, rows in (("Разделы", sections), ("Позиции", positions)) if rows]
+    return _document_details(payload), tables
+
+
+def arp_context_chunks(
+    payload: Dict[str, Any],
+    rows_per_chunk: int,
+) -> Tuple[Dict[str, Any], List[Tuple[str, Dict[str, Any]]]]:
+    """
+    Фрагменты для поиска: позиции каждого раздела блоками по `rows_per_chunk` с путём раздела в заголовке.
+    Фрагмент имеет вид результата обработчика (`{"data": {...}}`) и кодируется теми же таблицами.
+    """
+    document = payload.get("data") or {}
+    chunks: List[Tuple[str, Dict[str, Any]]] = []
+
+    def add_positions(items: List[Dict[str, Any]], path: str, section: Optional[Dict[str, Any]]) -> None:
+        positions = [item for item in items if item.get("type") == 20]
+        section_notes = {
+            key: _without_type(section.get(key)) if key == "coefficients" else section.get(key)
+            for key in ("coefficients", "comments")
+            if section is not None and section.get(key)
+        }
+        if not positions and section_notes:
+            chunks.append((path, {"data": section_notes}))
+        for start in range(0, len(positions), rows_per_chunk):
+            block = positions[start:start + rows_per_chunk]
+            title = f"{path or 'Позиции вне разделов'} (позиции {start + 1}–{start + len(block)})"
+            # Коэффициенты и комментарии раздела — только в первом фрагменте, чтобы не размывать поиск
+            chunks.append((title, {"data": {**(section_notes if start == 0 else {}), "items": block}}))
+        for item in items:
+            if item.get("type") == 10:
+                section_path = f"{item['number']}. {item['name']}"
+                add_positions(item.get("items", []), f"{path} / {section_path}" if path else section_path, item)
+
+    add_positions(document.get("items", []), "", None)
+    add_positions(document.get("sections", []), "", None)
+    return _document_details(payload), chunks
+
+
 def _decode_arp_bytes(data: bytes) -> str:
     """
     Подбирает подходящую кодировку для ARP-файла.
@@ -241,7 +332,7 @@ async def convert_arp_upload_to_json(arp_file: UploadFile) -> Dict[str, Any]:
     text = _decode_arp_bytes(payload)
 
     try:
-        data = await to_thread(_parse_arp, text)
+        data = await run_converter(ARP_EXECUTION, _parse_arp, text)
     except Exception as exc:  # pragma: no cover - защита от непредвиденных ошибок
         raise HTTPException(status_code=422, detail="Не удалось распарсить ARP-файл.") from exc
 
@@ -251,6 +342,6 @@ async def convert_arp_upload_to_json(arp_file: UploadFile) -> Dict[str, Any]:
     }
 
 
-__all__ = ["convert_arp_upload_to_json"]
+__all__ = ["arp_context_chunks", "arp_context_tables", "convert_arp_upload_to_json"]
 
 
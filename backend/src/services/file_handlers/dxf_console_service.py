@@ -3,22 +3,28 @@
 DWG/DXF to JSON Converter using ezdxf
 """
 
+import io
 import json
+import logging
 import os
-
-import tempfile
+import re
 from pathlib import Path
 from typing import TYPE_CHECKING, Any, Dict
 
 from fastapi import HTTPException, UploadFile
 
-from ..utils.compat_asyncio import to_thread
+from ..converter_pool import PROCESS, converter_execution, run_converter
+from ..utils.spill import should_spill, spill_to_disk
+
+logger = logging.getLogger(__name__)
 
 try:  # pragma: no cover - dependency availability is runtime-specific
     import ezdxf  # type: ignore
 except ImportError:  # pragma: no cover - handled at runtime
     ezdxf = None  # type: ignore[assignment]
 
+DXF_EXECUTION = converter_execution("dxf", PROCESS)
+
 
 if TYPE_CHECKING:  # pragma: no cover - typing helpers only
     from ezdxf.document import Drawing  # type: ignore
@@ -86,6 +92,82 @@ def extract_entity_data(entity):
     
     return data
 
+def _drawing_to_dict(doc, filename):
+    """Collect layers, modelspace entities and blocks of a loaded drawing"""
+    result = {
+        'filename': filename,
+        'version': doc.dxfversion,
+        'layers': {},
+        'entities': [],
+        'blocks': {},
+        'statistics': {
+            'total_entities': 0,
+            'entities_by_type': {},
+            'total_layers': 0,
+            'total_blocks': 0
+        }
+    }
+
+    # Get layers
+    for layer in doc.layers:
+        result['layers'][layer.dxf.name] = {
+            'name': layer.dxf.name,
+            'color': layer.dxf.color if hasattr(layer.dxf, 'color') else None,
+            'linetype': layer.dxf.linetype if hasattr(layer.dxf, 'linetype') else None,
+        }
+    result['statistics']['total_layers'] = len(result['layers'])
+
+    # Get entities from modelspace
+    msp = doc.modelspace()
+    for entity in msp:
+        entity_data = extract_entity_data(entity)
+        result['entities'].append(entity_data)
+
+        # Update statistics
+        entity_type = entity.dxftype()
+        if entity_type not in result['statistics']['entities_by_type']:
+            result['statistics']['entities_by_type'][entity_type] = 0
+        result['statistics']['entities_by_type'][entity_type] += 1
+
+    result['statistics']['total_entities'] = len(result['entities'])
+
+    # Get blocks
+    for block in doc.blocks:
+        if not block.name.startswith('*'):  # Skip anonymous blocks
+            block_entities = []
+            for entity in block:
+                block_entities.append(extract_entity_data(entity))
+            result['blocks'][block.name] = {
+                'name': block.name,
+                'entities': block_entities
+            }
+    result['statistics']['total_blocks'] = len(result['blocks'])
+
+    return result
+
+
+def dxf_context_chunks(drawing, rows_per_chunk):
+    """Fragments for retrieval: modelspace entities grouped by layer, then block definitions"""
+    common = {key: value for key, value in drawing.items() if key not in ('entities', 'blocks')}
+    by_layer = {}
+    for entity in drawing.get('entities', []):
+        entity = dict(entity)
+        by_layer.setdefault(entity.pop('layer', None) or '0', []).append(entity)
+
+    chunks = []
+    for layer, entities in by_layer.items():
+        for start in range(0, len(entities), rows_per_chunk):
+            block = entities[start:start + rows_per_chunk]
+            title = f"Layer {layer} (entities {start + 1}-{start + len(block)})"
+            chunks.append((title, {'layer': layer, 'entities': block}))
+    for name, block_def in drawing.get('blocks', {}).items():
+        entities = block_def.get('entities', [])
+        for start in range(0, len(entities), rows_per_chunk):
+            block = entities[start:start + rows_per_chunk]
+            chunks.append((f"Block {name} (entities {start + 1}-{start + len(block)})", {'block': name, 'entities': block}))
+    return common, chunks
+
+
 def convert_dwg_to_json(input_file, output_file=None):
     """Convert DWG/DXF to JSON"""
     import ezdxf
@@ -112,59 +194,8 @@ def convert_dwg_to_json(input_file, output_file=None):
             print("❌ Unsupported file format. Use .dwg or .dxf")
             return None
         
-        # Extract data
-        result = {
-            'filename': os.path.basename(input_file),
-            'version': doc.dxfversion,
-            'layers': {},
-            'entities': [],
-            'blocks': {},
-            'statistics': {
-                'total_entities': 0,
-                'entities_by_type': {},
-                'total_layers': 0,
-                'total_blocks': 0
-            }
-        }
-        
-        # Get layers
-        print("📊 Extracting layers...")
-        for layer in doc.layers:
-            result['layers'][layer.dxf.name] = {
-                'name': layer.dxf.name,
-                'color': layer.dxf.color if hasattr(layer.dxf, 'color') else None,
-                'linetype': layer.dxf.linetype if hasattr(layer.dxf, 'linetype') else None,
-            }
-        result['statistics']['total_layers'] = len(result['layers'])
-        
-        # Get entities from modelspace
-        print("📐 Extracting entities...")
-        msp = doc.modelspace()
-        for entity in msp:
-            entity_data = extract_entity_data(entity)
-            result['entities'].append(entity_data)
-            
-            # Update statistics
-            entity_type = entity.dxftype()
-            if entity_type not in result['statistics']['entities_by_type']:
-                result['statistics']['entities_by_type'][entity_type] = 0
-            result['statistics']['entities_by_type'][entity_type] += 1
-        
-        result['statistics']['total_entities'] = len(result['entities'])
-        
-        # Get blocks
-        print("🧱 Extracting blocks...")
-        for block in doc.blocks:
-            if not block.name.startswith('*'):  # Skip anonymous blocks
-                block_entities = []
-                for entity in block:
-                    block_entities.append(extract_entity_data(entity))
-                result['blocks'][block.name] = {
-                    'name': block.name,
-                    'entities': block_entities
-                }
-        result['statistics']['total_blocks'] = len(result['blocks'])
-        
+        result = _drawing_to_dict(doc, os.path.basename(input_file))
+
         # Write to JSON
         if output_file is None:
             output_file = os.path.splitext(input_file)[0] + '.json'
@@ -191,6 +222,46 @@ def convert_dwg_to_json(input_file, output_file=None):
         traceback.print_exc()
         return None
 
+_BINARY_DXF_SIGNATURE = b"AutoCAD Binary DXF"
+_DXF_HEADER_SCAN_BYTES = 64 * 1024
+
+
+def _detect_dxf_encoding(payload):
+    """Text encoding of a DXF: UTF-8 since R2007 (AC1021), otherwise $DWGCODEPAGE from the header"""
+    header = payload[:_DXF_HEADER_SCAN_BYTES].decode('latin-1')
+    version = re.search(r'\$ACADVER\s*\r?\n\s*1\s*\r?\n\s*(\S+)', header)
+    if version and version.group(1) >= 'AC1021':
+        return 'utf-8'
+    codepage = re.search(r'\$DWGCODEPAGE\s*\r?\n\s*3\s*\r?\n\s*(\S+)', header)
+    if codepage:
+        from ezdxf.tools.codepage import toencoding
+        return toencoding(codepage.group(1))
+    # No header: files written by scripts are usually UTF-8
+    try:
+        payload.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1252'
+
+
+def _read_drawing(payload, suffix):
+    """Load a drawing from uploaded bytes: text DXF from memory, binary DXF/DWG and large files via disk"""
+    if (
+        suffix.lower() != '.dxf'
+        or payload.startswith(_BINARY_DXF_SIGNATURE)
+        or should_spill(len(payload))
+    ):
+        with spill_to_disk(payload, suffix) as path:
+            return ezdxf.readfile(str(path))
+
+    encoding = _detect_dxf_encoding(payload)
+    return ezdxf.read(io.StringIO(payload.decode(encoding, errors='replace')))
+
+
+def _convert_dxf_bytes(payload, filename, suffix):
+    return _drawing_to_dict(_read_drawing(payload, suffix), filename)
+
+
 async def convert_dxf_upload_to_json(dxf_file: UploadFile) -> Dict[str, Any]:
 
     if dxf_file is None:
@@ -204,22 +275,15 @@ async def convert_dxf_upload_to_json(dxf_file: UploadFile) -> Dict[str, Any]:
     if not payload:
         raise HTTPException(status_code=400, detail="Uploaded DXF/DWG file is empty")
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_input:
-        temp_input.write(payload)
-        temp_input_path = Path(temp_input.name)
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as temp_output:
-        output_path = Path(temp_output.name)
+    if ezdxf is None:
+        raise HTTPException(status_code=500, detail="ezdxf is not installed")
 
     try:
-        result = await to_thread(convert_dwg_to_json, str(temp_input_path), str(output_path))
-    finally:
-        temp_input_path.unlink(missing_ok=True)
-        output_path.unlink(missing_ok=True)
-
-    if result is None:
-        raise HTTPException(status_code=500, detail="Failed to convert DXF/DWG to JSON")
+        result = await run_converter(DXF_EXECUTION, _convert_dxf_bytes, payload, filename, suffix)
+    except Exception as exc:
+        logger.error("Failed to convert DXF/DWG %s: %s", filename, exc, exc_info=True)
+        raise HTTPException(status_code=500, detail="Failed to convert DXF/DWG to JSON") from exc
 
     return result
 
-__all__ = ["convert_dxf_upload_to_json"]
+__all__ = ["convert_dxf_upload_to_json", "dxf_context_chunks"]
@@ -6,22 +6,26 @@
 
 from __future__ import annotations
 
+import io
 import shutil
 import subprocess
 import tempfile
 import zipfile
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import HTTPException, UploadFile
 
-from ..utils.compat_asyncio import to_thread
+from ..converter_pool import PROCESS, converter_execution, run_converter
+from ..utils.spill import spill_to_disk
 
 try:  # pragma: no cover - доступность зависит от окружения выполнения
     import xmltodict  # type: ignore
 except ImportError:  # pragma: no cover - перехватываем позже
     xmltodict = None  # type: ignore[assignment]
 
+GSFX_EXECUTION = converter_execution("gsfx", PROCESS)
+
 
 def _try_decode_xml_bytes(data: bytes) -> str:
     for enc in ("utf-8", "cp1251", "latin-1"):
@@ -32,14 +36,6 @@ def _try_decode_xml_bytes(data: bytes) -> str:
     return data.decode("utf-8", errors="replace")
 
 
-def _extract_with_zip(gsfx_path: Path, out_dir: Path) -> bool:
-    if not zipfile.is_zipfile(gsfx_path):
-        return False
-    with zipfile.ZipFile(gsfx_path, "r") as zip_file:
-        zip_file.extractall(out_dir)
-    return True
-
-
 def _which_7z() -> str | None:
     for candidate in ("7z", "7za"):
         path = shutil.which(candidate)
@@ -66,41 +62,102 @@ def _find_xml_files(root: Path) -> list[Path]:
     return [path for path in root.rglob("*") if path.is_file() and path.suffix.lower() == ".xml"]
 
 
-def _process_gsfx_file(gsfx_path: Path, original_name: str) -> Dict[str, Any]:
-    if xmltodict is None:
-        raise ImportError("Модуль xmltodict недоступен. Установите зависимость `xmltodict`.")
+def _xml_files_from_zip(payload: bytes) -> Optional[Dict[str, bytes]]:
+    """XML-файлы ZIP-совместимого архива, прочитанные прямо из памяти; None — не ZIP."""
+    buffer = io.BytesIO(payload)
+    if not zipfile.is_zipfile(buffer):
+        return None
+    with zipfile.ZipFile(buffer, "r") as zip_file:
+        return {
+            info.filename: zip_file.read(info)
+            for info in zip_file.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(".xml")
+        }
+
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
+def _xml_files_from_7z(payload: bytes, suffix: str) -> Optional[Dict[str, bytes]]:
+    """Запасной путь для архивов, которые не открывает zipfile: 7-Zip работает только с файлами на диске."""
+    if not _which_7z():
+        return None
+    with tempfile.TemporaryDirectory() as tmp_dir, spill_to_disk(payload, suffix) as gsfx_path:
         extracted_dir = Path(tmp_dir) / "extracted"
         extracted_dir.mkdir(parents=True, exist_ok=True)
+        if not _extract_with_7z(gsfx_path, extracted_dir):
+            return None
+        return {
+            path.relative_to(extracted_dir).as_posix(): path.read_bytes()
+            for path in _find_xml_files(extracted_dir)
+        }
 
-        extracted = _extract_with_zip(gsfx_path, extracted_dir)
-        if not extracted:
-            extracted = _extract_with_7z(gsfx_path, extracted_dir)
-
-        if not extracted:
-            raise ValueError(
-                "Не удалось распаковать GSFX. Убедитесь, что файл является ZIP-совместимым "
-                "либо установлена утилита 7-Zip (`7z` или `7za`)."
-            )
-
-        xml_files = _find_xml_files(extracted_dir)
-        if not xml_files:
-            raise ValueError("В архиве GSFX не обнаружены XML-файлы.")
 
-        files: Dict[str, Any] = {}
-        for xml_path in xml_files:
-            data_bytes = xml_path.read_bytes()
-            xml_text = _try_decode_xml_bytes(data_bytes)
-            json_payload = xmltodict.parse(xml_text)
-            rel_path = xml_path.relative_to(extracted_dir).as_posix()
-            files[rel_path] = json_payload
+def _process_gsfx_bytes(payload: bytes, original_name: str, suffix: str = ".gsfx") -> Dict[str, Any]:
+    if xmltodict is None:
+        raise ImportError("Модуль xmltodict недоступен. Установите зависимость `xmltodict`.")
 
-        return {
-            "source_filename": original_name,
-            "xml_file_count": len(xml_files),
-            "files": files,
-        }
+    xml_files = _xml_files_from_zip(payload)
+    if xml_files is None:
+        xml_files = _xml_files_from_7z(payload, suffix)
+
+    if xml_files is None:
+        raise ValueError(
+            "Не удалось распаковать GSFX. Убедитесь, что файл является ZIP-совместимым "
+            "либо установлена утилита 7-Zip (`7z` или `7za`)."
+        )
+
+    if not xml_files:
+        raise ValueError("В архиве GSFX не обнаружены XML-файлы.")
+
+    files: Dict[str, Any] = {}
+    for rel_path, data_bytes in sorted(xml_files.items()):
+        xml_text = _try_decode_xml_bytes(data_bytes)
+        files[rel_path] = xmltodict.parse(xml_text)
+
+    return {
+        "source_filename": original_name,
+        "xml_file_count": len(xml_files),
+        "files": files,
+    }
+
+
+def _has_repeated(node: Any) -> bool:
+    if isinstance(node, list):
+        return True
+    return isinstance(node, dict) and any(_has_repeated(child) for child in node.values())
+
+
+def _xml_chunks(path: str, node: Any, rows_per_chunk: int, chunks: List[Tuple[str, Any]]) -> None:
+    # Повторяющиеся элементы (списки xmltodict) — блоками по `rows_per_chunk`; остальные поля элемента —
+    # одним фрагментом; вглубь идём только через элементы, внутри которых есть повторяющиеся
+    if isinstance(node, list):
+        for start in range(0, len(node), rows_per_chunk):
+            block = node[start:start + rows_per_chunk]
+            chunks.append((f"{path} (элементы {start + 1}–{start + len(block)})", {"items": block}))
+        return
+    if not isinstance(node, dict):
+        chunks.append((path, node))
+        return
+    rest: Dict[str, Any] = {}
+    nested = []
+    for key, value in node.items():
+        if _has_repeated(value):
+            nested.append((key, value))
+        else:
+            rest[key] = value
+    if rest:
+        chunks.append((path, rest))
+    for key, value in nested:
+        _xml_chunks(f"{path}/{key}", value, rows_per_chunk, chunks)
+
+
+def gsfx_context_chunks(payload: Dict[str, Any], rows_per_chunk: int) -> Tuple[Dict[str, Any], List[Tuple[str, Any]]]:
+    """Фрагменты для поиска и обработки по частям: элементы XML-файлов архива с путём элемента в заголовке."""
+    files = payload.get("files") or {}
+    common = {key: value for key, value in payload.items() if key != "files"}
+    common["xml_files"] = list(files)
+    chunks: List[Tuple[str, Any]] = []
+    for rel_path, document in files.items():
+        _xml_chunks(rel_path, document, rows_per_chunk, chunks)
+    return common, chunks
 
 
 async def convert_gsfx_upload_to_json(gsfx_file: UploadFile) -> Dict[str, Any]:
@@ -118,20 +175,14 @@ async def convert_gsfx_upload_to_json(gsfx_file: UploadFile) -> Dict[str, Any]:
     if not payload:
         raise HTTPException(status_code=400, detail="Загруженный GSFX-файл пуст.")
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-        tmp_file.write(payload)
-        tmp_path = Path(tmp_file.name)
-
     try:
-        result = await to_thread(_process_gsfx_file, tmp_path, filename)
+        result = await run_converter(GSFX_EXECUTION, _process_gsfx_bytes, payload, filename, suffix)
     except ImportError as exc:
         raise HTTPException(status_code=500, detail=str(exc)) from exc
     except ValueError as exc:
         raise HTTPException(status_code=422, detail=str(exc)) from exc
     except Exception as exc:  # pragma: no cover - защита от непредвиденных ошибок
         raise HTTPException(status_code=500, detail="Неожиданная ошибка при обработке GSFX.") from exc
-    finally:
-        tmp_path.unlink(missing_ok=True)
 
     return result
 
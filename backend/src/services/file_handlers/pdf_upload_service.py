@@ -11,14 +11,18 @@ from typing import Any, Dict, List, Tuple
 
 from fastapi import HTTPException, UploadFile
 
-try:
-    import pypdfium2 as pdfium
-except ImportError as exc:
-    raise ImportError(
-        "pypdfium2 не установлен. Установите его командой: pip install pypdfium2>=4.27.0"
-    ) from exc
+from ..converter_pool import THREAD, converter_execution, run_converter
 
-from src.services.utils.compat_asyncio import to_thread
+try:  # pragma: no cover - доступность зависит от окружения выполнения
+    import pypdfium2 as pdfium  # type: ignore
+except ImportError:  # pragma: no cover - перехватываем при обработке файла
+    # Без pypdfium2 приложение работает, недоступна только обработка PDF
+    pdfium = None  # type: ignore[assignment]
+
+PDFIUM_MISSING = "pypdfium2 не установлен. Установите его командой: pip install pypdfium2>=4.27.0"
+
+# pdfium рисует страницы в C-коде, а результат (Base64 изображения) дорого передавать между процессами
+PDF_EXECUTION = converter_execution("pdf", THREAD)
 
 
 def _render_pdf_pages(pdf_bytes: bytes, scale: float = 2.0, max_pages: int = 50) -> Tuple[int, List[Dict[str, Any]]]:
@@ -96,6 +100,9 @@ async def convert_pdf_upload_to_base64_images(pdf_file: UploadFile) -> Dict[str,
 
     filename = pdf_file.filename or "uploaded.pdf"
 
+    if pdfium is None:
+        raise HTTPException(status_code=503, detail=PDFIUM_MISSING)
+
     # Ограничение размера файла (50 MB)
     MAX_FILE_SIZE = 50 * 1024 * 1024
     
@@ -112,7 +119,7 @@ async def convert_pdf_upload_to_base64_images(pdf_file: UploadFile) -> Dict[str,
         )
 
     try:
-        page_count, images = await to_thread(_render_pdf_pages, payload)
+        page_count, images = await run_converter(PDF_EXECUTION, _render_pdf_pages, payload)
     except ValueError as exc:
         error_msg = str(exc) or "Ошибка валидации PDF"
         raise HTTPException(
@@ -10,7 +10,9 @@ from typing import Any, Dict, List, Tuple
 
 from fastapi import HTTPException, UploadFile
 
-from ..utils.compat_asyncio import to_thread
+from ..converter_pool import PROCESS, converter_execution, run_converter
+
+RTF_EXECUTION = converter_execution("rtf", PROCESS)
 
 
 def _decode_rtf_bytes(data: bytes) -> str:
@@ -226,6 +228,17 @@ def _prepare_rtf_payload(rtf_text: str) -> Dict[str, Any]:
     }
 
 
+def rtf_context_chunks(payload: Dict[str, Any], rows_per_chunk: int) -> Tuple[Dict[str, Any], List[Tuple[str, str]]]:
+    """Фрагменты для поиска: абзацы текста блоками по `rows_per_chunk`."""
+    common = {key: value for key, value in payload.items() if key not in ("plain_text", "paragraphs")}
+    paragraphs = payload.get("paragraphs") or []
+    chunks = []
+    for start in range(0, len(paragraphs), rows_per_chunk):
+        block = paragraphs[start:start + rows_per_chunk]
+        chunks.append((f"Абзацы {start + 1}–{start + len(block)}", "\n".join(block)))
+    return common, chunks
+
+
 async def convert_rtf_upload_to_json(rtf_file: UploadFile) -> Dict[str, Any]:
     """
     Конвертирует RTF-файл, полученный через UploadFile, в словарь с извлечённым текстом.
@@ -280,7 +293,7 @@ async def convert_rtf_upload_to_json(rtf_file: UploadFile) -> Dict[str, Any]:
             ) from exc
 
     try:
-        parsed = await to_thread(_prepare_rtf_payload, rtf_text)
+        parsed = await run_converter(RTF_EXECUTION, _prepare_rtf_payload, rtf_text)
     except Exception as exc:
         error_msg = str(exc)
         # Улучшаем сообщение об ошибке
@@ -306,7 +319,7 @@ async def convert_rtf_upload_to_json(rtf_file: UploadFile) -> Dict[str, Any]:
     }
 
 
-__all__ = ["convert_rtf_upload_to_json"]
+__all__ = ["convert_rtf_upload_to_json", "rtf_context_chunks"]
 
 
 
@@ -8,9 +8,8 @@ from __future__ import annotations
 
 import math
 import re
-import tempfile
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
 
 try:
     import pandas as pd  # type: ignore[import-untyped]
@@ -46,10 +45,13 @@ except ImportError:
 from zipfile import BadZipFile
 import logging
 
-from ..utils.compat_asyncio import to_thread
+from ..converter_pool import PROCESS, converter_execution, run_converter
+from ..utils.spill import binary_source
 
 logger = logging.getLogger(__name__)
 
+XLSX_EXECUTION = converter_execution("xlsx", PROCESS)
+
 
 EU_DECIMAL_RE = re.compile(
     r"""^\s*      # leading spaces
@@ -184,20 +186,22 @@ def dataframe_to_records(df: pd.DataFrame) -> List[Dict[str, Any]]:
 
 
 def convert_xlsx_to_json(
-    xlsx_path: Union[str, Path],
+    xlsx_source: Union[str, Path, BinaryIO],
     sheet: Optional[str],
     header_row: Optional[int],
     ffill_merged: bool,
     drop_empty_rows: bool,
     drop_empty_cols: bool,
 ) -> Dict[str, Any]:
-    xlsx_path = Path(xlsx_path)
-    if not xlsx_path.exists():
-        raise FileNotFoundError(f"Not found: {xlsx_path}")
+    # Путь или открытый бинарный буфер (BytesIO с загруженным файлом)
+    if isinstance(xlsx_source, (str, Path)):
+        xlsx_source = Path(xlsx_source)
+        if not xlsx_source.exists():
+            raise FileNotFoundError(f"Not found: {xlsx_source}")
 
     try:
         sheets = pd.read_excel(
-            xlsx_path,
+            xlsx_source,
             sheet_name=None if sheet is None else sheet,
             dtype=object,
             engine="openpyxl",
@@ -237,6 +241,43 @@ def convert_xlsx_to_json(
     return result
 
 
+def xlsx_context_tables(payload: Dict[str, Any]) -> Tuple[Dict[str, Any], List[Tuple[str, List[Dict[str, Any]]]]]:
+    """
+    Таблицы результата `convert_xlsx_upload_to_json`: каждый непустой лист `sheets` — таблица,
+    пустые листы и остальные поля документа — отдельно.
+    """
+    sheets = payload.get("sheets") or {}
+    remainder = {key: value for key, value in payload.items() if key != "sheets"}
+    empty = [name for name, records in sheets.items() if not records]
+    if empty:
+        remainder["empty_sheets"] = empty
+    tables = [(f"Лист {name}", records) for name, records in sheets.items() if records]
+    return remainder, tables
+
+
+def xlsx_context_chunks(
+    payload: Dict[str, Any],
+    rows_per_chunk: int,
+) -> Tuple[Dict[str, Any], List[Tuple[str, Dict[str, Any]]]]:
+    """
+    Фрагменты для поиска: строки листов блоками по `rows_per_chunk`, у каждого блока своя строка заголовков.
+    Блок имеет вид результата обработчика (`{"sheets": {лист: строки}}`) и кодируется теми же таблицами.
+    """
+    common, _ = xlsx_context_tables(payload)
+    chunks = []
+    for name, records in (payload.get("sheets") or {}).items():
+        for start in range(0, len(records), rows_per_chunk):
+            block = records[start:start + rows_per_chunk]
+            chunks.append((f"Лист {name}, строки {start + 1}–{start + len(block)}", {"sheets": {name: block}}))
+    return common, chunks
+
+
+def _convert_xlsx_bytes(payload: bytes, suffix: str, *args: Any) -> Dict[str, Any]:
+    # Файл читается из памяти; на диск — только очень крупные книги (см. utils.spill)
+    with binary_source(payload, suffix) as source:
+        return convert_xlsx_to_json(source, *args)
+
+
 async def convert_xlsx_upload_to_json(
     xlsx_file: UploadFile,
     *,
@@ -261,15 +302,12 @@ async def convert_xlsx_upload_to_json(
     if not payload:
         raise HTTPException(status_code=400, detail="Загруженный XLSX-файл пуст.")
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, mode='wb') as tmp_file:
-        tmp_file.write(payload)
-        tmp_file.flush()  # Убеждаемся, что данные записаны на диск
-        tmp_path = Path(tmp_file.name)
-
     try:
-        sheets_payload = await to_thread(
-            convert_xlsx_to_json,
-            tmp_path,
+        sheets_payload = await run_converter(
+            XLSX_EXECUTION,
+            _convert_xlsx_bytes,
+            payload,
+            suffix,
             sheet,
             header_row,
             ffill_merged,
@@ -337,8 +375,6 @@ async def convert_xlsx_upload_to_json(
             status_code=500,
             detail=detail_msg
         ) from exc
-    finally:
-        tmp_path.unlink(missing_ok=True)
 
     return {
         "source_filename": filename,
@@ -347,6 +383,6 @@ async def convert_xlsx_upload_to_json(
     }
 
 
-__all__ = ["convert_xlsx_to_json", "convert_xlsx_upload_to_json"]
+__all__ = ["convert_xlsx_to_json", "convert_xlsx_upload_to_json", "xlsx_context_chunks", "xlsx_context_tables"]
 
 
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterator, Mapping, Optional
+
+from fastapi import HTTPException, UploadFile
+
+from .context_encoders import ENCODER_COMPACT, ENCODER_TSV, ContextEncoding
+from .utils.compat_asyncio import to_thread
+
+if TYPE_CHECKING:  # pragma: no cover - только для аннотаций
+    from .retrieval import Chunker
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[UploadFile], Awaitable[dict[str, Any]]]
+
+# Импортировать модули обработчиков в фоне после старта; 0 — только при первой загрузке файла этого типа
+HANDLER_PREWARM = os.getenv("HANDLER_PREWARM", "1").lower() not in ("0", "false", "no")
+
+# Знаков после запятой в координатах DXF; -1 — без округления
+DXF_CONTEXT_FLOAT_PRECISION = int(os.getenv("DXF_CONTEXT_FLOAT_PRECISION", "3"))
+
+_SERVICES_PACKAGE = __package__
+
+
+@dataclass(frozen=True)
+class HandlerConfig:
+    handler: Handler
+    instruction: str
+    # Версия формата вывода обработчика: входит в ключ кэша конвертаций
+    version: str = "1"
+    # Представление результата в промпте по умолчанию (context_encoder=auto)
+    encoding: ContextEncoding = field(default_factory=ContextEncoding)
+    # Разбиение на фрагменты для поиска по вопросу и обработки по частям
+    # (context_overflow=retrieve / map_reduce); None — не поддерживается
+    chunker: Optional[Chunker] = None
+
+
+@dataclass(frozen=True)
+class HandlerSpec:
+    """Описание обработчика без импорта его модуля: функции берутся из модуля при первом использовании."""
+
+    module: str
+    handler: str
+    instruction: str
+    version: str = "1"
+    encoder: str = ENCODER_COMPACT
+    float_precision: Optional[int] = None
+    # Имена функций модуля: извлечение таблиц для tsv/csv и разбиение на фрагменты
+    tables: Optional[str] = None
+    chunker: Optional[str] = None
+
+    def resolve(self) -> HandlerConfig:
+        module = importlib.import_module(self.module, package=_SERVICES_PACKAGE)
+        return HandlerConfig(
+            handler=getattr(module, self.handler),
+            instruction=self.instruction,
+            version=self.version,
+            encoding=ContextEncoding(
+                self.encoder,
+                float_precision=self.float_precision,
+                tables=getattr(module, self.tables) if self.tables else None,
+            ),
+            chunker=getattr(module, self.chunker) if self.chunker else None,
+        )
+
+
+class LazyHandlerMap(Mapping[str, HandlerConfig]):
+    """
+    Обработчики по расширению файла. Модуль обработчика (pandas, openpyxl, ezdxf, pypdfium2 …)
+    импортируется при первой загрузке файла этого типа или фоновым прогревом после старта,
+    а не при импорте приложения: процесс uvicorn и воркер очереди стартуют быстрее.
+    Отсутствующая зависимость отключает только свой тип файла — такие загрузки получают 503.
+    """
+
+    def __init__(self, specs: Dict[str, HandlerSpec], *, prewarm: bool = HANDLER_PREWARM) -> None:
+        self._specs = dict(specs)
+        self.prewarm_enabled = prewarm
+        self._resolved: Dict[str, HandlerConfig] = {}
+        self._errors: Dict[str, str] = {}
+        self._import_seconds: Dict[str, float] = {}
+        self._prewarm_task: Optional[asyncio.Task] = None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._specs)
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    def __contains__(self, suffix: object) -> bool:
+        return suffix in self._specs
+
+    def _resolve(self, suffix: str) -> Optional[HandlerConfig]:
+        spec = self._specs[suffix]
+        started = time.perf_counter()
+        try:
+            config = spec.resolve()
+        except ImportError as exc:
+            # Повторный импорт не поможет до перезапуска процесса с установленной зависимостью
+            self._errors[suffix] = str(exc)
+            logger.error("Handler for %s is unavailable: %s", suffix, exc)
+            return None
+        self._import_seconds[suffix] = time.perf_counter() - started
+        self._resolved[suffix] = config
+        logger.info("Handler for %s loaded in %.3fs", suffix, self._import_seconds[suffix])
+        return config
+
+    def _unavailable(self, suffix: str) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail=f"Обработка файлов {suffix} недоступна: {self._errors[suffix]}"
+        )
+
+    def __getitem__(self, suffix: str) -> HandlerConfig:
+        """Конфигурация обработчика; импорт модуля — синхронно, в асинхронном коде используйте `load`."""
+        config = self._resolved.get(suffix)
+        if config is None and suffix not in self._errors:
+            config = self._resolve(suffix)
+        if config is None:
+            raise self._unavailable(suffix)
+        return config
+
+    async def load(self, suffix: str) -> Optional[HandlerConfig]:
+        """Обработчик для расширения или None; первый импорт модуля выполняется вне цикла событий."""
+        config = self._resolved.get(suffix)
+        if config is not None:
+            return config
+        if suffix not in self._specs:
+            return None
+        if suffix not in self._errors:
+            config = await to_thread(self._resolve, suffix)
+        if config is None:
+            raise self._unavailable(suffix)
+        return config
+
+    async def prewarm(self) -> None:
+        """Импортирует модули всех обработчиков по одному в пуле потоков."""
+        started = time.perf_counter()
+        for suffix in self._specs:
+            if suffix not in self._resolved and suffix not in self._errors:
+                await to_thread(self._resolve, suffix)
+        logger.info(
+            "Handlers prewarmed in %.2fs: %d loaded, %d unavailable",
+            time.perf_counter() - started, len(self._resolved), len(self._errors),
+        )
+
+    async def start(self) -> None:
+        # Прогрев не задерживает готовность приложения: первые запросы обслуживаются параллельно
+        if self.prewarm_enabled and self._prewarm_task is None:
+            self._prewarm_task = asyncio.create_task(self.prewarm())
+
+    async def stop(self) -> None:
+        task, self._prewarm_task = self._prewarm_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def snapshot(self) -> dict:
+        return {
+            "prewarm": self.prewarm_enabled,
+            "handlers": {
+                suffix: {
+                    "module": spec.module,
+                    "loaded": suffix in self._resolved,
+                    "import_seconds": (
+                        round(self._import_seconds[suffix], 4) if suffix in self._import_seconds else None
+                    ),
+                    "error": self._errors.get(suffix),
+                }
+                for suffix, spec in self._specs.items()
+            },
+        }
+
+
+HANDLER_MAP = LazyHandlerMap({
+    ".arp": HandlerSpec(
+        module=".file_handlers.arp_upload_service",
+        handler="convert_arp_upload_to_json",
+        instruction=(
+            "Входные данные получены из файла ARP (строительная смета). "
+            "Опирайтесь на разделы, позиции и коэффициенты, чтобы отвечать на вопросы о смете."
+        ),
+        encoder=ENCODER_TSV,
+        tables="arp_context_tables",
+        chunker="arp_context_chunks",
+    ),
+    ".dxf": HandlerSpec(
+        module=".file_handlers.dxf_console_service",
+        handler="convert_dxf_upload_to_json",
+        instruction=(
+            "Входные данные — JSON, сформированный из DXF/DWG. "
+            "Используйте сведения о слоях, блоках и геометрии сущностей для анализа чертежа."
+        ),
+        encoder=ENCODER_COMPACT,
+        float_precision=DXF_CONTEXT_FLOAT_PRECISION if DXF_CONTEXT_FLOAT_PRECISION >= 0 else None,
+        chunker="dxf_context_chunks",
+    ),
+    ".gsfx": HandlerSpec(
+        module=".file_handlers.gsfx_upload_service",
+        handler="convert_gsfx_upload_to_json",
+        instruction=(
+            "Входные данные — архив GSFX, преобразованный в набор XML-файлов в JSON-представлении. "
+            "Ссылайтесь на соответствующие элементы XML при ответах."
+        ),
+        chunker="gsfx_context_chunks",
+    ),
+    ".pdf": HandlerSpec(
+        module=".file_handlers.pdf_upload_service",
+        handler="convert_pdf_upload_to_base64_images",
+        instruction=(
+            "Входные данные — изображения страниц PDF, закодированные в Base64. "
+            "Извлеки текст/структуру страниц и используйте их при ответе."
+        ),
+    ),
+    ".rtf": HandlerSpec(
+        module=".file_handlers.rtf_upload_service",
+        handler="convert_rtf_upload_to_json",
+        instruction=(
+            "Входные данные — текст документа RTF в JSON-структуре. "
+            "Учитывайте форматирование и текстовые блоки при формировании ответа."
+        ),
+        chunker="rtf_context_chunks",
+    ),
+    ".xlsx": HandlerSpec(
+        module=".file_handlers.xlsx_upload_service",
+        handler="convert_xlsx_upload_to_json",
+        instruction=(
+            "Входные данные — таблицы XLSX, преобразованные в записи по листам. "
+            "Используйте значения ячеек и структуру столбцов для анализа."
+        ),
+        encoder=ENCODER_TSV,
+        tables="xlsx_context_tables",
+        chunker="xlsx_context_chunks",
+    ),
+})
+
+
+__all__ = [
+    "HANDLER_MAP",
+    "HandlerConfig",
+    "HandlerSpec",
+    "LazyHandlerMap",
+]
@@ -5,8 +5,15 @@ from pathlib import Path
 
 from fastapi import HTTPException, UploadFile
 
+from .conversion_cache import conversion_cache, conversion_cache_key
 from .file_handlers.image_upload_service import convert_upload_image_to_base64
-from .file_handlers.pdf_upload_service import convert_pdf_upload_to_base64_images
+from .handler_registry import HANDLER_MAP
+from .metrics import CONVERSION_SECONDS
+from .single_flight import upload_sha256
+from .tracing import span
+
+# Версия формата страниц PDF в кэше конвертаций
+PDF_RENDER_VERSION = "1"
 
 
 @dataclass(frozen=True)
@@ -16,10 +23,11 @@ class RoutedImagePayload:
     filename: str
 
 
-async def route_image_payload(image_file: UploadFile) -> RoutedImagePayload:
+async def route_image_payload(image_file: UploadFile, file_digest: str | None = None) -> RoutedImagePayload:
     """
     Унифицированная маршрутизация файлов изображений и PDF.
     Возвращает список Base64-строк и описание источника для промпта.
+    Отрисованные страницы PDF берутся из кэша конвертаций, если файл уже встречался.
     """
     if image_file is None:
         raise HTTPException(status_code=400, detail="Файл обязателен для обработки изображения.")
@@ -31,7 +39,19 @@ async def route_image_payload(image_file: UploadFile) -> RoutedImagePayload:
     is_pdf = suffix == ".pdf" or content_type == "application/pdf"
 
     if is_pdf:
-        pdf_payload = await convert_pdf_upload_to_base64_images(image_file)
+        # pypdfium2 импортируется при первом PDF (или фоновым прогревом), как и в json_file_router
+        convert_pdf = (await HANDLER_MAP.load(".pdf")).handler
+        if file_digest is None:
+            file_digest = await upload_sha256(image_file)
+        cache_key = conversion_cache_key(
+            file_digest, convert_pdf.__name__, PDF_RENDER_VERSION, {"filename": filename}
+        )
+
+        async def render_pages() -> dict:
+            with CONVERSION_SECONDS.time(suffix=".pdf"), span("convert", suffix=".pdf"):
+                return await convert_pdf(image_file)
+
+        pdf_payload = await conversion_cache.get_or_convert(cache_key, render_pages)
         encoded_images = [
             page.get("base64")
             for page in pdf_payload.get("images", [])
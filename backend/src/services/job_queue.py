@@ -0,0 +1,478 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from fastapi import HTTPException, UploadFile
+
+from .ollama_scheduler import PRIORITY_BATCH
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+# Очередь хранится в SQLite и переживает перезапуск backend. Только один хост: режим WAL
+# опирается на разделяемую память и блокировки файлов, которые на сетевых ФС (NFS, SMB) ненадёжны,
+# поэтому backend и воркеры используют один локальный том. Воркерам на других хостах нужна
+# очередь на сервере (PostgreSQL, Redis), а не общий файл
+JOBS_DB_PATH = os.getenv(
+    "JOBS_DB_PATH",
+    os.path.join(tempfile.gettempdir(), "ba_ai_gost", "jobs.sqlite3"),
+)
+# Сколько задача может выполняться без продления аренды, прежде чем её заберёт другой воркер
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", str(7 * 24 * 3600)))
+JOB_MAX_BATCH_FILES = int(os.getenv("JOB_MAX_BATCH_FILES", "100"))
+JOBS_POLL_INTERVAL_SECONDS = float(os.getenv("JOBS_POLL_INTERVAL_SECONDS", "1"))
+
+JOB_KINDS = ("json", "vision")
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED)
+
+# Ошибки, после которых задачу имеет смысл повторить: Ollama недоступна, перегружена или не успела
+_RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    batch_id TEXT,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    file_data BLOB,
+    question TEXT NOT NULL,
+    response_language TEXT NOT NULL,
+    options TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, created_at);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id);
+"""
+
+_PUBLIC_COLUMNS = (
+    "job_id, batch_id, kind, status, priority, filename, question, response_language, "
+    "result, error, attempts, worker_id, created_at, started_at, finished_at"
+)
+
+
+def resolve_job_kind(kind: str | None) -> str:
+    normalized = (kind or "json").strip().lower()
+    if normalized not in JOB_KINDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный тип задачи '{kind}'. Допустимые значения: {', '.join(JOB_KINDS)}."
+        )
+    return normalized
+
+
+@dataclass
+class ClaimedJob:
+    job_id: str
+    kind: str
+    priority: int
+    filename: str
+    content_type: Optional[str]
+    file_data: bytes
+    question: str
+    response_language: str
+    options: Dict[str, Any]
+    attempts: int
+
+
+def _describe_row(row: sqlite3.Row) -> dict:
+    job = {
+        "job_id": row["job_id"],
+        "batch_id": row["batch_id"],
+        "kind": row["kind"],
+        "status": row["status"],
+        "filename": row["filename"],
+        "question": row["question"],
+        "response_language": row["response_language"],
+        "attempts": row["attempts"],
+        "worker_id": row["worker_id"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+    }
+    if row["result"] is not None:
+        job["result"] = json.loads(row["result"])
+    if row["error"] is not None:
+        job["error"] = json.loads(row["error"])
+    return job
+
+
+class JobQueue:
+    """
+    Надёжная очередь задач на SQLite (режим WAL) для процессов одного хоста.
+
+    - база должна лежать на локальном диске: WAL на сетевой ФС может повредить её;
+    - задача хранит загруженный файл целиком, поэтому воркеру нужен только доступ к базе;
+    - воркер забирает задачу с арендой на `lease_seconds` и продлевает её, пока работает;
+    - задача с истёкшей арендой (воркер упал или перезапущен) снова выдаётся другому воркеру,
+      но не больше `max_attempts` раз.
+    """
+
+    def __init__(
+        self,
+        db_path: str = JOBS_DB_PATH,
+        *,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        result_ttl: float = JOB_RESULT_TTL_SECONDS,
+    ) -> None:
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.result_ttl = result_ttl
+        self._local = threading.local()
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3-соединение нельзя делить между потоками пула to_thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        with self._init_lock:
+            if not self._initialized:
+                connection.executescript(_SCHEMA)
+                self._initialized = True
+        return connection
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self._connection()
+        # IMMEDIATE сразу берёт блокировку записи: два воркера не заберут одну задачу
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    # Синхронные операции: вызываются из воркера напрямую или из API через to_thread
+
+    def _insert(self, jobs: List[dict]) -> None:
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                """
+                INSERT INTO jobs (job_id, batch_id, kind, status, priority, filename, content_type,
+                                  file_data, question, response_language, options, created_at)
+                VALUES (:job_id, :batch_id, :kind, :status, :priority, :filename, :content_type,
+                        :file_data, :question, :response_language, :options, :created_at)
+                """,
+                [{**job, "status": STATUS_QUEUED, "created_at": now} for job in jobs],
+            )
+
+    def claim(self, worker_id: str) -> Optional[ClaimedJob]:
+        now = time.time()
+        with self._transaction() as connection:
+            # Задачи, чья аренда истекла после последней попытки, помечаются как упавшие
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, finished_at = ?, file_data = NULL, error = ?
+                WHERE status = ? AND lease_expires_at < ? AND attempts >= ?
+                """,
+                (
+                    STATUS_FAILED, now,
+                    json.dumps({"status_code": 500, "detail": "Воркер не завершил задачу за отведённые попытки."},
+                               ensure_ascii=False),
+                    STATUS_RUNNING, now, self.max_attempts,
+                ),
+            )
+            row = connection.execute(
+                """
+                SELECT job_id, kind, priority, filename, content_type, file_data, question,
+                       response_language, options, attempts
+                FROM jobs
+                WHERE status = ? OR (status = ? AND lease_expires_at < ?)
+                ORDER BY priority, created_at
+                LIMIT 1
+                """,
+                (STATUS_QUEUED, STATUS_RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, worker_id = ?, attempts = attempts + 1,
+                                started_at = ?, lease_expires_at = ?
+                WHERE job_id = ?
+                """,
+                (STATUS_RUNNING, worker_id, now, now + self.lease_seconds, row["job_id"]),
+            )
+        if row["attempts"]:
+            logger.warning("Job %s picked up again by %s (attempt %d)", row["job_id"], worker_id, row["attempts"] + 1)
+        return ClaimedJob(
+            job_id=row["job_id"],
+            kind=row["kind"],
+            priority=row["priority"],
+            filename=row["filename"],
+            content_type=row["content_type"],
+            file_data=row["file_data"],
+            question=row["question"],
+            response_language=row["response_language"],
+            options=json.loads(row["options"]),
+            attempts=row["attempts"] + 1,
+        )
+
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        """Продлевает аренду; False — задачу уже забрал другой воркер."""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE job_id = ? AND worker_id = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, worker_id, STATUS_RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, result = ?, error = NULL, finished_at = ?, file_data = NULL
+                WHERE job_id = ? AND worker_id = ?
+                """,
+                (STATUS_DONE, json.dumps(result, ensure_ascii=False), time.time(), job_id, worker_id),
+            )
+
+    def fail(self, job_id: str, worker_id: str, status_code: int, detail: Any, attempts: int) -> None:
+        error = json.dumps({"status_code": status_code, "detail": detail}, ensure_ascii=False)
+        with self._transaction() as connection:
+            if status_code in _RETRYABLE_STATUS_CODES and attempts < self.max_attempts:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, worker_id = NULL, lease_expires_at = NULL "
+                    "WHERE job_id = ? AND worker_id = ?",
+                    (STATUS_QUEUED, error, job_id, worker_id),
+                )
+                logger.warning("Job %s will be retried after error %d: %s", job_id, status_code, detail)
+                return
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, error = ?, finished_at = ?, file_data = NULL
+                WHERE job_id = ? AND worker_id = ?
+                """,
+                (STATUS_FAILED, error, time.time(), job_id, worker_id),
+            )
+
+    def release(self, job_id: str, worker_id: str) -> None:
+        """Возвращает задачу в очередь при штатной остановке воркера, не засчитывая попытку."""
+        with self._transaction() as connection:
+            connection.execute(
+                """
+                UPDATE jobs SET status = ?, worker_id = NULL, lease_expires_at = NULL, attempts = attempts - 1
+                WHERE job_id = ? AND worker_id = ? AND status = ?
+                """,
+                (STATUS_QUEUED, job_id, worker_id, STATUS_RUNNING),
+            )
+
+    def _get(self, job_id: str) -> Optional[dict]:
+        row = self._connection().execute(
+            f"SELECT {_PUBLIC_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return _describe_row(row) if row is not None else None
+
+    def _get_many(self, job_ids: List[str]) -> List[dict]:
+        placeholders = ",".join("?" for _ in job_ids)
+        rows = self._connection().execute(
+            f"SELECT {_PUBLIC_COLUMNS} FROM jobs WHERE job_id IN ({placeholders})", job_ids
+        ).fetchall()
+        return [_describe_row(row) for row in rows]
+
+    def purge_finished(self) -> int:
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                f"DELETE FROM jobs WHERE status IN ({','.join('?' for _ in FINISHED_STATUSES)}) AND finished_at < ?",
+                (*FINISHED_STATUSES, time.time() - self.result_ttl),
+            )
+        return cursor.rowcount
+
+    def _counts(self) -> Dict[str, int]:
+        rows = self._connection().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED)}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    # Асинхронные обёртки для API
+
+    async def submit(self, jobs: List[dict]) -> None:
+        await to_thread(self._insert, jobs)
+
+    async def get(self, job_id: str) -> dict:
+        job = await to_thread(self._get, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Задача '{job_id}' не найдена.")
+        return job
+
+    async def get_many(self, job_ids: List[str]) -> List[dict]:
+        return await to_thread(self._get_many, job_ids) if job_ids else []
+
+    async def snapshot(self) -> dict:
+        return {
+            "db_path": self.db_path,
+            "lease_seconds": self.lease_seconds,
+            "max_attempts": self.max_attempts,
+            "jobs": await to_thread(self._counts),
+        }
+
+
+job_queue = JobQueue()
+
+
+def build_job(
+    *,
+    kind: str,
+    filename: str,
+    content_type: Optional[str],
+    file_data: bytes,
+    question: str,
+    response_language: str,
+    priority: int = PRIORITY_BATCH,
+    use_cache: bool = True,
+    context_overflow: Optional[str] = None,
+    context_encoder: Optional[str] = None,
+    batch_id: Optional[str] = None,
+) -> dict:
+    if not file_data:
+        raise HTTPException(status_code=400, detail=f"Загруженный файл '{filename}' пустой")
+    return {
+        "job_id": uuid.uuid4().hex,
+        "batch_id": batch_id,
+        "kind": kind,
+        "priority": priority,
+        "filename": filename,
+        "content_type": content_type,
+        "file_data": file_data,
+        "question": question,
+        "response_language": response_language,
+        "options": json.dumps({
+            "use_cache": use_cache,
+            "context_overflow": context_overflow,
+            "context_encoder": context_encoder,
+        }),
+    }
+
+
+async def submit_upload_jobs(
+    uploads: List[UploadFile],
+    question: str,
+    response_language: str = "ru",
+    *,
+    kind: str = "json",
+    priority: int = PRIORITY_BATCH,
+    use_cache: bool = True,
+    context_overflow: Optional[str] = None,
+    context_encoder: Optional[str] = None,
+    batch: bool = False,
+) -> List[dict]:
+    """Ставит загруженные файлы в очередь; файлы читаются целиком и сохраняются в базе задач."""
+    if not uploads:
+        raise HTTPException(status_code=400, detail="Файлы не предоставлены.")
+    if len(uploads) > JOB_MAX_BATCH_FILES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много файлов в пакете: {len(uploads)} (максимум {JOB_MAX_BATCH_FILES})."
+        )
+
+    batch_id = uuid.uuid4().hex if batch else None
+    jobs = []
+    for upload in uploads:
+        jobs.append(build_job(
+            kind=kind,
+            filename=upload.filename or "unknown",
+            content_type=upload.content_type,
+            file_data=await upload.read(),
+            question=question,
+            response_language=response_language,
+            priority=priority,
+            use_cache=use_cache,
+            context_overflow=context_overflow,
+            context_encoder=context_encoder,
+            batch_id=batch_id,
+        ))
+    await job_queue.submit(jobs)
+    logger.info("Queued %d %s job(s)%s", len(jobs), kind, f" in batch {batch_id}" if batch_id else "")
+    return [
+        {"job_id": job["job_id"], "batch_id": batch_id, "filename": job["filename"], "status": STATUS_QUEUED}
+        for job in jobs
+    ]
+
+
+async def iter_batch_results(submitted: List[dict]) -> AsyncIterator[dict]:
+    """
+    События пакета: сначала список задач, затем каждая задача по мере завершения
+    (в порядке завершения, а не подачи), в конце — итог.
+    Отключение клиента не отменяет задачи: результаты остаются доступны по `GET /jobs/{id}`.
+    """
+    yield {
+        "type": "batch",
+        "batch_id": submitted[0]["batch_id"] if submitted else None,
+        "jobs": submitted,
+    }
+    pending = [job["job_id"] for job in submitted]
+    failed = 0
+    while pending:
+        finished = [job for job in await job_queue.get_many(pending) if job["status"] in FINISHED_STATUSES]
+        for job in finished:
+            pending.remove(job["job_id"])
+            failed += job["status"] == STATUS_FAILED
+            yield {"type": "job", **job}
+        if pending:
+            await asyncio.sleep(JOBS_POLL_INTERVAL_SECONDS)
+    yield {"type": "done", "completed": len(submitted) - failed, "failed": failed}
+
+
+async def get_job_result(job_id: str) -> Optional[dict]:
+    """Результат задачи; None — задача ещё не завершена; ошибка задачи поднимается как HTTPException."""
+    job = await job_queue.get(job_id)
+    if job["status"] == STATUS_DONE:
+        return job["result"]
+    if job["status"] == STATUS_FAILED:
+        error = job.get("error") or {}
+        raise HTTPException(status_code=error.get("status_code", 500), detail=error.get("detail"))
+    return None
+
+
+__all__ = [
+    "ClaimedJob",
+    "FINISHED_STATUSES",
+    "JOB_MAX_BATCH_FILES",
+    "JOBS_POLL_INTERVAL_SECONDS",
+    "JobQueue",
+    "build_job",
+    "get_job_result",
+    "iter_batch_results",
+    "job_queue",
+    "resolve_job_kind",
+    "submit_upload_jobs",
+]
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import logging
+import os
+import socket
+import uuid
+from typing import List, Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.datastructures import Headers
+
+from .converter_pool import converter_pool
+from .handler_registry import HANDLER_MAP
+from .job_queue import JOBS_POLL_INTERVAL_SECONDS, ClaimedJob, JobQueue, job_queue
+from .json_service import process_json_query
+from .ollama_pool import pool
+from .ollama_service import shutdown_ollama_client, startup_ollama_client
+from .utils.compat_asyncio import to_thread
+from .vision import process_vision_query
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+_PURGE_INTERVAL_SECONDS = 3600
+
+
+def _job_upload(job: ClaimedJob) -> UploadFile:
+    headers = Headers({"content-type": job.content_type}) if job.content_type else None
+    return UploadFile(file=io.BytesIO(job.file_data), filename=job.filename, headers=headers)
+
+
+async def run_job(job: ClaimedJob) -> dict:
+    """Тот же конвейер, что у `/json-query` и `/vision-query`: конвертация и запрос к Ollama."""
+    upload = _job_upload(job)
+    try:
+        if job.kind == "vision":
+            return await process_vision_query(
+                upload,
+                job.question,
+                job.response_language,
+                priority=job.priority,
+                use_cache=job.options.get("use_cache", True),
+            )
+        return await process_json_query(
+            upload,
+            job.question,
+            job.response_language,
+            priority=job.priority,
+            use_cache=job.options.get("use_cache", True),
+            context_overflow=job.options.get("context_overflow"),
+            context_encoder=job.options.get("context_encoder"),
+        )
+    finally:
+        await upload.close()
+
+
+class JobWorker:
+    """
+    Воркер очереди задач: `concurrency` параллельных циклов «забрать — выполнить — записать».
+    Пока задача выполняется, аренда продлевается; при остановке незавершённые задачи
+    возвращаются в очередь.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue = job_queue,
+        *,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        worker_id: Optional[str] = None,
+    ) -> None:
+        self.queue = queue
+        self.concurrency = max(1, concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def _keep_lease(self, job: ClaimedJob) -> None:
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await to_thread(self.queue.renew, job.job_id, self.worker_id):
+                logger.warning("Lost lease on job %s", job.job_id)
+                return
+
+    async def _process(self, job: ClaimedJob) -> None:
+        logger.info("Job %s started: kind=%s, file=%s, attempt=%d", job.job_id, job.kind, job.filename, job.attempts)
+        heartbeat = asyncio.create_task(self._keep_lease(job))
+        try:
+            result = await run_job(job)
+        except asyncio.CancelledError:
+            await to_thread(self.queue.release, job.job_id, self.worker_id)
+            raise
+        except HTTPException as exc:
+            logger.warning("Job %s failed: status=%d, detail=%s", job.job_id, exc.status_code, exc.detail)
+            await to_thread(self.queue.fail, job.job_id, self.worker_id, exc.status_code, exc.detail, job.attempts)
+        except Exception as exc:
+            logger.error("Job %s crashed: %s", job.job_id, exc, exc_info=True)
+            await to_thread(
+                self.queue.fail, job.job_id, self.worker_id, 500, f"{type(exc).__name__}: {exc}", job.attempts
+            )
+        else:
+            await to_thread(self.queue.complete, job.job_id, self.worker_id, result)
+            logger.info("Job %s done", job.job_id)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _loop(self) -> None:
+        while not self._stopping.is_set():
+            job = await to_thread(self.queue.claim, self.worker_id)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=JOBS_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _purge_loop(self) -> None:
+        while True:
+            purged = await to_thread(self.queue.purge_finished)
+            if purged:
+                logger.info("Purged %d finished job(s)", purged)
+            await asyncio.sleep(_PURGE_INTERVAL_SECONDS)
+
+    def stop(self) -> None:
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self) -> None:
+        # Event создаётся внутри работающего цикла событий (на Python 3.9 он привязывается к циклу)
+        self._stopping = asyncio.Event()
+        await startup_ollama_client()
+        await pool.start()
+        await converter_pool.start()
+        await HANDLER_MAP.start()
+        logger.info("Job worker %s started: concurrency=%d, db=%s",
+                    self.worker_id, self.concurrency, self.queue.db_path)
+        loops: List[asyncio.Task] = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+        purge = asyncio.create_task(self._purge_loop())
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in (*loops, purge):
+                task.cancel()
+            await asyncio.gather(*loops, purge, return_exceptions=True)
+            await HANDLER_MAP.stop()
+            await converter_pool.stop()
+            await pool.stop()
+            await shutdown_ollama_client()
+            logger.info("Job worker %s stopped", self.worker_id)
+
+
+__all__ = ["JobWorker", "run_job"]
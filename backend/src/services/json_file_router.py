@@ -1,29 +1,37 @@
 from __future__ import annotations
 
-import json
 import logging
-from dataclasses import dataclass
+import time
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Any, Awaitable, Callable, Dict
+from typing import Any, Optional
 
 from fastapi import HTTPException, UploadFile
 
 logger = logging.getLogger(__name__)
 
-from .file_handlers.arp_upload_service import convert_arp_upload_to_json
-from .file_handlers.dxf_console_service import convert_dxf_upload_to_json
-from .file_handlers.gsfx_upload_service import convert_gsfx_upload_to_json
-from .file_handlers.pdf_upload_service import convert_pdf_upload_to_base64_images
-from .file_handlers.rtf_upload_service import convert_rtf_upload_to_json
-from .file_handlers.xlsx_upload_service import convert_xlsx_upload_to_json
-
-Handler = Callable[[UploadFile], Awaitable[dict[str, Any]]]
-
-
-@dataclass(frozen=True)
-class HandlerConfig:
-    handler: Handler
-    instruction: str
+from .context_encoders import (
+    ENCODER_AUTO,
+    EncodedContext,
+    build_encoded_context,
+    context_encoder_stats,
+    context_format_note,
+    resolve_context_encoder,
+)
+from .conversion_cache import conversion_cache, conversion_cache_key
+from .handler_registry import HANDLER_MAP, HandlerConfig
+from .metrics import CONVERSION_SECONDS, SERIALIZATION_SECONDS, UPLOAD_BYTES, UPLOAD_READ_SECONDS
+from .retrieval import (
+    RETRIEVAL_CHUNK_ROWS,
+    RETRIEVAL_CONTEXT_TOKENS,
+    RETRIEVAL_INDEX_VERSION,
+    DocumentIndex,
+    build_document_index,
+    document_indexes,
+)
+from .single_flight import upload_sha256
+from .tracing import span, traced
+from .utils.compat_asyncio import to_thread
 
 
 @dataclass(frozen=True)
@@ -31,59 +39,117 @@ class RoutedJsonPayload:
     content: str
     instruction: str
     filename: str
+    # Кодировщик и оценка токенов документа (для файлов без обработчика — None)
+    encoding: Optional[dict] = None
+    # BM25-индекс фрагментов, если он запрошен и документ достаточно велик
+    index: Optional[DocumentIndex] = None
 
 
 DEFAULT_ROUTER_INSTRUCTION = (
     "Вам предоставлены данные из файла. Используйте их, чтобы ответить на вопрос пользователя ясно и кратко."
 )
 
-HANDLER_MAP: Dict[str, HandlerConfig] = {
-    ".arp": HandlerConfig(
-        handler=convert_arp_upload_to_json,
-        instruction=(
-            "Входные данные получены из файла ARP (строительная смета). "
-            "Опирайтесь на разделы, позиции и коэффициенты, чтобы отвечать на вопросы о смете."
-        ),
-    ),
-    ".dxf": HandlerConfig(
-        handler=convert_dxf_upload_to_json,
-        instruction=(
-            "Входные данные — JSON, сформированный из DXF/DWG. "
-            "Используйте сведения о слоях, блоках и геометрии сущностей для анализа чертежа."
-        ),
-    ),
-    ".gsfx": HandlerConfig(
-        handler=convert_gsfx_upload_to_json,
-        instruction=(
-            "Входные данные — архив GSFX, преобразованный в набор XML-файлов в JSON-представлении. "
-            "Ссылайтесь на соответствующие элементы XML при ответах."
-        ),
-    ),
-    ".pdf": HandlerConfig(
-        handler=convert_pdf_upload_to_base64_images,
-        instruction=(
-            "Входные данные — изображения страниц PDF, закодированные в Base64. "
-            "Извлеки текст/структуру страниц и используйте их при ответе."
-        ),
-    ),
-    ".rtf": HandlerConfig(
-        handler=convert_rtf_upload_to_json,
-        instruction=(
-            "Входные данные — текст документа RTF в JSON-структуре. "
-            "Учитывайте форматирование и текстовые блоки при формировании ответа."
-        ),
-    ),
-    ".xlsx": HandlerConfig(
-        handler=convert_xlsx_upload_to_json,
-        instruction=(
-            "Входные данные — таблицы XLSX, преобразованные в записи по листам. "
-            "Используйте значения ячеек и структуру столбцов для анализа."
-        ),
-    ),
-}
-
-
-async def load_raw_json_data(json_file: UploadFile) -> RoutedJsonPayload:
+
+def _cache_key(handler_config: HandlerConfig, file_digest: str, filename: str, **options: Any) -> str:
+    # Имя файла входит в ключ: обработчики записывают его в результат
+    return conversion_cache_key(
+        file_digest,
+        handler_config.handler.__name__,
+        handler_config.version,
+        {"filename": filename, **options},
+    )
+
+
+async def _converted_payload(
+    handler_config: HandlerConfig,
+    json_file: UploadFile,
+    file_digest: str,
+    filename: str,
+) -> Any:
+    async def convert() -> Any:
+        suffix = Path(filename).suffix.lower()
+        with CONVERSION_SECONDS.time(suffix=suffix), span("convert", suffix=suffix):
+            return await handler_config.handler(json_file)
+
+    return await conversion_cache.get_or_convert(_cache_key(handler_config, file_digest, filename), convert)
+
+
+async def _encode_document(
+    handler_config: HandlerConfig,
+    json_file: UploadFile,
+    file_digest: str,
+    filename: str,
+    encoder: str,
+) -> EncodedContext:
+    """
+    Два уровня кэша конвертаций: результат обработчика и его текст в выбранном формате.
+    Смена кодировщика для уже встречавшегося файла не запускает конвертацию заново.
+    """
+    encoding = handler_config.encoding
+    encoded_key = _cache_key(
+        handler_config, file_digest, filename, encoding={**encoding.as_key(), "encoder": encoder}
+    )
+    cached = await conversion_cache.get(encoded_key)
+    if cached is not None:
+        return EncodedContext(**cached)
+
+    converted_payload = await _converted_payload(handler_config, json_file, file_digest, filename)
+    started = time.perf_counter()
+    # Кодирование и оценка токенов крупных чертежей и таблиц занимают заметное время — не на цикле событий
+    with span("encode", encoder=encoder):
+        encoded = await to_thread(build_encoded_context, converted_payload, encoder, encoding)
+    seconds = time.perf_counter() - started
+    SERIALIZATION_SECONDS.observe(seconds, encoder=encoder)
+    await conversion_cache.put(encoded_key, asdict(encoded), seconds=seconds)
+    return encoded
+
+
+async def _document_index(
+    handler_config: HandlerConfig,
+    json_file: UploadFile,
+    file_digest: str,
+    filename: str,
+    encoded: EncodedContext,
+) -> DocumentIndex:
+    """Индекс хранится в кэше конвертаций рядом с результатом и строится один раз на документ и формат."""
+    encoding = handler_config.encoding
+    index_key = _cache_key(
+        handler_config,
+        file_digest,
+        filename,
+        encoding={**encoding.as_key(), "encoder": encoded.encoder},
+        index={"version": RETRIEVAL_INDEX_VERSION, "chunk_rows": RETRIEVAL_CHUNK_ROWS},
+    )
+
+    async def build() -> DocumentIndex:
+        converted_payload = await _converted_payload(handler_config, json_file, file_digest, filename)
+        with span("index"):
+            return await to_thread(
+                build_document_index,
+                converted_payload,
+                handler_config.chunker,
+                encoded.encoder,
+                encoding,
+                encoded.tokens,
+            )
+
+    return await document_indexes.get_or_build(index_key, build)
+
+
+@traced("load")
+async def load_raw_json_data(
+    json_file: UploadFile,
+    file_digest: str | None = None,
+    context_encoder: str | None = None,
+    build_index: bool = False,
+) -> RoutedJsonPayload:
+    """
+    Конвертирует загруженный файл обработчиком по расширению и кодирует результат для промпта
+    (`context_encoder`: auto — формат по умолчанию для типа файла, см. context_encoders).
+    `build_index` — подготовить индекс фрагментов для документов длиннее `RETRIEVAL_CONTEXT_TOKENS`
+    (политики retrieve и map_reduce).
+    Результат кэшируется по SHA-256 содержимого (`file_digest`, если уже посчитан), см. conversion_cache.
+    """
     if json_file is None:
         raise HTTPException(status_code=400, detail="JSON file is required")
 
@@ -91,10 +157,13 @@ async def load_raw_json_data(json_file: UploadFile) -> RoutedJsonPayload:
     suffix = Path(filename).suffix.lower()
     logger.info("Loading file: %s (suffix: %s)", filename, suffix)
 
-    handler_config = HANDLER_MAP.get(suffix)
+    # Модуль обработчика импортируется при первой загрузке файла этого типа
+    handler_config = await HANDLER_MAP.load(suffix)
 
     if handler_config is None:
-        raw_bytes = await json_file.read()
+        with UPLOAD_READ_SECONDS.time():
+            raw_bytes = await json_file.read()
+        UPLOAD_BYTES.observe(len(raw_bytes))
         if not raw_bytes:
             raise HTTPException(status_code=400, detail="Загруженный файл пустой")
         
@@ -122,10 +191,18 @@ async def load_raw_json_data(json_file: UploadFile) -> RoutedJsonPayload:
 
     try:
         logger.info("=== ROUTER: Calling handler for file: %s ===", filename)
-        converted_payload = await handler_config.handler(json_file)
+        if file_digest is None:
+            file_digest = await upload_sha256(json_file)
+        encoder = resolve_context_encoder(context_encoder)
+        if encoder == ENCODER_AUTO:
+            encoder = handler_config.encoding.encoder
+        encoded = await _encode_document(handler_config, json_file, file_digest, filename, encoder)
+        context_encoder_stats.observe(suffix.lstrip("."), encoded)
+        index = None
+        if build_index and handler_config.chunker is not None and encoded.tokens > RETRIEVAL_CONTEXT_TOKENS:
+            index = await _document_index(handler_config, json_file, file_digest, filename, encoded)
         logger.info("=== ROUTER: Handler completed for file: %s ===", filename)
-        serialized_json = json.dumps(converted_payload, indent=2, ensure_ascii=False)
-        logger.debug("JSON serialized, length: %d", len(serialized_json))
+        logger.debug("Context encoded as %s: %d tokens (json: %d)", encoder, encoded.tokens, encoded.baseline_tokens)
     except HTTPException as exc:
         logger.error("=== ROUTER: HTTPException for file %s: status=%d, detail=%s ===", 
                     filename, exc.status_code, exc.detail)
@@ -140,9 +217,12 @@ async def load_raw_json_data(json_file: UploadFile) -> RoutedJsonPayload:
             detail=f"Ошибка обработки файла '{filename}' ({error_type}): {error_msg}"
         ) from exc
 
+    format_note = context_format_note(encoded)
     return RoutedJsonPayload(
-        content=serialized_json,
-        instruction=handler_config.instruction,
+        content=encoded.content,
+        instruction=f"{handler_config.instruction} {format_note}" if format_note else handler_config.instruction,
         filename=filename,
+        encoding=encoded.as_dict(),
+        index=index,
     )
 
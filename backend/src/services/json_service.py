@@ -2,25 +2,44 @@ from __future__ import annotations
 
 import json
 import logging
-import tempfile
-from pathlib import Path
+from typing import AsyncIterator
 
 from fastapi import HTTPException, UploadFile
 
-from .console_json_ollama import run_console_json_ollama
-from .json_file_router import load_raw_json_data
+from .console_json_ollama import JSON_QUERY_MODEL, run_console_json_ollama, stream_console_json_ollama
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .prompt_budget import OVERFLOW_MAP_REDUCE, OVERFLOW_RETRIEVE, resolve_context_overflow
+from .reasoning import ReasoningBudget
+from .json_file_router import RoutedJsonPayload, load_raw_json_data
+from .single_flight import buffer_upload, conversion_flights, flight_key, generation_flights
+from .streaming import prime_event_stream
 
 logger = logging.getLogger(__name__)
 
-async def process_json_query(json_file: UploadFile, question: str, response_language: str = "ru") -> dict:
+def _require_file(json_file: UploadFile) -> None:
     if json_file is None:
         raise HTTPException(status_code=400, detail="Файл не предоставлен. Загрузите JSON файл для обработки.")
 
+
+async def _load_routed_payload(
+    json_file: UploadFile,
+    question: str,
+    file_digest: str,
+    context_encoder: str | None = None,
+    context_overflow: str | None = None,
+) -> RoutedJsonPayload:
     filename = json_file.filename or "unknown"
     logger.info("Processing JSON query for file: %s, question: %s", filename, question[:100] if question else "")
 
+    # Одинаковые файлы, загруженные одновременно, конвертируются один раз;
+    # имя файла входит в ключ, так как попадает в промпт
+    # Индекс фрагментов нужен только для поиска по вопросу и обработки по частям
+    build_index = resolve_context_overflow(context_overflow) in (OVERFLOW_RETRIEVE, OVERFLOW_MAP_REDUCE)
+    conversion_key = flight_key("json", file_digest, json_file.filename, context_encoder, build_index)
     try:
-        routed_payload = await load_raw_json_data(json_file)
+        routed_payload = await conversion_flights.do(
+            conversion_key, lambda: load_raw_json_data(json_file, file_digest, context_encoder, build_index)
+        )
         logger.debug("File loaded successfully: %s, content length: %d", filename, len(routed_payload.content))
     except HTTPException:
         raise
@@ -33,35 +52,80 @@ async def process_json_query(json_file: UploadFile, question: str, response_lang
             detail=f"Ошибка при чтении файла '{filename}' ({error_type}): {error_msg}"
         ) from exc
 
-    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".json", delete=False) as temp_file:
-        temp_file.write(routed_payload.content)
-        temp_path = Path(temp_file.name)
+    return routed_payload
+
+
+async def process_json_query(
+    json_file: UploadFile,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    context_encoder: str | None = None,
+) -> dict:
+    """
+    Одновременные запросы с тем же файлом, вопросом, языком и моделью
+    ждут одну общую конвертацию и одну генерацию.
+    """
+    _require_file(json_file)
+    json_file, file_digest = await buffer_upload(json_file)
+    generation_key = flight_key(
+        "json", file_digest, json_file.filename, question, response_language, JSON_QUERY_MODEL,
+        use_cache, context_overflow, reasoning.as_key() if reasoning else None, context_encoder,
+    )
+    return await generation_flights.do(
+        generation_key,
+        lambda: _answer_json_query(
+            json_file,
+            file_digest,
+            question,
+            response_language,
+            priority=priority,
+            use_cache=use_cache,
+            context_overflow=context_overflow,
+            reasoning=reasoning,
+            context_encoder=context_encoder,
+        ),
+    )
+
+
+async def _answer_json_query(
+    json_file: UploadFile,
+    file_digest: str,
+    question: str,
+    response_language: str,
+    *,
+    priority: int,
+    use_cache: bool,
+    context_overflow: str | None,
+    reasoning: ReasoningBudget | None,
+    context_encoder: str | None,
+) -> dict:
+    routed_payload = await _load_routed_payload(
+        json_file, question, file_digest, context_encoder, context_overflow
+    )
+    filename = json_file.filename or "unknown"
 
     try:
-        logger.debug("Calling Ollama with temp file: %s", temp_path)
         result = await run_console_json_ollama(
             question,
-            str(temp_path),
+            routed_payload.content,
             response_language,
             instruction=routed_payload.instruction,
-            original_filename=routed_payload.filename,
+            filename=routed_payload.filename,
+            priority=priority,
+            use_cache=use_cache,
+            context_overflow=context_overflow,
+            reasoning=reasoning,
+            index=routed_payload.index,
         )
         logger.debug("Ollama response received for file: %s", filename)
     except HTTPException:
         # Пробрасываем HTTPException как есть
         raise
-    except FileNotFoundError as exc:
-        logger.error("Temp file not found: %s", temp_path, exc_info=True)
-        raise HTTPException(
-            status_code=500,
-            detail=f"Временный файл не найден: {str(exc)}"
-        ) from exc
-    except UnicodeDecodeError as exc:
-        logger.error("Unicode decode error for file: %s", filename, exc_info=True)
-        raise HTTPException(
-            status_code=400,
-            detail=f"Файл '{filename}' содержит некорректные символы (не UTF-8): {str(exc)}"
-        ) from exc
     except ConnectionError as exc:
         logger.error("Connection error to Ollama for file: %s", filename, exc_info=True)
         raise HTTPException(
@@ -82,8 +146,6 @@ async def process_json_query(json_file: UploadFile, question: str, response_lang
             status_code=500,
             detail=f"Неожиданная ошибка при обработке файла '{filename}' ({error_type}): {error_msg}"
         ) from exc
-    finally:
-        temp_path.unlink(missing_ok=True)
 
     if not result or not result.get("response"):
         raise HTTPException(
@@ -95,5 +157,45 @@ async def process_json_query(json_file: UploadFile, question: str, response_lang
         "model": result.get("model", "deepseek-r1"),
         "response": result.get("response"),
         "prompt": result.get("prompt"),
+        "cached": result.get("cached", False),
+        "context_budget": result.get("context_budget"),
+        "reasoning": result.get("reasoning"),
+        "context_encoding": routed_payload.encoding,
+        "timings": result.get("timings"),
     }
 
+
+async def open_json_query_stream(
+    json_file: UploadFile,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    context_overflow: str | None = None,
+    reasoning: ReasoningBudget | None = None,
+    context_encoder: str | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Готовит потоковый ответ deepseek-r1 по загруженному файлу.
+    Возвращает итератор событий, у которого уже получено первое событие:
+    ошибки конвертации и подключения к Ollama поднимаются здесь как HTTPException.
+    """
+    _require_file(json_file)
+    json_file, file_digest = await buffer_upload(json_file)
+    routed_payload = await _load_routed_payload(
+        json_file, question, file_digest, context_encoder, context_overflow
+    )
+    events = stream_console_json_ollama(
+        question,
+        routed_payload.content,
+        response_language,
+        instruction=routed_payload.instruction,
+        filename=routed_payload.filename,
+        priority=priority,
+        use_cache=use_cache,
+        context_overflow=context_overflow,
+        reasoning=reasoning,
+        index=routed_payload.index,
+    )
+    return await prime_event_stream(events)
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, List, Sequence, Tuple
+
+from fastapi import HTTPException
+
+from .ollama_scheduler import PRIORITY_INTERACTIVE, scheduler
+from .prompt_budget import OVERFLOW_TRIM, choose_num_ctx, estimate_tokens, prompt_budgeter
+from .reasoning import ReasoningBudget, ReasoningResult, generate_with_budget
+from .retrieval import Chunk
+
+logger = logging.getLogger(__name__)
+
+# Предел токенов одной части документа; меньше окна модели — больше частей обрабатываются параллельно
+MAP_REDUCE_PART_TOKENS = int(os.getenv("MAP_REDUCE_PART_TOKENS", "8192"))
+# Документ, который делится на большее число частей, отклоняется с 413
+MAP_REDUCE_MAX_PARTS = int(os.getenv("MAP_REDUCE_MAX_PARTS", "64"))
+# Одновременных частичных запросов; 0 — по числу слотов планировщика для модели
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "0"))
+# Сколько раз частичные ответы, не поместившиеся в окно, сводятся промежуточно
+MAP_REDUCE_MAX_ROUNDS = int(os.getenv("MAP_REDUCE_MAX_ROUNDS", "3"))
+
+NO_DATA_ANSWER = "НЕТ ДАННЫХ"
+
+MAP_INSTRUCTION = (
+    "Вам передана только часть документа. Выпишите из неё всё, что нужно для ответа на вопрос: "
+    "названия, значения, количества и суммы с единицами измерения. Не делайте выводов о документе в целом. "
+    f"Если в этой части нужных сведений нет, ответьте ровно «{NO_DATA_ANSWER}»."
+)
+REDUCE_INSTRUCTION = (
+    "Документ слишком велик для одного запроса и обработан по частям: ниже — сведения, выписанные "
+    "из каждой части по вопросу. Объедините их в один ответ; если вопрос об итогах, сложите значения из разных частей."
+)
+EMPTY_EXTRACTS = "В частях документа нет сведений, относящихся к вопросу."
+
+
+def _is_boundary(chunk: Chunk, token_limit: int) -> bool:
+    # Граница части зависит только от содержимого фрагмента (в среднем часть занимает половину предела):
+    # правка документа сдвигает границы лишь рядом с изменённым местом, поэтому остальные части
+    # и их ответы в кэше LLM остаются прежними
+    period = max(1, token_limit // (2 * max(1, chunk.tokens)))
+    digest = hashlib.sha256(f"{chunk.title}\n{chunk.text}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % period == 0
+
+
+def split_parts(header: str, chunks: Sequence[Chunk], token_limit: int) -> List[Tuple[str, str]]:
+    """Части документа `(заголовок, текст)`: реквизиты документа и подряд идущие фрагменты в пределах `token_limit`."""
+    available = max(1, token_limit - estimate_tokens(header))
+    groups: List[List[Chunk]] = []
+    current: List[Chunk] = []
+    used = 0
+    for chunk in chunks:
+        if current and used + chunk.tokens > available:
+            groups.append(current)
+            current, used = [], 0
+        current.append(chunk)
+        used += chunk.tokens
+        if _is_boundary(chunk, available):
+            groups.append(current)
+            current, used = [], 0
+    if current:
+        groups.append(current)
+
+    parts = []
+    for group in groups:
+        title = group[0].title if len(group) == 1 else f"{group[0].title} … {group[-1].title}"
+        # Номер части в текст не входит: иначе добавление одной части меняло бы промпты всех остальных
+        sections = [header] if header else []
+        sections.extend(f"## {chunk.title}\n{chunk.text}" for chunk in group)
+        parts.append((title, "\n".join(sections)))
+    return parts
+
+
+def join_extracts(extracts: Sequence[Tuple[str, str]]) -> str:
+    if not extracts:
+        return EMPTY_EXTRACTS
+    return "\n\n".join(f"### {title}\n{text}" for title, text in extracts)
+
+
+def _has_data(answer: str) -> bool:
+    normalized = answer.strip().strip(".«»\"'").strip().upper()
+    return bool(normalized) and not normalized.startswith(NO_DATA_ANSWER)
+
+
+def _concurrency() -> int:
+    if MAP_REDUCE_CONCURRENCY > 0:
+        return MAP_REDUCE_CONCURRENCY
+    # Больше одновременных запросов планировщик всё равно не допустит, а лишние заняли бы его очередь
+    return max(1, scheduler.slots_per_model * scheduler.node_count)
+
+
+@dataclass
+class MapReduceStats:
+    documents: int = 0
+    parts: int = 0
+    cached_parts: int = 0
+    empty_parts: int = 0
+    reduce_rounds: int = 0
+    map_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["map_seconds"] = round(self.map_seconds, 3)
+        data["cached_ratio"] = round(self.cached_parts / self.parts, 4) if self.parts else 0.0
+        return data
+
+
+class MapReducer:
+    """
+    Ответ по документу, который не помещается в окно модели:
+    - map: документ делится на части по фрагментам индекса (см. retrieval), по каждой части
+      модель выписывает сведения для ответа; запросы идут параллельно в пределах слотов планировщика;
+    - reduce: выписки сводятся в итоговый ответ одним запросом; если они сами не помещаются
+      в окно, сначала сводятся группами.
+    Частичные ответы кэшируются кэшем LLM по тексту промпта: промпт части зависит только от её
+    фрагментов и вопроса, а `num_ctx` одинаков для всех частей, поэтому после правки документа
+    заново выполняются только изменившиеся части.
+    """
+
+    def __init__(self) -> None:
+        self.stats = MapReduceStats()
+
+    async def _run_parts(
+        self,
+        model: str,
+        texts: Sequence[str],
+        build_prompt: Callable[[str], str],
+        *,
+        num_ctx: int,
+        reasoning: ReasoningBudget,
+        priority: int,
+        use_cache: bool,
+    ) -> List[ReasoningResult]:
+        limit = asyncio.Semaphore(_concurrency())
+
+        async def run_part(text: str) -> ReasoningResult:
+            async with limit:
+                prompt, budget = await prompt_budgeter.fit_document(model, text, build_prompt, overflow=OVERFLOW_TRIM)
+                payload = {"model": model, "prompt": prompt, "options": {"num_ctx": max(num_ctx, budget.num_ctx)}}
+                # Без привязки к узлу: части распределяются по всем узлам пула
+                return await generate_with_budget(payload, reasoning, priority=priority, use_cache=use_cache)
+
+        tasks = [asyncio.ensure_future(run_part(text)) for text in texts]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            # Ошибка одной части (или уход клиента) отменяет остальные
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def map_document(
+        self,
+        model: str,
+        header: str,
+        chunks: Sequence[Chunk],
+        build_map_prompt: Callable[[str], str],
+        build_reduce_prompt: Callable[[str], str],
+        *,
+        context_length: int,
+        reserve_tokens: int,
+        reasoning: ReasoningBudget,
+        priority: int = PRIORITY_INTERACTIVE,
+        use_cache: bool = True,
+    ) -> Tuple[str, dict]:
+        """Выписки из частей документа для итогового запроса и сведения о частях для `context_budget`."""
+        overhead = estimate_tokens(build_map_prompt(""))
+        token_limit = min(MAP_REDUCE_PART_TOKENS, context_length - reserve_tokens - overhead)
+        if token_limit <= 0:
+            raise HTTPException(
+                status_code=413,
+                detail="Вопрос и инструкции не помещаются в окно модели даже без документа."
+            )
+        parts = split_parts(header, chunks, token_limit)
+        if len(parts) > MAP_REDUCE_MAX_PARTS:
+            raise HTTPException(
+                status_code=413,
+                detail=(
+                    f"Документ слишком большой для обработки по частям: {len(parts)} частей "
+                    f"при пределе {MAP_REDUCE_MAX_PARTS}. Используйте context_overflow=retrieve."
+                )
+            )
+        num_ctx = choose_num_ctx(token_limit + overhead + reserve_tokens, context_length)
+        run_options = dict(num_ctx=num_ctx, reasoning=reasoning, priority=priority, use_cache=use_cache)
+
+        started = time.perf_counter()
+        results = await self._run_parts(model, [text for _, text in parts], build_map_prompt, **run_options)
+        cached = sum(1 for result in results if result.final_chunk.get("cached"))
+        extracts = [(title, result.answer) for (title, _), result in zip(parts, results) if _has_data(result.answer)]
+        info = {
+            "parts": len(parts),
+            "cached_parts": cached,
+            "empty_parts": len(parts) - len(extracts),
+            "reduce_rounds": 0,
+        }
+
+        # Выписки, не помещающиеся в итоговый промпт, сводятся группами тем же запросом, что и части
+        while (
+            len(extracts) > 1
+            and info["reduce_rounds"] < MAP_REDUCE_MAX_ROUNDS
+            and estimate_tokens(build_reduce_prompt(join_extracts(extracts))) + reserve_tokens > context_length
+        ):
+            extract_chunks = [
+                Chunk(title=title, text=text, tokens=estimate_tokens(f"### {title}\n{text}\n\n"))
+                for title, text in extracts
+            ]
+            groups = split_parts("", extract_chunks, token_limit)
+            if len(groups) >= len(extracts):
+                break
+            results = await self._run_parts(model, [text for _, text in groups], build_map_prompt, **run_options)
+            extracts = [(title, result.answer) for (title, _), result in zip(groups, results) if _has_data(result.answer)]
+            info["reduce_rounds"] += 1
+        info["map_seconds"] = round(time.perf_counter() - started, 3)
+
+        self.stats.documents += 1
+        self.stats.parts += info["parts"]
+        self.stats.cached_parts += cached
+        self.stats.empty_parts += info["empty_parts"]
+        self.stats.reduce_rounds += info["reduce_rounds"]
+        self.stats.map_seconds += info["map_seconds"]
+        logger.info(
+            "Map-reduce over %d parts (%d cached, %d without data, %d extra rounds) in %.2fs",
+            info["parts"], cached, info["empty_parts"], info["reduce_rounds"], info["map_seconds"],
+        )
+        return join_extracts(extracts), info
+
+    def snapshot(self) -> dict:
+        return {
+            "part_tokens": MAP_REDUCE_PART_TOKENS,
+            "max_parts": MAP_REDUCE_MAX_PARTS,
+            "concurrency": _concurrency(),
+            **self.stats.as_dict(),
+        }
+
+
+map_reducer = MapReducer()
+
+
+__all__ = [
+    "MAP_INSTRUCTION",
+    "REDUCE_INSTRUCTION",
+    "MapReducer",
+    "join_extracts",
+    "map_reducer",
+    "split_parts",
+]
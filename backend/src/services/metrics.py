@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import bisect
+import math
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Префикс имён метрик; в одном Prometheus может быть несколько сервисов
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "ba_ai_gost")
+
+# Границы гистограмм по умолчанию: от миллисекунд до десятков минут генерации
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+SIZE_BUCKETS = tuple(float(4 ** power) * 256 for power in range(10))  # 256 Б … 64 MiB
+TOKEN_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+LabelValues = Tuple[str, ...]
+
+_INF_BOUND = 'le="+Inf"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = f"{METRICS_PREFIX}_{name}" if METRICS_PREFIX else name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}")
+        return lines
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, buckets: int) -> None:
+        self.counts = [0] * buckets
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        self._series: Dict[LabelValues, _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _HistogramSeries(len(self.buckets))
+        # Счётчики хранятся по корзинам, накопленные суммы считаются при выдаче
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series.counts[index] += 1
+        series.total += value
+        series.count += 1
+
+    @contextmanager
+    def time(self, **labels: object) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, _INF_BOUND)} {series.count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_number(series.total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса в текстовом формате Prometheus (`GET /metrics`) без внешних зависимостей.
+    Значения хранятся в памяти процесса: при нескольких процессах uvicorn каждый отдаёт свои.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+UPLOAD_READ_SECONDS = metrics.histogram(
+    "upload_read_seconds", "Time to read an uploaded file into memory."
+)
+UPLOAD_BYTES = metrics.histogram(
+    "upload_bytes", "Size of uploaded files.", buckets=SIZE_BUCKETS
+)
+CONVERSION_SECONDS = metrics.histogram(
+    "conversion_seconds", "File handler conversion time, cache misses only.", ["suffix"]
+)
+SERIALIZATION_SECONDS = metrics.histogram(
+    "serialization_seconds", "Encoding a converted document into prompt text.", ["encoder"]
+)
+PROMPT_BYTES = metrics.histogram(
+    "prompt_bytes", "Size of prompts sent to Ollama (UTF-8).", ["model"], buckets=SIZE_BUCKETS
+)
+PROMPT_TOKENS = metrics.histogram(
+    "prompt_tokens", "Prompt tokens evaluated by Ollama (prompt_eval_count).", ["model"], buckets=TOKEN_BUCKETS
+)
+OLLAMA_QUEUE_WAIT_SECONDS = metrics.histogram(
+    "ollama_queue_wait_seconds", "Time spent waiting for an Ollama scheduler slot.", ["model"]
+)
+OLLAMA_PROMPT_EVAL_SECONDS = metrics.histogram(
+    "ollama_prompt_eval_seconds", "Ollama prompt evaluation time (prompt_eval_duration).", ["model"]
+)
+OLLAMA_EVAL_SECONDS = metrics.histogram(
+    "ollama_eval_seconds", "Ollama generation time (eval_duration).", ["model"]
+)
+OLLAMA_TOKENS_PER_SECOND = metrics.histogram(
+    "ollama_tokens_per_second", "Ollama throughput by phase: prompt evaluation or generation.",
+    ["model", "phase"], buckets=RATE_BUCKETS,
+)
+HTTP_ERRORS = metrics.counter(
+    "http_errors_total", "Responses with status 400 and above.", ["route", "status"]
+)
+CACHE_LOOKUPS = metrics.counter(
+    "cache_lookups_total", "Cache lookups by cache and result (hit or miss).", ["cache", "result"]
+)
+
+_NS_IN_SECOND = 1_000_000_000
+
+
+def observe_ollama_response(model: str, response: dict) -> None:
+    """Длительности и скорость из финального ответа Ollama (наносекунды, см. extract_ollama_timings)."""
+    for count_key, duration_key, histogram, phase in (
+        ("prompt_eval_count", "prompt_eval_duration", OLLAMA_PROMPT_EVAL_SECONDS, "prompt"),
+        ("eval_count", "eval_duration", OLLAMA_EVAL_SECONDS, "eval"),
+    ):
+        count = response.get(count_key)
+        duration = response.get(duration_key)
+        if not isinstance(duration, (int, float)) or duration <= 0:
+            continue
+        histogram.observe(duration / _NS_IN_SECOND, model=model)
+        if isinstance(count, int) and count > 0:
+            OLLAMA_TOKENS_PER_SECOND.observe(count / (duration / _NS_IN_SECOND), model=model, phase=phase)
+    prompt_tokens = response.get("prompt_eval_count")
+    if isinstance(prompt_tokens, int):
+        PROMPT_TOKENS.observe(prompt_tokens, model=model)
+
+
+def prompt_bytes(payload: dict) -> int:
+    """Размер промпта: `prompt` и `system` (/api/generate), сообщения (/api/chat), `input` (/api/embed)."""
+    size = 0
+    inputs = payload.get("input")
+    texts = [payload.get("system"), payload.get("prompt"), *(inputs if isinstance(inputs, list) else [inputs])]
+    for value in texts:
+        if isinstance(value, str):
+            size += len(value.encode("utf-8"))
+    for message in payload.get("messages") or ():
+        if isinstance(message, dict) and isinstance(message.get("content"), str):
+            size += len(message["content"].encode("utf-8"))
+    return size
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+__all__ = [
+    "CACHE_LOOKUPS",
+    "CONVERSION_SECONDS",
+    "Counter",
+    "HTTP_ERRORS",
+    "Histogram",
+    "MetricsRegistry",
+    "OLLAMA_QUEUE_WAIT_SECONDS",
+    "PROMPT_BYTES",
+    "SERIALIZATION_SECONDS",
+    "UPLOAD_BYTES",
+    "UPLOAD_READ_SECONDS",
+    "metrics",
+    "observe_ollama_response",
+    "prompt_bytes",
+    "record_cache_lookup",
+]
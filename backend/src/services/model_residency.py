@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from .ollama_pool import pool
+from .ollama_scheduler import PRIORITY_BATCH
+
+logger = logging.getLogger(__name__)
+
+
+def _split_models(value: str) -> List[str]:
+    return [model.strip() for model in value.split(",") if model.strip()]
+
+
+# Модели, которые загружаются в память при старте backend (JSON- и vision-запросы)
+OLLAMA_PRELOAD_MODELS = _split_models(os.getenv("OLLAMA_PRELOAD_MODELS", "deepseek-r1,llava"))
+OLLAMA_MANAGE_KEEP_ALIVE = os.getenv("OLLAMA_MANAGE_KEEP_ALIVE", "1").lower() not in ("0", "false", "no")
+OLLAMA_KEEP_ALIVE_HOT = os.getenv("OLLAMA_KEEP_ALIVE_HOT", "30m")
+OLLAMA_KEEP_ALIVE_COLD = os.getenv("OLLAMA_KEEP_ALIVE_COLD", "5m")
+OLLAMA_TRAFFIC_WINDOW_SECONDS = float(os.getenv("OLLAMA_TRAFFIC_WINDOW_SECONDS", "900"))
+OLLAMA_HOT_MODEL_MIN_REQUESTS = int(os.getenv("OLLAMA_HOT_MODEL_MIN_REQUESTS", "3"))
+# load_duration выше порога означает, что модель загружалась с диска, а не была в памяти
+OLLAMA_COLD_LOAD_THRESHOLD_MS = float(os.getenv("OLLAMA_COLD_LOAD_THRESHOLD_MS", "1000"))
+
+
+@dataclass
+class ModelResidencyStats:
+    requests: int = 0
+    cold_loads: int = 0
+    total_load_ms: float = 0.0
+    max_load_ms: float = 0.0
+    last_load_ms: float = 0.0
+    preloads: int = 0
+    preload_failures: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "cold_loads": self.cold_loads,
+            "avg_load_ms": round(self.total_load_ms / self.cold_loads, 1) if self.cold_loads else 0.0,
+            "max_load_ms": round(self.max_load_ms, 1),
+            "last_load_ms": round(self.last_load_ms, 1),
+            "preloads": self.preloads,
+            "preload_failures": self.preload_failures,
+        }
+
+
+class ModelResidencyManager:
+    """
+    Управляет тем, какие модели держит в памяти Ollama.
+
+    - при старте прогревает модели из OLLAMA_PRELOAD_MODELS;
+    - какие модели сейчас загружены, знает пул узлов (`/api/ps` в его проверке здоровья);
+    - выставляет `keep_alive` каждого запроса по недавнему трафику модели: часто используемые
+      модели держатся дольше, редкие быстрее освобождают место (OLLAMA_MAX_LOADED_MODELS
+      общий с agent-* моделями);
+    - считает холодные загрузки и их длительность по `load_duration` из ответов Ollama.
+    """
+
+    def __init__(
+        self,
+        preload_models: Optional[List[str]] = None,
+        *,
+        manage_keep_alive: bool = OLLAMA_MANAGE_KEEP_ALIVE,
+        keep_alive_hot: str = OLLAMA_KEEP_ALIVE_HOT,
+        keep_alive_cold: str = OLLAMA_KEEP_ALIVE_COLD,
+        traffic_window: float = OLLAMA_TRAFFIC_WINDOW_SECONDS,
+        hot_min_requests: int = OLLAMA_HOT_MODEL_MIN_REQUESTS,
+        cold_load_threshold_ms: float = OLLAMA_COLD_LOAD_THRESHOLD_MS,
+    ) -> None:
+        self.preload_models = list(OLLAMA_PRELOAD_MODELS if preload_models is None else preload_models)
+        self.manage_keep_alive = manage_keep_alive
+        self.keep_alive_hot = keep_alive_hot
+        self.keep_alive_cold = keep_alive_cold
+        self.traffic_window = traffic_window
+        self.hot_min_requests = max(1, hot_min_requests)
+        self.cold_load_threshold_ms = cold_load_threshold_ms
+        self._recent: Dict[str, Deque[float]] = {}
+        self._stats: Dict[str, ModelResidencyStats] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def _model_stats(self, model: str) -> ModelResidencyStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelResidencyStats()
+        return stats
+
+    def _recent_requests(self, model: str, now: float) -> int:
+        window = self._recent.get(model)
+        if not window:
+            return 0
+        while window and now - window[0] > self.traffic_window:
+            window.popleft()
+        return len(window)
+
+    def is_resident(self, model: str) -> bool:
+        return pool.is_loaded(model)
+
+    def keep_alive_for(self, model: str) -> str:
+        if self._recent_requests(model, time.monotonic()) >= self.hot_min_requests:
+            return self.keep_alive_hot
+        return self.keep_alive_cold
+
+    def prepare_payload(self, payload: dict, *, warm_up: bool = False) -> dict:
+        """
+        Отмечает запрос к модели и подставляет `keep_alive`, если вызывающий его не задал.
+        Прогрев (`warm_up`, см. `preload`) трафиком не считается и не делает модель «горячей».
+        """
+        model = payload.get("model")
+        if not model:
+            return payload
+        if not warm_up:
+            self._recent.setdefault(model, deque()).append(time.monotonic())
+            self._model_stats(model).requests += 1
+        if not self.manage_keep_alive or "keep_alive" in payload:
+            return payload
+        return {**payload, "keep_alive": self.keep_alive_for(model)}
+
+    def observe_response(self, model: str, ollama_response: dict, node_url: Optional[str] = None) -> None:
+        if model:
+            pool.mark_loaded(node_url, model)
+        load_duration = ollama_response.get("load_duration")
+        if not model or not isinstance(load_duration, (int, float)):
+            return
+        load_ms = load_duration / 1_000_000
+        if load_ms >= self.cold_load_threshold_ms:
+            stats = self._model_stats(model)
+            stats.cold_loads += 1
+            stats.total_load_ms += load_ms
+            stats.last_load_ms = load_ms
+            stats.max_load_ms = max(stats.max_load_ms, load_ms)
+            logger.info("Cold load of model %s on %s took %.0f ms", model, node_url or "ollama", load_ms)
+
+    async def _preload_node(self, model: str, node_url: str, options: dict) -> None:
+        from .ollama_service import call_ollama
+
+        stats = self._model_stats(model)
+        payload = {"model": model, "prompt": "", "stream": False, "keep_alive": self.keep_alive_hot}
+        if options:
+            payload["options"] = options
+        try:
+            await call_ollama(
+                "/api/generate",
+                payload,
+                priority=PRIORITY_BATCH,
+                use_cache=False,
+                node_url=node_url,
+                warm_up=True,
+            )
+        except HTTPException as exc:
+            stats.preload_failures += 1
+            logger.warning("Preload of model %s on %s failed: %s", model, node_url, exc.detail)
+            return
+        stats.preloads += 1
+        logger.info("Model %s preloaded on %s", model, node_url)
+
+    async def preload(self, model: str) -> None:
+        """
+        Загружает модель в память пустым запросом генерации на каждом здоровом узле, где её ещё нет:
+        запросы распределяются по всем узлам, и холодная загрузка не должна достаться первому из них.
+        """
+        from .prompt_budget import prompt_budgeter
+
+        nodes = [node for node in pool.healthy_nodes() if not node.has_loaded(model)]
+        if not nodes:
+            return
+        # Окно прогрева совпадает с окном запросов, иначе первый же запрос перезагрузит модель
+        options = await prompt_budgeter.preload_options(model)
+        await asyncio.gather(*(self._preload_node(model, node.url, options) for node in nodes))
+
+    async def _preload_all(self) -> None:
+        for model in self.preload_models:
+            await self.preload(model)
+
+    async def start(self) -> None:
+        """Запускает фоновый прогрев моделей, не задерживая старт приложения (пул узлов запускает вызывающий)."""
+        if self.preload_models:
+            self._tasks.append(asyncio.create_task(self._preload_all()))
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        models = set(self._stats) | set(self.preload_models)
+        return {
+            "preload_models": self.preload_models,
+            "resident": pool.loaded_models(),
+            "models": {
+                model: {
+                    **self._model_stats(model).as_dict(),
+                    "resident": self.is_resident(model),
+                    "recent_requests": self._recent_requests(model, now),
+                    "keep_alive": self.keep_alive_for(model),
+                }
+                for model in sorted(models)
+            },
+        }
+
+
+residency = ModelResidencyManager()
+
+
+__all__ = ["ModelResidencyManager", "residency"]
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Collection, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+from .ollama_scheduler import scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def _configured_urls() -> List[str]:
+    # OLLAMA_BASE_URLS — список узлов через запятую; для одного узла достаточно OLLAMA_BASE_URL
+    raw = os.getenv("OLLAMA_BASE_URLS") or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    return [url.strip().rstrip("/") for url in raw.split(",") if url.strip()]
+
+
+OLLAMA_BASE_URLS = _configured_urls()
+OLLAMA_HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("OLLAMA_HEALTH_CHECK_INTERVAL_SECONDS", "15"))
+OLLAMA_HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_HEALTH_CHECK_TIMEOUT_SECONDS", "5"))
+OLLAMA_NODE_FAILURE_THRESHOLD = int(os.getenv("OLLAMA_NODE_FAILURE_THRESHOLD", "2"))
+OLLAMA_AFFINITY_TTL_SECONDS = float(os.getenv("OLLAMA_AFFINITY_TTL_SECONDS", "3600"))
+_AFFINITY_MAX_KEYS = 10_000
+
+
+def normalize_model_name(model: str) -> str:
+    return model if ":" in model else f"{model}:latest"
+
+
+@dataclass
+class OllamaNode:
+    url: str
+    healthy: bool = True
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_error: Optional[str] = None
+    last_checked_at: Optional[float] = None
+    models: Set[str] = field(default_factory=set)
+    loaded_models: Dict[str, dict] = field(default_factory=dict)
+
+    def has_model(self, model: str) -> bool:
+        return normalize_model_name(model) in self.models
+
+    def has_loaded(self, model: str) -> bool:
+        return normalize_model_name(model) in self.loaded_models
+
+    def describe(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_checked_at": self.last_checked_at,
+            "models": sorted(self.models),
+            "loaded_models": sorted(self.loaded_models),
+        }
+
+
+class OllamaPool:
+    """
+    Пул узлов Ollama с активной проверкой здоровья и маршрутизацией по наименьшему числу
+    незавершённых запросов.
+
+    - узлы проверяются запросами `/api/tags` (доступные модели) и `/api/ps` (загруженные модели);
+    - после `failure_threshold` ошибок подряд узел исключается из маршрутизации до успешной проверки;
+    - среди здоровых узлов предпочтение отдаётся тем, где модель уже загружена в память;
+    - ключ привязки (сессия, документ) закрепляет запросы за одним узлом, чтобы Ollama
+      переиспользовала вычисленный префикс промпта; при падении узла привязка переносится.
+    """
+
+    def __init__(
+        self,
+        urls: Optional[List[str]] = None,
+        *,
+        health_check_interval: float = OLLAMA_HEALTH_CHECK_INTERVAL_SECONDS,
+        health_check_timeout: float = OLLAMA_HEALTH_CHECK_TIMEOUT_SECONDS,
+        failure_threshold: int = OLLAMA_NODE_FAILURE_THRESHOLD,
+        affinity_ttl: float = OLLAMA_AFFINITY_TTL_SECONDS,
+    ) -> None:
+        node_urls = urls if urls is not None else OLLAMA_BASE_URLS
+        if not node_urls:
+            raise ValueError("Не задан ни один адрес Ollama (OLLAMA_BASE_URLS / OLLAMA_BASE_URL).")
+        self.nodes: List[OllamaNode] = [OllamaNode(url=url.rstrip("/")) for url in node_urls]
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.failure_threshold = max(1, failure_threshold)
+        self.affinity_ttl = affinity_ttl
+        self._affinity: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def primary_url(self) -> str:
+        return self.nodes[0].url
+
+    def node(self, url: str) -> Optional[OllamaNode]:
+        url = url.rstrip("/")
+        for node in self.nodes:
+            if node.url == url:
+                return node
+        return None
+
+    def healthy_nodes(self) -> List[OllamaNode]:
+        return [node for node in self.nodes if node.healthy]
+
+    def has_candidates(self, exclude: Collection[str] = ()) -> bool:
+        return any(node.url not in exclude for node in self.nodes)
+
+    def is_loaded(self, model: str) -> bool:
+        return any(node.healthy and node.has_loaded(model) for node in self.nodes)
+
+    def loaded_models(self) -> Dict[str, dict]:
+        loaded: Dict[str, dict] = {}
+        for node in self.nodes:
+            if node.healthy:
+                for name, details in node.loaded_models.items():
+                    loaded.setdefault(name, {**details, "nodes": []})["nodes"].append(node.url)
+        return loaded
+
+    def _affinity_node(self, key: str, candidates: List[OllamaNode]) -> Optional[OllamaNode]:
+        entry = self._affinity.get(key)
+        if entry is None:
+            return None
+        url, touched_at = entry
+        if time.monotonic() - touched_at > self.affinity_ttl:
+            self._affinity.pop(key, None)
+            return None
+        for node in candidates:
+            if node.url == url:
+                return node
+        return None
+
+    def _remember_affinity(self, key: str, node: OllamaNode) -> None:
+        self._affinity[key] = (node.url, time.monotonic())
+        self._affinity.move_to_end(key)
+        while len(self._affinity) > _AFFINITY_MAX_KEYS:
+            self._affinity.popitem(last=False)
+
+    def choose(
+        self,
+        model: Optional[str] = None,
+        *,
+        affinity_key: Optional[str] = None,
+        exclude: Collection[str] = (),
+        pinned_url: Optional[str] = None,
+    ) -> OllamaNode:
+        if pinned_url is not None:
+            node = self.node(pinned_url)
+            if node is None:
+                raise HTTPException(status_code=400, detail=f"Узел Ollama '{pinned_url}' не настроен.")
+            return node
+
+        available = [node for node in self.nodes if node.url not in exclude]
+        candidates = [node for node in available if node.healthy] or available
+        if not candidates:
+            raise HTTPException(
+                status_code=503,
+                detail="Нет доступных узлов Ollama. Проверьте, что Ollama запущен и доступен."
+            )
+
+        if affinity_key:
+            sticky = self._affinity_node(affinity_key, candidates)
+            if sticky is not None and (not model or not sticky.models or sticky.has_model(model)):
+                self._remember_affinity(affinity_key, sticky)
+                return sticky
+
+        if model:
+            # Узлы, о моделях которых ещё ничего не известно, не исключаем
+            with_model = [node for node in candidates if not node.models or node.has_model(model)]
+            candidates = with_model or candidates
+            with_loaded = [node for node in candidates if node.has_loaded(model)]
+            candidates = with_loaded or candidates
+
+        chosen = min(candidates, key=lambda node: (node.outstanding, node.requests))
+        if affinity_key:
+            self._remember_affinity(affinity_key, chosen)
+        return chosen
+
+    @asynccontextmanager
+    async def lease(self, node: OllamaNode) -> AsyncIterator[OllamaNode]:
+        node.outstanding += 1
+        node.requests += 1
+        try:
+            yield node
+        finally:
+            node.outstanding -= 1
+
+    def mark_success(self, node: OllamaNode) -> None:
+        node.consecutive_failures = 0
+        if not node.healthy:
+            logger.info("Ollama node %s is back online", node.url)
+            node.healthy = True
+            self._sync_scheduler()
+
+    def mark_failure(self, node: OllamaNode, error: BaseException | str) -> None:
+        node.failures += 1
+        node.consecutive_failures += 1
+        node.last_error = str(error) or type(error).__name__
+        if node.healthy and node.consecutive_failures >= self.failure_threshold:
+            logger.warning("Ollama node %s marked unhealthy: %s", node.url, node.last_error)
+            node.healthy = False
+            self._sync_scheduler()
+
+    def mark_loaded(self, url: Optional[str], model: str) -> None:
+        node = self.node(url) if url else None
+        if node is not None:
+            name = normalize_model_name(model)
+            node.loaded_models.setdefault(name, {"name": name})
+
+    def _sync_scheduler(self) -> None:
+        # Слоты планировщика заданы на один узел Ollama; при нескольких здоровых узлах их больше
+        scheduler.set_node_count(len(self.healthy_nodes()) or 1)
+
+    async def check_node(self, node: OllamaNode) -> None:
+        from .ollama_service import get_ollama_http_client
+
+        client = get_ollama_http_client()
+        try:
+            tags = await client.get(f"{node.url}/api/tags", timeout=self.health_check_timeout)
+            tags.raise_for_status()
+            ps = await client.get(f"{node.url}/api/ps", timeout=self.health_check_timeout)
+            ps.raise_for_status()
+        except Exception as exc:
+            node.last_checked_at = time.time()
+            self.mark_failure(node, exc)
+            return
+
+        node.last_checked_at = time.time()
+        node.models = {
+            normalize_model_name(item.get("name") or item.get("model"))
+            for item in tags.json().get("models") or []
+            if item.get("name") or item.get("model")
+        }
+        node.loaded_models = {}
+        for item in ps.json().get("models") or []:
+            name = item.get("name") or item.get("model")
+            if name:
+                node.loaded_models[normalize_model_name(name)] = {
+                    "name": name,
+                    "size": item.get("size"),
+                    "size_vram": item.get("size_vram"),
+                    "expires_at": item.get("expires_at"),
+                }
+        self.mark_success(node)
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check_node(node) for node in self.nodes))
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # pragma: no cover - защита фонового цикла
+                logger.warning("Ollama health check failed: %s", exc)
+
+    async def start(self) -> None:
+        await self.check_all()
+        self._sync_scheduler()
+        if self.health_check_interval > 0:
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def snapshot(self) -> dict:
+        return {
+            "nodes": [node.describe() for node in self.nodes],
+            "healthy_nodes": len(self.healthy_nodes()),
+            "affinity_keys": len(self._affinity),
+            "health_check_interval_seconds": self.health_check_interval,
+        }
+
+
+pool = OllamaPool()
+
+
+__all__ = ["OllamaNode", "OllamaPool", "normalize_model_name", "pool"]
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию совпадают с настройками сервиса ollama в docker-compose.yml
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+OLLAMA_MAX_LOADED_MODELS = int(os.getenv("OLLAMA_MAX_LOADED_MODELS", "2"))
+OLLAMA_SCHEDULER_MAX_QUEUE = int(os.getenv("OLLAMA_SCHEDULER_MAX_QUEUE", "32"))
+OLLAMA_SCHEDULER_QUEUE_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_SCHEDULER_QUEUE_TIMEOUT_SECONDS", "600"))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+PRIORITIES: Dict[str, int] = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "batch": PRIORITY_BATCH,
+}
+
+# Коэффициент сглаживания для средней длительности занятия слота (для оценки Retry-After)
+_SERVICE_TIME_EWMA_ALPHA = 0.2
+
+
+def resolve_priority(priority: str | int | None) -> int:
+    if priority is None or priority == "":
+        return PRIORITY_INTERACTIVE
+    if isinstance(priority, int):
+        return priority
+    normalized = priority.strip().lower()
+    if normalized not in PRIORITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный приоритет '{priority}'. Допустимые значения: {', '.join(PRIORITIES)}."
+        )
+    return PRIORITIES[normalized]
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    model: str = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+@dataclass
+class ModelQueueStats:
+    active: int = 0
+    queued: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    last_wait_seconds: float = 0.0
+    avg_service_seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        avg_wait = self.total_wait_seconds / self.admitted if self.admitted else 0.0
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(avg_wait * 1000, 1),
+            "max_wait_ms": round(self.max_wait_seconds * 1000, 1),
+            "last_wait_ms": round(self.last_wait_seconds * 1000, 1),
+            "avg_service_ms": round(self.avg_service_seconds * 1000, 1),
+        }
+
+
+class OllamaScheduler:
+    """
+    Планировщик допуска запросов к Ollama.
+
+    - на каждую модель не больше `slots_per_model` одновременных запросов (OLLAMA_NUM_PARALLEL);
+    - одновременно активны не больше `max_active_models` разных моделей (OLLAMA_MAX_LOADED_MODELS);
+    - остальные запросы ждут в ограниченной очереди с приоритетами (меньше — важнее);
+    - при переполнении очереди запрос сразу отклоняется с 429 и заголовком Retry-After.
+    """
+
+    def __init__(
+        self,
+        slots_per_model: int = OLLAMA_NUM_PARALLEL,
+        max_active_models: int = OLLAMA_MAX_LOADED_MODELS,
+        max_queue: int = OLLAMA_SCHEDULER_MAX_QUEUE,
+        queue_timeout: float = OLLAMA_SCHEDULER_QUEUE_TIMEOUT_SECONDS,
+    ) -> None:
+        self.slots_per_model = max(1, slots_per_model)
+        self.max_active_models = max(1, max_active_models)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.node_count = 1
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._stats: Dict[str, ModelQueueStats] = {}
+
+    def _model_stats(self, model: str) -> ModelQueueStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelQueueStats()
+        return stats
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _active_models(self) -> int:
+        return sum(1 for stats in self._stats.values() if stats.active > 0)
+
+    def set_node_count(self, node_count: int) -> None:
+        """Ёмкость масштабируется числом здоровых узлов Ollama: настройки слотов заданы на один узел."""
+        node_count = max(1, node_count)
+        if node_count != self.node_count:
+            logger.info("Ollama scheduler capacity: %d node(s)", node_count)
+            self.node_count = node_count
+            self._dispatch()
+
+    def _can_admit(self, model: str) -> bool:
+        stats = self._model_stats(model)
+        if stats.active >= self.slots_per_model * self.node_count:
+            return False
+        if stats.active == 0 and self._active_models() >= self.max_active_models * self.node_count:
+            return False
+        return True
+
+    def _grant(self, model: str, wait_seconds: float) -> None:
+        stats = self._model_stats(model)
+        stats.active += 1
+        stats.admitted += 1
+        stats.total_wait_seconds += wait_seconds
+        stats.last_wait_seconds = wait_seconds
+        stats.max_wait_seconds = max(stats.max_wait_seconds, wait_seconds)
+
+    def _dispatch(self) -> None:
+        """Выдаёт освободившиеся слоты ожидающим в порядке приоритета и времени постановки в очередь."""
+        if not self._waiters:
+            return
+        remaining: List[_Waiter] = []
+        now = time.monotonic()
+        for waiter in sorted(self._waiters):
+            if waiter.future.done():
+                continue
+            if self._can_admit(waiter.model):
+                self._grant(waiter.model, now - waiter.enqueued_at)
+                waiter.future.set_result(None)
+            else:
+                remaining.append(waiter)
+        heapq.heapify(remaining)
+        self._waiters = remaining
+        self._refresh_queued()
+
+    def _refresh_queued(self) -> None:
+        for stats in self._stats.values():
+            stats.queued = 0
+        for waiter in self._waiters:
+            self._model_stats(waiter.model).queued += 1
+
+    def _remove_waiter(self, waiter: _Waiter) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+        self._refresh_queued()
+
+    def _retry_after_seconds(self, model: str) -> int:
+        stats = self._model_stats(model)
+        service_time = stats.avg_service_seconds or 30.0
+        estimate = service_time * (self.queue_depth + 1) / (self.slots_per_model * self.node_count)
+        return max(1, min(300, math.ceil(estimate)))
+
+    def _queued_ahead(self, model: str, priority: int) -> bool:
+        return any(
+            waiter.model == model and waiter.priority <= priority and not waiter.future.done()
+            for waiter in self._waiters
+        )
+
+    async def _acquire(self, model: str, priority: int) -> float:
+        # Очередь из запросов к другим, занятым моделям не мешает модели со свободным слотом:
+        # ждать и получать 429 приходится, только если слотов нет или впереди запрос к этой же модели
+        if self._can_admit(model) and not self._queued_ahead(model, priority):
+            self._grant(model, 0.0)
+            return 0.0
+
+        if self.queue_depth >= self.max_queue:
+            stats = self._model_stats(model)
+            stats.rejected += 1
+            retry_after = self._retry_after_seconds(model)
+            logger.warning(
+                "Ollama queue is full: model=%s, depth=%d, retry_after=%ds",
+                model, self.queue_depth, retry_after,
+            )
+            raise HTTPException(
+                status_code=429,
+                detail=f"Очередь запросов к модели '{model}' переполнена. Повторите запрос через {retry_after} с.",
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(
+            priority=priority,
+            seq=next(self._seq),
+            model=model,
+            enqueued_at=time.monotonic(),
+            future=loop.create_future(),
+        )
+        heapq.heappush(self._waiters, waiter)
+        self._refresh_queued()
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.queue_timeout)
+        except asyncio.TimeoutError as exc:
+            self._remove_waiter(waiter)
+            stats = self._model_stats(model)
+            stats.timed_out += 1
+            retry_after = self._retry_after_seconds(model)
+            raise HTTPException(
+                status_code=503,
+                detail=f"Модель '{model}' занята: запрос не дождался очереди за {self.queue_timeout:g} с.",
+                headers={"Retry-After": str(retry_after)},
+            ) from exc
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот успели выдать в момент отмены — возвращаем его
+                self._release(model, 0.0)
+            else:
+                self._remove_waiter(waiter)
+            raise
+
+        return time.monotonic() - waiter.enqueued_at
+
+    def _release(self, model: str, service_seconds: float) -> None:
+        stats = self._model_stats(model)
+        stats.active = max(0, stats.active - 1)
+        if service_seconds > 0:
+            if stats.avg_service_seconds:
+                stats.avg_service_seconds += _SERVICE_TIME_EWMA_ALPHA * (service_seconds - stats.avg_service_seconds)
+            else:
+                stats.avg_service_seconds = service_seconds
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[float]:
+        """Занимает слот модели на время блока; возвращает время ожидания в очереди (секунды)."""
+        wait_seconds = await self._acquire(model, priority)
+        started = time.monotonic()
+        try:
+            yield wait_seconds
+        finally:
+            self._release(model, time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        return {
+            "slots_per_model": self.slots_per_model,
+            "max_active_models": self.max_active_models,
+            "max_queue": self.max_queue,
+            "queue_timeout_seconds": self.queue_timeout,
+            "node_count": self.node_count,
+            "queue_depth": self.queue_depth,
+            "active_models": self._active_models(),
+            "models": {model: stats.as_dict() for model, stats in sorted(self._stats.items())},
+        }
+
+
+scheduler = OllamaScheduler()
+
+
+__all__ = [
+    "OllamaScheduler",
+    "PRIORITY_BATCH",
+    "PRIORITY_INTERACTIVE",
+    "resolve_priority",
+    "scheduler",
+]
@@ -1,73 +1,388 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
 
 import httpx
 from fastapi import HTTPException
 
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+from .cancellation import cancellations
+from .metrics import OLLAMA_QUEUE_WAIT_SECONDS, PROMPT_BYTES, observe_ollama_response, prompt_bytes
+from .model_residency import residency
+from .ollama_pool import pool
+from .ollama_scheduler import PRIORITY_INTERACTIVE, scheduler
+from .response_cache import build_cache_key, response_cache
+from .tracing import annotate, record_span, traced
+from .utils.compat_asyncio import aclosing
 
+# Параметры общего пула соединений с Ollama (один keep-alive клиент на процесс)
+OLLAMA_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_TIMEOUT_SECONDS", "1800"))
+OLLAMA_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_CONNECT_TIMEOUT_SECONDS", "10"))
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "32"))
+OLLAMA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "16"))
+OLLAMA_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY_SECONDS", "300"))
 
-async def call_ollama(endpoint: str, payload: dict) -> dict:
-    url = f"{OLLAMA_BASE_URL.rstrip('/')}/{endpoint.lstrip('/')}"
+logger = logging.getLogger(__name__)
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(1800.0)) as client:
-        try:
-            response = await client.post(url, json=payload)
-        except httpx.ConnectError as exc:
-            raise HTTPException(
-                status_code=502,
-                detail=f"Не удалось подключиться к Ollama по адресу {OLLAMA_BASE_URL}. Проверьте, что Ollama запущен и доступен."
-            ) from exc
-        except httpx.TimeoutException as exc:
-            raise HTTPException(
-                status_code=504,
-                detail="Превышено время ожидания ответа от Ollama (30 минут). Модель обрабатывает запрос слишком долго. Попробуйте уменьшить размер файла или упростить вопрос."
-            ) from exc
-        except httpx.RequestError as exc:
+_http_client: httpx.AsyncClient | None = None
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(OLLAMA_TIMEOUT_SECONDS, connect=OLLAMA_CONNECT_TIMEOUT_SECONDS),
+        limits=httpx.Limits(
+            max_connections=OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=OLLAMA_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OLLAMA_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+    )
+
+
+def get_ollama_http_client() -> httpx.AsyncClient:
+    """
+    Возвращает общий httpx-клиент для всех обращений к Ollama.
+    Если lifespan приложения ещё не создал клиент (скрипты, консольный запуск), создаёт его лениво.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _build_http_client()
+    return _http_client
+
+
+async def startup_ollama_client() -> httpx.AsyncClient:
+    """Создаёт общий пул соединений с Ollama при старте приложения."""
+    return get_ollama_http_client()
+
+
+async def shutdown_ollama_client() -> None:
+    """Закрывает общий пул соединений с Ollama при остановке приложения."""
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+
+def build_ollama_url(endpoint: str, base_url: Optional[str] = None) -> str:
+    return f"{(base_url or pool.primary_url).rstrip('/')}/{endpoint.lstrip('/')}"
+
+
+# Ошибки, при которых запрос гарантированно не дошёл до Ollama и его можно повторить на другом узле
+_FAILOVER_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+def _request_error_to_http(exc: httpx.RequestError, base_url: Optional[str] = None) -> HTTPException:
+    """Переводит сетевые ошибки httpx в HTTPException с понятным пользователю описанием."""
+    if isinstance(exc, _FAILOVER_ERRORS):
+        return HTTPException(
+            status_code=502,
+            detail=f"Не удалось подключиться к Ollama по адресу {base_url or pool.primary_url}. Проверьте, что Ollama запущен и доступен."
+        )
+    if isinstance(exc, httpx.TimeoutException):
+        return HTTPException(
+            status_code=504,
+            detail=f"Превышено время ожидания ответа от Ollama ({OLLAMA_TIMEOUT_SECONDS / 60:g} мин). Модель обрабатывает запрос слишком долго. Попробуйте уменьшить размер файла или упростить вопрос."
+        )
+    return HTTPException(
+        status_code=502,
+        detail=f"Ошибка при обращении к Ollama: {str(exc)}"
+    )
+
+
+def _raise_for_ollama_status(response: httpx.Response) -> None:
+    if response.status_code < 400:
+        return
+
+    error_detail = "Неизвестная ошибка"
+    try:
+        error_json = response.json()
+        if "error" in error_json:
+            error_detail = error_json["error"]
+    except (ValueError, json.JSONDecodeError):
+        error_detail = response.text[:200] if response.text else "Пустой ответ от Ollama"
+
+    if response.status_code == 404:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Модель не найдена в Ollama: {error_detail}"
+        )
+    elif response.status_code == 500:
+        # Проверяем, не связана ли ошибка с нехваткой памяти
+        if "memory" in error_detail.lower() or "system memory" in error_detail.lower():
             raise HTTPException(
-                status_code=502,
-                detail=f"Ошибка при обращении к Ollama: {str(exc)}"
-            ) from exc
+                status_code=507,
+                detail=f"Недостаточно памяти для запуска модели. {error_detail}. Попробуйте использовать более легкую модель или освободите память."
+            )
+        raise HTTPException(
+            status_code=502,
+            detail=f"Ошибка Ollama при генерации ответа: {error_detail}"
+        )
+    else:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Ошибка Ollama (код {response.status_code}): {error_detail}"
+        )
+
+
+_CACHEABLE_ENDPOINTS = {"/api/generate", "/api/chat"}
+
+
+def _response_cache_key(endpoint: str, payload: dict, use_cache: bool) -> Optional[str]:
+    if "/" + endpoint.lstrip("/") not in _CACHEABLE_ENDPOINTS:
+        return None
+    if not use_cache:
+        response_cache.record_bypass()
+        return None
+    if not response_cache.enabled:
+        return None
+    return build_cache_key(endpoint, payload)
+
+
+@asynccontextmanager
+async def _unscheduled() -> AsyncIterator[float]:
+    yield 0.0
+
+
+@traced("ollama")
+async def call_ollama(
+    endpoint: str,
+    payload: dict,
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    affinity_key: Optional[str] = None,
+    node_url: Optional[str] = None,
+    warm_up: bool = False,
+    scheduled: bool = True,
+) -> dict:
+    """
+    Выполняет запрос к Ollama: кэш ответов, слот планировщика, выбор узла пула.
+    `affinity_key` закрепляет запросы (сессия, документ) за одним узлом,
+    `node_url` отправляет запрос строго на указанный узел без переключения,
+    `warm_up` — прогрев модели, который не учитывается в трафике (см. model_residency),
+    `scheduled=False` — короткий запрос без генерации (эмбеддинги), который не занимает слот планировщика.
+    """
+    client = get_ollama_http_client()
 
+    model = payload.get("model", "")
+    annotate(endpoint=endpoint, model=model)
+    cache_key = _response_cache_key(endpoint, payload, use_cache)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            annotate(cached=True)
+            return {**cached, "cached": True}
+
+    request_payload = residency.prepare_payload(payload, warm_up=warm_up)
+    PROMPT_BYTES.observe(prompt_bytes(payload), model=model)
+    async with (scheduler.slot(model, priority) if scheduled else _unscheduled()) as wait_seconds:
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(wait_seconds, model=model)
+        record_span("queue", wait_seconds, model=model)
+        tried: set[str] = set()
+        while True:
+            node = pool.choose(model, affinity_key=affinity_key, exclude=tried, pinned_url=node_url)
+            annotate(node=node.url)
+            started = time.monotonic()
+            try:
+                async with pool.lease(node):
+                    response = await client.post(build_ollama_url(endpoint, node.url), json=request_payload)
+            except asyncio.CancelledError:
+                # Клиент ушёл или истёк срок запроса: закрытие соединения останавливает генерацию в Ollama
+                cancellations.record_abandoned_generation(model, time.monotonic() - started)
+                raise
+            except _FAILOVER_ERRORS as exc:
+                pool.mark_failure(node, exc)
+                tried.add(node.url)
+                if node_url is not None or not pool.has_candidates(exclude=tried):
+                    raise _request_error_to_http(exc, node.url) from exc
+                logger.warning("Ollama node %s is unreachable, failing over: %s", node.url, exc)
+                continue
+            except httpx.RequestError as exc:
+                raise _request_error_to_http(exc, node.url) from exc
+            pool.mark_success(node)
+            break
+
+    _raise_for_ollama_status(response)
+
+    try:
+        response_json = response.json()
+    except json.JSONDecodeError as exc:
+        raise HTTPException(status_code=502, detail="Invalid JSON from Ollama") from exc
+
+    residency.observe_response(model, response_json, node.url)
+    observe_ollama_response(model, response_json)
+
+    if cache_key is not None and response_json.get("done", True):
+        await response_cache.put(cache_key, response_json)
+    return response_json
+
+
+class _StreamCollector:
+    """Собирает потоковые чанки в ответ того же вида, что и при `stream: false`."""
+
+    def __init__(self) -> None:
+        self.response: list[str] = []
+        self.thinking: list[str] = []
+        self.message: list[str] = []
+        self.message_thinking: list[str] = []
+
+    def add(self, chunk: dict) -> None:
+        for key, parts in (("response", self.response), ("thinking", self.thinking)):
+            value = chunk.get(key)
+            if isinstance(value, str):
+                parts.append(value)
+        message = chunk.get("message")
+        if isinstance(message, dict):
+            if isinstance(message.get("content"), str):
+                self.message.append(message["content"])
+            if isinstance(message.get("thinking"), str):
+                self.message_thinking.append(message["thinking"])
+
+    def final(self, last_chunk: dict) -> dict:
+        result = dict(last_chunk)
+        if self.response or "response" in last_chunk:
+            result["response"] = "".join(self.response)
+        if self.thinking:
+            result["thinking"] = "".join(self.thinking)
+        if isinstance(last_chunk.get("message"), dict):
+            message = dict(last_chunk["message"])
+            message["content"] = "".join(self.message)
+            if self.message_thinking:
+                message["thinking"] = "".join(self.message_thinking)
+            result["message"] = message
+        return result
+
+
+async def stream_ollama(
+    endpoint: str,
+    payload: dict,
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    affinity_key: Optional[str] = None,
+    node_url: Optional[str] = None,
+) -> AsyncIterator[dict]:
+    """
+    Отправляет запрос в Ollama в потоковом режиме и отдаёт NDJSON-чанки по мере генерации.
+    Последний чанк содержит `done: true` и метрики модели (см. `extract_ollama_timings`).
+    Закрытие итератора закрывает соединение, и Ollama прекращает генерацию.
+    Слот планировщика удерживается до конца потока.
+    Ответ из кэша отдаётся одним финальным чанком с полем `cached: true`.
+    Переключение на другой узел пула возможно только до получения первого чанка.
+    """
+    client = get_ollama_http_client()
+    # Спан потока записывается по завершении: контекст генератора — контекст его потребителя
+    requested = time.monotonic()
+    model = payload.get("model", "")
+
+    cache_key = _response_cache_key(endpoint, payload, use_cache)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            record_span("ollama", time.monotonic() - requested, endpoint=endpoint, model=model, cached=True)
+            yield {**cached, "done": True, "cached": True}
+            return
+    collected = _StreamCollector()
+    request_payload = {**residency.prepare_payload(payload), "stream": True}
+    PROMPT_BYTES.observe(prompt_bytes(payload), model=model)
+
+    done = False
+    async with scheduler.slot(model, priority) as wait_seconds:
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(wait_seconds, model=model)
+        record_span("queue", wait_seconds, model=model)
+        tried: set[str] = set()
+        while True:
+            node = pool.choose(model, affinity_key=affinity_key, exclude=tried, pinned_url=node_url)
+            started = time.monotonic()
+            chunks = 0
+            try:
+                async with pool.lease(node), client.stream(
+                    "POST", build_ollama_url(endpoint, node.url), json=request_payload
+                ) as response, aclosing(_iter_stream_chunks(response)) as response_chunks:
+                    pool.mark_success(node)
+                    async for chunk in response_chunks:
+                        chunks += 1
+                        collected.add(chunk)
+                        if chunk.get("done"):
+                            done = True
+                            residency.observe_response(model, chunk, node.url)
+                            observe_ollama_response(model, chunk)
+                            record_span(
+                                "ollama", time.monotonic() - requested,
+                                endpoint=endpoint, model=model, node=node.url, stream=True,
+                            )
+                            if cache_key is not None:
+                                # Сохраняем до отдачи финального чанка: потребитель может закрыть поток сразу после него
+                                await response_cache.put(cache_key, collected.final(chunk))
+                        yield chunk
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                # Поток закрыт до финального чанка: клиент отключился или истёк срок запроса
+                if not done:
+                    cancellations.record_abandoned_generation(model, time.monotonic() - started, chunks)
+                raise
+            except _FAILOVER_ERRORS as exc:
+                pool.mark_failure(node, exc)
+                tried.add(node.url)
+                if node_url is not None or not pool.has_candidates(exclude=tried):
+                    raise _request_error_to_http(exc, node.url) from exc
+                logger.warning("Ollama node %s is unreachable, failing over: %s", node.url, exc)
+            except httpx.RequestError as exc:
+                raise _request_error_to_http(exc, node.url) from exc
+
+
+async def _iter_stream_chunks(response: httpx.Response) -> AsyncIterator[dict]:
     if response.status_code >= 400:
-        error_detail = "Неизвестная ошибка"
+        await response.aread()
+        _raise_for_ollama_status(response)
+
+    async for line in response.aiter_lines():
+        if not line.strip():
+            continue
         try:
-            error_json = response.json()
-            if "error" in error_json:
-                error_detail = error_json["error"]
-        except (ValueError, json.JSONDecodeError):
-            error_detail = response.text[:200] if response.text else "Пустой ответ от Ollama"
-        
-        if response.status_code == 404:
-            raise HTTPException(
-                status_code=404,
-                detail=f"Модель не найдена в Ollama: {error_detail}"
-            )
-        elif response.status_code == 500:
-            # Проверяем, не связана ли ошибка с нехваткой памяти
-            if "memory" in error_detail.lower() or "system memory" in error_detail.lower():
-                raise HTTPException(
-                    status_code=507,
-                    detail=f"Недостаточно памяти для запуска модели. {error_detail}. Попробуйте использовать более легкую модель или освободите память."
-                )
+            chunk = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise HTTPException(status_code=502, detail="Invalid JSON from Ollama") from exc
+        if chunk.get("error"):
             raise HTTPException(
                 status_code=502,
-                detail=f"Ошибка Ollama при генерации ответа: {error_detail}"
-            )
-        else:
-            raise HTTPException(
-                status_code=response.status_code,
-                detail=f"Ошибка Ollama (код {response.status_code}): {error_detail}"
+                detail=f"Ошибка Ollama при генерации ответа: {chunk['error']}"
             )
+        yield chunk
 
-    try:
-        response_json = response.json()
 
-        return response_json
-    except json.JSONDecodeError as exc:
-        raise HTTPException(status_code=502, detail="Invalid JSON from Ollama") from exc
+_NS_IN_MS = 1_000_000
+
+
+def extract_ollama_timings(ollama_response: dict) -> dict:
+    """
+    Приводит метрики из финального ответа Ollama (наносекунды) к миллисекундам
+    и добавляет скорость обработки промпта и генерации в токенах в секунду.
+    """
+    timings: dict = {}
+    for key in ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration"):
+        value = ollama_response.get(key)
+        if isinstance(value, (int, float)):
+            timings[f"{key}_ms"] = round(value / _NS_IN_MS, 3)
+    for key in ("prompt_eval_count", "eval_count"):
+        value = ollama_response.get(key)
+        if isinstance(value, int):
+            timings[key] = value
+
+    for count_key, duration_key, rate_key in (
+        ("prompt_eval_count", "prompt_eval_duration", "prompt_tokens_per_second"),
+        ("eval_count", "eval_duration", "eval_tokens_per_second"),
+    ):
+        count = ollama_response.get(count_key)
+        duration = ollama_response.get(duration_key)
+        if isinstance(count, int) and isinstance(duration, (int, float)) and duration > 0:
+            timings[rate_key] = round(count / (duration / 1_000_000_000), 2)
+
+    return timings
 
 
 def _extract_assistant_message(ollama_response: dict) -> str:
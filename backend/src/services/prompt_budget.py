@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from .ollama_pool import normalize_model_name, pool
+from .ollama_service import build_ollama_url, get_ollama_http_client
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_buckets(value: str) -> List[int]:
+    return sorted({int(item) for item in value.split(",") if item.strip()})
+
+
+# Допустимые значения num_ctx: каждое новое значение заставляет Ollama перезагрузить модель
+# и сбрасывает KV-кэш префиксов документов. По умолчанию одно крупное окно: оно же используется
+# при прогреве, а промпты длиннее получают полный контекст модели
+OLLAMA_NUM_CTX_BUCKETS = _parse_buckets(os.getenv("OLLAMA_NUM_CTX_BUCKETS", "32768"))
+# Модели, запросам к которым бюджет задаёт num_ctx: их прогрев загружает модель с тем же окном
+OLLAMA_BUDGETED_MODELS = [
+    model.strip() for model in os.getenv("OLLAMA_BUDGETED_MODELS", "deepseek-r1").split(",") if model.strip()
+]
+# Контекст модели, если /api/show недоступен
+OLLAMA_DEFAULT_CONTEXT_LENGTH = int(os.getenv("OLLAMA_DEFAULT_CONTEXT_LENGTH", "32768"))
+# Запас окна под ответ (у deepseek-r1 он включает рассуждения)
+PROMPT_RESPONSE_RESERVE_TOKENS = int(os.getenv("PROMPT_RESPONSE_RESERVE_TOKENS", "4096"))
+# Грубая оценка токенизатора: латиница и JSON-разметка плотнее, кириллица дробится мельче
+PROMPT_ASCII_CHARS_PER_TOKEN = float(os.getenv("PROMPT_ASCII_CHARS_PER_TOKEN", "3.5"))
+PROMPT_NON_ASCII_CHARS_PER_TOKEN = float(os.getenv("PROMPT_NON_ASCII_CHARS_PER_TOKEN", "2.0"))
+
+OVERFLOW_REJECT = "reject"
+OVERFLOW_TRIM = "trim"
+# Крупный документ заменяется фрагментами, найденными по вопросу (см. retrieval); без индекса — как trim
+OVERFLOW_RETRIEVE = "retrieve"
+# Документ обрабатывается по частям, частичные ответы сводятся в итоговый (см. map_reduce); без индекса — как trim
+OVERFLOW_MAP_REDUCE = "map_reduce"
+CONTEXT_OVERFLOW_POLICIES = (OVERFLOW_REJECT, OVERFLOW_TRIM, OVERFLOW_RETRIEVE, OVERFLOW_MAP_REDUCE)
+OLLAMA_CONTEXT_OVERFLOW = os.getenv("OLLAMA_CONTEXT_OVERFLOW", OVERFLOW_REJECT).strip().lower()
+
+_TRIM_MARKER = "\n…[документ обрезан: показано {shown} из {total} символов]"
+
+
+def resolve_context_overflow(policy: str | None) -> str:
+    if policy is None or policy == "":
+        return OLLAMA_CONTEXT_OVERFLOW
+    normalized = policy.strip().lower()
+    if normalized not in CONTEXT_OVERFLOW_POLICIES:
+        raise HTTPException(
+            status_code=400,
+            detail=(
+                f"Неизвестная политика переполнения контекста '{policy}'. "
+                f"Допустимые значения: {', '.join(CONTEXT_OVERFLOW_POLICIES)}."
+            )
+        )
+    return normalized
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценка числа токенов без токенизатора модели (с запасом в сторону завышения).
+    Число не-ASCII символов берётся по длине UTF-8: кодирование выполняется в C и не держит
+    цикл событий на крупных документах, в отличие от перебора символов в Python.
+    """
+    if not text:
+        return 0
+    # Кириллица занимает 2 байта; символы из 3–4 байт завышают оценку, что безопасно
+    non_ascii = min(len(text), len(text.encode("utf-8", "surrogatepass")) - len(text))
+    ascii_chars = len(text) - non_ascii
+    return math.ceil(ascii_chars / PROMPT_ASCII_CHARS_PER_TOKEN + non_ascii / PROMPT_NON_ASCII_CHARS_PER_TOKEN)
+
+
+def choose_num_ctx(tokens_needed: int, context_length: int) -> int:
+    """
+    Наименьшее окно из OLLAMA_NUM_CTX_BUCKETS, вмещающее запрос, но не больше контекста модели;
+    если запрос не помещается ни в одно окно — весь контекст модели.
+    """
+    for bucket in OLLAMA_NUM_CTX_BUCKETS:
+        if bucket >= tokens_needed:
+            return min(bucket, context_length)
+    return context_length
+
+
+@dataclass(frozen=True)
+class PromptBudget:
+    num_ctx: int
+    prompt_tokens: int
+    reserve_tokens: int
+    context_length: int
+    trimmed_chars: int = 0
+    # Сколько фрагментов документа отправлено вместо него целиком (политика retrieve)
+    retrieval: Optional[dict] = None
+    # Число частей документа и частичных ответов (политика map_reduce)
+    map_reduce: Optional[dict] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "num_ctx": self.num_ctx,
+            "estimated_prompt_tokens": self.prompt_tokens,
+            "reserve_tokens": self.reserve_tokens,
+            "context_length": self.context_length,
+            "trimmed_chars": self.trimmed_chars,
+            "retrieval": self.retrieval,
+            "map_reduce": self.map_reduce,
+        }
+
+
+class PromptBudgeter:
+    """
+    Подбирает `num_ctx` под размер промпта до отправки запроса в Ollama.
+
+    - предел окна берётся из `/api/show` (`<arch>.context_length`) и кэшируется по модели;
+    - промпт плюс запас под ответ должны помещаться в окно, иначе документ
+      либо отклоняется с 413, либо обрезается (политика `reject` / `trim`),
+      либо заменяется найденными по вопросу фрагментами (`retrieve`, см. retrieval);
+    - по фактическому `prompt_eval_count` из ответов считается точность оценки токенов.
+    """
+
+    def __init__(self) -> None:
+        self._context_lengths: Dict[str, int] = {}
+        self._budgeted_models = {normalize_model_name(model) for model in OLLAMA_BUDGETED_MODELS}
+        self.buckets: Dict[int, int] = {}
+        self.rejected = 0
+        self.trimmed = 0
+        self._observed = 0
+        self._estimate_ratio_sum = 0.0
+
+    async def context_length(self, model: str) -> int:
+        name = normalize_model_name(model)
+        cached = self._context_lengths.get(name)
+        if cached is not None:
+            return cached
+
+        node = pool.choose(model)
+        try:
+            response = await get_ollama_http_client().post(
+                build_ollama_url("/api/show", node.url), json={"model": model}, timeout=30.0
+            )
+            response.raise_for_status()
+            model_info = response.json().get("model_info") or {}
+        except (httpx.HTTPError, ValueError) as exc:
+            # Не кэшируем: модель может появиться позже
+            logger.warning("Ollama /api/show failed for %s, assuming %d tokens: %s",
+                           model, OLLAMA_DEFAULT_CONTEXT_LENGTH, exc)
+            return OLLAMA_DEFAULT_CONTEXT_LENGTH
+
+        architecture = model_info.get("general.architecture")
+        length = model_info.get(f"{architecture}.context_length")
+        if not isinstance(length, int):
+            length = next(
+                (value for key, value in model_info.items()
+                 if key.endswith(".context_length") and isinstance(value, int)),
+                OLLAMA_DEFAULT_CONTEXT_LENGTH,
+            )
+        self._context_lengths[name] = length
+        logger.info("Model %s context length: %d tokens", model, length)
+        return length
+
+    async def preload_options(self, model: str) -> dict:
+        """
+        `options` прогрева модели: для моделей с бюджетом — наименьшее окно из OLLAMA_NUM_CTX_BUCKETS,
+        с которым придут обычные запросы, иначе первый запрос перезагрузил бы прогретую модель.
+        """
+        if normalize_model_name(model) not in self._budgeted_models:
+            return {}
+        return {"num_ctx": choose_num_ctx(0, await self.context_length(model))}
+
+    def _record(self, budget: PromptBudget) -> PromptBudget:
+        self.buckets[budget.num_ctx] = self.buckets.get(budget.num_ctx, 0) + 1
+        if budget.trimmed_chars:
+            self.trimmed += 1
+        return budget
+
+    async def fit_document(
+        self,
+        model: str,
+        document: str,
+        build_prompt: Callable[[str], str],
+        *,
+        overflow: str | None = None,
+        reserve_tokens: int = PROMPT_RESPONSE_RESERVE_TOKENS,
+    ) -> tuple[str, PromptBudget]:
+        """
+        Собирает промпт `build_prompt(document)` так, чтобы он поместился в окно модели.
+        Возвращает промпт и выбранный бюджет; при политике `trim` (а также `retrieve` и `map_reduce`,
+        если фрагментов или частичных ответов всё ещё слишком много) обрезается только документ.
+        """
+        policy = resolve_context_overflow(overflow)
+        context_length = await self.context_length(model)
+        prompt = build_prompt(document)
+        prompt_tokens = estimate_tokens(prompt)
+        needed = prompt_tokens + reserve_tokens
+
+        self._budgeted_models.add(normalize_model_name(model))
+        trimmed_chars = 0
+        if needed > context_length:
+            if policy not in (OVERFLOW_TRIM, OVERFLOW_RETRIEVE, OVERFLOW_MAP_REDUCE):
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=413,
+                    detail=(
+                        f"Документ слишком большой для модели '{model}': около {prompt_tokens} токенов "
+                        f"при окне {context_length} (из них {reserve_tokens} зарезервировано под ответ). "
+                        f"Сократите файл или передайте context_overflow=trim, retrieve или map_reduce."
+                    )
+                )
+            document, trimmed_chars = self._trim(document, build_prompt, context_length - reserve_tokens)
+            prompt = build_prompt(document)
+            prompt_tokens = estimate_tokens(prompt)
+            needed = prompt_tokens + reserve_tokens
+            logger.warning("Trimmed %d chars of document for model %s to fit %d tokens",
+                           trimmed_chars, model, context_length)
+
+        budget = PromptBudget(
+            num_ctx=choose_num_ctx(needed, context_length),
+            prompt_tokens=prompt_tokens,
+            reserve_tokens=reserve_tokens,
+            context_length=context_length,
+            trimmed_chars=trimmed_chars,
+        )
+        return prompt, self._record(budget)
+
+    @staticmethod
+    def _trim(document: str, build_prompt: Callable[[str], str], token_limit: int) -> tuple[str, int]:
+        total = len(document)
+        overhead = estimate_tokens(build_prompt("")) + estimate_tokens(_TRIM_MARKER.format(shown=total, total=total))
+        available = token_limit - overhead
+        if available <= 0:
+            raise HTTPException(
+                status_code=413,
+                detail="Вопрос и инструкции не помещаются в окно модели даже без документа."
+            )
+        keep = total
+        while keep > 0 and estimate_tokens(document[:keep]) > available:
+            # Сокращаем пропорционально превышению, с небольшим запасом на неравномерность текста
+            keep = int(keep * available / estimate_tokens(document[:keep]) * 0.95)
+        shown = document[:keep]
+        return f"{shown}{_TRIM_MARKER.format(shown=keep, total=total)}", total - keep
+
+    async def budget_for_tokens(
+        self,
+        model: str,
+        prompt_tokens: int,
+        *,
+        reserve_tokens: int = PROMPT_RESPONSE_RESERVE_TOKENS,
+        min_num_ctx: int = 0,
+    ) -> Optional[PromptBudget]:
+        """Бюджет для промпта известной длины (например, `context` сессии); None, если окна не хватает."""
+        context_length = await self.context_length(model)
+        self._budgeted_models.add(normalize_model_name(model))
+        needed = prompt_tokens + reserve_tokens
+        if needed > context_length:
+            return None
+        budget = PromptBudget(
+            num_ctx=min(max(choose_num_ctx(needed, context_length), min_num_ctx), context_length),
+            prompt_tokens=prompt_tokens,
+            reserve_tokens=reserve_tokens,
+            context_length=context_length,
+        )
+        return self._record(budget)
+
+    def observe_response(self, budget: PromptBudget, ollama_response: dict) -> None:
+        """Сравнивает оценку с фактическим `prompt_eval_count` (только для полностью вычисленных промптов)."""
+        actual = ollama_response.get("prompt_eval_count")
+        if ollama_response.get("cached") or not isinstance(actual, int) or actual <= 0 or not budget.prompt_tokens:
+            return
+        self._observed += 1
+        self._estimate_ratio_sum += budget.prompt_tokens / actual
+
+    def snapshot(self) -> dict:
+        return {
+            "num_ctx_buckets": OLLAMA_NUM_CTX_BUCKETS,
+            "overflow_policy": OLLAMA_CONTEXT_OVERFLOW,
+            "reserve_tokens": PROMPT_RESPONSE_RESERVE_TOKENS,
+            "context_lengths": dict(sorted(self._context_lengths.items())),
+            "requests_by_num_ctx": {str(num_ctx): count for num_ctx, count in sorted(self.buckets.items())},
+            "rejected": self.rejected,
+            "trimmed": self.trimmed,
+            # >1 — оценка завышает число токенов (безопасно), <1 — занижает
+            "avg_estimate_to_actual_ratio": (
+                round(self._estimate_ratio_sum / self._observed, 3) if self._observed else None
+            ),
+        }
+
+
+prompt_budgeter = PromptBudgeter()
+
+
+__all__ = [
+    "CONTEXT_OVERFLOW_POLICIES",
+    "PromptBudget",
+    "PromptBudgeter",
+    "choose_num_ctx",
+    "estimate_tokens",
+    "prompt_budgeter",
+    "resolve_context_overflow",
+]
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import AsyncIterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .ollama_service import call_ollama, stream_ollama
+from .prompt_budget import estimate_tokens
+from .utils.compat_asyncio import aclosing
+
+logger = logging.getLogger(__name__)
+
+THINK_MODES = {"auto": None, "on": True, "off": False}
+
+# Значения по умолчанию для запросов без явных полей формы; 0 — без ограничения
+REASONING_THINK = os.getenv("REASONING_THINK", "auto").strip().lower()
+REASONING_MAX_TOKENS = int(os.getenv("REASONING_MAX_TOKENS", "0"))
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", "0"))
+REASONING_INCLUDE = os.getenv("REASONING_INCLUDE", "0").lower() in ("1", "true", "yes")
+
+THINK_OPEN_TAG = "<think>"
+THINK_CLOSE_TAG = "</think>"
+
+_CONTINUATION_INSTRUCTION = (
+    "\n\nХод рассуждений (сокращён по бюджету):\n{thinking}\n\n"
+    "Рассуждения завершены. Дай окончательный ответ кратко, без дополнительных рассуждений."
+)
+
+DELTA_THINKING = "thinking"
+DELTA_ANSWER = "answer"
+
+
+@dataclass(frozen=True)
+class ReasoningBudget:
+    """
+    Бюджет рассуждений deepseek-r1 на один запрос.
+    `think`: None — как решит модель, True/False — параметр `think` Ollama (для моделей с его поддержкой).
+    """
+
+    think: Optional[bool] = None
+    max_reasoning_tokens: int = 0
+    max_answer_tokens: int = 0
+    include_reasoning: bool = False
+
+    def as_key(self) -> tuple:
+        return (self.think, self.max_reasoning_tokens, self.max_answer_tokens, self.include_reasoning)
+
+
+def resolve_reasoning_budget(
+    think: str | None = None,
+    max_reasoning_tokens: int | None = None,
+    max_answer_tokens: int | None = None,
+    include_reasoning: bool | None = None,
+) -> ReasoningBudget:
+    mode = (think or REASONING_THINK).strip().lower()
+    if mode not in THINK_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный режим рассуждений '{think}'. Допустимые значения: {', '.join(THINK_MODES)}."
+        )
+    for name, value in (("max_reasoning_tokens", max_reasoning_tokens), ("max_answer_tokens", max_answer_tokens)):
+        if value is not None and value < 0:
+            raise HTTPException(status_code=400, detail=f"Поле {name} не может быть отрицательным.")
+    return ReasoningBudget(
+        think=THINK_MODES[mode],
+        max_reasoning_tokens=max_reasoning_tokens or REASONING_MAX_TOKENS,
+        max_answer_tokens=max_answer_tokens or ANSWER_MAX_TOKENS,
+        include_reasoning=REASONING_INCLUDE if include_reasoning is None else include_reasoning,
+    )
+
+
+class ThinkSplitter:
+    """
+    Разделяет текст ответа на рассуждения `<think>…</think>` и собственно ответ.
+    Работает потоково: теги могут быть разрезаны между чанками.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._in_think = False
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self._buffer += text
+        deltas: List[Tuple[str, str]] = []
+        while self._buffer:
+            tag = THINK_CLOSE_TAG if self._in_think else THINK_OPEN_TAG
+            kind = DELTA_THINKING if self._in_think else DELTA_ANSWER
+            index = self._buffer.find(tag)
+            if index >= 0:
+                if index:
+                    deltas.append((kind, self._buffer[:index]))
+                self._buffer = self._buffer[index + len(tag):]
+                self._in_think = not self._in_think
+                continue
+            # Хвост, похожий на начало тега, придерживаем до следующего чанка
+            keep = _partial_tag_suffix(self._buffer, tag)
+            ready = self._buffer[:len(self._buffer) - keep]
+            if ready:
+                deltas.append((kind, ready))
+            self._buffer = self._buffer[len(ready):]
+            break
+        return deltas
+
+    def flush(self) -> List[Tuple[str, str]]:
+        if not self._buffer:
+            return []
+        kind = DELTA_THINKING if self._in_think else DELTA_ANSWER
+        text, self._buffer = self._buffer, ""
+        return [(kind, text)]
+
+    @property
+    def in_think(self) -> bool:
+        return self._in_think
+
+
+def _partial_tag_suffix(text: str, tag: str) -> int:
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+def split_reasoning(ollama_response: dict) -> Tuple[str, str]:
+    """Рассуждения и ответ из полного ответа Ollama: поле `thinking` или теги `<think>` в `response`."""
+    splitter = ThinkSplitter()
+    parts = {DELTA_THINKING: [ollama_response.get("thinking") or ""], DELTA_ANSWER: []}
+    for kind, text in splitter.feed(ollama_response.get("response") or "") + splitter.flush():
+        parts[kind].append(text)
+    return "".join(parts[DELTA_THINKING]).strip(), "".join(parts[DELTA_ANSWER]).strip()
+
+
+def apply_reasoning_options(payload: dict, budget: ReasoningBudget) -> dict:
+    """Параметры запроса: `think` и `num_predict` как жёсткий предел суммарной генерации."""
+    request = {**payload, "options": dict(payload.get("options") or {})}
+    if budget.think is not None:
+        request["think"] = budget.think
+    if budget.max_answer_tokens:
+        reasoning_allowance = 0 if budget.think is False else budget.max_reasoning_tokens
+        if budget.think is False or reasoning_allowance:
+            request["options"]["num_predict"] = reasoning_allowance + budget.max_answer_tokens
+    return request
+
+
+@dataclass
+class ReasoningResult:
+    thinking: str = ""
+    answer: str = ""
+    reasoning_tokens: int = 0
+    answer_tokens: int = 0
+    reasoning_truncated: bool = False
+    answer_truncated: bool = False
+    final_chunk: dict = field(default_factory=dict)
+
+    def stats(self, include_reasoning: bool) -> dict:
+        stats = {
+            "reasoning_tokens": self.reasoning_tokens,
+            "answer_tokens": self.answer_tokens,
+            "reasoning_truncated": self.reasoning_truncated,
+            "answer_truncated": self.answer_truncated,
+        }
+        if include_reasoning:
+            stats["content"] = self.thinking
+        return stats
+
+
+def _split_token_count(eval_count: int, thinking: str, answer: str) -> Tuple[int, int]:
+    """Делит `eval_count` между рассуждениями и ответом пропорционально оценке их длины."""
+    thinking_estimate, answer_estimate = estimate_tokens(thinking), estimate_tokens(answer)
+    total = thinking_estimate + answer_estimate
+    if not eval_count or not total:
+        return thinking_estimate, answer_estimate
+    reasoning_tokens = round(eval_count * thinking_estimate / total)
+    return reasoning_tokens, eval_count - reasoning_tokens
+
+
+async def generate_with_budget(
+    payload: dict,
+    budget: ReasoningBudget,
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    affinity_key: Optional[str] = None,
+) -> ReasoningResult:
+    """
+    Непотоковая генерация с бюджетом. Без лимита на рассуждения — один обычный запрос;
+    с лимитом — потоковый запрос, который прерывается при исчерпании бюджета (см. `stream_with_budget`).
+    """
+    if budget.max_reasoning_tokens and budget.think is not False:
+        result = ReasoningResult()
+        events = stream_with_budget(
+            payload, budget, priority=priority, use_cache=use_cache, affinity_key=affinity_key
+        )
+        async with aclosing(events):
+            async for _, _, result in events:
+                pass
+        result.thinking = result.thinking.strip()
+        result.answer = result.answer.strip()
+        return result
+
+    ollama_response = await call_ollama(
+        "/api/generate",
+        {**apply_reasoning_options(payload, budget), "stream": False},
+        priority=priority,
+        use_cache=use_cache,
+        affinity_key=affinity_key,
+    )
+    thinking, answer = split_reasoning(ollama_response)
+    reasoning_tokens, answer_tokens = _split_token_count(ollama_response.get("eval_count") or 0, thinking, answer)
+    return ReasoningResult(
+        thinking=thinking,
+        answer=answer,
+        reasoning_tokens=reasoning_tokens,
+        answer_tokens=answer_tokens,
+        answer_truncated=ollama_response.get("done_reason") == "length",
+        final_chunk=ollama_response,
+    )
+
+
+async def stream_with_budget(
+    payload: dict,
+    budget: ReasoningBudget,
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+    affinity_key: Optional[str] = None,
+) -> AsyncIterator[Tuple[str, str, ReasoningResult]]:
+    """
+    Потоковая генерация с бюджетом: отдаёт `(вид, текст, накопленный результат)`,
+    где вид — `thinking` или `answer`; последний элемент — `("done", "", результат)`.
+
+    Токены считаются по чанкам потока (Ollama отдаёт примерно один токен на чанк).
+    Когда рассуждения превышают `max_reasoning_tokens`, поток закрывается (Ollama прекращает
+    генерацию) и отправляется продолжение с `think: false`: тот же промпт, к которому добавлены
+    накопленные рассуждения и просьба сразу дать ответ. Префикс промпта совпадает, поэтому
+    Ollama переиспользует его KV-кэш. Ответ обрезается после `max_answer_tokens` токенов.
+    """
+    result = ReasoningResult()
+    request = apply_reasoning_options(payload, budget)
+    continued = False
+
+    while True:
+        splitter = ThinkSplitter()
+        stopped = False
+        chunks = stream_ollama(
+            "/api/generate", request, priority=priority, use_cache=use_cache, affinity_key=affinity_key
+        )
+        try:
+            async for chunk in chunks:
+                deltas: List[Tuple[str, str]] = []
+                if chunk.get("thinking"):
+                    deltas.append((DELTA_THINKING, chunk["thinking"]))
+                if chunk.get("response"):
+                    deltas.extend(splitter.feed(chunk["response"]))
+                if chunk.get("done"):
+                    deltas.extend(splitter.flush())
+
+                for kind, text in deltas:
+                    if kind == DELTA_THINKING:
+                        result.thinking += text
+                    else:
+                        result.answer += text
+                    yield kind, text, result
+
+                if chunk.get("cached"):
+                    # Ответ из кэша приходит целиком одним чанком
+                    thinking_tokens, answer_tokens = _split_token_count(
+                        chunk.get("eval_count") or 0, result.thinking, result.answer
+                    )
+                    result.reasoning_tokens += thinking_tokens
+                    result.answer_tokens += answer_tokens
+                elif chunk.get("thinking") or (chunk.get("response") and splitter.in_think):
+                    result.reasoning_tokens += 1
+                elif chunk.get("response"):
+                    result.answer_tokens += 1
+
+                if chunk.get("done"):
+                    result.final_chunk = chunk
+                    result.answer_truncated = result.answer_truncated or chunk.get("done_reason") == "length"
+                    break
+                if (
+                    not continued
+                    and budget.max_reasoning_tokens
+                    and result.reasoning_tokens >= budget.max_reasoning_tokens
+                    and not result.answer.strip()
+                ):
+                    result.reasoning_truncated = True
+                    stopped = True
+                    break
+                if budget.max_answer_tokens and result.answer_tokens >= budget.max_answer_tokens:
+                    result.answer_truncated = True
+                    break
+        finally:
+            # Закрытие потока прерывает генерацию в Ollama
+            await chunks.aclose()
+
+        if not stopped:
+            break
+
+        logger.info("Reasoning budget of %d tokens exhausted, forcing the answer", budget.max_reasoning_tokens)
+        continued = True
+        request = {
+            **request,
+            "prompt": request["prompt"] + _CONTINUATION_INSTRUCTION.format(thinking=result.thinking.strip()),
+            "think": False,
+            "options": {
+                **request["options"],
+                **({"num_predict": budget.max_answer_tokens} if budget.max_answer_tokens else {}),
+            },
+        }
+
+    yield "done", "", result
+
+
+__all__ = [
+    "ReasoningBudget",
+    "ReasoningResult",
+    "ThinkSplitter",
+    "apply_reasoning_options",
+    "generate_with_budget",
+    "resolve_reasoning_budget",
+    "split_reasoning",
+    "stream_with_budget",
+]
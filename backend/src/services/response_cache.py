@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .metrics import record_cache_lookup
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+LLM_CACHE_DIR = os.getenv(
+    "LLM_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "ba_ai_gost", "llm_cache"),
+)
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "256"))
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Поля запроса, которые не влияют на текст ответа модели
+_NON_SEMANTIC_FIELDS = {"stream", "keep_alive"}
+# Поля ответа, которые не имеет смысла хранить: `context` — это токены конкретной сессии
+_NON_CACHED_RESPONSE_FIELDS = {"context"}
+# После вытеснения по размеру диск заполняется не более чем на эту долю лимита
+_DISK_EVICTION_TARGET = 0.9
+
+
+def _sha256(data: str | bytes) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+def build_cache_key(endpoint: str, payload: Dict[str, Any]) -> str:
+    """
+    Ключ кэша: модель, параметры, хэш промпта и хэши изображений.
+    Большие поля (prompt, images, messages, context) заменяются SHA-256, остальные входят как есть.
+    """
+    material: Dict[str, Any] = {"endpoint": "/" + endpoint.lstrip("/")}
+    for name, value in payload.items():
+        if name in _NON_SEMANTIC_FIELDS:
+            continue
+        if name in ("prompt", "system"):
+            material[f"{name}_sha256"] = _sha256(value or "")
+        elif name == "images":
+            material["images_sha256"] = [_sha256(image) for image in value or []]
+        elif name in ("messages", "context"):
+            material[f"{name}_sha256"] = _sha256(json.dumps(value, ensure_ascii=False, sort_keys=True))
+        else:
+            material[name] = value
+    return _sha256(json.dumps(material, ensure_ascii=False, sort_keys=True, default=str))
+
+
+@dataclass
+class ResponseCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    stores: int = 0
+    expired: int = 0
+    evictions: int = 0
+
+    def as_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        data = asdict(self)
+        data["hit_ratio"] = round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+        return data
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов LLM: LRU в памяти процесса и каталог на диске с TTL
+    и вытеснением самых давно использованных записей при превышении лимита размера.
+    Записи на диске — gzip JSON, запись через временный файл и атомарное переименование,
+    поэтому каталог можно разделять между несколькими воркерами uvicorn.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path = LLM_CACHE_DIR,
+        *,
+        memory_items: int = LLM_CACHE_MEMORY_ITEMS,
+        disk_max_bytes: int = LLM_CACHE_DISK_MAX_BYTES,
+        ttl_seconds: float = LLM_CACHE_TTL_SECONDS,
+        enabled: bool = LLM_CACHE_ENABLED,
+    ) -> None:
+        self.directory = Path(directory)
+        self.memory_items = max(0, memory_items)
+        self.disk_max_bytes = max(0, disk_max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.stats = ResponseCacheStats()
+        self._memory: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._disk_bytes: Optional[int] = None
+
+    def _path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json.gz"
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds
+
+    def _remember(self, key: str, stored_at: float, value: dict) -> None:
+        if self.memory_items == 0:
+            return
+        self._memory[key] = (stored_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, dict]]:
+        path = self._path_for(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as handle:
+                record = json.load(handle)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logger.warning("Corrupted LLM cache entry %s: %s", path, exc)
+            path.unlink(missing_ok=True)
+            return None
+
+        stored_at = float(record.get("stored_at", 0))
+        if self._is_expired(stored_at):
+            path.unlink(missing_ok=True)
+            self.stats.expired += 1
+            return None
+        # mtime служит отметкой последнего использования для LRU-вытеснения на диске
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return stored_at, record.get("response") or {}
+
+    def _write_disk(self, key: str, stored_at: float, value: dict) -> None:
+        path = self._path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = gzip.compress(
+            json.dumps({"stored_at": stored_at, "response": value}, ensure_ascii=False).encode("utf-8")
+        )
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False, suffix=".tmp") as tmp_file:
+            tmp_file.write(data)
+            tmp_path = Path(tmp_file.name)
+        os.replace(tmp_path, path)
+
+        if self._disk_bytes is None:
+            self._disk_bytes = self._scan_disk_bytes()
+        else:
+            self._disk_bytes += len(data)
+        if self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _scan_entries(self) -> list[Tuple[float, int, Path]]:
+        entries = []
+        for path in self.directory.glob("*/*.json.gz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(size for _, size, _ in self._scan_entries())
+
+    def _evict_disk(self) -> None:
+        entries = sorted(self._scan_entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_max_bytes * _DISK_EVICTION_TARGET)
+        now = time.time()
+        for mtime, size, path in entries:
+            expired = self.ttl_seconds > 0 and now - mtime > self.ttl_seconds
+            if total <= target and not expired:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self.stats.evictions += 1
+        self._disk_bytes = total
+
+    async def get(self, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+
+        cached = self._memory.get(key)
+        if cached is not None:
+            stored_at, value = cached
+            if not self._is_expired(stored_at):
+                self._memory.move_to_end(key)
+                self.stats.memory_hits += 1
+                record_cache_lookup("llm", True)
+                return value
+            self._memory.pop(key, None)
+            self.stats.expired += 1
+
+        record = await to_thread(self._read_disk, key)
+        record_cache_lookup("llm", record is not None)
+        if record is None:
+            self.stats.misses += 1
+            return None
+
+        stored_at, value = record
+        self._remember(key, stored_at, value)
+        self.stats.disk_hits += 1
+        return value
+
+    async def put(self, key: str, response: dict) -> None:
+        if not self.enabled:
+            return
+        value = {name: item for name, item in response.items() if name not in _NON_CACHED_RESPONSE_FIELDS}
+        stored_at = time.time()
+        self._remember(key, stored_at, value)
+        try:
+            await to_thread(self._write_disk, key, stored_at, value)
+        except OSError as exc:
+            logger.warning("Failed to write LLM cache entry %s: %s", key, exc)
+            return
+        self.stats.stores += 1
+
+    def record_bypass(self) -> None:
+        self.stats.bypassed += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "directory": str(self.directory),
+            "memory_items": len(self._memory),
+            "memory_max_items": self.memory_items,
+            "disk_bytes": self._disk_bytes,
+            "disk_max_bytes": self.disk_max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            **self.stats.as_dict(),
+        }
+
+
+response_cache = ResponseCache()
+
+
+__all__ = ["ResponseCache", "build_cache_key", "response_cache"]
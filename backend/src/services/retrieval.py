@@ -0,0 +1,346 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .context_encoders import ContextEncoding, encode_context
+from .conversion_cache import conversion_cache
+from .embeddings import embedding_store
+from .prompt_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Документ длиннее этого числа токенов при политике `retrieve` заменяется релевантными фрагментами
+RETRIEVAL_CONTEXT_TOKENS = int(os.getenv("RETRIEVAL_CONTEXT_TOKENS", "8192"))
+# Строк XLSX, позиций ARP, абзацев RTF или сущностей DXF в одном фрагменте
+RETRIEVAL_CHUNK_ROWS = int(os.getenv("RETRIEVAL_CHUNK_ROWS", "40"))
+RETRIEVAL_MEMORY_INDEXES = int(os.getenv("RETRIEVAL_MEMORY_INDEXES", "32"))
+RETRIEVAL_BM25_K1 = float(os.getenv("RETRIEVAL_BM25_K1", "1.2"))
+RETRIEVAL_BM25_B = float(os.getenv("RETRIEVAL_BM25_B", "0.75"))
+# Слова обрезаются до этой длины — грубая замена стемминга для русских словоформ
+RETRIEVAL_STEM_CHARS = int(os.getenv("RETRIEVAL_STEM_CHARS", "6"))
+
+MODE_BM25 = "bm25"
+MODE_SEMANTIC = "semantic"
+MODE_HYBRID = "hybrid"
+RETRIEVAL_MODES = (MODE_BM25, MODE_SEMANTIC, MODE_HYBRID)
+
+# bm25 — совпадение слов; semantic — близость эмбеддингов (см. embeddings); hybrid — оба ранжирования.
+# По умолчанию bm25: модель эмбеддингов стала бы третьей моделью в памяти Ollama рядом с deepseek-r1
+# и llava и вытесняла бы их при OLLAMA_MAX_LOADED_MODELS=2
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", MODE_BM25).strip().lower()
+# Фрагментов-кандидатов из поиска по эмбеддингам; в промпт из них идут те, что помещаются в бюджет
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "24"))
+# Константа reciprocal rank fusion: чем больше, тем меньше вес первых мест каждого ранжирования
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+
+if RETRIEVAL_MODE not in RETRIEVAL_MODES:
+    logger.warning("Unknown RETRIEVAL_MODE %r, using %s", RETRIEVAL_MODE, MODE_BM25)
+    RETRIEVAL_MODE = MODE_BM25
+
+# Версия разбиения и формата индекса: входит в ключ кэша конвертаций
+RETRIEVAL_INDEX_VERSION = "1"
+
+# Фрагменты документа: (общие сведения, которые отправляются всегда, [(заголовок, данные фрагмента)]);
+# данные фрагмента кодируются тем же кодировщиком, что и весь документ, строка передаётся как есть
+Chunker = Callable[[Any, int], Tuple[Any, List[Tuple[str, Any]]]]
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        if len(word) < 2 and not word.isdigit():
+            continue
+        terms.append(word if word.isdigit() else word[:RETRIEVAL_STEM_CHARS])
+    return terms
+
+
+@dataclass(frozen=True)
+class Chunk:
+    title: str
+    text: str
+    tokens: int
+
+
+class DocumentIndex:
+    """
+    BM25-индекс фрагментов одного документа в памяти: инвертированный список
+    «терм → [(номер фрагмента, частота)]» и длины фрагментов в термах.
+    """
+
+    def __init__(
+        self,
+        header: str,
+        chunks: List[Chunk],
+        postings: Dict[str, List[List[int]]],
+        lengths: List[int],
+        document_tokens: int,
+    ) -> None:
+        self.header = header
+        self.chunks = chunks
+        self.postings = postings
+        self.lengths = lengths
+        self.document_tokens = document_tokens
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+        # Ключ в кэше конвертаций; по нему же хранятся эмбеддинги фрагментов
+        self.key: Optional[str] = None
+
+    @classmethod
+    def build(cls, header: str, chunks: List[Chunk], document_tokens: int) -> "DocumentIndex":
+        postings: Dict[str, List[List[int]]] = {}
+        lengths = []
+        for number, chunk in enumerate(chunks):
+            terms = tokenize(f"{chunk.title}\n{chunk.text}")
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings.setdefault(term, []).append([number, frequency])
+        return cls(header, chunks, postings, lengths, document_tokens)
+
+    def scores(self, question: str) -> Dict[int, float]:
+        total = len(self.chunks)
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(question)):
+            entries = self.postings.get(term)
+            if not entries:
+                continue
+            idf = math.log(1 + (total - len(entries) + 0.5) / (len(entries) + 0.5))
+            for number, frequency in entries:
+                norm = 1 - RETRIEVAL_BM25_B + RETRIEVAL_BM25_B * self.lengths[number] / (self.avg_length or 1)
+                scores[number] = scores.get(number, 0.0) + idf * frequency * (RETRIEVAL_BM25_K1 + 1) / (
+                    frequency + RETRIEVAL_BM25_K1 * norm
+                )
+        return scores
+
+    def ranking(self, question: str) -> List[int]:
+        """Номера фрагментов с совпадениями по BM25, от лучшего к худшему."""
+        scores = self.scores(question)
+        return sorted(scores, key=lambda number: (-scores[number], number))
+
+    def chunk_texts(self) -> List[str]:
+        """Тексты фрагментов для эмбеддингов."""
+        return [f"{chunk.title}\n{chunk.text}" for chunk in self.chunks]
+
+    def select(
+        self,
+        question: str,
+        token_limit: int,
+        ranked: Optional[List[int]] = None,
+        method: str = MODE_BM25,
+    ) -> Tuple[str, dict]:
+        """
+        Фрагменты по порядку `ranked` (по умолчанию — BM25 по вопросу), пока помещаются в `token_limit`;
+        в тексте они идут в порядке документа. Без совпадений — фрагменты с начала документа.
+        """
+        available = token_limit - estimate_tokens(self.header)
+        if ranked is None:
+            ranked = self.ranking(question)
+        matched = len(ranked)
+        if not ranked:
+            ranked = list(range(len(self.chunks)))
+
+        selected = []
+        used = 0
+        for number in ranked:
+            chunk_tokens = self.chunks[number].tokens
+            if used + chunk_tokens > available:
+                continue
+            selected.append(number)
+            used += chunk_tokens
+        selected.sort()
+
+        parts = [self.header] if self.header else []
+        parts.append(f"Фрагменты документа, относящиеся к вопросу ({len(selected)} из {len(self.chunks)}):")
+        parts.extend(f"## {self.chunks[number].title}\n{self.chunks[number].text}" for number in selected)
+        text = "\n".join(parts)
+        return text, {
+            "chunks": len(selected),
+            "total_chunks": len(self.chunks),
+            "matched_chunks": matched,
+            "method": method,
+            "document_tokens": self.document_tokens,
+            "sent_tokens": estimate_tokens(text),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "header": self.header,
+            "chunks": [asdict(chunk) for chunk in self.chunks],
+            "postings": self.postings,
+            "lengths": self.lengths,
+            "document_tokens": self.document_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DocumentIndex":
+        return cls(
+            data["header"],
+            [Chunk(**chunk) for chunk in data["chunks"]],
+            data["postings"],
+            data["lengths"],
+            data["document_tokens"],
+        )
+
+
+def build_document_index(
+    payload: Any,
+    chunker: Chunker,
+    encoder: str,
+    encoding: ContextEncoding,
+    document_tokens: int,
+) -> DocumentIndex:
+    """Разбивает результат обработчика на фрагменты и строит индекс. Синхронно — вызывать через to_thread."""
+    common, parts = chunker(payload, max(1, RETRIEVAL_CHUNK_ROWS))
+    header = encode_context(common, encoder, encoding) if common else ""
+    chunks = []
+    for title, data in parts:
+        text = data if isinstance(data, str) else encode_context(data, encoder, encoding)
+        chunks.append(Chunk(title=title, text=text, tokens=estimate_tokens(f"## {title}\n{text}\n")))
+    return DocumentIndex.build(header, chunks, document_tokens)
+
+
+@dataclass
+class RetrievalStats:
+    indexes_built: int = 0
+    memory_hits: int = 0
+    retrievals: int = 0
+    chunks_sent: int = 0
+    chunks_total: int = 0
+    document_tokens: int = 0
+    sent_tokens: int = 0
+    by_method: Dict[str, int] = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        data["sent_ratio"] = round(self.sent_tokens / self.document_tokens, 4) if self.document_tokens else None
+        return data
+
+
+class DocumentIndexCache:
+    """
+    Индексы последних документов в памяти процесса (LRU); на диске индекс хранится
+    в кэше конвертаций рядом с результатом конвертации.
+    """
+
+    def __init__(self, max_items: int = RETRIEVAL_MEMORY_INDEXES) -> None:
+        self.max_items = max(0, max_items)
+        self._items: "OrderedDict[str, DocumentIndex]" = OrderedDict()
+        self.stats = RetrievalStats()
+
+    def get(self, key: str) -> Optional[DocumentIndex]:
+        index = self._items.get(key)
+        if index is not None:
+            self._items.move_to_end(key)
+            self.stats.memory_hits += 1
+        return index
+
+    async def get_or_build(self, key: str, build: Callable[[], Awaitable[DocumentIndex]]) -> DocumentIndex:
+        """Индекс из памяти, из кэша конвертаций на диске или построенный заново (`key` — ключ кэша конвертаций)."""
+        index = self.get(key)
+        if index is not None:
+            return index
+        cached = await conversion_cache.get(key)
+        if cached is not None:
+            index = DocumentIndex.from_dict(cached)
+        else:
+            started = time.perf_counter()
+            index = await build()
+            self.stats.indexes_built += 1
+            await conversion_cache.put(key, index.to_dict(), seconds=time.perf_counter() - started)
+        index.key = key
+        self.put(key, index)
+        return index
+
+    def put(self, key: str, index: DocumentIndex) -> None:
+        if not self.max_items:
+            return
+        self._items[key] = index
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def observe(self, retrieval: dict) -> None:
+        self.stats.retrievals += 1
+        self.stats.by_method[retrieval["method"]] = self.stats.by_method.get(retrieval["method"], 0) + 1
+        self.stats.chunks_sent += retrieval["chunks"]
+        self.stats.chunks_total += retrieval["total_chunks"]
+        self.stats.document_tokens += retrieval["document_tokens"]
+        self.stats.sent_tokens += retrieval["sent_tokens"]
+
+    def snapshot(self) -> dict:
+        return {
+            "context_tokens": RETRIEVAL_CONTEXT_TOKENS,
+            "chunk_rows": RETRIEVAL_CHUNK_ROWS,
+            "mode": RETRIEVAL_MODE,
+            "indexes_in_memory": len(self._items),
+            **self.stats.as_dict(),
+            "embeddings": embedding_store.snapshot(),
+        }
+
+
+document_indexes = DocumentIndexCache()
+
+
+def fuse_rankings(*rankings: List[int], k: int = RETRIEVAL_RRF_K) -> List[int]:
+    """Reciprocal rank fusion: фрагмент получает сумму 1 / (k + место) по всем ранжированиям."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for place, number in enumerate(ranking, start=1):
+            scores[number] = scores.get(number, 0.0) + 1.0 / (k + place)
+    return sorted(scores, key=lambda number: (-scores[number], number))
+
+
+async def _rank_chunks(index: DocumentIndex, question: str) -> Tuple[Optional[List[int]], str]:
+    """Ранжирование фрагментов в режиме `RETRIEVAL_MODE`; если эмбеддинги недоступны — BM25."""
+    if RETRIEVAL_MODE == MODE_BM25 or index.key is None or not embedding_store.available:
+        return None, MODE_BM25
+    try:
+        matches = await embedding_store.search(index.key, index.chunk_texts(), question, RETRIEVAL_TOP_K)
+    except (HTTPException, ValueError) as exc:
+        embedding_store.mark_failure(exc)
+        return None, MODE_BM25
+    semantic = [number for number, _ in matches]
+    if RETRIEVAL_MODE == MODE_SEMANTIC:
+        return semantic, MODE_SEMANTIC
+    return fuse_rankings(index.ranking(question), semantic), MODE_HYBRID
+
+
+async def select_context(index: DocumentIndex, question: str, token_limit: int) -> Optional[Tuple[str, dict]]:
+    """
+    Текст из релевантных фрагментов, если документ не помещается в `RETRIEVAL_CONTEXT_TOKENS`
+    или в `token_limit` (окно модели без вопроса и запаса под ответ); иначе None — документ целиком.
+    """
+    limit = min(RETRIEVAL_CONTEXT_TOKENS, token_limit)
+    if index.document_tokens <= limit or not index.chunks:
+        return None
+    ranked, method = await _rank_chunks(index, question)
+    text, retrieval = index.select(question, limit, ranked, method)
+    document_indexes.observe(retrieval)
+    logger.info(
+        "Retrieved %d of %d chunks (%s): %d of %d document tokens",
+        retrieval["chunks"], retrieval["total_chunks"], method, retrieval["sent_tokens"], retrieval["document_tokens"],
+    )
+    return text, retrieval
+
+
+__all__ = [
+    "RETRIEVAL_INDEX_VERSION",
+    "RETRIEVAL_MODES",
+    "Chunk",
+    "Chunker",
+    "DocumentIndex",
+    "build_document_index",
+    "document_indexes",
+    "fuse_rankings",
+    "select_context",
+    "tokenize",
+]
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Tuple, TypeVar
+
+from fastapi import UploadFile
+
+from .metrics import UPLOAD_BYTES, UPLOAD_READ_SECONDS
+from .tracing import span
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def flight_key(*parts: Any) -> str:
+    """Ключ объединения запросов: SHA-256 от составных частей (хэш файла, вопрос, язык, модель)."""
+    serialized = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+async def _read_upload(upload: UploadFile) -> bytes:
+    with UPLOAD_READ_SECONDS.time(), span("upload") as current:
+        payload = await upload.read()
+        current.set(bytes=len(payload))
+    UPLOAD_BYTES.observe(len(payload))
+    return payload
+
+
+async def upload_sha256(upload: UploadFile) -> str:
+    """Хэш содержимого загруженного файла; позиция чтения возвращается в начало для обработчиков."""
+    payload = await _read_upload(upload)
+    await upload.seek(0)
+    digest = await to_thread(hashlib.sha256, payload)
+    return digest.hexdigest()
+
+
+async def buffer_upload(upload: UploadFile) -> Tuple[UploadFile, str]:
+    """
+    Копия загрузки в памяти и хэш её содержимого — для работы, объединяемой через SingleFlight.
+    Файл запроса Starlette закрывает, когда его клиент отключается, а общую работу в это время
+    ещё ждут другие запросы, поэтому она читает прочитанные заранее байты.
+    """
+    payload = await _read_upload(upload)
+    digest = await to_thread(hashlib.sha256, payload)
+    buffered = UploadFile(
+        io.BytesIO(payload), size=len(payload), filename=upload.filename, headers=upload.headers
+    )
+    return buffered, digest.hexdigest()
+
+
+@dataclass
+class _Flight:
+    task: asyncio.Future
+    waiters: int = 0
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int = 0
+    executed: int = 0
+    coalesced: int = 0
+    abandoned: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+        }
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные операции: первый запрос с ключом запускает работу
+    в отдельной задаче, остальные ждут её результат (или ошибку).
+    Уход одного ожидающего (отключение клиента) не отменяет работу для остальных;
+    работа отменяется, только когда её результата больше никто не ждёт.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stats = SingleFlightStats()
+        self._flights: Dict[str, _Flight] = {}
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        self.stats.calls += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(task=asyncio.ensure_future(factory()))
+            flight.task.add_done_callback(lambda _task, key=key, flight=flight: self._forget(key, flight))
+            self._flights[key] = flight
+            self.stats.executed += 1
+        else:
+            self.stats.coalesced += 1
+            logger.info("Coalesced %s request with an in-flight one (%d waiting)", self.name, flight.waiters + 1)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+                self.stats.abandoned += 1
+
+    def snapshot(self) -> dict:
+        return {**self.stats.as_dict(), "in_flight": len(self._flights)}
+
+
+conversion_flights = SingleFlight("conversion")
+generation_flights = SingleFlight("generation")
+
+
+def single_flight_snapshot() -> dict:
+    return {
+        "conversions": conversion_flights.snapshot(),
+        "generations": generation_flights.snapshot(),
+        "saved_conversions": conversion_flights.stats.coalesced,
+        "saved_generations": generation_flights.stats.coalesced,
+    }
+
+
+__all__ = [
+    "SingleFlight",
+    "buffer_upload",
+    "conversion_flights",
+    "flight_key",
+    "generation_flights",
+    "single_flight_snapshot",
+    "upload_sha256",
+]
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from .cancellation import REASON_DISCONNECT, cancellations, stream_with_deadline
+from .utils.compat_asyncio import aclosing
+
+logger = logging.getLogger(__name__)
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def resolve_stream_format(stream_format: str | None) -> str:
+    normalized = (stream_format or "ndjson").strip().lower()
+    if normalized not in STREAM_MEDIA_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный формат потока '{stream_format}'. Допустимые значения: ndjson, sse."
+        )
+    return normalized
+
+
+def encode_stream_event(event: dict, stream_format: str) -> bytes:
+    """
+    Кодирует событие потока.
+    NDJSON: одна JSON-строка на событие; SSE: `event: <type>` и `data: <json>`.
+    """
+    data = json.dumps(event, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {event.get('type', 'message')}\ndata: {data}\n\n".encode("utf-8")
+    return f"{data}\n".encode("utf-8")
+
+
+async def prime_event_stream(events: AsyncGenerator[dict, None]) -> AsyncIterator[dict]:
+    """
+    Дожидается первого события до отправки заголовков ответа.
+    Ошибки подключения к Ollama и отсутствие модели поднимаются как обычные HTTPException,
+    а не приходят клиенту внутри потока со статусом 200.
+    """
+    try:
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        first_event = None
+
+    async def _chained() -> AsyncIterator[dict]:
+        try:
+            if first_event is not None:
+                yield first_event
+            async for event in events:
+                yield event
+        finally:
+            await events.aclose()
+
+    return _chained()
+
+
+def event_stream_response(
+    events: AsyncIterator[dict],
+    stream_format: str,
+    *,
+    deadline: Optional[float] = None,
+) -> StreamingResponse:
+    """`deadline` по умолчанию — REQUEST_DEADLINE_SECONDS; 0 снимает ограничение (пакеты задач)."""
+    async def _body() -> AsyncIterator[bytes]:
+        try:
+            # aclosing: цепочка генераторов закрывается здесь же, а не сборщиком мусора в другой задаче
+            async with aclosing(stream_with_deadline(events, deadline)) as stream:
+                async for event in stream:
+                    yield encode_stream_event(event, stream_format)
+        except (asyncio.CancelledError, GeneratorExit):
+            # Клиент отключился: Starlette прекращает отдачу, поток Ollama закрывается вместе с генератором
+            cancellations.record_cancellation(REASON_DISCONNECT)
+            raise
+        except HTTPException as exc:
+            logger.warning("Stream aborted: status=%d, detail=%s", exc.status_code, exc.detail)
+            yield encode_stream_event(
+                {"type": "error", "status_code": exc.status_code, "detail": exc.detail},
+                stream_format,
+            )
+
+    return StreamingResponse(
+        _body(),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+__all__ = [
+    "encode_stream_event",
+    "event_stream_response",
+    "prime_event_stream",
+    "resolve_stream_format",
+]
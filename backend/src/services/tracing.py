@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+from .utils.compat_asyncio import to_thread
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1").lower() not in ("0", "false", "no")
+# Запросы дольше порога записываются в TRACE_SLOW_LOG целиком, со всеми этапами
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "30"))
+# Пустое значение — медленные запросы не записываются
+TRACE_SLOW_LOG = os.getenv(
+    "TRACE_SLOW_LOG",
+    os.path.join(tempfile.gettempdir(), "ba_ai_gost", "slow_traces.jsonl"),
+)
+# При превышении размера файл переименовывается в `<имя>.1`, предыдущая копия удаляется
+TRACE_SLOW_LOG_MAX_BYTES = int(os.getenv("TRACE_SLOW_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    # Смещение от начала запроса и длительность, секунды
+    start: float
+    duration: Optional[float] = None
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def as_dict(self) -> dict:
+        data = {
+            "name": self.name,
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "start_ms": round(self.start * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        return data
+
+
+class Trace:
+    """Этапы одного HTTP-запроса. Дочерние задачи и потоки (to_thread) пишут в тот же объект."""
+
+    def __init__(self, name: str) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans: List[Span] = []
+        self.attrs: Dict[str, Any] = {}
+        self.duration: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def open_span(self, name: str, parent_id: Optional[int], attrs: Dict[str, Any]) -> Span:
+        opened = Span(name, len(self.spans) + 1, parent_id, self.elapsed(), attrs=attrs)
+        # list.append атомарен: спаны из рабочих потоков не теряются
+        self.spans.append(opened)
+        return opened
+
+    def stages(self) -> Dict[str, dict]:
+        """Суммарная длительность и число завершённых спанов по имени этапа."""
+        stages: Dict[str, dict] = {}
+        for item in self.spans:
+            if item.duration is None:
+                continue
+            stage = stages.setdefault(item.name, {"duration_ms": 0.0, "count": 0})
+            stage["duration_ms"] += item.duration * 1000
+            stage["count"] += 1
+        for stage in stages.values():
+            stage["duration_ms"] = round(stage["duration_ms"], 3)
+        return stages
+
+    def server_timing(self) -> str:
+        """
+        Значение заголовка `Server-Timing`: этапы по именам и `total`. Этапы, выполнявшиеся несколько раз
+        (части map-reduce), суммируются, поэтому их сумма может превышать total.
+        """
+        metrics = []
+        for name, stage in self.stages().items():
+            description = f';desc="{stage["count"]} calls"' if stage["count"] > 1 else ""
+            metrics.append(f'{name}{description};dur={stage["duration_ms"]}')
+        metrics.append(f"total;dur={round(self.elapsed() * 1000, 3)}")
+        return ", ".join(metrics)
+
+    def as_dict(self) -> dict:
+        duration = self.duration if self.duration is not None else self.elapsed()
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "total_ms": round(duration * 1000, 3),
+            **({"attrs": self.attrs} if self.attrs else {}),
+            "stages": self.stages(),
+            "spans": [item.as_dict() for item in self.spans],
+        }
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+class _NoopSpan:
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Any]:
+    """
+    Этап текущего запроса: `with span("convert", suffix=".xlsx") as current: ... current.set(rows=10)`.
+    Вне запроса (воркер очереди, пул процессов, скрипты) ничего не записывает.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+    parent = _current_span.get()
+    current = trace.open_span(name, parent.span_id if parent else None, attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.attrs["error"] = type(exc).__name__
+        raise
+    finally:
+        current.duration = trace.elapsed() - current.start
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Спан закрыт в другом контексте (асинхронный генератор завершён из другой задачи)
+            pass
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Декоратор асинхронной функции: вызов записывается этапом `name` текущего запроса."""
+
+    def decorate(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorate
+
+
+def annotate(**attrs: Any) -> None:
+    """Атрибуты текущего этапа (модель, узел, попадание в кэш)."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+
+def record_span(name: str, seconds: float, **attrs: Any) -> None:
+    """Завершившийся только что этап известной длительности (например, ожидание слота планировщика)."""
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    parent = _current_span.get()
+    current = trace.open_span(name, parent.span_id if parent else None, attrs)
+    current.start = max(0.0, current.start - seconds)
+    current.duration = seconds
+
+
+@dataclass
+class TracingStats:
+    traces: int = 0
+    slow_traces: int = 0
+    write_errors: int = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "traces": self.traces,
+            "slow_traces": self.slow_traces,
+            "write_errors": self.write_errors,
+        }
+
+
+class Tracer:
+    """
+    Трассировка запросов: этапы записываются в контекст запроса (contextvars) и отдаются
+    заголовком `Server-Timing`; запросы дольше `TRACE_SLOW_SECONDS` дописываются в JSONL.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = TRACING_ENABLED,
+        slow_seconds: float = TRACE_SLOW_SECONDS,
+        slow_log: str = TRACE_SLOW_LOG,
+        slow_log_max_bytes: int = TRACE_SLOW_LOG_MAX_BYTES,
+    ) -> None:
+        self.enabled = enabled
+        self.slow_seconds = slow_seconds
+        self.slow_log = Path(slow_log) if slow_log else None
+        self.slow_log_max_bytes = slow_log_max_bytes
+        self.stats = TracingStats()
+
+    def start(self, name: str) -> Optional[Trace]:
+        """Новая трасса в текущем контексте; дочерние задачи, созданные после вызова, её наследуют."""
+        if not self.enabled:
+            return None
+        trace = Trace(name)
+        _current_trace.set(trace)
+        _current_span.set(None)
+        return trace
+
+    def _append(self, line: str) -> None:
+        path = self.slow_log
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            if self.slow_log_max_bytes > 0 and path.stat().st_size + len(line) > self.slow_log_max_bytes:
+                os.replace(path, path.with_name(path.name + ".1"))
+        except FileNotFoundError:
+            pass
+        with path.open("a", encoding="utf-8") as log_file:
+            log_file.write(line)
+
+    async def finish(self, trace: Optional[Trace], **attrs: Any) -> None:
+        if trace is None or trace.duration is not None:
+            return
+        trace.duration = trace.elapsed()
+        trace.attrs.update(attrs)
+        self.stats.traces += 1
+        if self.slow_log is None or trace.duration < self.slow_seconds:
+            return
+        self.stats.slow_traces += 1
+        line = json.dumps(trace.as_dict(), ensure_ascii=False, default=str) + "\n"
+        try:
+            await to_thread(self._append, line)
+        except OSError as exc:
+            self.stats.write_errors += 1
+            logger.warning("Failed to write slow trace to %s: %s", self.slow_log, exc)
+
+    def snapshot(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "slow_seconds": self.slow_seconds,
+            "slow_log": str(self.slow_log) if self.slow_log else None,
+            **self.stats.as_dict(),
+        }
+
+
+tracer = Tracer()
+
+
+__all__ = [
+    "Span",
+    "Trace",
+    "Tracer",
+    "annotate",
+    "current_trace",
+    "record_span",
+    "span",
+    "traced",
+    "tracer",
+]
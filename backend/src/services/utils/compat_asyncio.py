@@ -1,8 +1,9 @@
 import asyncio
 import functools
-from typing import Any, Callable, TypeVar
+from typing import Any, AsyncIterator, Callable, TypeVar
 
 T = TypeVar("T")
+A = TypeVar("A", bound=AsyncIterator[Any])
 
 try:
     to_thread = asyncio.to_thread  # Python 3.9+
@@ -12,4 +13,19 @@ except AttributeError:
         bound = functools.partial(func, *args, **kwargs)
         return await loop.run_in_executor(None, bound)
 
-__all__ = ["to_thread"]
+try:
+    from contextlib import aclosing  # Python 3.10+
+except ImportError:
+    class aclosing:  # type: ignore[no-redef]
+        """`async with aclosing(gen) as gen:` — закрывает асинхронный генератор при выходе из блока."""
+
+        def __init__(self, thing: A) -> None:
+            self.thing = thing
+
+        async def __aenter__(self) -> A:
+            return self.thing
+
+        async def __aexit__(self, *exc_info: Any) -> None:
+            await self.thing.aclose()
+
+__all__ = ["aclosing", "to_thread"]
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Union
+
+from ..tracing import span
+
+# Загрузки до этого размера разбираются прямо из памяти; крупнее — через временный файл,
+# чтобы парсеры (ezdxf, openpyxl) не держали рядом с исходными байтами ещё несколько копий
+UPLOAD_SPILL_THRESHOLD_BYTES = int(os.getenv("UPLOAD_SPILL_THRESHOLD_BYTES", str(64 * 1024 * 1024)))
+
+BinarySource = Union[BinaryIO, Path]
+
+
+def should_spill(size: int, threshold: int | None = None) -> bool:
+    limit = UPLOAD_SPILL_THRESHOLD_BYTES if threshold is None else threshold
+    return limit >= 0 and size > limit
+
+
+@contextmanager
+def spill_to_disk(data: bytes, suffix: str = "") -> Iterator[Path]:
+    """Временный файл с `data`, удаляется при выходе. Вызывать из рабочего потока, не из цикла событий."""
+    with span("spill", bytes=len(data)), tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+        temp_file.write(data)
+        path = Path(temp_file.name)
+    try:
+        yield path
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@contextmanager
+def binary_source(data: bytes, suffix: str = "", *, threshold: int | None = None) -> Iterator[BinarySource]:
+    """
+    Источник для парсера: `BytesIO` поверх загруженных байтов или, если они больше
+    `UPLOAD_SPILL_THRESHOLD_BYTES`, путь к временному файлу.
+    """
+    if should_spill(len(data), threshold):
+        with spill_to_disk(data, suffix) as path:
+            yield path
+    else:
+        yield io.BytesIO(data)
+
+
+__all__ = ["UPLOAD_SPILL_THRESHOLD_BYTES", "binary_source", "should_spill", "spill_to_disk"]
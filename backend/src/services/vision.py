@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+from typing import AsyncGenerator, AsyncIterator
+
 from fastapi import HTTPException, UploadFile
 
 from .image_file_router import route_image_payload
-from .ollama_service import call_ollama
+from .ollama_scheduler import PRIORITY_INTERACTIVE
+from .ollama_service import call_ollama, extract_ollama_timings, stream_ollama
+from .single_flight import buffer_upload, conversion_flights, flight_key, generation_flights
+from .streaming import prime_event_stream
+from .utils.compat_asyncio import aclosing
 
 
 def _sanitize_question(question: str | None) -> str:
@@ -47,8 +53,20 @@ def _build_prompt_prefix(response_language: str) -> str:
     return "Опиши это изображение на русском языке."
 
 
-async def process_vision_query(image_file: UploadFile, question: str, response_language: str = "ru") -> dict:
-    routed_payload = await route_image_payload(image_file)
+VISION_MODEL = "llava"
+
+
+async def _build_vision_payload(
+    image_file: UploadFile,
+    question: str,
+    response_language: str,
+    file_digest: str,
+) -> dict:
+    # Одинаковые изображения/PDF, загруженные одновременно, кодируются один раз
+    conversion_key = flight_key("image", file_digest, image_file.filename, image_file.content_type)
+    routed_payload = await conversion_flights.do(
+        conversion_key, lambda: route_image_payload(image_file, file_digest)
+    )
     encoded_images = routed_payload.images
     document_context = routed_payload.context
 
@@ -63,8 +81,8 @@ async def process_vision_query(image_file: UploadFile, question: str, response_l
         prompt = f"{document_context}\n{prompt}"
 
     # Используем более легкую модель llava (4.7 GB), так как llama3.2-vision требует слишком много памяти (10.9 GB)
-    payload = {
-        "model": "llava",
+    return {
+        "model": VISION_MODEL,
         "stream": False,
         "prompt": prompt,
         "images": encoded_images,
@@ -74,8 +92,49 @@ async def process_vision_query(image_file: UploadFile, question: str, response_l
         }
     }
 
+
+async def process_vision_query(
+    image_file: UploadFile,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+) -> dict:
+    """
+    Одновременные запросы с тем же файлом, вопросом, языком и моделью
+    ждут одну общую конвертацию и одну генерацию.
+    """
+    if image_file is None:
+        raise HTTPException(status_code=400, detail="Файл обязателен для обработки изображения.")
+    image_file, file_digest = await buffer_upload(image_file)
+    generation_key = flight_key(
+        "image", file_digest, image_file.filename, image_file.content_type,
+        question, response_language, VISION_MODEL, use_cache,
+    )
+    return await generation_flights.do(
+        generation_key,
+        lambda: _answer_vision_query(
+            image_file, file_digest, question, response_language, priority=priority, use_cache=use_cache
+        ),
+    )
+
+
+async def _answer_vision_query(
+    image_file: UploadFile,
+    file_digest: str,
+    question: str,
+    response_language: str,
+    *,
+    priority: int,
+    use_cache: bool,
+) -> dict:
+    payload = await _build_vision_payload(image_file, question, response_language, file_digest)
+
     try:
-        ollama_response = await call_ollama("/api/generate", payload)
+        ollama_response = await call_ollama(
+            "/api/generate", payload, priority=priority, use_cache=use_cache
+        )
     except HTTPException:
         # Пробрасываем HTTPException как есть
         raise
@@ -94,8 +153,42 @@ async def process_vision_query(image_file: UploadFile, question: str, response_l
         )
 
     return {
-        "model": "llava",
+        "model": VISION_MODEL,
         "response": response_text,
-        "prompt": prompt,
+        "prompt": payload["prompt"],
+        "cached": bool(ollama_response.get("cached")),
+        "timings": extract_ollama_timings(ollama_response),
     }
 
+
+async def _stream_vision_events(payload: dict, priority: int, use_cache: bool) -> AsyncGenerator[dict, None]:
+    chunks = stream_ollama("/api/generate", payload, priority=priority, use_cache=use_cache)
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            token = chunk.get("response")
+            if token:
+                yield {"type": "token", "content": token}
+            if chunk.get("done"):
+                yield {
+                    "type": "done",
+                    "model": VISION_MODEL,
+                    "done_reason": chunk.get("done_reason"),
+                    "cached": bool(chunk.get("cached")),
+                    "timings": extract_ollama_timings(chunk),
+                }
+
+
+async def open_vision_query_stream(
+    image_file: UploadFile,
+    question: str,
+    response_language: str = "ru",
+    *,
+    priority: int = PRIORITY_INTERACTIVE,
+    use_cache: bool = True,
+) -> AsyncIterator[dict]:
+    """Потоковый вариант `process_vision_query`: токены llava отдаются по мере генерации."""
+    if image_file is None:
+        raise HTTPException(status_code=400, detail="Файл обязателен для обработки изображения.")
+    image_file, file_digest = await buffer_upload(image_file)
+    payload = await _build_vision_payload(image_file, question, response_language, file_digest)
+    return await prime_event_stream(_stream_vision_events(payload, priority, use_cache))
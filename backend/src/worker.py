@@ -0,0 +1,32 @@
+"""
+Воркер очереди задач: `python -m src.worker`.
+
+Забирает задачи из базы JOBS_DB_PATH (той же, что у backend) и выполняет конвертацию
+и запрос к Ollama. Воркеров можно запускать несколько, в том числе на других хостах
+с доступом к общей базе.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import signal
+
+from .services.job_worker import JobWorker
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s", force=True)
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    worker = JobWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:  # pragma: no cover - Windows
+            pass
+    await worker.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
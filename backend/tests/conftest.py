@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import io
+import os
+from pathlib import Path
+
+# Конвертеры выполняются в потоках теста, обработчики импортируются по требованию
+os.environ.setdefault("CONVERTER_PROCESS_WORKERS", "0")
+os.environ.setdefault("HANDLER_PREWARM", "0")
+# Тесты не пишут в общий кэш конвертаций во временном каталоге системы
+os.environ.setdefault("CONVERSION_CACHE_ENABLED", "0")
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+from starlette.datastructures import UploadFile  # noqa: E402
+
+SAMPLES_DIR = (
+    Path(__file__).resolve().parents[2]
+    / "documentation" / "06-assets" / "input-documents" / "prototype-input-documents"
+)
+
+
+def make_upload(filename: str, data: bytes) -> UploadFile:
+    return UploadFile(file=io.BytesIO(data), filename=filename)
+
+
+def oversized_workbook(rows: int) -> bytes:
+    """Смета XLSX, которая не помещается в окно модели; «Кабель силовой» — в каждой 500-й строке."""
+    import openpyxl
+
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = "Смета"
+    sheet.append(["№", "Наименование", "Единица", "Количество", "Стоимость, руб."])
+    for number in range(1, rows + 1):
+        # Нужные для ответа строки встречаются только в части документа
+        name = "Кабель силовой" if number % 500 == 0 else f"Материал {number}"
+        sheet.append([number, name, "м", number % 7 + 1, number * 10.5])
+    out = io.BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+@pytest.fixture
+def sample_upload():
+    """Загрузка образца из documentation/06-assets по имени файла."""
+
+    def load(name: str) -> UploadFile:
+        path = SAMPLES_DIR / name
+        if not path.exists():
+            pytest.skip(f"sample {name} is not available")
+        return make_upload(name, path.read_bytes())
+
+    return load
+
+
+@pytest.fixture
+def ollama_http(monkeypatch):
+    """Подменяет общий HTTP-клиент Ollama: `install(handler)` — обработчик для httpx.MockTransport."""
+    from src.services import ollama_service
+
+    def install(handler) -> httpx.AsyncClient:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(ollama_service, "_http_client", client)
+        return client
+
+    return install
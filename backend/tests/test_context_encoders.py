@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+from src.services.context_encoders import (
+    ENCODER_COMPACT,
+    ENCODER_TSV,
+    build_encoded_context,
+    context_format_note,
+    encode_context,
+)
+from src.services.handler_registry import HANDLER_MAP
+
+
+def _convert(suffix: str, upload):
+    config = HANDLER_MAP[suffix]
+    return config, asyncio.run(config.handler(upload))
+
+
+def test_xlsx_handler_output_is_encoded_as_tsv(sample_upload):
+    config, payload = _convert(".xlsx", sample_upload("8.xlsx"))
+
+    encoded = build_encoded_context(payload, ENCODER_TSV, config.encoding)
+
+    details, *table_lines = encoded.content.splitlines()
+    assert json.loads(details) == {"source_filename": "8.xlsx", "sheet_count": payload["sheet_count"]}
+    sheet, records = next((name, rows) for name, rows in payload["sheets"].items() if rows)
+    assert table_lines[0] == f"# Лист {sheet} (строк: {len(records)})"
+    assert "\t" in table_lines[1]
+    assert encoded.tabular
+    assert encoded.tokens < encoded.baseline_tokens
+    assert context_format_note(encoded).startswith("Данные переданы таблицами в формате TSV")
+
+
+def test_arp_handler_output_is_encoded_as_tsv(sample_upload):
+    config, payload = _convert(".arp", sample_upload("4.arp"))
+
+    encoded = build_encoded_context(payload, ENCODER_TSV, config.encoding)
+
+    details = json.loads(encoded.content.splitlines()[0])
+    assert details["source_filename"] == "4.arp"
+    assert details["standard"] == payload["data"]["standard"]
+    assert "sections" not in details and "items" not in details
+    assert "# Разделы (строк: " in encoded.content
+    assert "# Позиции (строк: " in encoded.content
+    assert encoded.tabular
+    assert context_format_note(encoded)
+
+
+def test_format_note_only_when_tables_written():
+    encoding = HANDLER_MAP[".xlsx"].encoding
+    empty_workbook = {"source_filename": "empty.xlsx", "sheet_count": 1, "sheets": {"Лист1": []}}
+
+    encoded = build_encoded_context(empty_workbook, ENCODER_TSV, encoding)
+
+    assert json.loads(encoded.content) == empty_workbook
+    assert not encoded.tabular
+    assert context_format_note(encoded) == ""
+
+
+def test_compact_encoder_has_no_format_note(sample_upload):
+    config, payload = _convert(".arp", sample_upload("4.arp"))
+
+    encoded = build_encoded_context(payload, ENCODER_COMPACT, config.encoding)
+
+    assert encoded.content == encode_context(payload, ENCODER_COMPACT, config.encoding)
+    assert json.loads(encoded.content)["data"]["standard"] == payload["data"]["standard"]
+    assert not encoded.tabular
+    assert context_format_note(encoded) == ""
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import importlib
+
+import pytest
+
+from conftest import make_upload, oversized_workbook
+from src.services import context_encoders, json_file_router
+from src.services.context_encoders import ENCODER_COMPACT, ENCODER_JSON
+from src.services.conversion_cache import ConversionCache, conversion_cache_key
+from src.services.handler_registry import HandlerConfig
+
+# `src.services.conversion_cache` в пакете перекрыт одноимённым экземпляром кэша
+conversion_cache_module = importlib.import_module("src.services.conversion_cache")
+
+DIGEST = hashlib.sha256(b"smeta").hexdigest()
+
+
+def test_key_covers_file_handler_version_and_options():
+    key = conversion_cache_key(DIGEST, "handle_xlsx", "1", {"filename": "a.xlsx", "encoding": {"encoder": "tsv"}})
+
+    assert key == conversion_cache_key(
+        DIGEST, "handle_xlsx", "1", {"encoding": {"encoder": "tsv"}, "filename": "a.xlsx"}
+    )
+    variants = {
+        conversion_cache_key(hashlib.sha256(b"smeta-2").hexdigest(), "handle_xlsx", "1", {"filename": "a.xlsx"}),
+        conversion_cache_key(DIGEST, "handle_csv", "1", {"filename": "a.xlsx"}),
+        conversion_cache_key(DIGEST, "handle_xlsx", "2", {"filename": "a.xlsx"}),
+        conversion_cache_key(DIGEST, "handle_xlsx", "1", {"filename": "b.xlsx"}),
+        conversion_cache_key(DIGEST, "handle_xlsx", "1", {"filename": "a.xlsx"}),
+        key,
+    }
+    assert len(variants) == 6
+
+
+def test_entries_survive_a_new_instance_and_are_evicted_by_size(tmp_path):
+    cache = ConversionCache(tmp_path, enabled=True)
+    key = conversion_cache_key(DIGEST, "handle_xlsx", "1")
+
+    asyncio.run(cache.put(key, {"rows": [1, 2, 3]}, seconds=1.5))
+    reopened = ConversionCache(tmp_path, enabled=True)
+
+    assert asyncio.run(reopened.get(key)) == {"rows": [1, 2, 3]}
+    assert reopened.stats.hits == 1 and reopened.stats.seconds_saved == 1.5
+
+    small = ConversionCache(tmp_path / "small", max_bytes=1000, compression_level=0, enabled=True)
+
+    async def fill():
+        for number in range(10):
+            await small.put(conversion_cache_key(DIGEST, "handle_xlsx", str(number)), "x" * 200)
+
+    asyncio.run(fill())
+
+    assert small.stats.evictions > 0
+    assert sum(path.stat().st_size for path in (tmp_path / "small").glob("*/*.json.z")) <= 1000
+
+
+def test_failed_conversion_is_not_cached(tmp_path):
+    cache = ConversionCache(tmp_path, enabled=True)
+
+    async def failing():
+        raise ValueError("битый файл")
+
+    with pytest.raises(ValueError):
+        asyncio.run(cache.get_or_convert("ab" * 32, failing))
+
+    assert cache.stats.stores == 0
+    assert not list(tmp_path.glob("*/*.json.z"))
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ConversionCache(tmp_path, enabled=True)
+    monkeypatch.setattr(json_file_router, "conversion_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def handler_calls():
+    return []
+
+
+def _handler_config(handler_calls, version: str = "1") -> HandlerConfig:
+    async def handle_smeta(upload):
+        handler_calls.append(upload.filename)
+        return {"filename": upload.filename, "rows": [{"Наименование": "Кабель силовой", "Количество": 3}]}
+
+    return HandlerConfig(handler=handle_smeta, instruction="Смета.", version=version)
+
+
+def _encode(config: HandlerConfig, filename: str, encoder: str, digest: str = DIGEST):
+    upload = make_upload(filename, b"smeta")
+    return asyncio.run(json_file_router._encode_document(config, upload, digest, filename, encoder))
+
+
+def test_encoded_text_is_served_without_converting_again(cache, handler_calls):
+    config = _handler_config(handler_calls)
+
+    first = _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+    second = _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+
+    assert second == first
+    assert handler_calls == ["smeta.xlsx"]
+    # Результат обработчика и его текст — две записи
+    assert cache.stats.stores == 2
+    assert cache.stats.hits == 1
+
+
+def test_new_encoder_reuses_the_converted_payload(cache, handler_calls):
+    config = _handler_config(handler_calls)
+
+    compact = _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+    as_json = _encode(config, "smeta.xlsx", ENCODER_JSON)
+
+    assert handler_calls == ["smeta.xlsx"]
+    assert as_json.encoder == ENCODER_JSON and compact.encoder == ENCODER_COMPACT
+    assert as_json.content != compact.content
+
+
+def test_encoder_version_invalidates_only_the_encoded_text(cache, handler_calls, monkeypatch):
+    config = _handler_config(handler_calls)
+    _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+    hits = cache.stats.hits
+
+    monkeypatch.setattr(context_encoders, "CONTEXT_ENCODING_VERSION", "test-next")
+    _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+
+    assert handler_calls == ["smeta.xlsx"]
+    # Промах по тексту, попадание по результату обработчика
+    assert cache.stats.hits == hits + 1
+    assert cache.stats.stores == 3
+
+
+def test_handler_version_invalidates_both_levels(cache, handler_calls):
+    _encode(_handler_config(handler_calls), "smeta.xlsx", ENCODER_COMPACT)
+    _encode(_handler_config(handler_calls, version="2"), "smeta.xlsx", ENCODER_COMPACT)
+
+    assert handler_calls == ["smeta.xlsx", "smeta.xlsx"]
+    assert cache.stats.hits == 0
+
+
+def test_other_file_name_or_content_does_not_collide(cache, handler_calls):
+    config = _handler_config(handler_calls)
+
+    original = _encode(config, "smeta.xlsx", ENCODER_COMPACT)
+    renamed = _encode(config, "smeta-copy.xlsx", ENCODER_COMPACT)
+    changed = _encode(config, "smeta.xlsx", ENCODER_COMPACT, digest=hashlib.sha256(b"other").hexdigest())
+
+    assert handler_calls == ["smeta.xlsx", "smeta-copy.xlsx", "smeta.xlsx"]
+    assert "smeta-copy.xlsx" in renamed.content and "smeta-copy.xlsx" not in original.content
+    assert changed == original
+    assert cache.stats.hits == 0
+
+
+def test_second_upload_of_the_same_workbook_skips_conversion(cache):
+    data = oversized_workbook(50)
+
+    first = asyncio.run(json_file_router.load_raw_json_data(make_upload("smeta.xlsx", data)))
+    second = asyncio.run(json_file_router.load_raw_json_data(make_upload("smeta.xlsx", data)))
+
+    assert second.content == first.content
+    assert "Материал 50" in first.content
+    # Повторная загрузка берёт готовый текст: результат обработчика даже не читается
+    assert cache.stats.hits == 1
+    assert cache.stats.stores == 2
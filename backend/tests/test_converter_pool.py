@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.services.converter_pool import PROCESS, ConverterExecution, ConverterPool
+
+pytestmark = pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="POSIX shared memory is not available")
+
+
+def _slow_length(payload: bytes, seconds: float) -> int:
+    time.sleep(seconds)
+    return len(payload)
+
+
+def test_cancelled_conversion_keeps_shared_memory_until_worker_finishes():
+    pool = ConverterPool(workers=1, shared_memory_threshold=0, preload=[])
+    segments = []
+    share = pool._share
+
+    def recording_share(payload):
+        shared = share(payload)
+        segments.append(shared[1].name)
+        return shared
+
+    pool._share = recording_share
+    execution = ConverterExecution(name="slow", mode=PROCESS)
+
+    async def scenario():
+        await pool.start()
+        try:
+            task = asyncio.ensure_future(pool.run(execution, _slow_length, b"x" * 4096, 0.5))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            attached_after_cancel = os.path.exists(f"/dev/shm/{segments[0]}")
+            # Пул по-прежнему работает после отмены
+            result = await pool.run(execution, _slow_length, b"y" * 2048, 0)
+        finally:
+            await pool.stop()
+        return attached_after_cancel, result
+
+    attached_after_cancel, result = asyncio.run(scenario())
+
+    assert attached_after_cancel
+    assert result == 2048
+    assert not any(os.path.exists(f"/dev/shm/{name}") for name in segments)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from src.services import document_sessions, reasoning
+from src.services.prompt_budget import prompt_budgeter
+from src.services.reasoning import resolve_reasoning_budget
+
+THINKING = "<think>Сначала найду раздел сметы.</think>\n\n"
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    """Ответы deepseek-r1 с рассуждениями `<think>`; запросы сохраняются в `requests`."""
+    requests = []
+
+    async def context_length(model):
+        return 32768
+
+    async def call_ollama(path, payload, **kwargs):
+        requests.append(payload)
+        return {
+            "response": f"{THINKING}Ответ {len(requests)}",
+            "done": True,
+            "done_reason": "stop",
+            "context": [1, 2, 3, len(requests)],
+            "eval_count": 20,
+        }
+
+    async def stream_ollama(path, payload, **kwargs):
+        requests.append(payload)
+        for piece in ("<thi", "nk>Считаю", " позиции</think>", "\n\nОтвет", " потоком"):
+            yield {"response": piece, "done": False}
+        yield {"response": "", "done": True, "done_reason": "stop", "context": [4, 5, 6]}
+
+    monkeypatch.setattr(prompt_budgeter, "context_length", context_length)
+    monkeypatch.setattr(reasoning, "call_ollama", call_ollama)
+    monkeypatch.setattr(reasoning, "stream_ollama", stream_ollama)
+    return requests
+
+
+def _create_session(upload) -> str:
+    return asyncio.run(document_sessions.create_document_session(upload))["session_id"]
+
+
+def test_session_answer_has_no_reasoning(sample_upload, fake_ollama):
+    session_id = _create_session(sample_upload("4.arp"))
+
+    first = asyncio.run(document_sessions.ask_document_session(session_id, "Какова сметная стоимость?"))
+    second = asyncio.run(document_sessions.ask_document_session(
+        session_id, "А по разделу 1?", reasoning=resolve_reasoning_budget(include_reasoning=True)
+    ))
+
+    assert first["response"] == "Ответ 1"
+    assert "content" not in first["reasoning"]
+    assert second["response"] == "Ответ 2"
+    assert second["reasoning"]["content"] == "Сначала найду раздел сметы."
+    # Второй вопрос идёт без документа, с `context` первого ответа
+    assert not first["reused_context"] and second["reused_context"]
+    assert fake_ollama[1]["context"] == [1, 2, 3, 1]
+    assert "4.arp" not in fake_ollama[1]["prompt"]
+
+
+def test_session_stream_has_no_reasoning(sample_upload, fake_ollama):
+    session_id = _create_session(sample_upload("4.arp"))
+
+    async def collect():
+        events = await document_sessions.open_document_session_stream(
+            session_id, "Какова сметная стоимость?", reasoning=resolve_reasoning_budget(think="on")
+        )
+        return [event async for event in events]
+
+    events = asyncio.run(collect())
+
+    assert "".join(event["content"] for event in events if event["type"] == "token") == "Ответ потоком"
+    done = events[-1]
+    assert done["type"] == "done" and done["turn"] == 1
+    assert done["reasoning"]["reasoning_tokens"] > 0
+    assert fake_ollama[0]["think"] is True
+    assert document_sessions.session_store.get(session_id).context == [4, 5, 6]
+
+
+def test_session_context_encoder_reencodes_document(sample_upload, fake_ollama):
+    session_id = _create_session(sample_upload("4.arp"))
+    asyncio.run(document_sessions.ask_document_session(session_id, "Какова сметная стоимость?"))
+    assert document_sessions.describe_document_session(session_id)["context_encoding"]["encoder"] == "tsv"
+
+    result = asyncio.run(document_sessions.ask_document_session(
+        session_id, "Перечисли разделы", context_encoder="json"
+    ))
+
+    assert result["context_encoding"]["encoder"] == "json"
+    # Документ в новом формате отправляется заново, а не через прежний `context`
+    assert not result["reused_context"]
+    assert "context" not in fake_ollama[1]
+    assert '\n  "source_filename": "4.arp"' in fake_ollama[1]["prompt"]
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from src.services import embeddings, retrieval
+from src.services.embeddings import EmbeddingStore, embed_texts
+from src.services.retrieval import Chunk, DocumentIndex, fuse_rankings
+
+TEXTS = ["Кабель силовой ВВГнг", "Бетон М300", "Кабель контрольный", "Арматура А500", "Песок"]
+
+
+def _vector(text: str) -> list:
+    lowered = text.lower()
+    return [float("кабель" in lowered), float("бетон" in lowered), 1.0]
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+
+    async def fake_call_ollama(endpoint, payload, **kwargs):
+        calls.append((endpoint, list(payload["input"]), kwargs))
+        return {"embeddings": [_vector(text) for text in payload["input"]]}
+
+    monkeypatch.setattr(embeddings, "call_ollama", fake_call_ollama)
+    return calls
+
+
+def test_texts_are_embedded_in_batches_outside_the_scheduler(monkeypatch, embed_calls):
+    monkeypatch.setattr(embeddings, "EMBEDDING_BATCH_SIZE", 2)
+
+    vectors = asyncio.run(embed_texts(TEXTS))
+
+    assert [inputs for _, inputs, _ in embed_calls] == [TEXTS[:2], TEXTS[2:4], TEXTS[4:]]
+    assert all(endpoint == "/api/embed" and not kwargs["scheduled"] for endpoint, _, kwargs in embed_calls)
+    assert vectors.shape == (5, 3)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+
+
+def test_vectors_are_reused_from_memory_and_disk(tmp_path, embed_calls):
+    store = EmbeddingStore(tmp_path)
+    asyncio.run(store.get_or_embed("index-1", TEXTS))
+    asyncio.run(store.get_or_embed("index-1", TEXTS))
+    # Новый процесс: векторы читаются из .npy, модель не вызывается
+    reopened = EmbeddingStore(tmp_path)
+    index = asyncio.run(reopened.get_or_embed("index-1", TEXTS))
+
+    assert len(embed_calls) == 1
+    assert store.stats.memory_hits == 1
+    assert reopened.stats.disk_hits == 1
+    assert len(list(tmp_path.glob("*/*.npy"))) == 1
+    assert len(index) == len(TEXTS)
+
+
+def test_disk_eviction_removes_least_recently_used(tmp_path):
+    store = EmbeddingStore(tmp_path, max_bytes=0)
+    vectors = np.ones((64, 16), dtype=np.float32)
+    for number, key in enumerate(("aa-old", "bb-mid", "cc-new")):
+        store._save(key, vectors)
+        os.utime(store._path_for(key), (1000 + number, 1000 + number))
+    store.max_bytes = 2 * store._path_for("cc-new").stat().st_size + 1
+
+    store._evict()
+
+    assert not store._path_for("aa-old").exists()
+    assert store._path_for("cc-new").exists()
+
+
+def test_failure_backs_off_to_bm25(monkeypatch, tmp_path):
+    store = EmbeddingStore(tmp_path, retry_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(embeddings.time, "monotonic", lambda: now[0])
+
+    store.mark_failure(HTTPException(status_code=404, detail="model 'bge-m3' not found"))
+
+    assert not store.available
+    assert store.snapshot()["last_error"] == "model 'bge-m3' not found"
+    now[0] += 61
+    assert store.available
+
+
+def _index() -> DocumentIndex:
+    chunks = [Chunk(title=f"Позиция {number}", text=text, tokens=5) for number, text in enumerate(TEXTS)]
+    index = DocumentIndex.build("{}", chunks, 25)
+    index.key = "index-1"
+    return index
+
+
+def test_hybrid_ranking_fuses_bm25_and_embeddings(monkeypatch, tmp_path, embed_calls):
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MODE", retrieval.MODE_HYBRID)
+    monkeypatch.setattr(retrieval, "embedding_store", EmbeddingStore(tmp_path))
+
+    ranked, method = asyncio.run(retrieval._rank_chunks(_index(), "кабель"))
+
+    assert method == retrieval.MODE_HYBRID
+    assert set(ranked[:2]) == {0, 2}
+
+
+def test_hybrid_ranking_falls_back_to_bm25_when_embeddings_fail(monkeypatch, tmp_path):
+    store = EmbeddingStore(tmp_path)
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MODE", retrieval.MODE_HYBRID)
+    monkeypatch.setattr(retrieval, "embedding_store", store)
+
+    async def failing_call_ollama(endpoint, payload, **kwargs):
+        raise HTTPException(status_code=502, detail="Не удалось подключиться к Ollama")
+
+    monkeypatch.setattr(embeddings, "call_ollama", failing_call_ollama)
+
+    first = asyncio.run(retrieval._rank_chunks(_index(), "кабель"))
+    # Во время паузы модель эмбеддингов не вызывается
+    second = asyncio.run(retrieval._rank_chunks(_index(), "кабель"))
+
+    assert first == second == (None, retrieval.MODE_BM25)
+    assert store.stats.failures == 1
+    assert not store.available
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    assert fuse_rankings([1, 2, 3], [3, 1], k=60) == [1, 3, 2]
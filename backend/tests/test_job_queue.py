@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src.services.job_queue import (
+    STATUS_DONE,
+    STATUS_FAILED,
+    STATUS_QUEUED,
+    STATUS_RUNNING,
+    JobQueue,
+    build_job,
+)
+from src.services.ollama_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+
+
+def _job(filename: str = "smeta.arp", priority: int = PRIORITY_BATCH) -> dict:
+    return build_job(
+        kind="json",
+        filename=filename,
+        content_type=None,
+        file_data=b"1#ARPS 1.10#",
+        question="Итог сметы?",
+        response_language="ru",
+        priority=priority,
+    )
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=60, max_attempts=2)
+
+
+def test_jobs_are_claimed_by_priority_and_completed(queue):
+    batch, interactive = _job("batch.arp"), _job("interactive.arp", PRIORITY_INTERACTIVE)
+    asyncio.run(queue.submit([batch, interactive]))
+
+    claimed = queue.claim("worker-1")
+    queue.complete(claimed.job_id, "worker-1", {"response": "42"})
+
+    assert claimed.filename == "interactive.arp"
+    assert claimed.file_data == b"1#ARPS 1.10#"
+    assert claimed.attempts == 1
+    job = asyncio.run(queue.get(claimed.job_id))
+    assert job["status"] == STATUS_DONE
+    assert job["result"] == {"response": "42"}
+    assert asyncio.run(queue.get(batch["job_id"]))["status"] == STATUS_QUEUED
+
+
+def test_retryable_errors_requeue_until_attempts_run_out(queue):
+    asyncio.run(queue.submit([_job()]))
+
+    first = queue.claim("worker-1")
+    queue.fail(first.job_id, "worker-1", 503, "Ollama недоступна", first.attempts)
+    requeued = asyncio.run(queue.get(first.job_id))
+    second = queue.claim("worker-2")
+    queue.fail(second.job_id, "worker-2", 503, "Ollama недоступна", second.attempts)
+
+    assert requeued["status"] == STATUS_QUEUED
+    assert second.attempts == 2
+    job = asyncio.run(queue.get(first.job_id))
+    assert job["status"] == STATUS_FAILED
+    assert job["error"] == {"status_code": 503, "detail": "Ollama недоступна"}
+    assert queue.claim("worker-3") is None
+
+
+def test_client_errors_fail_without_retry(queue):
+    asyncio.run(queue.submit([_job()]))
+
+    claimed = queue.claim("worker-1")
+    queue.fail(claimed.job_id, "worker-1", 400, "Загруженный файл пустой", claimed.attempts)
+
+    assert asyncio.run(queue.get(claimed.job_id))["status"] == STATUS_FAILED
+    assert queue.claim("worker-2") is None
+
+
+def test_expired_lease_is_picked_up_by_another_worker(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=-1, max_attempts=2)
+    asyncio.run(queue.submit([_job()]))
+
+    first = queue.claim("worker-1")
+    second = queue.claim("worker-2")
+
+    assert second.job_id == first.job_id
+    assert second.attempts == 2
+    # Аренда снова истекла, а попытки исчерпаны — задача помечается как упавшая
+    assert queue.claim("worker-3") is None
+    job = asyncio.run(queue.get(first.job_id))
+    assert job["status"] == STATUS_FAILED
+    assert job["error"]["status_code"] == 500
+    # Старый воркер не может продлить аренду чужой задачи
+    assert not queue.renew(first.job_id, "worker-1")
+
+
+def test_released_job_keeps_its_attempts(queue):
+    asyncio.run(queue.submit([_job()]))
+
+    claimed = queue.claim("worker-1")
+    running = asyncio.run(queue.get(claimed.job_id))["status"]
+    queue.release(claimed.job_id, "worker-1")
+    reclaimed = queue.claim("worker-2")
+
+    assert running == STATUS_RUNNING
+    assert reclaimed.attempts == 1
+
+
+def test_unknown_job_is_not_found(queue):
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(queue.get("missing"))
+
+    assert excinfo.value.status_code == 404
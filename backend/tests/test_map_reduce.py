@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+
+from conftest import make_upload, oversized_workbook
+
+from src.services import console_json_ollama, map_reduce
+from src.services.context_encoders import build_encoded_context
+from src.services.handler_registry import HANDLER_MAP
+from src.services.map_reduce import MAP_INSTRUCTION, NO_DATA_ANSWER, REDUCE_INSTRUCTION
+from src.services.prompt_budget import estimate_tokens, prompt_budgeter
+from src.services.reasoning import ReasoningResult
+from src.services.retrieval import build_document_index
+
+CONTEXT_LENGTH = 8192
+REDUCED_ANSWER = "Кабель: итого 40 м по всем частям."
+
+
+def test_oversized_xlsx_is_answered_by_map_then_reduce(monkeypatch):
+    config = HANDLER_MAP[".xlsx"]
+    payload = asyncio.run(config.handler(make_upload("large.xlsx", oversized_workbook(2000))))
+    encoded = build_encoded_context(payload, config.encoding.encoder, config.encoding)
+    index = build_document_index(payload, config.chunker, encoded.encoder, config.encoding, encoded.tokens)
+    assert encoded.tokens > CONTEXT_LENGTH
+
+    async def context_length(model):
+        return CONTEXT_LENGTH
+
+    map_prompts = []
+    final_prompts = []
+
+    async def fake_generate(payload, budget, **kwargs):
+        prompt = payload["prompt"]
+        assert estimate_tokens(prompt) <= CONTEXT_LENGTH
+        if MAP_INSTRUCTION in prompt:
+            map_prompts.append(prompt)
+            answer = "Кабель силовой: 10 м" if "Кабель силовой" in prompt else NO_DATA_ANSWER
+        else:
+            final_prompts.append(prompt)
+            answer = REDUCED_ANSWER
+        return ReasoningResult(answer=answer, final_chunk={"done": True})
+
+    monkeypatch.setattr(prompt_budgeter, "context_length", context_length)
+    monkeypatch.setattr(map_reduce, "generate_with_budget", fake_generate)
+    monkeypatch.setattr(console_json_ollama, "generate_with_budget", fake_generate)
+
+    result = asyncio.run(console_json_ollama.run_console_json_ollama(
+        "Сколько всего кабеля в смете?",
+        encoded.content,
+        filename="large.xlsx",
+        instruction=config.instruction,
+        context_overflow="map_reduce",
+        index=index,
+        use_cache=False,
+    ))
+
+    parts = result["context_budget"]["map_reduce"]
+    assert parts["parts"] == len(map_prompts) > 1
+    assert parts["empty_parts"] == sum(1 for prompt in map_prompts if "Кабель силовой" not in prompt)
+    assert parts["empty_parts"] < parts["parts"]
+    # Каждая часть начинается с реквизитов документа и несёт свою строку заголовков таблицы
+    assert all(index.header in prompt and "# Лист Смета (строк: " in prompt for prompt in map_prompts)
+
+    assert len(final_prompts) == 1
+    final_prompt = final_prompts[0]
+    assert REDUCE_INSTRUCTION in final_prompt
+    assert final_prompt.count("Кабель силовой: 10 м") == parts["parts"] - parts["empty_parts"]
+    assert NO_DATA_ANSWER not in final_prompt
+    assert result["response"] == REDUCED_ANSWER
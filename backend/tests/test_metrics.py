@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import pytest
+
+from src.services.metrics import (
+    OLLAMA_EVAL_SECONDS,
+    OLLAMA_TOKENS_PER_SECOND,
+    PROMPT_TOKENS,
+    MetricsRegistry,
+    observe_ollama_response,
+    prompt_bytes,
+)
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+def test_counter_renders_prometheus_text(registry):
+    errors = registry.counter("test_errors_total", "Errors.", ["route", "status"])
+    errors.inc(route="/json-query", status=502)
+    errors.inc(route="/json-query", status=502)
+    errors.inc(route='/say "hi"', status=400)
+
+    lines = registry.render().splitlines()
+
+    assert lines[:2] == ["# HELP ba_ai_gost_test_errors_total Errors.", "# TYPE ba_ai_gost_test_errors_total counter"]
+    assert 'ba_ai_gost_test_errors_total{route="/json-query",status="502"} 2' in lines
+    assert 'ba_ai_gost_test_errors_total{route="/say \\"hi\\"",status="400"} 1' in lines
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    latency = registry.histogram("test_seconds", "Latency.", ["model"], buckets=(0.1, 1.0, 10.0))
+    for value in (0.05, 0.1, 0.5, 20.0):
+        latency.observe(value, model="deepseek-r1")
+
+    lines = registry.render().splitlines()
+
+    assert lines[2:] == [
+        'ba_ai_gost_test_seconds_bucket{model="deepseek-r1",le="0.1"} 2',
+        'ba_ai_gost_test_seconds_bucket{model="deepseek-r1",le="1"} 3',
+        'ba_ai_gost_test_seconds_bucket{model="deepseek-r1",le="10"} 3',
+        'ba_ai_gost_test_seconds_bucket{model="deepseek-r1",le="+Inf"} 4',
+        'ba_ai_gost_test_seconds_sum{model="deepseek-r1"} 20.65',
+        'ba_ai_gost_test_seconds_count{model="deepseek-r1"} 4',
+    ]
+
+
+def test_labels_must_match_and_names_are_unique(registry):
+    latency = registry.histogram("test_seconds", "Latency.", ["model"])
+
+    with pytest.raises(ValueError):
+        latency.observe(1.0)
+    with pytest.raises(ValueError):
+        latency.observe(1.0, model="deepseek-r1", node="ollama-1")
+    with pytest.raises(ValueError):
+        registry.counter("test_seconds", "Duplicate.")
+
+
+def test_ollama_durations_and_throughput():
+    model = "test-observe-model"
+    observe_ollama_response(model, {
+        "prompt_eval_count": 1000,
+        "prompt_eval_duration": 500_000_000,
+        "eval_count": 50,
+        "eval_duration": 2_000_000_000,
+    })
+    # Ответ из кэша без длительностей ничего не добавляет
+    observe_ollama_response(model, {"response": "42", "cached": True})
+
+    key = (model,)
+    assert OLLAMA_EVAL_SECONDS._series[key].total == 2.0
+    assert PROMPT_TOKENS._series[key].count == 1
+    assert OLLAMA_TOKENS_PER_SECOND._series[(model, "prompt")].total == 2000.0
+    assert OLLAMA_TOKENS_PER_SECOND._series[(model, "eval")].total == 25.0
+
+
+def test_prompt_bytes_counts_every_text_field():
+    assert prompt_bytes({"system": "ab", "prompt": "смета"}) == 2 + 10
+    assert prompt_bytes({"messages": [{"role": "user", "content": "да"}, {"role": "user", "images": []}]}) == 4
+    assert prompt_bytes({"input": ["a", "бв"]}) == 1 + 4
+    assert prompt_bytes({"input": "abc"}) == 3
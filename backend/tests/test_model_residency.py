@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import asyncio
+
+from src.services import model_residency, ollama_service
+from src.services.prompt_budget import prompt_budgeter
+from src.services.model_residency import ModelResidencyManager
+from src.services.ollama_pool import OllamaPool
+
+
+def test_preload_warms_every_healthy_node_without_counting_traffic(monkeypatch):
+    pool = OllamaPool(["http://ollama-1:11434", "http://ollama-2:11434", "http://ollama-3:11434"])
+    pool.mark_loaded(pool.nodes[1].url, "deepseek-r1")
+    pool.nodes[2].healthy = False
+    monkeypatch.setattr(model_residency, "pool", pool)
+    manager = ModelResidencyManager(["deepseek-r1"], hot_min_requests=1)
+    warmed = []
+
+    async def context_length(model):
+        return 131072
+
+    async def fake_call_ollama(endpoint, payload, *, node_url=None, warm_up=False, **kwargs):
+        manager.prepare_payload(payload, warm_up=warm_up)
+        warmed.append((node_url, payload.get("options")))
+        return {"done": True}
+
+    monkeypatch.setattr(prompt_budgeter, "context_length", context_length)
+    monkeypatch.setattr(ollama_service, "call_ollama", fake_call_ollama)
+
+    asyncio.run(manager.preload("deepseek-r1"))
+
+    stats = manager.snapshot()["models"]["deepseek-r1"]
+    # Окно прогрева совпадает с окном обычных запросов (см. prompt_budget)
+    assert warmed == [("http://ollama-1:11434", {"num_ctx": 32768})]
+    assert stats["preloads"] == 1
+    assert stats["requests"] == 0
+    assert stats["recent_requests"] == 0
+    assert stats["keep_alive"] == manager.keep_alive_cold
+
+
+def test_prompted_requests_count_as_traffic():
+    manager = ModelResidencyManager([], hot_min_requests=1)
+
+    payload = manager.prepare_payload({"model": "deepseek-r1", "prompt": "Вопрос"})
+
+    assert payload["keep_alive"] == manager.keep_alive_hot
+    assert manager.snapshot()["models"]["deepseek-r1"]["requests"] == 1
+
+
+def test_embedding_requests_count_as_traffic():
+    manager = ModelResidencyManager([], hot_min_requests=1)
+
+    manager.prepare_payload({"model": "bge-m3", "input": ["смета"]})
+
+    assert manager.snapshot()["models"]["bge-m3"]["requests"] == 1
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from src.services import ollama_pool, ollama_service
+from src.services.ollama_pool import OllamaPool
+from src.services.ollama_scheduler import OllamaScheduler
+
+NODE_1 = "http://ollama-1:11434"
+NODE_2 = "http://ollama-2:11434"
+PAYLOAD = {"model": "deepseek-r1", "prompt": "Итог сметы?", "stream": False}
+
+
+@pytest.fixture
+def node_scheduler(monkeypatch):
+    scheduler = OllamaScheduler(slots_per_model=4, max_active_models=2)
+    monkeypatch.setattr(ollama_pool, "scheduler", scheduler)
+    return scheduler
+
+
+def _tags_and_ps(request: httpx.Request) -> httpx.Response:
+    if request.url.path == "/api/tags":
+        return httpx.Response(200, json={"models": [{"name": "deepseek-r1:latest"}, {"name": "llava"}]})
+    return httpx.Response(200, json={"models": [{"name": "deepseek-r1:latest", "size_vram": 1024}]})
+
+
+def test_health_check_reads_models_and_takes_failing_nodes_out(node_scheduler, ollama_http):
+    pool = OllamaPool([NODE_1, NODE_2], failure_threshold=2, health_check_interval=0)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "ollama-2":
+            raise httpx.ConnectError("connection refused", request=request)
+        return _tags_and_ps(request)
+
+    ollama_http(handler)
+
+    asyncio.run(pool.start())
+    healthy, down = pool.nodes
+
+    assert healthy.models == {"deepseek-r1:latest", "llava:latest"}
+    assert healthy.has_loaded("deepseek-r1")
+    # Первая ошибка ещё не выводит узел из маршрутизации
+    assert down.healthy and down.consecutive_failures == 1
+    assert node_scheduler.node_count == 2
+
+    asyncio.run(pool.check_all())
+
+    assert not down.healthy
+    assert pool.choose("deepseek-r1") is healthy
+    assert node_scheduler.node_count == 1
+
+
+def test_node_returning_after_a_failure_restores_capacity(node_scheduler):
+    pool = OllamaPool([NODE_1, NODE_2], failure_threshold=1)
+    pool._sync_scheduler()
+    assert node_scheduler.node_count == 2
+
+    pool.mark_failure(pool.nodes[1], "connection refused")
+    assert node_scheduler.node_count == 1
+
+    pool.mark_success(pool.nodes[1])
+    assert node_scheduler.node_count == 2
+
+
+def test_least_outstanding_node_is_chosen():
+    pool = OllamaPool([NODE_1, NODE_2])
+
+    async def scenario():
+        async with pool.lease(pool.choose("deepseek-r1")) as first:
+            second = pool.choose("deepseek-r1")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+
+    assert first.url == NODE_1
+    assert second.url == NODE_2
+    assert first.outstanding == 0 and first.requests == 1
+
+
+def test_node_with_the_model_loaded_is_preferred():
+    pool = OllamaPool([NODE_1, NODE_2])
+    pool.nodes[0].outstanding = 3
+    pool.mark_loaded(NODE_1, "deepseek-r1")
+
+    assert pool.choose("deepseek-r1").url == NODE_1
+    assert pool.choose("llava").url == NODE_2
+
+
+def test_affinity_sticks_until_it_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ollama_pool.time, "monotonic", lambda: now[0])
+    pool = OllamaPool([NODE_1, NODE_2], affinity_ttl=60)
+
+    sticky = pool.choose("deepseek-r1", affinity_key="session-1")
+    sticky.outstanding = 5
+    now[0] += 30
+    assert pool.choose("deepseek-r1", affinity_key="session-1") is sticky
+
+    # Обращение продлевает привязку, поэтому срок отсчитывается от последнего запроса
+    now[0] += 61
+    moved = pool.choose("deepseek-r1", affinity_key="session-1")
+    assert moved is not sticky
+    assert pool.choose("deepseek-r1", affinity_key="session-1") is moved
+
+
+def test_call_fails_over_to_a_live_node_and_keeps_affinity_there(node_scheduler, ollama_http, monkeypatch):
+    pool = OllamaPool([NODE_1, NODE_2], failure_threshold=1)
+    monkeypatch.setattr(ollama_service, "pool", pool)
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        if request.url.host == "ollama-1":
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200, json={"response": "42", "done": True})
+
+    ollama_http(handler)
+
+    pool._sync_scheduler()
+    assert node_scheduler.node_count == 2
+
+    async def scenario():
+        return [
+            await ollama_service.call_ollama("/api/generate", PAYLOAD, use_cache=False, affinity_key="session-1")
+            for _ in range(2)
+        ]
+
+    results = asyncio.run(scenario())
+
+    assert [result["response"] for result in results] == ["42", "42"]
+    assert hosts == ["ollama-1", "ollama-2", "ollama-2"]
+    assert not pool.nodes[0].healthy
+    assert node_scheduler.node_count == 1
+
+
+def test_pinned_node_does_not_fail_over(ollama_http, monkeypatch):
+    pool = OllamaPool([NODE_1, NODE_2])
+    monkeypatch.setattr(ollama_service, "pool", pool)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("connection refused", request=request)
+
+    ollama_http(handler)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(ollama_service.call_ollama("/api/generate", PAYLOAD, use_cache=False, node_url=NODE_1))
+
+    assert error.value.status_code == 502
+    assert NODE_1 in error.value.detail
+    assert pool.nodes[1].requests == 0
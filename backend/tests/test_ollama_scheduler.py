@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src.services.ollama_scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, OllamaScheduler
+
+
+def test_waiters_are_admitted_by_priority_then_arrival():
+    scheduler = OllamaScheduler(slots_per_model=1)
+    admitted = []
+
+    async def request(name: str, priority: int, hold: asyncio.Event):
+        async with scheduler.slot("deepseek-r1", priority):
+            admitted.append(name)
+            await hold.wait()
+
+    async def scenario():
+        hold = asyncio.Event()
+        tasks = [asyncio.ensure_future(request("first", PRIORITY_INTERACTIVE, hold))]
+        await asyncio.sleep(0)
+        for name, priority in (("batch", PRIORITY_BATCH), ("interactive-1", PRIORITY_INTERACTIVE),
+                               ("interactive-2", PRIORITY_INTERACTIVE)):
+            tasks.append(asyncio.ensure_future(request(name, priority, hold)))
+            await asyncio.sleep(0)
+        queued = scheduler.snapshot()["queue_depth"]
+        hold.set()
+        await asyncio.gather(*tasks)
+        return queued
+
+    assert asyncio.run(scenario()) == 3
+    assert admitted == ["first", "interactive-1", "interactive-2", "batch"]
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    scheduler = OllamaScheduler(slots_per_model=1, max_queue=1)
+
+    async def scenario():
+        hold = asyncio.Event()
+
+        async def occupy():
+            async with scheduler.slot("deepseek-r1"):
+                await hold.wait()
+
+        tasks = [asyncio.ensure_future(occupy()), asyncio.ensure_future(occupy())]
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(HTTPException) as excinfo:
+                async with scheduler.slot("deepseek-r1"):
+                    pass
+        finally:
+            hold.set()
+            await asyncio.gather(*tasks)
+        return excinfo.value, scheduler.snapshot()
+
+    error, snapshot = asyncio.run(scenario())
+
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert snapshot["models"]["deepseek-r1"]["rejected"] == 1
+    assert snapshot["models"]["deepseek-r1"]["active"] == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = OllamaScheduler(slots_per_model=1)
+
+    async def scenario():
+        hold = asyncio.Event()
+
+        async def occupy():
+            async with scheduler.slot("deepseek-r1"):
+                await hold.wait()
+
+        holder = asyncio.ensure_future(occupy())
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(occupy())
+        await asyncio.sleep(0)
+        queued = scheduler.queue_depth
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        hold.set()
+        await holder
+        return queued, scheduler.snapshot()
+
+    queued, snapshot = asyncio.run(scenario())
+
+    assert queued == 1
+    assert snapshot["queue_depth"] == 0
+    assert snapshot["models"]["deepseek-r1"]["active"] == 0
+    assert snapshot["models"]["deepseek-r1"]["admitted"] == 1
+
+
+def test_full_queue_of_another_model_does_not_block_a_free_model():
+    scheduler = OllamaScheduler(slots_per_model=1, max_active_models=2, max_queue=1)
+
+    async def scenario():
+        hold = asyncio.Event()
+
+        async def occupy(model):
+            async with scheduler.slot(model):
+                await hold.wait()
+
+        tasks = [asyncio.ensure_future(occupy("deepseek-r1")), asyncio.ensure_future(occupy("deepseek-r1"))]
+        await asyncio.sleep(0)
+        queued = scheduler.queue_depth
+        try:
+            async with scheduler.slot("llava") as wait_seconds:
+                pass
+        finally:
+            hold.set()
+            await asyncio.gather(*tasks)
+        return queued, wait_seconds, scheduler.snapshot()
+
+    queued, wait_seconds, snapshot = asyncio.run(scenario())
+
+    assert queued == 1
+    assert wait_seconds == 0.0
+    assert snapshot["models"]["llava"]["admitted"] == 1
+    assert snapshot["models"]["llava"]["rejected"] == 0
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import math
+
+import pytest
+from conftest import make_upload, oversized_workbook
+from fastapi import HTTPException
+
+from src.services import prompt_budget
+from src.services.console_json_ollama import build_budgeted_payload
+from src.services.context_encoders import build_encoded_context
+from src.services.handler_registry import HANDLER_MAP
+from src.services.prompt_budget import (
+    PROMPT_RESPONSE_RESERVE_TOKENS,
+    PromptBudgeter,
+    choose_num_ctx,
+    estimate_tokens,
+    prompt_budgeter,
+)
+from src.services.retrieval import build_document_index
+
+CONTEXT_LENGTH = 16384
+
+
+def _build_prompt(document: str) -> str:
+    return f"Инструкция.\n\nфайл (smeta.xlsx):\n{document}\n\nВопрос:\nСколько кабеля?"
+
+
+@pytest.fixture
+def budgeter(monkeypatch):
+    budgeter = PromptBudgeter()
+
+    async def context_length(model):
+        return CONTEXT_LENGTH
+
+    monkeypatch.setattr(budgeter, "context_length", context_length)
+    return budgeter
+
+
+def test_one_num_ctx_for_everything_that_fits():
+    assert prompt_budget.OLLAMA_NUM_CTX_BUCKETS == [32768]
+    assert choose_num_ctx(100, 131072) == choose_num_ctx(30000, 131072) == 32768
+    # Длиннее окна — весь контекст модели; короткий контекст модели ограничивает окно
+    assert choose_num_ctx(40000, 131072) == 131072
+    assert choose_num_ctx(100, 8192) == 8192
+
+
+def test_smallest_configured_bucket_is_chosen(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "OLLAMA_NUM_CTX_BUCKETS", [16384, 65536])
+
+    assert choose_num_ctx(1000, 131072) == 16384
+    assert choose_num_ctx(20000, 131072) == 65536
+    assert choose_num_ctx(70000, 131072) == 131072
+
+
+def _per_character_estimate(text: str) -> int:
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return math.ceil(
+        (len(text) - non_ascii) / prompt_budget.PROMPT_ASCII_CHARS_PER_TOKEN
+        + non_ascii / prompt_budget.PROMPT_NON_ASCII_CHARS_PER_TOKEN
+    )
+
+
+def test_estimate_matches_per_character_count():
+    text = "Смета 5: кабель ВВГнг 3x2.5, 40 м, {\"price\": 1250.50}" * 50
+
+    assert estimate_tokens(text) == _per_character_estimate(text)
+    assert estimate_tokens("") == 0
+    # Символы длиннее двух байт UTF-8 завышают оценку, но не занижают её
+    assert estimate_tokens("№ — ✓" * 10) >= _per_character_estimate("№ — ✓" * 10)
+
+
+def test_reject_policy_answers_413(budgeter):
+    document = "строка сметы " * 20000
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(budgeter.fit_document("deepseek-r1", document, _build_prompt, overflow="reject"))
+
+    assert excinfo.value.status_code == 413
+    assert budgeter.rejected == 1
+
+
+def test_trim_policy_fits_the_window(budgeter):
+    document = "строка сметы " * 20000
+
+    prompt, budget = asyncio.run(budgeter.fit_document("deepseek-r1", document, _build_prompt, overflow="trim"))
+
+    assert budget.trimmed_chars > 0
+    assert "[документ обрезан: показано " in prompt
+    assert prompt.endswith("Вопрос:\nСколько кабеля?")
+    assert budget.prompt_tokens + PROMPT_RESPONSE_RESERVE_TOKENS <= CONTEXT_LENGTH == budget.num_ctx
+    assert budgeter.trimmed == 1
+
+
+@pytest.mark.parametrize("policy", ["retrieve", "map_reduce"])
+def test_policies_without_index_trim(budgeter, policy):
+    document = "строка сметы " * 20000
+
+    _, budget = asyncio.run(budgeter.fit_document("deepseek-r1", document, _build_prompt, overflow=policy))
+
+    assert budget.trimmed_chars > 0
+
+
+def test_small_document_is_sent_whole(budgeter):
+    prompt, budget = asyncio.run(budgeter.fit_document("deepseek-r1", "итого 42", _build_prompt, overflow="reject"))
+
+    assert "итого 42" in prompt
+    assert budget.trimmed_chars == 0
+    assert budget.num_ctx == CONTEXT_LENGTH
+
+
+def test_retrieve_policy_sends_matching_chunks(monkeypatch):
+    config = HANDLER_MAP[".xlsx"]
+    payload = asyncio.run(config.handler(make_upload("large.xlsx", oversized_workbook(2000))))
+    encoded = build_encoded_context(payload, config.encoding.encoder, config.encoding)
+    index = build_document_index(payload, config.chunker, encoded.encoder, config.encoding, encoded.tokens)
+
+    async def context_length(model):
+        return CONTEXT_LENGTH
+
+    monkeypatch.setattr(prompt_budgeter, "context_length", context_length)
+
+    request, budget = asyncio.run(build_budgeted_payload(
+        "Кабель силовой",
+        encoded.content,
+        filename="large.xlsx",
+        context_overflow="retrieve",
+        index=index,
+    ))
+
+    assert budget.retrieval["chunks"] < budget.retrieval["total_chunks"]
+    assert budget.retrieval["matched_chunks"] > 0
+    assert "Кабель силовой" in request["prompt"]
+    assert budget.prompt_tokens + PROMPT_RESPONSE_RESERVE_TOKENS <= CONTEXT_LENGTH
+    assert request["options"]["num_ctx"] == budget.num_ctx
+
+
+def test_preload_uses_the_request_window(budgeter):
+    assert asyncio.run(budgeter.preload_options("deepseek-r1")) == {"num_ctx": choose_num_ctx(0, CONTEXT_LENGTH)}
+    # Запросы к llava идут без num_ctx — и прогрев тоже
+    assert asyncio.run(budgeter.preload_options("llava")) == {}
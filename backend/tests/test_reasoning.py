@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from src.services import reasoning
+from src.services.reasoning import (
+    ReasoningBudget,
+    ThinkSplitter,
+    generate_with_budget,
+    split_reasoning,
+    stream_with_budget,
+)
+
+
+def _feed_all(parts):
+    splitter = ThinkSplitter()
+    deltas = [delta for part in parts for delta in splitter.feed(part)] + splitter.flush()
+    joined = {"thinking": "", "answer": ""}
+    for kind, text in deltas:
+        joined[kind] += text
+    return joined, splitter
+
+
+def test_tags_split_between_chunks():
+    joined, splitter = _feed_all(["<th", "ink>Считаю ", "строки</", "thi", "nk>\n\nИтого: 42 <", "b>м</b>"])
+
+    assert joined == {"thinking": "Считаю строки", "answer": "\n\nИтого: 42 <b>м</b>"}
+    assert not splitter.in_think
+
+
+def test_unclosed_think_is_all_reasoning():
+    joined, splitter = _feed_all(["<think>Долго ", "думаю</th"])
+
+    assert joined == {"thinking": "Долго думаю</th", "answer": ""}
+    assert splitter.in_think
+
+
+def test_split_reasoning_reads_thinking_field_and_tags():
+    assert split_reasoning({"thinking": "Поле.", "response": "Ответ"}) == ("Поле.", "Ответ")
+    assert split_reasoning({"response": "<think>Теги.</think>\nОтвет"}) == ("Теги.", "Ответ")
+
+
+class FakeOllama:
+    """Первый запрос рассуждает бесконечно, продолжение с `think: false` отвечает."""
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.closed = []
+
+    async def stream(self, endpoint, request, **kwargs):
+        self.requests.append(request)
+        number = len(self.requests)
+        try:
+            if request.get("think") is False:
+                for token in ("Итого", ": ", "42"):
+                    yield {"response": token}
+                yield {"response": "", "done": True, "done_reason": "stop", "eval_count": 3}
+                return
+            yield {"response": "<think>"}
+            while True:
+                yield {"response": "шаг "}
+        finally:
+            self.closed.append(number)
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    fake = FakeOllama()
+    monkeypatch.setattr(reasoning, "stream_ollama", fake.stream)
+    return fake
+
+
+def _assert_forced_answer(fake, result):
+    first, continuation = fake.requests
+    assert "think" not in first
+    assert continuation["think"] is False
+    assert continuation["prompt"].startswith(first["prompt"])
+    assert "Ход рассуждений (сокращён по бюджету):\nшаг шаг шаг" in continuation["prompt"]
+    # Поток с рассуждениями закрыт до отправки продолжения — Ollama прекращает генерацию
+    assert fake.closed == [1, 2]
+    assert result.reasoning_truncated
+    assert result.reasoning_tokens == 5
+    assert result.answer == "Итого: 42"
+
+
+def test_stream_forces_answer_when_reasoning_budget_runs_out(fake_ollama):
+    budget = ReasoningBudget(max_reasoning_tokens=5)
+
+    async def scenario():
+        return [event async for event in stream_with_budget({"model": "deepseek-r1", "prompt": "Вопрос"}, budget)]
+
+    events = asyncio.run(scenario())
+
+    assert [text for kind, text, _ in events if kind == "answer"] == ["Итого", ": ", "42"]
+    kind, _, result = events[-1]
+    assert kind == "done"
+    _assert_forced_answer(fake_ollama, result)
+
+
+def test_generate_forces_answer_when_reasoning_budget_runs_out(fake_ollama):
+    budget = ReasoningBudget(max_reasoning_tokens=5)
+
+    result = asyncio.run(generate_with_budget({"model": "deepseek-r1", "prompt": "Вопрос"}, budget))
+
+    _assert_forced_answer(fake_ollama, result)
+
+
+def test_generate_without_budget_is_one_request(monkeypatch):
+    requests = []
+
+    async def fake_call_ollama(endpoint, payload, **kwargs):
+        requests.append(payload)
+        return {"response": "<think>Думаю.</think>\n\nОтвет", "done": True, "eval_count": 10}
+
+    monkeypatch.setattr(reasoning, "call_ollama", fake_call_ollama)
+
+    result = asyncio.run(generate_with_budget({"model": "deepseek-r1", "prompt": "Вопрос"}, ReasoningBudget()))
+
+    assert len(requests) == 1 and requests[0]["stream"] is False
+    assert (result.thinking, result.answer) == ("Думаю.", "Ответ")
+    assert result.reasoning_tokens + result.answer_tokens == 10
+    assert not result.reasoning_truncated
+
+
+def test_answer_is_cut_after_max_answer_tokens(monkeypatch):
+    async def fake_stream(endpoint, request, **kwargs):
+        for token in ("один ", "два ", "три ", "четыре"):
+            yield {"response": token}
+
+    monkeypatch.setattr(reasoning, "stream_ollama", fake_stream)
+    budget = ReasoningBudget(think=False, max_answer_tokens=2)
+
+    async def scenario():
+        return [event async for event in stream_with_budget({"model": "deepseek-r1", "prompt": "Вопрос"}, budget)]
+
+    _, _, result = asyncio.run(scenario())[-1]
+
+    assert result.answer == "один два "
+    assert result.answer_truncated
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import json
+import os
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from src.services import ollama_service
+from src.services.ollama_service import call_ollama, stream_ollama
+from src.services.response_cache import ResponseCache, build_cache_key
+
+# `src.services.response_cache` в пакете перекрыт одноимённым экземпляром кэша
+response_cache_module = importlib.import_module("src.services.response_cache")
+
+PAYLOAD = {"model": "deepseek-r1", "prompt": "Итог сметы?", "options": {"num_ctx": 32768}}
+
+
+def test_key_ignores_transport_fields_and_hashes_content():
+    key = build_cache_key("/api/generate", PAYLOAD)
+
+    assert key == build_cache_key("api/generate", {**PAYLOAD, "stream": True, "keep_alive": "30m"})
+    assert key == build_cache_key("/api/generate", dict(reversed(list(PAYLOAD.items()))))
+    assert key != build_cache_key("/api/chat", PAYLOAD)
+    assert key != build_cache_key("/api/generate", {**PAYLOAD, "prompt": "Итог сметы?!"})
+    assert key != build_cache_key("/api/generate", {**PAYLOAD, "options": {"num_ctx": 8192}})
+    assert build_cache_key("/api/generate", {**PAYLOAD, "images": ["aGVsbG8="]}) != build_cache_key(
+        "/api/generate", {**PAYLOAD, "images": ["d29ybGQ="]}
+    )
+
+
+def test_memory_lru_falls_back_to_disk(tmp_path):
+    cache = ResponseCache(tmp_path, memory_items=2)
+
+    async def scenario():
+        for key in ("a1", "b2", "c3"):
+            await cache.put(key, {"response": key, "context": [1, 2, 3]})
+        return [await cache.get(key) for key in ("a1", "c3")]
+
+    first, last = asyncio.run(scenario())
+
+    assert first == {"response": "a1"}
+    assert last == {"response": "c3"}
+    assert cache.stats.disk_hits == 1
+    assert cache.stats.memory_hits == 1
+
+
+def test_expired_entries_are_dropped(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(response_cache_module.time, "time", lambda: now[0])
+    cache = ResponseCache(tmp_path, ttl_seconds=60)
+
+    async def scenario():
+        await cache.put("a1", {"response": "старый"})
+        now[0] += 61
+        return await cache.get("a1")
+
+    assert asyncio.run(scenario()) is None
+    assert cache.stats.expired == 2
+    assert not list(tmp_path.glob("*/*.json.gz"))
+
+
+def test_disk_is_trimmed_to_the_size_limit(tmp_path):
+    cache = ResponseCache(tmp_path, memory_items=0, disk_max_bytes=2000)
+
+    async def scenario():
+        for number in range(20):
+            # Несжимаемое содержимое, чтобы каждая запись занимала на диске около 300 байт
+            await cache.put(f"{number:02d}", {"response": os.urandom(200).hex()})
+
+    asyncio.run(scenario())
+
+    assert cache.stats.evictions > 0
+    assert sum(path.stat().st_size for path in tmp_path.glob("*/*.json.gz")) <= 2000
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path)
+    monkeypatch.setattr(ollama_service, "response_cache", cache)
+    return cache
+
+
+def test_call_ollama_reuses_cached_responses(cache, ollama_http):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"response": "42", "done": True, "context": [1, 2]})
+
+    ollama_http(handler)
+
+    async def scenario():
+        return [await call_ollama("/api/generate", {**PAYLOAD, "stream": False}) for _ in range(2)]
+
+    first, second = asyncio.run(scenario())
+
+    assert len(requests) == 1
+    assert first["response"] == second["response"] == "42"
+    assert "cached" not in first and second["cached"] is True
+    assert "context" not in second
+
+
+def test_no_cache_bypasses_lookup_and_store(cache, ollama_http):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"response": "42", "done": True})
+
+    ollama_http(handler)
+
+    async def scenario():
+        for _ in range(2):
+            await call_ollama("/api/generate", {**PAYLOAD, "stream": False}, use_cache=False)
+
+    asyncio.run(scenario())
+
+    assert len(requests) == 2
+    assert cache.stats.bypassed == 2
+    assert cache.stats.stores == 0
+
+
+def test_errors_are_not_cached(cache, ollama_http):
+    statuses = [500, 200]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        status = statuses.pop(0)
+        if status == 500:
+            return httpx.Response(500, json={"error": "model runner has unexpectedly stopped"})
+        return httpx.Response(200, json={"response": "42", "done": True})
+
+    ollama_http(handler)
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await call_ollama("/api/generate", {**PAYLOAD, "stream": False})
+        return await call_ollama("/api/generate", {**PAYLOAD, "stream": False})
+
+    result = asyncio.run(scenario())
+
+    assert result["response"] == "42" and "cached" not in result
+    assert statuses == []
+
+
+def _ndjson(*chunks: dict) -> bytes:
+    return "".join(json.dumps(chunk, ensure_ascii=False) + "\n" for chunk in chunks).encode("utf-8")
+
+
+def test_unfinished_and_failed_streams_are_not_cached(cache, ollama_http):
+    bodies = [
+        _ndjson({"response": "4"}, {"response": "2"}),
+        _ndjson({"response": "4"}, {"error": "out of memory"}),
+    ]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=bodies.pop(0))
+
+    ollama_http(handler)
+
+    async def scenario():
+        # Клиент закрыл поток после первого токена
+        stream = stream_ollama("/api/generate", PAYLOAD)
+        await stream.__anext__()
+        await stream.aclose()
+        with pytest.raises(HTTPException):
+            async for _ in stream_ollama("/api/generate", PAYLOAD):
+                pass
+
+    asyncio.run(scenario())
+
+    assert cache.stats.stores == 0
+    assert not list(cache.directory.glob("*/*.json.gz"))
+
+
+def test_finished_stream_is_replayed_as_one_chunk(cache, ollama_http):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, content=_ndjson({"response": "4"}, {"response": "2", "done": True}))
+
+    ollama_http(handler)
+
+    async def scenario():
+        streamed = [chunk async for chunk in stream_ollama("/api/generate", PAYLOAD)]
+        replayed = [chunk async for chunk in stream_ollama("/api/generate", PAYLOAD)]
+        return streamed, replayed
+
+    streamed, replayed = asyncio.run(scenario())
+
+    assert len(requests) == 1
+    assert [chunk["response"] for chunk in streamed] == ["4", "2"]
+    assert replayed == [{"response": "42", "done": True, "cached": True}]
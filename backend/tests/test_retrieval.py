@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+from src.services.context_encoders import ENCODER_TSV, build_encoded_context
+from src.services.handler_registry import HANDLER_MAP
+from src.services.retrieval import build_document_index
+
+
+def _convert(suffix: str, upload):
+    config = HANDLER_MAP[suffix]
+    return config, asyncio.run(config.handler(upload))
+
+
+def test_xlsx_chunks_cover_every_row(sample_upload):
+    config, payload = _convert(".xlsx", sample_upload("8.xlsx"))
+    sheet, records = next((name, rows) for name, rows in payload["sheets"].items() if rows)
+
+    common, chunks = config.chunker(payload, 25)
+
+    assert common == {"source_filename": "8.xlsx", "sheet_count": payload["sheet_count"]}
+    assert [len(data["sheets"][sheet]) for _, data in chunks] == [25, 25, len(records) - 50]
+    assert chunks[1][0] == f"Лист {sheet}, строки 26–50"
+    assert [row for _, data in chunks for row in data["sheets"][sheet]] == records
+
+
+def test_xlsx_index_chunks_are_tsv_tables(sample_upload):
+    config, payload = _convert(".xlsx", sample_upload("8.xlsx"))
+    encoded = build_encoded_context(payload, ENCODER_TSV, config.encoding)
+
+    index = build_document_index(payload, config.chunker, encoded.encoder, config.encoding, encoded.tokens)
+
+    assert json.loads(index.header)["source_filename"] == "8.xlsx"
+    assert index.chunks
+    for chunk in index.chunks:
+        assert chunk.text.startswith("# Лист ")
+        assert chunk.tokens > 0
+
+
+def test_arp_chunks_cover_every_position(sample_upload):
+    config, payload = _convert(".arp", sample_upload("4.arp"))
+    _, tables = config.encoding.tables(payload)
+    positions = dict(tables)["Позиции"]
+
+    common, chunks = config.chunker(payload, 4)
+
+    assert common["source_filename"] == "4.arp"
+    assert common["standard"] == payload["data"]["standard"]
+    chunked = [item for _, data in chunks for item in data["data"].get("items", [])]
+    assert [item["code"] for item in chunked] == [position["code"] for position in positions]
+    assert all(len(data["data"].get("items", [])) <= 4 for _, data in chunks)
+
+
+def test_arp_index_finds_position_by_question(sample_upload):
+    config, payload = _convert(".arp", sample_upload("4.arp"))
+    encoded = build_encoded_context(payload, ENCODER_TSV, config.encoding)
+    index = build_document_index(payload, config.chunker, encoded.encoder, config.encoding, encoded.tokens)
+    assert all("# Позиции (строк: " in chunk.text for chunk in index.chunks if "(позиции " in chunk.title)
+
+    position = payload["data"]["sections"][0]["items"][0]
+    text, retrieval = index.select(f"Сколько стоит {position['name']}?", encoded.tokens)
+
+    assert retrieval["matched_chunks"] > 0
+    assert position["code"] in text
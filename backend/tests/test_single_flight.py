@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+
+from conftest import make_upload
+
+from src.services.single_flight import SingleFlight, buffer_upload
+
+
+def test_buffered_upload_survives_closing_the_request_file():
+    async def scenario():
+        upload = make_upload("smeta.arp", b"1#ARPS 1.10#")
+        buffered, digest = await buffer_upload(upload)
+        # Так Starlette поступает с файлами формы, когда клиент отключился
+        await upload.close()
+        return buffered.filename, await buffered.read(), digest
+
+    filename, data, digest = asyncio.run(scenario())
+
+    assert filename == "smeta.arp"
+    assert data == b"1#ARPS 1.10#"
+    assert digest == hashlib.sha256(b"1#ARPS 1.10#").hexdigest()
+
+
+def test_coalesced_work_continues_when_first_caller_leaves():
+    flights = SingleFlight("test")
+
+    async def scenario():
+        started = asyncio.Event()
+        release = asyncio.Event()
+        runs = []
+
+        async def work():
+            runs.append(1)
+            started.set()
+            await release.wait()
+            return "готово"
+
+        first = asyncio.ensure_future(flights.do("key", work))
+        await started.wait()
+        second = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await second, first.cancelled(), len(runs)
+
+    result, first_cancelled, runs = asyncio.run(scenario())
+
+    assert result == "готово"
+    assert first_cancelled
+    assert runs == 1
+    assert flights.stats.coalesced == 1
+    assert flights.stats.abandoned == 0
+
+
+def test_work_is_cancelled_when_nobody_waits():
+    flights = SingleFlight("test")
+
+    async def scenario():
+        cancelled = asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flights.snapshot()
+
+    snapshot = asyncio.run(scenario())
+
+    assert snapshot["abandoned"] == 1
+    assert snapshot["in_flight"] == 0
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+from src.services.ollama_scheduler import OllamaScheduler
+from src.services.streaming import event_stream_response
+
+
+def _upstream(scheduler: OllamaScheduler, log: list, delay: float = 0.0):
+    """Имитация stream_ollama: слот планировщика занят, пока генератор не закрыт."""
+
+    async def events():
+        async with scheduler.slot("deepseek-r1"):
+            try:
+                for index in range(3):
+                    await asyncio.sleep(delay)
+                    yield {"type": "token", "content": str(index)}
+                yield {"type": "done"}
+            finally:
+                log.append(asyncio.current_task())
+
+    return events()
+
+
+def test_deadline_ends_stream_with_error_and_closes_upstream():
+    scheduler = OllamaScheduler(slots_per_model=1)
+    closed_in = []
+
+    async def scenario():
+        response = event_stream_response(_upstream(scheduler, closed_in, delay=1.0), "ndjson", deadline=0.05)
+        lines = [chunk async for chunk in response.body_iterator]
+        return lines, asyncio.current_task(), scheduler.snapshot()
+
+    lines, task, snapshot = asyncio.run(scenario())
+
+    assert [json.loads(line) for line in lines] == [
+        {"type": "error", "status_code": 504, "detail": "Запрос не уложился в 0.05 с и был отменён."}
+    ]
+    assert closed_in == [task]
+    assert snapshot["models"]["deepseek-r1"]["active"] == 0
+
+
+def test_client_disconnect_releases_slot_in_request_task():
+    scheduler = OllamaScheduler(slots_per_model=1)
+    closed_in = []
+
+    async def scenario():
+        body = event_stream_response(_upstream(scheduler, closed_in), "ndjson").body_iterator
+        first = await body.__anext__()
+        # Так Starlette закрывает тело ответа, когда клиент отключился
+        await body.aclose()
+        return first, asyncio.current_task(), scheduler.snapshot()
+
+    first, task, snapshot = asyncio.run(scenario())
+
+    assert json.loads(first) == {"type": "token", "content": "0"}
+    assert closed_in == [task]
+    assert snapshot["models"]["deepseek-r1"]["active"] == 0
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from src import main
+from src.services import tracing
+from src.services.tracing import Tracer, annotate, record_span, span, traced
+
+
+def test_spans_nest_and_record_errors():
+    tracer = Tracer(slow_log="")
+
+    @traced("llm")
+    async def ask():
+        with span("ollama", model="deepseek-r1") as current:
+            annotate(node="http://ollama-1:11434")
+            current.set(cached=False)
+        with pytest.raises(RuntimeError), span("ollama"):
+            raise RuntimeError("узел недоступен")
+
+    async def scenario():
+        trace = tracer.start("POST /json-query")
+        await ask()
+        await tracer.finish(trace, status=200)
+        return trace
+
+    trace = asyncio.run(scenario())
+    llm, first, failed = trace.spans
+
+    assert (llm.parent_id, first.parent_id, failed.parent_id) == (None, llm.span_id, llm.span_id)
+    assert first.attrs == {"model": "deepseek-r1", "node": "http://ollama-1:11434", "cached": False}
+    assert failed.attrs == {"error": "RuntimeError"}
+    assert trace.attrs == {"status": 200}
+    assert tracer.stats.traces == 1
+
+
+def test_outside_a_request_nothing_is_recorded():
+    with span("convert") as current:
+        current.set(rows=10)
+        annotate(rows=10)
+    record_span("queue", 1.0)
+
+    assert tracing.current_trace() is None
+
+
+def test_server_timing_sums_repeated_stages():
+    async def scenario():
+        trace = Tracer(slow_log="").start("POST /json-query")
+        record_span("queue", 0.25)
+        for _ in range(3):
+            record_span("ollama", 0.5)
+        return trace
+
+    header = asyncio.run(scenario()).server_timing()
+    metrics = header.split(", ")
+
+    assert metrics[:2] == ["queue;dur=250.0", 'ollama;desc="3 calls";dur=1500.0']
+    assert metrics[2].startswith("total;dur=")
+
+
+def test_slow_traces_are_logged_and_rotated(tmp_path):
+    log = tmp_path / "slow.jsonl"
+    tracer = Tracer(slow_seconds=0, slow_log=str(log), slow_log_max_bytes=400)
+
+    async def scenario():
+        for number in range(3):
+            trace = tracer.start(f"POST /jobs/{number}")
+            with span("convert", suffix=".xlsx"):
+                pass
+            await tracer.finish(trace, status=200)
+            # Повторное завершение (тело ответа после исключения) не пишет трассу дважды
+            await tracer.finish(trace, status=500)
+
+    asyncio.run(scenario())
+
+    records = [json.loads(line) for path in (log.with_name("slow.jsonl.1"), log) for line in path.read_text().splitlines()]
+    assert [record["name"] for record in records] == ["POST /jobs/1", "POST /jobs/2"]
+    assert records[-1]["attrs"] == {"status": 200}
+    assert records[-1]["stages"]["convert"]["count"] == 1
+    assert tracer.stats.traces == tracer.stats.slow_traces == 3
+
+
+@pytest.fixture
+def finished_traces(tmp_path, monkeypatch):
+    """Трассы, завершённые middleware: все запросы считаются медленными и пишутся в журнал."""
+    log = tmp_path / "slow.jsonl"
+    tracer = Tracer(slow_seconds=0, slow_log=str(log))
+    monkeypatch.setattr(main, "tracer", tracer)
+
+    def read() -> list:
+        return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+
+    return read
+
+
+def _post_json_query(stream: bool) -> httpx.Response:
+    async def scenario():
+        # Без lifespan: пул узлов, прогрев и пул конвертеров в тесте не нужны
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            return await client.post(
+                "/json-query",
+                files={"json_file": ("note.txt", "Итог сметы: 42".encode("utf-8"), "text/plain")},
+                data={"question": "Итог?", "stream": str(stream).lower(), "no_cache": "true"},
+            )
+
+    return asyncio.run(scenario())
+
+
+def _ollama(finished_traces, stream_log: list):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/show":
+            return httpx.Response(404, json={"error": "model not found"})
+        if not json.loads(request.content).get("stream"):
+            return httpx.Response(200, json={"response": "42", "done": True})
+
+        async def chunks():
+            yield b'{"response": "4"}\n'
+            # Заголовки уже отправлены, но трасса ещё не завершена
+            stream_log.append(len(finished_traces()))
+            yield b'{"response": "2", "done": true}\n'
+
+        return httpx.Response(200, content=chunks())
+
+    return handler
+
+
+def test_non_streaming_response_carries_server_timing(finished_traces, ollama_http):
+    ollama_http(_ollama(finished_traces, []))
+
+    response = _post_json_query(stream=False)
+
+    assert response.status_code == 200
+    timing = response.headers["Server-Timing"]
+    assert {"load", "llm", "ollama", "queue", "total"} <= {item.split(";")[0] for item in timing.split(", ")}
+    (trace,) = finished_traces()
+    assert trace["name"] == "POST /json-query"
+    assert trace["attrs"] == {"method": "POST", "path": "/json-query", "route": "/json-query", "status": 200}
+    assert trace["stages"]["ollama"]["count"] == 1
+
+
+def test_streaming_trace_is_finished_after_the_body(finished_traces, ollama_http):
+    stream_log = []
+    ollama_http(_ollama(finished_traces, stream_log))
+
+    response = _post_json_query(stream=True)
+
+    assert response.status_code == 200
+    assert [json.loads(line)["type"] for line in response.text.splitlines()] == ["token", "token", "done"]
+    # Заголовок отправлен до генерации: в нём только этапы до первого чанка
+    stages = {item.split(";")[0] for item in response.headers["Server-Timing"].split(", ")}
+    assert "total" in stages and "ollama" not in stages
+    assert stream_log == [0]
+    (trace,) = finished_traces()
+    # Генерация целиком попала в трассу: её этап записан при финальном чанке
+    ollama = next(item for item in trace["spans"] if item["name"] == "ollama")
+    assert ollama["attrs"]["stream"] is True
+    assert trace["total_ms"] >= ollama["start_ms"] + ollama["duration_ms"]
+    assert trace["attrs"]["status"] == 200
@@ -30,6 +30,14 @@ else
     echo "  ⚠ Warning: llava model installation failed"
 fi
 
+EMBEDDING_MODEL=${EMBEDDING_MODEL:-"bge-m3"}
+echo "Pull embedding model: ${EMBEDDING_MODEL} (for document retrieval)"
+if ollama pull "${EMBEDDING_MODEL}" 2>/dev/null; then
+    echo "  ✓ ${EMBEDDING_MODEL} installed"
+else
+    echo "  ⚠ Warning: ${EMBEDDING_MODEL} installation failed, retrieval will use BM25 only"
+fi
+
 ROOT_DIR=$(cd "$(dirname "$0")/.." && pwd)
 
 gen_and_create() {
@@ -55,6 +63,7 @@ echo "Done. Models installed:"
 echo "  - Base: ${BASE_MODEL}"
 echo "  - deepseek-r1 (for JSON queries)"
 echo "  - llava (for vision queries)"
+echo "  - ${EMBEDDING_MODEL} (embeddings for document retrieval)"
 echo "  - agent-classify"
 echo "  - agent-doc-extract"
 echo "  - agent-qa"